@@ -1,145 +1,45 @@
 # -*- coding: utf-8 -*-
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 from datetime import datetime, timedelta
 from pathlib import Path
-from difflib import SequenceMatcher
 import os
 import json
+import queue
+import threading
+import functools
+import heapq
+
+import production_engine as engine
+import vitaka_watch
+from production_engine import (
+    initialize_database, get_laser_cache_path, get_bending_cache_path,
+    load_data, _safe_str,
+)
 
-DATABASE_FILE = "production_database.xlsx"
-LASER_CACHE_FILE = "laser_import_cache.xlsx"
-BENDING_CACHE_FILE = "bending_import_cache.xlsx"
 DATA_PATH = Path(__file__).parent  # Папка где лежит скрипт
 
-# Веса для расчёта схожести при поиске деталей гибщиков
-BENDING_CUSTOMER_SIM_WEIGHT = 0.3
-BENDING_PART_SIM_WEIGHT = 0.7
-
-
-def initialize_database():
-    if not os.path.exists(DATABASE_FILE):
-        wb = Workbook()
-        materials_sheet = wb.active
-        materials_sheet.title = "Materials"
-        materials_sheet.append([
-            "ID", "Марка", "Толщина", "Длина", "Ширина",
-            "Количество штук", "Общая площадь", "Зарезервировано", "Доступно", "Дата добавления"
-        ])
-        orders_sheet = wb.create_sheet("Orders")
-        orders_sheet.append(["ID заказа", "Название заказа", "Заказчик", "Дата создания", "Статус", "Примечания"])
-        order_details_sheet = wb.create_sheet("OrderDetails")
-        order_details_sheet.append(["ID", "ID заказа", "Название детали", "Количество", "Порезано", "Погнуто"])
-        reservations_sheet = wb.create_sheet("Reservations")
-        reservations_sheet.append(
-            ["ID резерва", "ID заказа", "ID детали", "Название детали", "ID материала", "Марка", "Толщина", "Длина",
-             "Ширина", "Зарезервировано штук", "Списано", "Остаток к списанию", "Дата резерва"])
-        writeoffs_sheet = wb.create_sheet("WriteOffs")
-        writeoffs_sheet.append([
-            "ID списания", "ID резерва", "ID заказа", "ID материала", "Марка", "Толщина", "Длина", "Ширина",
-            "Количество", "Дата списания", "Комментарий"
-        ])
-
-        # 🆕 ЛИСТ ДЛЯ ЛОГИРОВАНИЯ ИЗМЕНЕНИЙ КОЛИЧЕСТВА МАТЕРИАЛА
-        changelogs_sheet = wb.create_sheet("MaterialChangeLogs")
-        changelogs_sheet.append([
-            "ID лога", "Дата и время", "ID материала", "Марка", "Толщина",
-            "Длина", "Ширина", "Старое кол-во", "Новое кол-во", "Изменение", "Комментарий"
-        ])
-
-        # 🆕 ЛИСТ ДЛЯ ЖУРНАЛА СПИСАНИЙ ГИБКИ
-        bending_writeoffs_sheet = wb.create_sheet("BendingWriteOffs")
-        bending_writeoffs_sheet.append([
-            "ID списания", "ID импорта гибки", "ID заказа", "ID детали",
-            "Название детали", "Количество", "Дата списания", "Оператор", "Комментарий", "Тип"
-        ])
-
-        wb.save(DATABASE_FILE)
-        print(f"База данных '{DATABASE_FILE}' создана!")
-
-
-def get_database_path():
-    """Получить путь к папке с базой данных из настроек"""
-    settings_file = "app_settings.json"
-    try:
-        if os.path.exists(settings_file):
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                return settings.get("database_path", os.path.dirname(os.path.abspath(__file__)))
-    except:
-        pass
-    # По умолчанию - текущая папка
-    return os.path.dirname(os.path.abspath(__file__))
-
-def get_laser_cache_path():
-    """Получить путь к файлу кэша лазерщиков из настроек"""
-    db_path = get_database_path()
-    return os.path.join(db_path, LASER_CACHE_FILE)
-
-
-def get_bending_cache_path():
-    """Получить путь к файлу кэша гибщиков из настроек"""
-    db_path = get_database_path()
-    return os.path.join(db_path, BENDING_CACHE_FILE)
-
-def load_data(sheet_name):
-    """Загрузка данных из Excel с учётом пути из настроек"""
-    db_path = get_database_path()
-    file_path = os.path.join(db_path, "production_database.xlsx")
-
-    try:
-        if os.path.exists(file_path):
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-
-            # 🆕 КОНВЕРТИРУЕМ ТЕКСТОВЫЕ КОЛОНКИ (NaN → пустая строка)
-            text_columns = ["Примечания", "Комментарий", "Описание", "Заметки"]
-            for col in text_columns:
-                if col in df.columns:
-                    df[col] = df[col].fillna('').astype(str)
-
-            return df
-        else:
-            print(f"⚠️ Файл базы данных не найден: {file_path}")
-            return pd.DataFrame()
-    except Exception as e:
-        print(f"❌ Ошибка загрузки данных из {sheet_name}: {e}")
-        return pd.DataFrame()
+# Как часто проверять, не перезаписал ли кэши импорта другой процесс (vitaka_api, vitaka_watch), мс
+IMPORT_CACHE_POLL_MS = 2000
 
 
 def save_data(sheet_name, df):
-    """Сохранение данных в Excel с учётом пути из настроек"""
-    db_path = get_database_path()
-    file_path = os.path.join(db_path, "production_database.xlsx")
-
+    """Сохранение данных в Excel с учётом пути из настроек (ошибка показывается пользователю)"""
     try:
-        if os.path.exists(file_path):
-            with pd.ExcelFile(file_path, engine='openpyxl') as xls:
-                sheets = {s: pd.read_excel(xls, s) for s in xls.sheet_names}
-        else:
-            sheets = {}
-
-        sheets[sheet_name] = df
-
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-            for s, data in sheets.items():
-                data.to_excel(writer, sheet_name=s, index=False)
-
-        print(f"✅ Данные сохранены в {sheet_name}")
+        engine.save_data(sheet_name, df)
     except Exception as e:
-        print(f"❌ Ошибка сохранения данных в {sheet_name}: {e}")
         messagebox.showerror("Ошибка сохранения", f"Не удалось сохранить данные: {e}")
 
 
-def _safe_str(value):
-    """Преобразует значение в строку, заменяя пустые/null значения на пустую строку"""
-    if value is None:
-        return ""
-    if isinstance(value, float) and pd.isna(value):
-        return ""
-    s = str(value).strip()
-    return "" if s in ('nan', 'None', 'NaN') else s
+def _tree_value(value):
+    """Значение ячейки так, как его возвращает Treeview.item(): целое, если строка похожа на целое, иначе строка"""
+    value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        return value
 
 
 class ExcelStyleFilter:
@@ -202,7 +102,7 @@ class ExcelStyleFilter:
             all_unique_values = set()
             visible_unique_values = set()
 
-            visible_items = list(self.tree.get_children(''))
+            visible_items = set(self.tree.get_children(''))
 
             if not hasattr(self, '_all_item_cache'):
                 self._all_item_cache = set()
@@ -492,8 +392,8 @@ class ExcelStyleFilter:
             items.sort(key=lambda x: str(x[0][column_index]).lower(),
                        reverse=(direction == 'desc'))
 
-        for index, (values, item_id) in enumerate(items):
-            self.tree.move(item_id, '', index)
+        # Один set_children вместо move по каждой строке
+        self.tree.set_children('', *[item_id for values, item_id in items])
 
         window.destroy()
         self._filter_window_open = False
@@ -502,43 +402,34 @@ class ExcelStyleFilter:
         """Применить фильтр"""
         self.active_filters[column_id] = selected_values
 
-        column_index = list(self.tree["columns"]).index(column_id)
-
-        # Показываем все из кэша
-        for item_id in self._all_item_cache:
-            try:
-                self.tree.reattach(item_id, '', 'end')
-            except:
-                pass
-
-        # Применяем ВСЕ активные фильтры
-        visible_items = set(self.tree.get_children(''))
-
-        for col_id, values in self.active_filters.items():
-            col_index = list(self.tree["columns"]).index(col_id)
-
-            items_to_hide = set()
-
-            for item_id in visible_items:
-                try:
-                    item_values = self.tree.item(item_id)["values"]
-                    value = str(item_values[col_index])
-
-                    if value not in values:
-                        items_to_hide.add(item_id)
-                except:
-                    pass
-
-            for item_id in items_to_hide:
-                self.tree.detach(item_id)
-
-            visible_items -= items_to_hide
+        # Применяем ВСЕ активные фильтры к видимым и скрытым строкам одним set_children
+        self.tree.set_children('', *self._filter_items(self._ordered_items()))
 
         self.update_column_headers()
 
         if self.refresh_callback:
             self.refresh_callback()
 
+    def _ordered_items(self):
+        """Видимые строки по порядку, затем скрытые фильтром (из кэша)"""
+        items = list(self.tree.get_children(''))
+        attached = set(items)
+        items += [item_id for item_id in getattr(self, '_all_item_cache', ())
+                  if item_id not in attached and self.tree.exists(item_id)]
+        return items
+
+    def _filter_items(self, items):
+        """Строки items (в том же порядке), проходящие все активные фильтры"""
+        columns = list(self.tree["columns"])
+        filters = [(columns.index(col_id), values) for col_id, values in self.active_filters.items()]
+
+        visible = []
+        for item_id in items:
+            item_values = self.tree.item(item_id)["values"]
+            if all(index >= len(item_values) or str(item_values[index]) in values for index, values in filters):
+                visible.append(item_id)
+        return visible
+
     def update_column_headers(self):
         """Обновить заголовки колонок (добавить/убрать индикатор фильтра)"""
         for col in self.tree["columns"]:
@@ -556,53 +447,16 @@ class ExcelStyleFilter:
         if not self.active_filters:
             return
 
-        # 🆕 СОХРАНЯЕМ ИСХОДНЫЙ ПОРЯДОК ЭЛЕМЕНТОВ
-        all_items_ordered = []
-        for item_id in self.tree.get_children(''):
-            all_items_ordered.append(item_id)
-
-        # Добавляем скрытые элементы из кеша
-        for item_id in self._all_item_cache:
-            if item_id not in all_items_ordered:
-                all_items_ordered.append(item_id)
-
-        # Определяем какие элементы должны быть видимы
-        visible_items = set(all_items_ordered)
-
-        for column_id, selected_values in self.active_filters.items():
-            column_index = list(self.tree["columns"]).index(column_id)
-
-            items_to_hide = set()
-
-            for item_id in visible_items:
-                try:
-                    values = self.tree.item(item_id)["values"]
-                    value = str(values[column_index])
-
-                    if value not in selected_values:
-                        items_to_hide.add(item_id)
-                except:
-                    pass
-
-            visible_items -= items_to_hide
-
-        # 🆕 ПРЯЧЕМ/ПОКАЗЫВАЕМ С СОХРАНЕНИЕМ ИСХОДНОГО ПОРЯДКА
-        for idx, item_id in enumerate(all_items_ordered):
-            try:
-                if item_id in visible_items:
-                    # Показываем элемент на его исходной позиции
-                    self.tree.reattach(item_id, '', idx)
-                else:
-                    # Прячем элемент
-                    self.tree.detach(item_id)
-            except:
-                pass
+        # 🆕 ПРЯЧЕМ/ПОКАЗЫВАЕМ С СОХРАНЕНИЕМ ИСХОДНОГО ПОРЯДКА (видимые, затем скрытые из кеша)
+        self.tree.set_children('', *self._filter_items(self._ordered_items()))
 
         self.update_column_headers()
 
         # 🆕 ВЫЗЫВАЕМ СПЕЦИАЛЬНУЮ СОРТИРОВКУ ДЛЯ ИМПОРТА ОТ ЛАЗЕРЩИКОВ
-        if self.refresh_callback and hasattr(self.refresh_callback, '__self__'):
-            app_instance = self.refresh_callback.__self__
+        # (обновление вкладки может быть обёрнуто register_data_view — метод окна в __wrapped__)
+        refresh_method = getattr(self.refresh_callback, '__wrapped__', self.refresh_callback)
+        if refresh_method and hasattr(refresh_method, '__self__'):
+            app_instance = refresh_method.__self__
             if hasattr(app_instance, 'sort_laser_import_by_original_order'):
                 # Проверяем что это именно таблица импорта
                 if hasattr(app_instance, 'laser_import_tree') and self.tree == app_instance.laser_import_tree:
@@ -615,11 +469,7 @@ class ExcelStyleFilter:
         """очистить все фильтры"""
         self.active_filters = {}
 
-        for item_id in self._all_item_cache:
-            try:
-                self.tree.reattach(item_id, '', 'end')
-            except:
-                pass
+        self.tree.set_children('', *self._ordered_items())
 
         self.update_column_headers()
 
@@ -627,6 +477,447 @@ class ExcelStyleFilter:
             self.refresh_callback()
 
 
+class VirtualTreeview(ttk.Treeview):
+    """
+    Treeview для больших таблиц: строки хранятся в памяти, а в самом виджете есть только
+    столько элементов, сколько помещается на экране. При прокрутке эти элементы получают
+    значения и теги нужных строк, поэтому вставка и прокрутка десятков тысяч строк не тормозят.
+
+    Снаружи таблица ведёт себя как обычный ttk.Treeview (insert/delete/item/selection/
+    move/detach/reattach/set_children/index/identify_row/yview), поэтому теги и цвета,
+    выделение, контекстные меню и ExcelStyleFilter работают без изменений.
+    Поддерживаются только строки верхнего уровня (show="headings").
+    """
+
+    _instances = 0
+
+    def __init__(self, master=None, **kw):
+        self._yscrollcommand = kw.pop("yscrollcommand", None)
+        super().__init__(master, **kw)
+
+        self._rows = {}             # iid → [значения, теги, значения в виде item()["values"]]
+        self._order = []            # строки верхнего уровня по порядку
+        self._order_dirty = False   # в _order остались удалённые/откреплённые строки
+        self._attached = set()
+        self._positions = None      # iid → позиция в _order (строится по запросу)
+        self._selected = {}        # выделенные строки (dict как упорядоченное множество)
+        self._focus = ""
+        self._anchor = ""
+        self._next_iid = 0
+
+        self._first = 0             # позиция первой показанной строки
+        self._slots = []            # настоящие элементы виджета
+        self._slot_rows = {}        # элемент виджета → iid строки
+        self._row_slots = {}        # iid строки → элемент виджета
+        self._render_pending = False
+        self._click = None          # "plain"/"control" — клик мышью, выделение которого ещё не перенесено
+
+        # Свой bindtag перед классом Treeview: прокрутка и Shift-клик обрабатываются здесь
+        VirtualTreeview._instances += 1
+        tag = f"VirtualTreeview{VirtualTreeview._instances}"
+        self.bindtags((tag,) + self.bindtags())
+        self.bind_class(tag, "<Configure>", lambda e: self._schedule_render())
+        self.bind_class(tag, "<MouseWheel>", self._on_mousewheel)
+        self.bind_class(tag, "<Button-4>", lambda e: self._scroll_by(-3))
+        self.bind_class(tag, "<Button-5>", lambda e: self._scroll_by(3))
+        self.bind_class(tag, "<ButtonPress-1>", self._on_press)
+        self.bind_class(tag, "<Control-ButtonPress-1>", self._on_control_press)
+        self.bind_class(tag, "<Shift-ButtonPress-1>", self._on_shift_press)
+        self.bind_class(tag, "<ButtonRelease-1>", self._on_release)
+        self.bind_class(tag, "<<TreeviewSelect>>", self._on_select)
+        self.bind_class(tag, "<Key-Up>", lambda e: self._move_focus(-1))
+        self.bind_class(tag, "<Key-Down>", lambda e: self._move_focus(1))
+        self.bind_class(tag, "<Key-Prior>", lambda e: self._scroll_by(-self._visible_count()))
+        self.bind_class(tag, "<Key-Next>", lambda e: self._scroll_by(self._visible_count()))
+        self.bind_class(tag, "<Key-Home>", lambda e: self._scroll_to(0))
+        self.bind_class(tag, "<Key-End>", lambda e: self._scroll_to(len(self._ordered())))
+
+    # ---------- модель строк ----------
+
+    @staticmethod
+    def _key(item):
+        """iid строки (Treeview принимает и кортеж из одного элемента, как от selection())"""
+        if isinstance(item, (tuple, list)) and len(item) == 1:
+            item = item[0]
+        return str(item)
+
+    @staticmethod
+    def _items(items):
+        if len(items) == 1 and isinstance(items[0], (tuple, list)):
+            items = items[0]
+        return [str(item) for item in items]
+
+    def _row(self, item):
+        try:
+            return self._rows[self._key(item)]
+        except KeyError:
+            raise tk.TclError(f'Item {self._key(item)} not found')
+
+    def _ordered(self):
+        """Строки верхнего уровня по порядку (без удалённых и откреплённых)"""
+        if self._order_dirty:
+            self._order = [iid for iid in self._order if iid in self._attached]
+            self._order_dirty = False
+            self._positions = None
+        return self._order
+
+    def _position(self, iid):
+        if self._positions is None:
+            self._positions = {row_iid: index for index, row_iid in enumerate(self._ordered())}
+        return self._positions.get(iid)
+
+    def _attach(self, iid, index):
+        order = self._ordered()
+        if iid in self._attached:
+            order.remove(iid)
+        if index == "end" or int(index) >= len(order):
+            order.append(iid)
+            if self._positions is not None and len(self._positions) == len(order) - 1:
+                self._positions[iid] = len(order) - 1
+            else:
+                self._positions = None
+        else:
+            order.insert(max(0, int(index)), iid)
+            self._positions = None
+        self._attached.add(iid)
+        self._schedule_render()
+
+    def _unlink(self, iid):
+        """Убрать строку из порядка и выделения (сама строка остаётся в _rows)"""
+        if iid in self._attached:
+            self._attached.discard(iid)
+            self._order_dirty = True
+            self._positions = None
+        self._selected.pop(iid, None)
+        if self._focus == iid:
+            self._focus = ""
+        if self._anchor == iid:
+            self._anchor = ""
+
+    # ---------- методы ttk.Treeview ----------
+
+    def insert(self, parent, index, iid=None, **kw):
+        if iid is None:
+            self._next_iid += 1
+            iid = f"V{self._next_iid:06d}"
+        iid = str(iid)
+        if iid in self._rows:
+            raise tk.TclError(f'Item {iid} already exists')
+        self._rows[iid] = [(), (), None]
+        self._set_row(self._rows[iid], kw)
+        self._attach(iid, index)
+        return iid
+
+    def _set_row(self, row, kw):
+        if "values" in kw:
+            values = kw["values"]
+            row[0] = tuple(values) if isinstance(values, (tuple, list)) else (values,) if values != "" else ()
+            row[2] = None
+        if "tags" in kw:
+            tags = kw["tags"]
+            if isinstance(tags, (tuple, list)):
+                row[1] = tuple(str(tag) for tag in tags if tag is not None)
+            else:
+                row[1] = (str(tags),) if tags else ()
+
+    def item(self, item, option=None, **kw):
+        row = self._row(item)
+        if kw:
+            self._set_row(row, kw)
+            slot = self._row_slots.get(self._key(item))
+            if slot is not None:
+                super().item(slot, values=row[0], tags=row[1])
+            return None
+        if row[2] is None:
+            row[2] = [_tree_value(value) for value in row[0]]
+        if option is None:
+            return {"text": "", "image": "", "values": list(row[2]) or "", "open": 0, "tags": list(row[1]) or ""}
+        option = option.lstrip("-")
+        if option == "values":
+            return tuple(row[2]) or ""
+        if option == "tags":
+            return row[1] or ""
+        return {"text": "", "image": "", "open": 0}.get(option, "")
+
+    def set(self, item, column=None, value=None):
+        row = self._row(item)
+        columns = list(self["columns"])
+        values = list(row[0]) + [""] * (len(columns) - len(row[0]))
+        if column is None:
+            return {col: _tree_value(val) for col, val in zip(columns, values)}
+        index = columns.index(column) if column in columns else int(str(column).lstrip("#")) - 1
+        if value is None:
+            return _tree_value(values[index])
+        values[index] = value
+        self.item(item, values=values)
+
+    def delete(self, *items):
+        for iid in self._items(items):
+            self._row(iid)
+            self._unlink(iid)
+            del self._rows[iid]
+        self._schedule_render()
+
+    def detach(self, *items):
+        for iid in self._items(items):
+            self._row(iid)
+            self._unlink(iid)
+        self._schedule_render()
+
+    def move(self, item, parent, index):
+        self._row(item)
+        self._attach(self._key(item), index)
+
+    reattach = move
+
+    def set_children(self, item, *newchildren):
+        newchildren = self._items(newchildren)
+        for iid in newchildren:
+            self._row(iid)
+        for iid in self._attached.difference(newchildren):
+            self._selected.pop(iid, None)
+        self._order = newchildren
+        self._attached = set(newchildren)
+        self._order_dirty = False
+        self._positions = None
+        self._schedule_render()
+
+    def get_children(self, item=None):
+        if item not in (None, ""):
+            return ()
+        return tuple(self._ordered())
+
+    def exists(self, item):
+        return self._key(item) in self._rows
+
+    def row_values(self):
+        """Значения строк верхнего уровня по порядку — прямо из памяти, без обращения к виджету"""
+        rows = self._rows
+        return [rows[iid][0] for iid in self._ordered()]
+
+    def index(self, item):
+        self._row(item)
+        position = self._position(self._key(item))
+        return 0 if position is None else position
+
+    def parent(self, item):
+        return ""
+
+    def selection(self):
+        selected = list(self._selected)
+        selected.sort(key=lambda iid: self._position(iid) or 0)
+        return tuple(selected)
+
+    def _selection_op(self, selop, items):
+        items = [iid for iid in self._items(items) if iid in self._attached]
+        if selop == "set":
+            self._selected = dict.fromkeys(items)
+        elif selop == "add":
+            self._selected.update(dict.fromkeys(items))
+        elif selop == "remove":
+            for iid in items:
+                self._selected.pop(iid, None)
+        else:
+            for iid in items:
+                if self._selected.pop(iid, 0) == 0:
+                    self._selected[iid] = None
+        self._schedule_render()
+
+    def selection_set(self, *items):
+        self._selection_op("set", items)
+
+    def selection_add(self, *items):
+        self._selection_op("add", items)
+
+    def selection_remove(self, *items):
+        self._selection_op("remove", items)
+
+    def selection_toggle(self, *items):
+        self._selection_op("toggle", items)
+
+    def focus(self, item=None):
+        if item is None:
+            return self._focus
+        self._focus = self._key(item)
+        self._schedule_render()
+
+    def see(self, item):
+        position = self._position(self._key(item))
+        if position is None:
+            return
+        visible = self._visible_count()
+        if position < self._first:
+            self._scroll_to(position)
+        elif position >= self._first + visible:
+            self._scroll_to(position - visible + 1)
+
+    def identify_row(self, y):
+        return self._slot_rows.get(super().identify_row(y), "")
+
+    def bbox(self, item, column=None):
+        slot = self._row_slots.get(self._key(item))
+        return super().bbox(slot, column) if slot is not None else ""
+
+    def yview(self, *args):
+        total = len(self._ordered())
+        visible = self._visible_count()
+        if not args:
+            if not total:
+                return 0.0, 1.0
+            return self._first / total, min(1.0, (self._first + visible) / total)
+        if args[0] == "moveto":
+            self._scroll_to(int(float(args[1]) * total))
+        elif args[0] == "scroll":
+            step = visible if str(args[2]).startswith("page") else 1
+            self._scroll_by(int(args[1]) * step)
+
+    def yview_moveto(self, fraction):
+        self.yview("moveto", fraction)
+
+    def yview_scroll(self, number, what):
+        self.yview("scroll", number, what)
+
+    def configure(self, cnf=None, **kw):
+        if cnf:
+            kw = {**cnf, **kw}
+        if "yscrollcommand" in kw:
+            self._yscrollcommand = kw.pop("yscrollcommand")
+            self._schedule_render()
+            if not kw:
+                return None
+        return super().configure(**kw)
+
+    config = configure
+
+    # ---------- отрисовка видимого окна ----------
+
+    def _row_height(self):
+        """Высота строки и заголовка в пикселях (по первому элементу виджета или по стилю)"""
+        if self._slots and self._slot_rows:
+            box = super().bbox(self._slots[0])
+            if box:
+                return box[3], box[1]
+        height = ttk.Style(self).lookup(self.cget("style") or "Treeview", "rowheight")
+        try:
+            height = int(height)
+        except (TypeError, ValueError):
+            height = 20
+        return height, height
+
+    def _visible_count(self):
+        """Сколько строк целиком помещается в окне"""
+        widget_height = self.winfo_height()
+        if widget_height <= 1:
+            return max(1, int(self.cget("height") or 10))
+        row_height, header_height = self._row_height()
+        return max(1, (widget_height - header_height) // max(1, row_height))
+
+    def _schedule_render(self):
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._render)
+
+    def _render(self):
+        """Заполнить элементы виджета строками видимого окна"""
+        self._render_pending = False
+        if not self.winfo_exists():
+            return
+        order = self._ordered()
+        visible = self._visible_count()
+        self._first = max(0, min(self._first, len(order) - visible))
+        rows = order[self._first:self._first + visible + 1]
+
+        while len(self._slots) < len(rows):
+            self._slots.append(super().insert("", "end"))
+        slots = self._slots[:len(rows)]
+        self._slot_rows = dict(zip(slots, rows))
+        self._row_slots = dict(zip(rows, slots))
+        for slot, iid in self._slot_rows.items():
+            values, tags, _ = self._rows[iid]
+            super().item(slot, values=values, tags=tags)
+        super().set_children("", *slots)
+
+        super().selection_set([self._row_slots[iid] for iid in rows if iid in self._selected])
+        if self._focus in self._row_slots:
+            super().focus(self._row_slots[self._focus])
+        super().yview_moveto(0)
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        if not self._yscrollcommand:
+            return
+        first, last = self.yview()
+        if callable(self._yscrollcommand):
+            self._yscrollcommand(first, last)
+        else:
+            self.tk.call(*self.tk.splitlist(self._yscrollcommand), first, last)
+
+    def _scroll_to(self, first):
+        self._first = max(0, first)
+        self._render()
+        return "break"
+
+    def _scroll_by(self, rows):
+        return self._scroll_to(self._first + rows)
+
+    # ---------- мышь и клавиатура ----------
+
+    def _on_mousewheel(self, event):
+        if event.delta:
+            return self._scroll_by(-3 if event.delta > 0 else 3)
+        return "break"
+
+    def _on_press(self, event):
+        self._click = "plain" if self.identify_region(event.x, event.y) in ("cell", "tree") else None
+
+    def _on_control_press(self, event):
+        self._click = "control" if self.identify_region(event.x, event.y) in ("cell", "tree") else None
+
+    def _on_shift_press(self, event):
+        """Shift-клик выделяет диапазон по всей таблице, а не только по видимому окну"""
+        iid = self.identify_row(event.y)
+        if not iid or self._anchor not in self._attached:
+            return self._on_press(event)
+        start, end = sorted((self._position(self._anchor), self._position(iid)))
+        self._selected = dict.fromkeys(self._ordered()[start:end + 1])
+        self._focus = iid
+        self.focus_set()
+        self._render()
+        self.event_generate("<<TreeviewSelect>>")
+        return "break"
+
+    def _on_select(self, event):
+        # Выделение, выставленное самой отрисовкой, уже совпадает с моделью
+        if self._click:
+            self._sync_click()
+
+    def _on_release(self, event):
+        if self._click:
+            self._sync_click()
+
+    def _sync_click(self):
+        """Перенести выделение, сделанное кликом в видимом окне, в модель строк"""
+        keep_outside = self._click == "control"
+        self._click = None
+        real = [self._slot_rows[slot] for slot in super().selection() if slot in self._slot_rows]
+        outside = [iid for iid in self._selected if iid not in self._row_slots] if keep_outside else []
+        self._selected = dict.fromkeys(outside + real)
+        self._focus = self._slot_rows.get(super().focus(), self._focus)
+        self._anchor = self._focus
+
+    def _move_focus(self, step):
+        order = self._ordered()
+        if not order:
+            return "break"
+        position = self._position(self._focus)
+        position = 0 if position is None else max(0, min(len(order) - 1, position + step))
+        self._focus = self._anchor = order[position]
+        self._selected = {self._focus: None}
+        self.see(self._focus)
+        self._render()
+        self.event_generate("<<TreeviewSelect>>")
+        return "break"
+
 
 class ProductionApp:
     def __init__(self, root):
@@ -681,9 +972,32 @@ class ProductionApp:
         # 🆕 Инициализация данных для импорта от гибщиков
         self.bending_table_data = []
 
+        # 🆕 Планировщик обновления вкладок (request_refresh): запросы до простоя цикла Tk объединяются
+        self.data_views = {}
+        self.dirty_views = set()
+        self.pending_views = set()
+        self._views_flush_scheduled = False
+        self._views_flushing = False
+        self.refresh_stats = {"requested": 0, "coalesced": 0, "run": 0, "deferred": 0}
+
+        # Автоподбор ширины колонок: шрифт → (Font, {текст: ширина}), таблица → последняя выборка
+        self._text_widths = {}
+        self._column_width_samples = {}
+
+        # Строки, выведенные sync_tree_rows: таблица → {item_id: (значения, теги) строками}
+        self._rendered_rows = {}
+
+        # Отметки версий кэш-файлов импорта на момент последнего чтения/записи окном
+        self.import_cache_stamps = {}
+        # Отметка файла базы, до которой вкладки уже показывают данные (записи других процессов — после неё)
+        _, self.database_stamp = engine.database_changed_since(None)
+
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
+        # Подписка вкладок до их создания: первичная загрузка скрытых вкладок откладывается до их открытия
+        self.setup_data_views()
+
         self.materials_frame = tk.Frame(self.notebook, bg='white')
         self.notebook.add(self.materials_frame, text='Материалы на складе')
         self.setup_materials_tab()
@@ -719,8 +1033,6 @@ class ProductionApp:
         # self.notebook.add(self.balance_frame, text='Баланс материалов')
         # self.setup_balance_tab()
 
-        self.load_toggle_settings()
-
         # Загрузка настроек и обработчик закрытия
         self.load_toggle_settings()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -729,8 +1041,260 @@ class ProductionApp:
         self.notebook.add(self.material_logs_frame, text="📊 История материалов")
         self.setup_material_logs_tab()
 
+        # Загружаем только вкладку, открытую при старте
+        self._on_tab_changed()
+        self.start_watch_service()
+        self.root.after(IMPORT_CACHE_POLL_MS, self._poll_import_caches)
+
         self.fix_russian_keyboard_shortcuts()
 
+    # ==================== ОБНОВЛЕНИЕ ВКЛАДОК ПО ИЗМЕНЕНИЯМ ДАННЫХ ====================
+
+    def setup_data_views(self):
+        """
+        Подписка вкладок на листы базы.
+        После сохранения обновляются только вкладки, чьи листы изменились;
+        скрытая вкладка помечается устаревшей и обновляется при её открытии.
+        Вызывается до создания вкладок, поэтому и первичная загрузка скрытых вкладок
+        (и таблиц импорта из кэша) выполняется только при их первом открытии.
+        """
+        self.register_data_view("refresh_materials", "materials_frame", ["Materials"])
+        self.register_data_view("refresh_orders", "orders_frame", ["Orders"])
+        self.register_data_view("refresh_order_details", "orders_frame", ["OrderDetails"])
+        self.register_data_view("refresh_reservations", "reservations_frame", ["Reservations", "Orders"])
+        self.register_data_view("refresh_writeoffs", "writeoffs_frame", ["WriteOffs", "Reservations", "Orders"])
+        self.register_data_view("refresh_laser_import_table", "laser_import_frame", [])
+        self.register_data_view("refresh_bending_import_table", "bending_import_frame", [])
+        self.register_data_view("refresh_details", "details_frame", ["OrderDetails", "Orders"])
+        self.register_data_view("refresh_material_logs", "material_logs_frame", ["MaterialChangeLogs"])
+        self.register_data_view("refresh_balance", "balance_frame", ["Materials"])
+
+        self.notebook.bind("<<NotebookTabChanged>>", self._on_tab_changed, add="+")
+        engine.subscribe_changes(self._on_data_changed)
+
+    def register_data_view(self, refresh_name, frame_name, sheets):
+        """
+        Зарегистрировать метод обновления вкладки (frame_name — атрибут с фреймом вкладки);
+        вызов для скрытой вкладки только помечает её устаревшей
+        """
+        refresh = getattr(self, refresh_name)
+
+        @functools.wraps(refresh)
+        def guarded_refresh(*args, **kwargs):
+            if refresh_name in self.pending_views and not self._views_flushing:
+                # Прямой вызов раньше запланированного — запланированный уже не нужен
+                self.refresh_stats["coalesced"] += 1
+            self.pending_views.discard(refresh_name)
+            if not self._is_view_visible(refresh_name):
+                self.dirty_views.add(refresh_name)
+                self.refresh_stats["deferred"] += 1
+                return None
+            self.dirty_views.discard(refresh_name)
+            self.refresh_stats["run"] += 1
+            return refresh(*args, **kwargs)
+
+        self.data_views[refresh_name] = {"frame": frame_name, "sheets": set(sheets)}
+        setattr(self, refresh_name, guarded_refresh)
+
+    def _is_view_visible(self, refresh_name):
+        frame = getattr(self, self.data_views[refresh_name]["frame"], None)
+        return frame is not None and self.notebook.select() == str(frame)
+
+    def _on_data_changed(self, changes):
+        """Событие сохранения: {лист: ID изменённых строк}"""
+        if threading.current_thread() is not threading.main_thread():
+            # Сохранение из потока слежения (автосписание) — вкладки обновит поток окна
+            self.watch_queue.put(functools.partial(self._on_data_changed, changes))
+            return
+        for name, view in self.data_views.items():
+            if not view["sheets"] & set(changes):
+                continue
+            if self._is_view_visible(name):
+                self.request_refresh(name)
+            else:
+                self.dirty_views.add(name)
+
+    def request_refresh(self, *names):
+        """
+        Запросить обновление вкладок по именам методов ("refresh_materials", "refresh_orders"…).
+        Запросы до ближайшего простоя цикла Tk объединяются: каждый метод выполнится один раз
+        через after_idle, скрытые вкладки только помечаются устаревшими. Сколько обновлений
+        запрошено, выполнено и сэкономлено — в self.refresh_stats.
+        """
+        for name in names:
+            self.refresh_stats["requested"] += 1
+            if name in self.pending_views:
+                self.refresh_stats["coalesced"] += 1
+            self.pending_views.add(name)
+
+        if self.pending_views and not self._views_flush_scheduled:
+            self._views_flush_scheduled = True
+            self.root.after_idle(self._flush_pending_views)
+
+    def _flush_pending_views(self):
+        """Выполнить запрошенные обновления в порядке регистрации вкладок (заказы раньше их деталей)"""
+        self._views_flush_scheduled = False
+        order = list(self.data_views)
+        names = sorted(self.pending_views, key=lambda n: order.index(n) if n in order else len(order))
+        self._views_flushing = True
+        try:
+            for name in names:
+                # Вкладка могла быть обновлена напрямую, пока обрабатывались предыдущие
+                if name in self.pending_views:
+                    self.pending_views.discard(name)
+                    getattr(self, name)()
+                    if name not in self.data_views:
+                        # Таблицы импорта не привязаны к листам базы — считаем их запуск здесь
+                        self.refresh_stats["run"] += 1
+        finally:
+            self._views_flushing = False
+
+    def _on_tab_changed(self, event=None):
+        """Открыта вкладка: обновить её устаревшие таблицы (в порядке регистрации)"""
+        order = list(self.data_views)
+        for name in sorted(self.dirty_views, key=order.index):
+            if self._is_view_visible(name):
+                getattr(self, name)()
+
+    # ==================== ПРИЁМ ВЫГРУЗОК ИЗ ПАПОК ====================
+
+    def start_watch_service(self):
+        """
+        Запуск фонового приёма выгрузок (vitaka_watch) для папок из настроек.
+        Файлы читаются, дописываются в кэши импорта и списываются в потоке сервиса;
+        окну через очередь, которую оно разбирает раз в секунду, передаётся только итог.
+        """
+        settings = self.load_settings()
+        folders = {vitaka_watch.LASER: settings.get("watch_laser_folder", ""),
+                   vitaka_watch.BENDING: settings.get("watch_bending_folder", "")}
+        self.watch_auto_writeoff = bool(settings.get("watch_auto_writeoff", False))
+        self.watch_queue = queue.Queue()
+        self.watch_service = None
+        if not any(folders.values()):
+            return
+
+        self.watch_service = vitaka_watch.WatchService(folders, self._ingest_watched_rows)
+        self.watch_service.start_in_thread()
+        print(f"👀 Слежение за папками выгрузок: {', '.join(self.watch_service.folders.values())}")
+        self.root.after(1000, self._drain_watch_queue)
+
+    def _drain_watch_queue(self):
+        """Выполнить в потоке окна действия, переданные потоком слежения"""
+        try:
+            while True:
+                action = self.watch_queue.get_nowait()
+                try:
+                    action()
+                except Exception as e:
+                    print(f"❌ Ошибка приёма выгрузки: {e}")
+        except queue.Empty:
+            pass
+        self.root.after(1000, self._drain_watch_queue)
+
+    def _ingest_watched_rows(self, kind, df, path):
+        """
+        Поток слежения: новые строки выгрузки дописываются в кэш-файл импорта и, если включено,
+        сразу списываются — окно при этом не блокируется. Таблица окна подхватит строки из кэша.
+        """
+        message = vitaka_watch.ingest_to_cache(kind, df, path, self.watch_auto_writeoff)
+        if message:
+            self.watch_queue.put(functools.partial(self._show_watched_rows, kind, message))
+
+    def _show_watched_rows(self, kind, message):
+        """Итог приёма выгрузки в потоке окна"""
+        self._sync_import_cache(kind)
+        self.show_status_tooltip(message)
+
+    # ==================== КЭШИ ИМПОРТА И ДРУГИЕ ПРОЦЕССЫ ====================
+
+    def _import_cache_source(self, kind):
+        """(атрибут со строками, путь кэш-файла, ключ строки, загрузка кэша) таблицы импорта kind"""
+        if kind == vitaka_watch.LASER:
+            return "laser_table_data", get_laser_cache_path(), engine.laser_row_key, engine.load_laser_cache
+        return "bending_table_data", get_bending_cache_path(), engine.bending_row_key, engine.load_bending_cache
+
+    def _merge_foreign_cache(self, kind):
+        """
+        Если кэш-файл импорта перезаписан другим процессом после последнего чтения/записи окном —
+        перенести его новые строки и отметки "Списано" в таблицу окна (вызывать под engine.data_lock).
+
+        Returns:
+            int: число перенесённых строк
+        """
+        attr, cache_path, key_func, load_cache = self._import_cache_source(kind)
+        stamp = engine.import_cache_stamp(cache_path)
+        if stamp is None or stamp == self.import_cache_stamps.get(cache_path):
+            return 0
+        cache_rows = load_cache(cache_path)
+        self.import_cache_stamps[cache_path] = stamp
+        if not cache_rows:
+            return 0
+        rows = getattr(self, attr, None)
+        if rows is None:
+            setattr(self, attr, cache_rows)
+            return len(cache_rows)
+        # Новые строки дописываются в конец без пересортировки: открытые диалоги держат индексы строк
+        return engine.merge_import_cache(rows, cache_rows, key_func)
+
+    def _sync_import_cache(self, kind):
+        """
+        Перенести в таблицу окна изменения кэш-файла импорта kind. Блокировку базы окно не ждёт:
+        если идёт запись (автосписание, HTTP-сервис), строки подхватит следующая проверка.
+
+        Returns:
+            int: число перенесённых строк
+        """
+        if not engine.data_lock.acquire(blocking=False):
+            return 0
+        try:
+            merged = self._merge_foreign_cache(kind)
+        finally:
+            engine.data_lock.release()
+        if merged:
+            if kind == vitaka_watch.LASER:
+                self.refresh_laser_import_table()
+            else:
+                self.refresh_bending_import_table()
+        return merged
+
+    def _sync_database_views(self):
+        """
+        Если файл базы перезаписал другой процесс (списание с планшета через vitaka_api, vitaka.py,
+        vitaka_watch) — обновить открытые вкладки и пометить устаревшими скрытые. События сохранения
+        приходят только от записей этого процесса. Блокировку базы окно не ждёт.
+
+        Returns:
+            bool: база изменена другим процессом
+        """
+        if not engine.data_lock.acquire(blocking=False):
+            return False
+        try:
+            changed, self.database_stamp = engine.database_changed_since(self.database_stamp)
+        finally:
+            engine.data_lock.release()
+        if changed:
+            self._on_data_changed({sheet: set() for sheet in engine.SHEET_COLUMNS})
+        return changed
+
+    def _poll_import_caches(self):
+        """
+        Подхватить изменения других процессов (vitaka_api, vitaka, vitaka_watch): записи в базу
+        и строки и отметки, записанные в кэши импорта
+        """
+        try:
+            if self._sync_database_views():
+                print("🔄 База изменена другой программой: вкладки обновляются")
+        except Exception as e:
+            print(f"⚠️ Ошибка проверки файла базы: {e}")
+        for kind in (vitaka_watch.LASER, vitaka_watch.BENDING):
+            try:
+                merged = self._sync_import_cache(kind)
+                if merged:
+                    print(f"🔄 Кэш импорта изменён другой программой: перенесено строк {merged}")
+            except Exception as e:
+                print(f"⚠️ Ошибка проверки кэша импорта: {e}")
+        self.root.after(IMPORT_CACHE_POLL_MS, self._poll_import_caches)
+
     def load_settings(self):
         """Загрузка настроек из файла"""
         settings_file = "app_settings.json"
@@ -768,7 +1332,7 @@ class ProductionApp:
         """Открытие окна настроек"""
         settings_window = tk.Toplevel(self.root)
         settings_window.title("⚙️ Настройки программы")
-        settings_window.geometry("700x300")
+        settings_window.geometry("700x520")
         settings_window.configure(bg='#ecf0f1')
         settings_window.resizable(False, False)
 
@@ -836,6 +1400,38 @@ class ProductionApp:
         )
         browse_button.pack(side=tk.LEFT, padx=5)
 
+        # Папки, из которых выгрузки лазерщиков и гибщиков принимаются автоматически
+        watch_frame = tk.LabelFrame(
+            settings_window,
+            text="📥 Автоприём выгрузок из папок",
+            bg='#ecf0f1',
+            font=("Arial", 11, "bold"),
+            fg='#34495e'
+        )
+        watch_frame.pack(fill=tk.X, padx=30, pady=5)
+
+        watch_vars = {}
+        for key, label in (("watch_laser_folder", "Лазерщики:"), ("watch_bending_folder", "Гибщики:")):
+            row_frame = tk.Frame(watch_frame, bg='#ecf0f1')
+            row_frame.pack(fill=tk.X, padx=10, pady=4)
+            tk.Label(row_frame, text=label, width=11, anchor='w', bg='#ecf0f1',
+                     font=("Arial", 10)).pack(side=tk.LEFT)
+            var = tk.StringVar(value=current_settings.get(key, ""))
+            tk.Entry(row_frame, textvariable=var, font=("Arial", 10), width=42).pack(side=tk.LEFT, padx=5)
+
+            def browse_watch_folder(var=var):
+                folder = filedialog.askdirectory(title="Выберите папку с выгрузками", initialdir=var.get() or None)
+                if folder:
+                    var.set(folder)
+
+            tk.Button(row_frame, text="📂 Обзор...", font=("Arial", 10), bg='#3498db', fg='white',
+                      command=browse_watch_folder, cursor='hand2').pack(side=tk.LEFT, padx=5)
+            watch_vars[key] = var
+
+        auto_writeoff_var = tk.BooleanVar(value=current_settings.get("watch_auto_writeoff", False))
+        tk.Checkbutton(watch_frame, text="Сразу списывать новые строки", variable=auto_writeoff_var,
+                       bg='#ecf0f1', font=("Arial", 10)).pack(anchor='w', padx=10, pady=(0, 5))
+
         # Кнопки Сохранить/Отмена
         buttons_frame = tk.Frame(settings_window, bg='#ecf0f1')
         buttons_frame.pack(pady=20)
@@ -851,10 +1447,17 @@ class ProductionApp:
                 )
                 return
 
+            watch_folders = {key: var.get().strip() for key, var in watch_vars.items()}
+            for folder in watch_folders.values():
+                if folder and not os.path.isdir(folder):
+                    messagebox.showerror("Ошибка", f"Папка выгрузок не существует:\n{folder}")
+                    return
+
             # Сохраняем настройки
-            new_settings = {
-                "database_path": new_path
-            }
+            new_settings = dict(current_settings)
+            new_settings["database_path"] = new_path
+            new_settings.update(watch_folders)
+            new_settings["watch_auto_writeoff"] = auto_writeoff_var.get()
 
             if self.save_settings(new_settings):
                 messagebox.showinfo(
@@ -974,11 +1577,49 @@ class ProductionApp:
             elif keycode == 65:
                 return universal_select_all(event)
 
+            # keycode 90 = Z: отмена операции (Ctrl+Shift+Z — повтор), keycode 89 = Y: повтор.
+            # В полях ввода клавиши не перехватываются
+            elif keycode in (90, 89) and not isinstance(self.root.focus_get(), (tk.Entry, tk.Text)):
+                if keycode == 89 or event.state & 0x0001:  # 0x0001 = Shift
+                    self.redo_last_operation()
+                else:
+                    self.undo_last_operation()
+                return "break"
+
         # Привязываем к событию нажатия ЛЮБОЙ клавиши
         self.root.bind_all("<KeyPress>", handle_hotkey)
 
         print("✅ Горячие клавиши настроены через keycode (работают на любой раскладке)")
-        print("   Поддержка: Ctrl+C, Ctrl+V, Ctrl+X, Ctrl+A")
+        print("   Поддержка: Ctrl+C, Ctrl+V, Ctrl+X, Ctrl+A, Ctrl+Z, Ctrl+Y")
+
+    def undo_last_operation(self):
+        """Ctrl+Z: отмена последней операции с базой"""
+        self._replay_operation(engine.undo, "↩️ Отменено", "Нечего отменять")
+
+    def redo_last_operation(self):
+        """Ctrl+Y / Ctrl+Shift+Z: повтор отменённой операции"""
+        self._replay_operation(engine.redo, "↪️ Повторено", "Нечего повторять")
+
+    def _replay_operation(self, action, done_text, empty_text):
+        try:
+            result = action()
+        except ValueError as e:
+            messagebox.showwarning("Отмена невозможна", str(e))
+            return
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось выполнить операцию:\n{e}")
+            return
+
+        if result is None:
+            self.show_status_tooltip(empty_text)
+            return
+
+        # Вкладки базы обновятся по событию сохранения; таблицы импорта перечитываем из кэша
+        if "laser" in result["imports"]:
+            self.load_laser_import_cache()
+        if "bending" in result["imports"]:
+            self.load_bending_import_cache()
+        self.show_status_tooltip(f"{done_text}: {result['label']}")
 
     def create_filter_panel(self, parent_frame, tree_widget, columns_to_filter, refresh_callback):
         """Создание панели фильтрации для любой таблицы"""
@@ -1090,35 +1731,125 @@ class ProductionApp:
 
         return toggle_vars
 
-    def auto_resize_columns(self, tree, min_width=80, max_width=None):  # ← None вместо 400
-        """Автоматический подбор ширины колонок по содержимому"""
+    def sync_tree_rows(self, tree, rows, excel_filter=None):
+        """
+        Обновить таблицу по новому списку строк без удаления и вставки всех строк заново.
+
+        rows — список (ключ, values, tags), где ключ — ID сущности (материала, заказа, списания…);
+        он становится item_id строки. Новые строки сравниваются с выведенными в прошлый раз
+        (self._rendered_rows), к виджету обращаемся только для вставки, изменения, удаления
+        и смены порядка, поэтому выделение, прокрутка и кэш ExcelStyleFilter сохраняются,
+        а неизменившиеся строки не стоят ни одного вызова Tk. Возвращает (вставлено, обновлено, удалено).
+        """
+        try:
+            return self._sync_rendered_rows(tree, rows, excel_filter, self._rendered_rows.get(str(tree)))
+        except tk.TclError:
+            # Строки таблицы удалены или изменены в обход sync_tree_rows — выводим все заново
+            return self._sync_rendered_rows(tree, rows, excel_filter, None)
+
+    def _sync_rendered_rows(self, tree, rows, excel_filter, rendered):
+        """sync_tree_rows по выведенным строкам rendered (None — неизвестны, таблица строится заново)"""
+        attached = tree.get_children('')
+        attached_set = set(attached)
+        # Строки, скрытые фильтром (detach), остаются в таблице и в кэше фильтра
+        hidden = getattr(excel_filter, '_all_item_cache', set()) if excel_filter is not None else set()
+        if rendered is None:
+            stale = list(attached) + [item_id for item_id in hidden
+                                      if item_id not in attached_set and tree.exists(item_id)]
+            rendered = {}
+        else:
+            rendered = dict(rendered)
+            for item_id in [item_id for item_id in rendered if item_id not in attached_set and item_id not in hidden]:
+                if not tree.exists(item_id):
+                    del rendered[item_id]
+            # Строки, вставленные в обход sync_tree_rows (без записи в rendered), удаляются
+            stale = [item_id for item_id in attached if item_id not in rendered]
+        if stale:
+            tree.delete(*stale)
+
+        keys = []
+        seen = set()
+        new_rendered = {}
+        inserted = updated = 0
+        for key, values, tags in rows:
+            # Повторяющиеся ID (ошибка в данных) получают суффикс, чтобы строка не пропала
+            item_id, copy = str(key), 1
+            while item_id in seen:
+                copy += 1
+                item_id = f"{key}#{copy}"
+            seen.add(item_id)
+            keys.append(item_id)
+
+            tags = tuple(tags or ())
+            row = (tuple(str(v) for v in values), tuple(str(t) for t in tags))
+            new_rendered[item_id] = row
+            if item_id not in rendered:
+                tree.insert("", "end", iid=item_id, values=values, tags=tags)
+                inserted += 1
+            elif rendered[item_id] != row:
+                tree.item(item_id, values=values, tags=tags)
+                updated += 1
+
+        removed = [item_id for item_id in rendered if item_id not in seen]
+        if removed:
+            tree.delete(*removed)
+        if (inserted or removed or stale or attached != tuple(keys)) and tree.get_children('') != tuple(keys):
+            tree.set_children('', *keys)
+        self._rendered_rows[str(tree)] = new_rendered
+
+        if excel_filter is not None:
+            excel_filter._all_item_cache = set(keys)
+        return inserted, updated, len(removed) + len(stale)
+
+    def auto_resize_columns(self, tree, min_width=80, max_width=None, sample_size=30, rows=None):  # ← None вместо 400
+        """
+        Автоматический подбор ширины колонок по содержимому.
+        Значения берутся из rows — значений строк, которые метод обновления уже собрал для таблицы,
+        или из памяти VirtualTreeview; построчное чтение виджета — только если их нет. В каждой колонке
+        измеряются только sample_size самых длинных разных строк, ширина каждой строки
+        запоминается. Если выборка не изменилась с прошлого раза — ширины не пересчитываются.
+        """
         try:
             import tkinter.font as tkfont
 
-            try:
-                font = tkfont.Font(font=tree.cget("font"))
-            except:
-                font = tkfont.Font(family="Arial", size=10)
-
-            for col in tree["columns"]:
-                # Измеряем ширину заголовка
-                heading_text = tree.heading(col)["text"]
-                heading_width = font.measure(heading_text) + 40
-
-                # Измеряем максимальную ширину значений
-                max_content_width = heading_width
-
-                for item_id in tree.get_children():
-                    try:
-                        col_index = tree["columns"].index(col)
-                        value = tree.item(item_id)["values"][col_index]
-                        value_str = str(value)
-                        value_width = font.measure(value_str) + 30
+            columns = list(tree["columns"])
+            if rows is None and hasattr(tree, "row_values"):
+                rows = tree.row_values()
+            elif rows is None:
+                rows = [tree.item(item_id, "values") for item_id in tree.get_children()]
+
+            # 🆕 ВЫБОРКА: САМЫЕ ДЛИННЫЕ РАЗНЫЕ СТРОКИ КАЖДОЙ КОЛОНКИ
+            samples = []
+            for col_index, col in enumerate(columns):
+                texts = {str(row[col_index]) for row in rows if len(row) > col_index}
+                longest = heapq.nlargest(sample_size, texts, key=len)
+                samples.append((col, tree.heading(col)["text"], tuple(longest)))
+            samples = (min_width, max_width, tuple(samples))
+
+            if self._column_width_samples.get(str(tree)) == samples:
+                return
+            self._column_width_samples[str(tree)] = samples
 
-                        if value_width > max_content_width:
-                            max_content_width = value_width
-                    except:
-                        continue
+            font_name = str(tree.cget("font") or "")
+            if font_name not in self._text_widths:
+                try:
+                    font = tkfont.Font(font=tree.cget("font"))
+                except:
+                    font = tkfont.Font(family="Arial", size=10)
+                self._text_widths[font_name] = (font, {})
+            font, widths = self._text_widths[font_name]
+
+            def measure(text):
+                width = widths.get(text)
+                if width is None:
+                    width = widths[text] = font.measure(text)
+                return width
+
+            for col, heading_text, longest in samples[2]:
+                # Заголовок и самые длинные значения
+                max_content_width = measure(heading_text) + 40
+                for value_str in longest:
+                    max_content_width = max(max_content_width, measure(value_str) + 30)
 
                 # Применяем ограничения
                 if max_width is not None:  # ← Добавить проверку
@@ -1128,8 +1859,6 @@ class ProductionApp:
 
                 tree.column(col, width=int(optimal_width))
 
-                print(f"📏 Колонка '{col}': {int(optimal_width)}px")
-
         except Exception as e:
             print(f"⚠️ Ошибка автоподбора ширины колонок: {e}")
 
@@ -1189,12 +1918,8 @@ class ProductionApp:
                     if k in self.writeoffs_toggles:
                         self.writeoffs_toggles[k].set(v)
 
-            self.refresh_materials()
-            self.refresh_orders()
-            self.refresh_reservations()
-            self.refresh_balance()
-            if hasattr(self, 'refresh_writeoffs'):
-                self.refresh_writeoffs()
+            self.request_refresh("refresh_materials", "refresh_orders", "refresh_reservations", "refresh_balance",
+                                 "refresh_writeoffs")
         except:
             pass
 
@@ -1212,6 +1937,9 @@ class ProductionApp:
         # Сохраняем настройки переключателей
         self.save_toggle_settings()
 
+        if getattr(self, 'watch_service', None):
+            self.watch_service.stop()
+
         print("✅ Данные сохранены")
 
         # Закрываем приложение
@@ -1239,7 +1967,7 @@ class ProductionApp:
         scroll_y = tk.Scrollbar(tree_frame, orient=tk.VERTICAL)
         scroll_x = tk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
 
-        self.materials_tree = ttk.Treeview(tree_frame,
+        self.materials_tree = VirtualTreeview(tree_frame,
                                            columns=("ID", "Марка", "Толщина", "Длина", "Ширина", "Кол-во шт", "Площадь",
                                                     "Резерв", "Доступно", "Дата"),
                                            show="headings", yscrollcommand=scroll_y.set, xscrollcommand=scroll_x.set)
@@ -1343,15 +2071,8 @@ class ProductionApp:
             active_filters_backup = self.materials_excel_filter.active_filters.copy()
             print(f"🔍 Сохранены фильтры материалов: {list(active_filters_backup.keys())}")
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.materials_tree.get_children():
-            self.materials_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'materials_excel_filter'):
-            self.materials_excel_filter._all_item_cache = set()
-
         df = load_data("Materials")
+        rows = []
 
         print(f"📊 Загружено материалов из БД: {len(df)}")
 
@@ -1428,28 +2149,20 @@ class ProductionApp:
                     print(f"      Условие: available={available}, quantity={quantity}")
                     print(f"      ✅ Тег: {tag}")
 
-                # Вставляем с тегом
-                item_id = self.materials_tree.insert("", "end", values=values, tags=(tag,))
+                # Строка с тегом, ключ — ID материала
+                rows.append((row["ID"], values, (tag,)))
                 inserted_count += 1
 
-                # 🆕 ПРОВЕРЯЕМ ЧТО ТЕГ ДЕЙСТВИТЕЛЬНО ПРИМЕНИЛСЯ
-                if inserted_count <= 5:
-                    actual_tags = self.materials_tree.item(item_id, 'tags')
-                    print(f"      Проверка: фактические теги элемента = {actual_tags}")
-
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'materials_excel_filter'):
-                    if not hasattr(self.materials_excel_filter, '_all_item_cache'):
-                        self.materials_excel_filter._all_item_cache = set()
-                    self.materials_excel_filter._all_item_cache.add(item_id)
-
-            print(f"\n✅ Вставлено строк: {inserted_count}")
+            print(f"\n✅ Строк к показу: {inserted_count}")
             print(f"📊 Статистика по тегам:")
             print(f"   🔴 negative (красный): {tag_stats['negative']}")
             print(f"   🟢 available (зелёный): {tag_stats['available']}")
             print(f"   🟡 fully_reserved (жёлтый): {tag_stats['fully_reserved']}")
             print(f"   🔵 empty (голубой): {tag_stats['empty']}")
 
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ
+        self.sync_tree_rows(self.materials_tree, rows, getattr(self, 'materials_excel_filter', None))
+
         # АВТОПОДБОР ШИРИНЫ КОЛОНОК
         self.auto_resize_columns(self.materials_tree, min_width=80, max_width=200)
 
@@ -1508,57 +2221,41 @@ class ProductionApp:
         if not file_path:
             return
         try:
-            import_df = pd.read_excel(file_path, engine='openpyxl')
-            required_columns = ["Марка", "Толщина", "Длина", "Ширина", "Количество штук"]
-            missing_columns = [col for col in required_columns if col not in import_df.columns]
-            if missing_columns:
-                messagebox.showerror("Ошибка", f"В файле отсутствуют колонки:\n{', '.join(missing_columns)}")
-                return
-            materials_df = load_data("Materials")
-            current_max_id = 0 if materials_df.empty else int(materials_df["ID"].max())
-            imported_count = 0
-            errors = []
-            for idx, row in import_df.iterrows():
-                try:
-                    if pd.isna(row["Марка"]) or row["Марка"] == "":
-                        continue
-                    marka = str(row["Марка"]).strip()
-                    thickness = float(row["Толщина"])
-                    length = float(row["Длина"])
-                    width = float(row["Ширина"])
-                    quantity = int(row["Количество штук"])
-                    duplicate = materials_df[(materials_df["Марка"] == marka) & (materials_df["Толщина"] == thickness) &
-                                             (materials_df["Длина"] == length) & (materials_df["Ширина"] == width)]
-                    if not duplicate.empty:
-                        material_id = duplicate.iloc[0]["ID"]
-                        old_qty = int(duplicate.iloc[0]["Количество штук"])
-                        new_qty = old_qty + quantity
-                        reserved = int(duplicate.iloc[0]["Зарезервировано"])
-                        area = (length * width * new_qty) / 1000000
-                        materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_qty
-                        materials_df.loc[materials_df["ID"] == material_id, "Общая площадь"] = round(area, 2)
-                        materials_df.loc[materials_df["ID"] == material_id, "Доступно"] = new_qty - reserved
-                    else:
-                        current_max_id += 1
-                        area = (length * width * quantity) / 1000000
-                        new_row = pd.DataFrame([{"ID": current_max_id, "Марка": marka, "Толщина": thickness,
-                                                 "Длина": length, "Ширина": width, "Количество штук": quantity,
-                                                 "Общая площадь": round(area, 2), "Зарезервировано": 0,
-                                                 "Доступно": quantity,
-                                                 "Дата добавления": datetime.now().strftime("%Y-%m-%d")}])
-                        materials_df = pd.concat([materials_df, new_row], ignore_index=True)
-                    imported_count += 1
-                except Exception as e:
-                    errors.append(f"Строка {idx + 2}: {str(e)}")
-            save_data("Materials", materials_df)
-            self.refresh_materials()
-            self.refresh_balance()
-            result_msg = f"Успешно импортировано: {imported_count} материалов"
-            if errors:
-                result_msg += f"\n\nОшибки:\n" + "\n".join(errors[:10])
-            messagebox.showinfo("Результат импорта", result_msg)
+            result = engine.import_materials(file_path)
+        except ValueError as e:
+            messagebox.showerror("Ошибка", str(e))
+            return
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось импортировать данные:\n{e}")
+            return
+        self.request_refresh("refresh_materials", "refresh_balance")
+        result_msg = (f"Успешно импортировано строк: {result['imported']}\n"
+                      f"Новых материалов: {result['new']}, пополнено: {result['updated']}")
+        if result["errors"]:
+            result_msg += f"\n\nОшибки ({len(result['errors'])}):\n" + "\n".join(result["errors"][:10])
+        messagebox.showinfo("Результат импорта", result_msg)
+        self.offer_import_error_report(result["report"])
+
+    def offer_import_error_report(self, report):
+        """Предложить сохранить полный отчёт об ошибках импорта (лист, строка, колонка, значение, ошибка)"""
+        if report is None or report.empty:
+            return
+        if not messagebox.askyesno("Отчёт об ошибках",
+                                   f"Ошибок в файле: {len(report)}.\n\nСохранить полный отчёт по строкам в файл?"):
+            return
+        file_path = filedialog.asksaveasfilename(
+            title="Сохранить отчёт об ошибках",
+            defaultextension=".xlsx",
+            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("All files", "*.*")],
+            initialfile=f"import_errors_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        )
+        if not file_path:
+            return
+        try:
+            engine.export_import_errors(report, file_path)
+            messagebox.showinfo("Успех", f"Отчёт сохранён:\n{file_path}")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось сохранить отчёт:\n{e}")
 
     def add_material(self):
         add_window = tk.Toplevel(self.root)
@@ -1588,17 +2285,8 @@ class ProductionApp:
                 if not marka:
                     messagebox.showwarning("Предупреждение", "Заполните марку стали!")
                     return
-                area = (length * width * quantity) / 1000000
-                df = load_data("Materials")
-                new_id = 1 if df.empty else int(df["ID"].max()) + 1
-                new_row = pd.DataFrame(
-                    [{"ID": new_id, "Марка": marka, "Толщина": thickness, "Длина": length, "Ширина": width,
-                      "Количество штук": quantity, "Общая площадь": round(area, 2), "Зарезервировано": 0,
-                      "Доступно": quantity, "Дата добавления": datetime.now().strftime("%Y-%m-%d")}])
-                df = pd.concat([df, new_row], ignore_index=True)
-                save_data("Materials", df)
-                self.refresh_materials()
-                self.refresh_balance()
+                engine.add_material(marka, thickness, length, width, quantity)
+                self.request_refresh("refresh_materials", "refresh_balance")
                 add_window.destroy()
                 messagebox.showinfo("Успех", "Материал успешно добавлен!")
             except ValueError:
@@ -1656,8 +2344,7 @@ class ProductionApp:
                 length = float(entries["Длина"].get())
                 width = float(entries["Ширина"].get())
                 new_quantity = int(entries["Количество штук"].get())
-                reserved = int(row["Зарезервировано"])
-                area = (length * width * new_quantity) / 1000000
+                comment_text = ""
 
                 # 🆕 ПРОВЕРКА: ИЗМЕНИЛОСЬ ЛИ КОЛИЧЕСТВО?
                 quantity_changed = (new_quantity != old_quantity)
@@ -1675,30 +2362,23 @@ class ProductionApp:
                             return
                         comment_text = "(без комментария)"
 
-                    # 🆕 ЗАПИСЫВАЕМ ЛОГ ИЗМЕНЕНИЯ
-                    self.log_material_change(
-                        material_id=item_id,
-                        marka=entries["Марка"].get(),
-                        thickness=thickness,
-                        length=length,
-                        width=width,
-                        old_qty=old_quantity,
-                        new_qty=new_quantity,
-                        comment=comment_text
-                    )
-
-                # СОХРАНЯЕМ ИЗМЕНЕНИЯ В МАТЕРИАЛАХ
-                df.loc[df["ID"] == item_id, "Марка"] = entries["Марка"].get()
-                df.loc[df["ID"] == item_id, "Толщина"] = thickness
-                df.loc[df["ID"] == item_id, "Длина"] = length
-                df.loc[df["ID"] == item_id, "Ширина"] = width
-                df.loc[df["ID"] == item_id, "Количество штук"] = new_quantity
-                df.loc[df["ID"] == item_id, "Общая площадь"] = round(area, 2)
-                df.loc[df["ID"] == item_id, "Доступно"] = new_quantity - reserved
-
-                save_data("Materials", df)
-                self.refresh_materials()
-                self.refresh_balance()
+                # СОХРАНЯЕМ ИЗМЕНЕНИЯ В МАТЕРИАЛАХ (количество — движением "Корректировка")
+                with engine.undo_group(f"Изменение материала #{item_id}"):
+                    if quantity_changed:
+                        # 🆕 ЗАПИСЫВАЕМ ЛОГ ИЗМЕНЕНИЯ
+                        self.log_material_change(
+                            material_id=item_id,
+                            marka=entries["Марка"].get(),
+                            thickness=thickness,
+                            length=length,
+                            width=width,
+                            old_qty=old_quantity,
+                            new_qty=new_quantity,
+                            comment=comment_text
+                        )
+                    engine.update_material(item_id, entries["Марка"].get(), thickness, length, width,
+                                           new_quantity, comment_text)
+                self.request_refresh("refresh_materials", "refresh_balance")
                 edit_window.destroy()
 
                 if quantity_changed:
@@ -1719,57 +2399,7 @@ class ProductionApp:
     def log_material_change(self, material_id, marka, thickness, length, width, old_qty, new_qty, comment):
         """Логирование изменения количества материала вручную"""
         try:
-            # Загружаем логи (или создаём пустой DataFrame если листа нет)
-            try:
-                logs_df = load_data("MaterialChangeLogs")
-            except:
-                logs_df = pd.DataFrame(columns=[
-                    "ID лога", "Дата и время", "ID материала", "Марка", "Толщина",
-                    "Длина", "Ширина", "Старое кол-во", "Новое кол-во", "Изменение", "Комментарий"
-                ])
-
-            # Генерируем ID лога
-            if logs_df.empty:
-                log_id = 1
-            else:
-                log_id = int(logs_df["ID лога"].max()) + 1
-
-            # Вычисляем изменение
-            change = new_qty - old_qty
-
-            # 🆕 ПРАВИЛЬНЫЙ ФОРМАТ: число с явным знаком
-            if change > 0:
-                change_str = f"+{change}"
-            elif change < 0:
-                change_str = str(change)  # минус уже есть
-            else:
-                change_str = "0"
-
-            print(f"🔍 Логирование изменения: старое={old_qty}, новое={new_qty}, изменение='{change_str}'")
-
-            # Создаём новую запись
-            new_log = pd.DataFrame([{
-                "ID лога": log_id,
-                "Дата и время": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "ID материала": material_id,
-                "Марка": marka,
-                "Толщина": thickness,
-                "Длина": length,
-                "Ширина": width,
-                "Старое кол-во": old_qty,
-                "Новое кол-во": new_qty,
-                "Изменение": change_str,  # ← СТРОКА С ЗНАКОМ: "+5" или "-3"
-                "Комментарий": comment
-            }])
-
-            # Добавляем в логи
-            logs_df = pd.concat([logs_df, new_log], ignore_index=True)
-
-            # Сохраняем
-            save_data("MaterialChangeLogs", logs_df)
-
-            print(
-                f"✅ Лог изменения записан: ID материала={material_id}, изменение={change_str}, комментарий='{comment}'")
+            engine.log_material_change(material_id, marka, thickness, length, width, old_qty, new_qty, comment)
 
             # АВТОМАТИЧЕСКОЕ ОБНОВЛЕНИЕ ВКЛАДКИ "История материалов"
             if hasattr(self, 'material_logs_tree'):
@@ -1810,7 +2440,7 @@ class ProductionApp:
         scroll_y = tk.Scrollbar(tree_frame, orient=tk.VERTICAL)
         scroll_x = tk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
 
-        self.material_logs_tree = ttk.Treeview(
+        self.material_logs_tree = VirtualTreeview(
             tree_frame,
             columns=("ID лога", "Дата", "ID материала", "Марка", "Толщина", "Размер",
                      "Старое", "Новое", "Изменение", "Комментарий"),
@@ -2047,16 +2677,9 @@ class ProductionApp:
         if hasattr(self, 'material_logs_excel_filter') and self.material_logs_excel_filter.active_filters:
             active_filters_backup = self.material_logs_excel_filter.active_filters.copy()
 
-        # Очищаем таблицу
-        for item in self.material_logs_tree.get_children():
-            self.material_logs_tree.delete(item)
-
-        # 🆕 ОЧИЩАЕМ КЭШ
-        if hasattr(self, 'material_logs_excel_filter'):
-            self.material_logs_excel_filter._all_item_cache = set()
-
         try:
             logs_df = load_data("MaterialChangeLogs")
+            rows = []
 
             if not logs_df.empty:
                 # Сортируем по дате (новые сверху)
@@ -2105,13 +2728,7 @@ class ProductionApp:
                     except:
                         tag = 'neutral'
 
-                    item_id = self.material_logs_tree.insert("", "end", values=values, tags=(tag,))
-
-                    # 🆕 СОХРАНЯЕМ В КЭШ
-                    if hasattr(self, 'material_logs_excel_filter'):
-                        if not hasattr(self.material_logs_excel_filter, '_all_item_cache'):
-                            self.material_logs_excel_filter._all_item_cache = set()
-                        self.material_logs_excel_filter._all_item_cache.add(item_id)
+                    rows.append((values[0], values, (tag,)))
 
                 # 🆕 ОБНОВЛЯЕМ СТАТУС
                 total = len(logs_df)
@@ -2130,6 +2747,9 @@ class ProductionApp:
                     fg='#856404'
                 )
 
+            # 🆕 ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ (КЛЮЧ — ID ЛОГА)
+            self.sync_tree_rows(self.material_logs_tree, rows, getattr(self, 'material_logs_excel_filter', None))
+
             self.auto_resize_columns(self.material_logs_tree)
 
             # 🆕 ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ
@@ -2155,13 +2775,8 @@ class ProductionApp:
             return
         count = len(selected)
         if messagebox.askyesno("Подтверждение", f"Удалить выбранные материалы ({count} шт)?"):
-            df = load_data("Materials")
-            for item in selected:
-                item_id = self.materials_tree.item(item)["values"][0]
-                df = df[df["ID"] != item_id]
-            save_data("Materials", df)
-            self.refresh_materials()
-            self.refresh_balance()  # <-- ЭТА СТРОКА ДОЛЖНА БЫТЬ!
+            engine.delete_materials([self.materials_tree.item(item)["values"][0] for item in selected])
+            self.request_refresh("refresh_materials", "refresh_balance")
             messagebox.showinfo("Успех", f"Удалено материалов: {count}")
 
     def delete_material(self):
@@ -2171,13 +2786,8 @@ class ProductionApp:
             return
         count = len(selected)
         if messagebox.askyesno("Подтверждение", f"Удалить выбранные материалы ({count} шт)?"):
-            df = load_data("Materials")
-            for item in selected:
-                item_id = self.materials_tree.item(item)["values"][0]
-                df = df[df["ID"] != item_id]
-            save_data("Materials", df)
-            self.refresh_materials()
-            self.refresh_balance()
+            engine.delete_materials([self.materials_tree.item(item)["values"][0] for item in selected])
+            self.request_refresh("refresh_materials", "refresh_balance")
             messagebox.showinfo("Успех", f"Удалено материалов: {count}")
 
     # 🆕 МЕТОДЫ КОНТЕКСТНОГО МЕНЮ ДЛЯ МАТЕРИАЛОВ
@@ -2267,6 +2877,14 @@ class ProductionApp:
         context_menu.add_separator()
 
         # ========== ДОПОЛНИТЕЛЬНЫЕ ОПЦИИ ==========
+        context_menu.add_command(
+            label="🧮  Сверить резервы",
+            command=self.check_stock_consistency
+        )
+        context_menu.add_command(
+            label="📅  Остатки на дату",
+            command=self.show_stock_on_date
+        )
         context_menu.add_command(
             label="🔄  Обновить таблицу",
             command=self.refresh_materials
@@ -2278,8 +2896,137 @@ class ProductionApp:
         finally:
             context_menu.grab_release()
 
-    def setup_orders_tab(self):
-        header = tk.Label(self.orders_frame, text="Управление заказами", font=("Arial", 16, "bold"), bg='white',
+    def check_stock_consistency(self):
+        """Сверка 'Зарезервировано'/'Доступно' материалов с листом резервов"""
+        try:
+            result = engine.reconcile_stock(fix=False)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось выполнить сверку:\n{e}")
+            return
+
+        discrepancies = result["discrepancies"]
+        orphans = result["orphan_reservations"]
+        orphans_text = f"\n\n⚠️ Резервы на удалённые материалы: {', '.join(map(str, orphans))}" if orphans else ""
+
+        if discrepancies.empty:
+            messagebox.showinfo("Сверка резервов", f"✅ Расхождений не найдено{orphans_text}")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Сверка резервов")
+        dialog.geometry("1000x450")
+        dialog.configure(bg='#ecf0f1')
+        dialog.grab_set()
+
+        tk.Label(dialog, text=f"⚠️ Найдено расхождений: {len(discrepancies)}{orphans_text}",
+                 font=("Arial", 12, "bold"), bg='#ecf0f1', fg='#e74c3c', justify=tk.LEFT).pack(pady=10)
+
+        tree_frame = tk.Frame(dialog, bg='#ecf0f1')
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=15, pady=5)
+        columns = list(discrepancies.columns)
+        tree = ttk.Treeview(tree_frame, columns=columns, show='headings', height=12)
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=95, anchor=tk.CENTER)
+        scroll_y = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scroll_y.set)
+        scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        for row in discrepancies.itertuples(index=False, name=None):
+            tree.insert("", "end", values=row)
+
+        def fix():
+            if not messagebox.askyesno("Подтверждение",
+                                       "Записать расчётные значения 'Зарезервировано' и 'Доступно'?",
+                                       parent=dialog):
+                return
+            try:
+                fixed = engine.reconcile_stock(fix=True)["fixed"]
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось исправить:\n{e}", parent=dialog)
+                return
+            dialog.destroy()
+            messagebox.showinfo("Успех", f"✅ Исправлено материалов: {fixed}")
+
+        btn_frame = tk.Frame(dialog, bg='#ecf0f1')
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="🛠 Исправить", bg='#27ae60', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=fix).pack(side=tk.LEFT, padx=8)
+        tk.Button(btn_frame, text="Закрыть", bg='#3498db', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=dialog.destroy).pack(side=tk.LEFT, padx=8)
+
+    def show_stock_on_date(self):
+        """Остатки склада на конец выбранного дня (по журналу движений)"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Остатки на дату")
+        dialog.geometry("950x500")
+        dialog.configure(bg='#ecf0f1')
+
+        top_frame = tk.Frame(dialog, bg='#ecf0f1')
+        top_frame.pack(fill=tk.X, padx=15, pady=10)
+        tk.Label(top_frame, text="Дата (ГГГГ-ММ-ДД):", font=("Arial", 10, "bold"),
+                 bg='#ecf0f1').pack(side=tk.LEFT)
+        date_entry = tk.Entry(top_frame, font=("Arial", 10), width=14)
+        date_entry.insert(0, datetime.now().replace(day=1).strftime("%Y-%m-%d"))
+        date_entry.pack(side=tk.LEFT, padx=8)
+
+        status_label = tk.Label(dialog, text="", font=("Arial", 10), bg='#ecf0f1', anchor='w')
+        status_label.pack(fill=tk.X, padx=15)
+
+        tree_frame = tk.Frame(dialog, bg='#ecf0f1')
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=15, pady=5)
+        columns = engine.STOCK_ON_DATE_COLUMNS
+        tree = ttk.Treeview(tree_frame, columns=columns, show='headings', height=15)
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=95, anchor=tk.CENTER)
+        scroll_y = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scroll_y.set)
+        scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        result = {"df": None, "date": None}
+
+        def show():
+            date_text = date_entry.get().strip()
+            try:
+                stock_df = engine.stock_on_date(datetime.strptime(date_text, "%Y-%m-%d"))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", f"Неверная дата или нет данных:\n{e}", parent=dialog)
+                return
+            tree.delete(*tree.get_children())
+            for row in stock_df.itertuples(index=False, name=None):
+                tree.insert("", "end", values=row)
+            result["df"], result["date"] = stock_df, date_text
+            status_label.config(
+                text=f"📅 Остатки на конец {date_text}: материалов {len(stock_df)}, "
+                     f"листов {int(stock_df['Количество штук'].sum())}, "
+                     f"площадь {stock_df['Общая площадь'].sum():.2f} м²")
+
+        def export():
+            if result["df"] is None:
+                messagebox.showwarning("Предупреждение", "Сначала покажите остатки", parent=dialog)
+                return
+            file_path = filedialog.asksaveasfilename(
+                parent=dialog, defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")],
+                initialfile=f"Остатки_на_{result['date']}.xlsx")
+            if not file_path:
+                return
+            try:
+                result["df"].to_excel(file_path, index=False, engine='openpyxl')
+                messagebox.showinfo("Успех", f"Остатки сохранены:\n{file_path}", parent=dialog)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{e}", parent=dialog)
+
+        tk.Button(top_frame, text="📅 Показать", bg='#3498db', fg='white', font=("Arial", 10, "bold"),
+                  command=show).pack(side=tk.LEFT, padx=5)
+        tk.Button(top_frame, text="📤 Экспорт в Excel", bg='#27ae60', fg='white', font=("Arial", 10, "bold"),
+                  command=export).pack(side=tk.LEFT, padx=5)
+        date_entry.bind('<Return>', lambda e: show())
+        show()
+
+    def setup_orders_tab(self):
+        header = tk.Label(self.orders_frame, text="Управление заказами", font=("Arial", 16, "bold"), bg='white',
                           fg='#2c3e50')
         header.pack(pady=10)
 
@@ -2421,15 +3168,8 @@ class ProductionApp:
             active_filters_backup = self.orders_excel_filter.active_filters.copy()
             print(f"🔍 Сохранены фильтры заказов: {list(active_filters_backup.keys())}")
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.orders_tree.get_children():
-            self.orders_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'orders_excel_filter'):
-            self.orders_excel_filter._all_item_cache = set()
-
         df = load_data("Orders")
+        rows = []
 
         if not df.empty:
             show_completed = True
@@ -2450,16 +3190,14 @@ class ProductionApp:
                 values = (row["ID заказа"], row["Название заказа"], row["Заказчик"],
                           row["Дата создания"], row["Статус"], row["Примечания"])
 
-                item_id = self.orders_tree.insert("", "end", values=values)
+                rows.append((row["ID заказа"], values, ()))
 
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'orders_excel_filter'):
-                    if not hasattr(self.orders_excel_filter, '_all_item_cache'):
-                        self.orders_excel_filter._all_item_cache = set()
-                    self.orders_excel_filter._all_item_cache.add(item_id)
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ (ВЫДЕЛЕННЫЙ ЗАКАЗ СОХРАНЯЕТСЯ)
+        self.sync_tree_rows(self.orders_tree, rows, getattr(self, 'orders_excel_filter', None))
 
         # АВТОПОДБОР ШИРИНЫ КОЛОНОК
-        self.auto_resize_columns(self.orders_tree, min_width=100, max_width=300)
+        self.auto_resize_columns(self.orders_tree, min_width=100, max_width=300,
+                                 rows=[values for _, values, _ in rows])
 
         # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ ПОСЛЕ ЗАГРУЗКИ ДАННЫХ
         if active_filters_backup and hasattr(self, 'orders_excel_filter'):
@@ -2478,17 +3216,13 @@ class ProductionApp:
             active_filters_backup = self.order_details_excel_filter.active_filters.copy()
             print(f"   Сохранены фильтры деталей: {list(active_filters_backup.keys())}")
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.order_details_tree.get_children():
-            self.order_details_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'order_details_excel_filter'):
-            self.order_details_excel_filter._all_item_cache = set()
+        order_details_filter = getattr(self, 'order_details_excel_filter', None)
+        rows = []
 
         selected = self.orders_tree.selection()
         if not selected:
             print(f"   ❌ Заказ не выбран")
+            self.sync_tree_rows(self.order_details_tree, rows, order_details_filter)
             return
 
         order_id = self.orders_tree.item(selected[0])["values"][0]
@@ -2526,13 +3260,7 @@ class ProductionApp:
                     values = (detail_id, order_id_val, detail_name, quantity, cut, bent)
 
                     print(f"      ✅ Вставка детали: {values}")
-                    item_id = self.order_details_tree.insert("", "end", values=values)
-
-                    # СОХРАНЯЕМ item_id В КЭШ
-                    if hasattr(self, 'order_details_excel_filter'):
-                        if not hasattr(self.order_details_excel_filter, '_all_item_cache'):
-                            self.order_details_excel_filter._all_item_cache = set()
-                        self.order_details_excel_filter._all_item_cache.add(item_id)
+                    rows.append((detail_id, values, ()))
 
                 except Exception as e:
                     print(f"      ⚠️ Ошибка чтения детали {index}: {e}")
@@ -2540,12 +3268,16 @@ class ProductionApp:
         else:
             print(f"   ❌ DataFrame OrderDetails пуст")
 
+        # Обновляем только изменившиеся строки
+        self.sync_tree_rows(self.order_details_tree, rows, order_details_filter)
+
         # Проверяем сколько элементов в дереве
         visible_items = self.order_details_tree.get_children()
         print(f"   📊 Видимых элементов в дереве: {len(visible_items)}")
 
         # АВТОПОДБОР ШИРИНЫ КОЛОНОК
-        self.auto_resize_columns(self.order_details_tree, min_width=100, max_width=300)
+        self.auto_resize_columns(self.order_details_tree, min_width=100, max_width=300,
+                                 rows=[values for _, values, _ in rows])
 
         # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ ПОСЛЕ ЗАГРУЗКИ ДАННЫХ
         if active_filters_backup and hasattr(self, 'order_details_excel_filter'):
@@ -2694,8 +3426,6 @@ class ProductionApp:
                                 edit_entry.destroy()
                                 return
 
-                        df.loc[df["ID"] == detail_id, "Порезано"] = new_cut
-
                     elif column_name == "Погнуто":
                         new_cut = actual_cut
                         new_bent = new_value
@@ -2708,10 +3438,9 @@ class ProductionApp:
                                 edit_entry.destroy()
                                 return
 
-                        df.loc[df["ID"] == detail_id, "Погнуто"] = new_bent
-
-                    # Сохраняем
-                    save_data("OrderDetails", df)
+                    # Сохраняем событием журнала деталей
+                    engine.set_detail_progress(detail_id, cut=new_cut, bent=new_bent,
+                                               comment=f"Правка в таблице: {column_name}")
                     self.refresh_order_details()
                     edit_entry.destroy()
 
@@ -3160,14 +3889,14 @@ class ProductionApp:
                         pass
                 ws_orders.column_dimensions[column].width = max_length + 2
             ws_details = wb.create_sheet("Детали")
-            headers_details = ["Название заказа", "Название детали", "Количество"]
+            headers_details = ["Название заказа", "Название детали", "Количество", "Материал", "Листов"]
             ws_details.append(headers_details)
             examples_details = [
-                ["Заказ №1 - Металлоконструкции", "Балка двутавровая 20", 15],
-                ["Заказ №1 - Металлоконструкции", "Швеллер 16", 8],
-                ["Заказ №2 - Лестница", "Ступень 300x250", 12],
-                ["Заказ №2 - Лестница", "Поручень", 2],
-                ["Заказ №3 - Ограждение", "Стойка 50x50", 20]
+                ["Заказ №1 - Металлоконструкции", "Балка двутавровая 20", 15, "Ст3 4мм 1500x3000", 2],
+                ["Заказ №1 - Металлоконструкции", "Швеллер 16", 8, "Ст3 4мм", 1],
+                ["Заказ №2 - Лестница", "Ступень 300x250", 12, "09Г2С 3мм 1250x2500", 1],
+                ["Заказ №2 - Лестница", "Поручень", 2, "", ""],
+                ["Заказ №3 - Ограждение", "Стойка 50x50", 20, "", ""]
             ]
             for example in examples_details:
                 ws_details.append(example)
@@ -3183,7 +3912,7 @@ class ProductionApp:
                 ws_details.column_dimensions[column].width = max_length + 2
             wb.save(file_path)
             messagebox.showinfo("Успех",
-                                f"Шаблон сохранен в:\n{file_path}\n\n📋 ИНСТРУКЦИЯ:\n\nЛист 'Заказы':\n• Название заказа - уникальное имя\n• Заказчик - обязательно\n• Статус: Новый, В работе, Завершен, Отменен\n• Примечания - опционально\n\nЛист 'Детали':\n• Название заказа - должно совпадать с листом 'Заказы'\n• Название детали - обязательно\n• Количество - число")
+                                f"Шаблон сохранен в:\n{file_path}\n\n📋 ИНСТРУКЦИЯ:\n\nЛист 'Заказы':\n• Название заказа - уникальное имя\n• Заказчик - обязательно\n• Статус: Новый, В работе, Завершен, Отменен\n• Примечания - опционально\n\nЛист 'Детали':\n• Название заказа - должно совпадать с листом 'Заказы'\n• Название детали - обязательно\n• Количество - число\n• Материал, Листов - опционально, для планировщика резервов")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось создать шаблон: {e}")
 
@@ -3193,126 +3922,24 @@ class ProductionApp:
         if not file_path:
             return
         try:
-            try:
-                orders_import_df = pd.read_excel(file_path, sheet_name="Заказы", engine='openpyxl')
-            except:
-                messagebox.showerror("Ошибка", "В файле отсутствует лист 'Заказы'!\n\nИспользуйте шаблон.")
-                return
-            try:
-                details_import_df = pd.read_excel(file_path, sheet_name="Детали", engine='openpyxl')
-                has_details = True
-            except:
-                details_import_df = pd.DataFrame()
-                has_details = False
-            required_columns_orders = ["Название заказа", "Заказчик"]
-            missing_columns = [col for col in required_columns_orders if col not in orders_import_df.columns]
-            if missing_columns:
-                messagebox.showerror("Ошибка",
-                                     f"В листе 'Заказы' отсутствуют колонки:\n{', '.join(missing_columns)}\n\nИспользуйте кнопку 'Скачать шаблон'.")
-                return
-            if has_details and not details_import_df.empty:
-                required_columns_details = ["Название заказа", "Название детали", "Количество"]
-                missing_details = [col for col in required_columns_details if col not in details_import_df.columns]
-                if missing_details:
-                    messagebox.showwarning("Предупреждение",
-                                           f"В листе 'Детали' отсутствуют колонки:\n{', '.join(missing_details)}\n\nДетали не будут импортированы.")
-                    has_details = False
-            orders_df = load_data("Orders")
-            current_max_order_id = 1000 if orders_df.empty else int(orders_df["ID заказа"].max())
-            order_details_df = load_data("OrderDetails")
-            current_max_detail_id = 0 if order_details_df.empty else int(order_details_df["ID"].max())
-            imported_orders = 0
-            imported_details = 0
-            errors = []
-            valid_statuses = ["Новый", "В работе", "Завершен", "Отменен"]
-            order_name_to_id = {}
-            for idx, row in orders_import_df.iterrows():
-                try:
-                    if pd.isna(row["Название заказа"]) or str(row["Название заказа"]).strip() == "":
-                        continue
-                    if pd.isna(row["Заказчик"]) or str(row["Заказчик"]).strip() == "":
-                        errors.append(f"Заказы, строка {idx + 2}: Отсутствует заказчик")
-                        continue
-                    order_name = str(row["Название заказа"]).strip()
-                    customer = str(row["Заказчик"]).strip()
-                    status = "Новый"
-                    if "Статус" in orders_import_df.columns and not pd.isna(row["Статус"]):
-                        status_input = str(row["Статус"]).strip()
-                        if status_input in valid_statuses:
-                            status = status_input
-                        else:
-                            errors.append(
-                                f"Заказы, строка {idx + 2}: Неверный статус '{status_input}', установлен 'Новый'")
-                    notes = ""
-                    if "Примечания" in orders_import_df.columns and not pd.isna(row["Примечания"]):
-                        notes = str(row["Примечания"]).strip()
-                    current_max_order_id += 1
-                    new_order_id = current_max_order_id
-                    new_row = pd.DataFrame([{
-                        "ID заказа": new_order_id,
-                        "Название заказа": order_name,
-                        "Заказчик": customer,
-                        "Дата создания": datetime.now().strftime("%Y-%m-%d"),
-                        "Статус": status,
-                        "Примечания": notes
-                    }])
-                    orders_df = pd.concat([orders_df, new_row], ignore_index=True)
-                    imported_orders += 1
-                    order_name_to_id[order_name] = new_order_id
-                except Exception as e:
-                    errors.append(f"Заказы, строка {idx + 2}: {str(e)}")
-            if has_details and not details_import_df.empty:
-                for idx, row in details_import_df.iterrows():
-                    try:
-                        if pd.isna(row["Название заказа"]) or str(row["Название заказа"]).strip() == "":
-                            continue
-                        order_name = str(row["Название заказа"]).strip()
-                        if order_name not in order_name_to_id:
-                            errors.append(f"Детали, строка {idx + 2}: Заказ '{order_name}' не найден в листе 'Заказы'")
-                            continue
-                        if pd.isna(row["Название детали"]) or str(row["Название детали"]).strip() == "":
-                            errors.append(f"Детали, строка {idx + 2}: Отсутствует название детали")
-                            continue
-                        detail_name = str(row["Название детали"]).strip()
-                        if pd.isna(row["Количество"]):
-                            errors.append(
-                                f"Детали, строка {idx + 2}: Отсутствует количество для детали '{detail_name}'")
-                            continue
-                        try:
-                            quantity = float(row["Количество"])
-                            quantity = int(quantity)
-                            if quantity <= 0:
-                                errors.append(
-                                    f"Детали, строка {idx + 2}: Количество должно быть больше нуля для детали '{detail_name}'")
-                                continue
-                        except (ValueError, TypeError):
-                            errors.append(
-                                f"Детали, строка {idx + 2}: Неверное количество '{row['Количество']}' для детали '{detail_name}'")
-                            continue
-                        current_max_detail_id += 1
-                        order_id = order_name_to_id[order_name]
-                        new_detail = pd.DataFrame([{
-                            "ID": current_max_detail_id,
-                            "ID заказа": order_id,
-                            "Название детали": detail_name,
-                            "Количество": quantity
-                        }])
-                        order_details_df = pd.concat([order_details_df, new_detail], ignore_index=True)
-                        imported_details += 1
-                    except Exception as e:
-                        errors.append(f"Детали, строка {idx + 2}: {str(e)}")
-            save_data("Orders", orders_df)
-            if imported_details > 0:
-                save_data("OrderDetails", order_details_df)
-            self.refresh_orders()
-            result_msg = f"✅ Успешно импортировано:\n• Заказов: {imported_orders}\n• Деталей: {imported_details}"
-            if errors:
-                result_msg += f"\n\n⚠ Ошибки ({len(errors)}):\n" + "\n".join(errors[:15])
-                if len(errors) > 15:
-                    result_msg += f"\n... и еще {len(errors) - 15} ошибок"
-            messagebox.showinfo("Результат импорта", result_msg)
+            result = engine.import_orders(file_path)
+        except ValueError as e:
+            messagebox.showerror("Ошибка", str(e))
+            return
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось импортировать данные:\n{e}")
+            return
+        for warning in result["warnings"]:
+            messagebox.showwarning("Предупреждение", warning)
+        self.refresh_orders()
+        errors = result["errors"]
+        result_msg = f"✅ Успешно импортировано:\n• Заказов: {result['orders']}\n• Деталей: {result['details']}"
+        if errors:
+            result_msg += f"\n\n⚠ Ошибки ({len(errors)}):\n" + "\n".join(errors[:15])
+            if len(errors) > 15:
+                result_msg += f"\n... и еще {len(errors) - 15} ошибок"
+        messagebox.showinfo("Результат импорта", result_msg)
+        self.offer_import_error_report(result["report"])
 
     def add_order(self):
         add_window = tk.Toplevel(self.root)
@@ -3481,20 +4108,28 @@ class ProductionApp:
             messagebox.showwarning("Предупреждение", "Выберите заказы для удаления")
             return
         count = len(selected)
-        if messagebox.askyesno("Подтверждение", f"Удалить выбранные заказы ({count} шт)?"):
-            df = load_data("Orders")
-            details_df = load_data("OrderDetails")
-            for item in selected:
-                item_id = self.orders_tree.item(item)["values"][0]
-                df = df[df["ID заказа"] != item_id]
-                if not details_df.empty:
-                    details_df = details_df[details_df["ID заказа"] != item_id]
-            save_data("Orders", df)
-            if not details_df.empty or len(selected) > 0:
-                save_data("OrderDetails", details_df)
-            self.refresh_orders()
-            self.refresh_order_details()
-            messagebox.showinfo("Успех", f"Удалено заказов: {count}")
+        if messagebox.askyesno("Подтверждение",
+                               f"Удалить выбранные заказы ({count} шт)?\n\n"
+                               f"Вместе с ними удалятся детали, резервы и списания заказов.\n"
+                               f"Несписанный остаток резервов вернётся на склад!"):
+            order_ids = [self.orders_tree.item(item)["values"][0] for item in selected]
+            try:
+                with engine.undo_group(f"Удаление заказов ({count} шт)"):
+                    deleted = engine.delete_cascade(order_ids=order_ids)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось удалить заказы: {e}")
+                return
+            self.request_refresh("refresh_materials", "refresh_orders", "refresh_order_details",
+                                 "refresh_reservations", "refresh_writeoffs", "refresh_balance")
+            messagebox.showinfo("Успех", self._cascade_summary("Удалено заказов", "Orders", deleted))
+
+    def _cascade_summary(self, title, sheet, deleted):
+        """Текст итога каскадного удаления: число удалённых строк листа sheet и зависимых строк"""
+        labels = [("OrderDetails", "деталей"), ("Reservations", "резервов"),
+                  ("WriteOffs", "списаний материалов"), ("BendingWriteOffs", "списаний гибки")]
+        lines = [f"{title}: {deleted[sheet]}"]
+        lines += [f"  • {label}: {deleted[name]}" for name, label in labels if name != sheet and deleted.get(name)]
+        return "\n".join(lines)
 
         # ===================================================================
         # КОНТЕКСТНОЕ МЕНЮ ДЛЯ ЗАКАЗОВ
@@ -3579,7 +4214,7 @@ class ProductionApp:
 
         add_window = tk.Toplevel(self.root)
         add_window.title("Добавить деталь")
-        add_window.geometry("500x350")
+        add_window.geometry("500x450")
         add_window.configure(bg='#ecf0f1')
 
         tk.Label(add_window, text=f"Добавление детали к заказу #{order_id}",
@@ -3652,6 +4287,24 @@ class ProductionApp:
         qty_entry = tk.Entry(qty_frame, font=("Arial", 10))
         qty_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
 
+        # ========== МАТЕРИАЛ ДЛЯ ПЛАНИРОВЩИКА РЕЗЕРВОВ (НЕОБЯЗАТЕЛЬНО) ==========
+        material_frame = tk.Frame(add_window, bg='#ecf0f1')
+        material_frame.pack(fill=tk.X, padx=20, pady=5)
+        tk.Label(material_frame, text="Материал:", width=20, anchor='w',
+                 bg='#ecf0f1', font=("Arial", 10)).pack(side=tk.LEFT)
+        material_entry = tk.Entry(material_frame, font=("Arial", 10))
+        material_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
+
+        sheets_frame = tk.Frame(add_window, bg='#ecf0f1')
+        sheets_frame.pack(fill=tk.X, padx=20, pady=5)
+        tk.Label(sheets_frame, text="Листов:", width=20, anchor='w',
+                 bg='#ecf0f1', font=("Arial", 10)).pack(side=tk.LEFT)
+        sheets_entry = tk.Entry(sheets_frame, font=("Arial", 10))
+        sheets_entry.insert(0, "1")
+        sheets_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
+        tk.Label(add_window, text="💡 Материал, например: Ст3 2мм 1250x2500 (для планировщика резервов)",
+                 font=("Arial", 8, "italic"), bg='#ecf0f1', fg='#7f8c8d').pack(fill=tk.X, padx=20)
+
         # ========== ИНФОРМАЦИЯ О ПОПУЛЯРНЫХ ДЕТАЛЯХ ==========
         if unique_detail_names:
             info_frame = tk.LabelFrame(add_window, text="📊 Часто используемые детали",
@@ -3691,7 +4344,9 @@ class ProductionApp:
                     "Название детали": detail_name,
                     "Количество": quantity,
                     "Порезано": 0,
-                    "Погнуто": 0
+                    "Погнуто": 0,
+                    "Материал": material_entry.get().strip(),
+                    "Листов": int(sheets_entry.get().strip() or 1)
                 }])
 
                 df = pd.concat([df, new_row], ignore_index=True)
@@ -3724,14 +4379,20 @@ class ProductionApp:
             messagebox.showwarning("Предупреждение", "Выберите детали для удаления")
             return
         count = len(selected)
-        if messagebox.askyesno("Подтверждение", f"Удалить выбранные детали ({count} шт)?"):
-            df = load_data("OrderDetails")
-            for item in selected:
-                detail_id = self.order_details_tree.item(item)["values"][0]
-                df = df[df["ID"] != detail_id]
-            save_data("OrderDetails", df)
-            self.refresh_order_details()
-            messagebox.showinfo("Успех", f"Удалено деталей: {count}")
+        if messagebox.askyesno("Подтверждение",
+                               f"Удалить выбранные детали ({count} шт)?\n\n"
+                               f"Резервы и списания гибки деталей тоже удалятся.\n"
+                               f"Несписанный остаток резервов вернётся на склад!"):
+            detail_ids = [self.order_details_tree.item(item)["values"][0] for item in selected]
+            try:
+                with engine.undo_group(f"Удаление деталей ({count} шт)"):
+                    deleted = engine.delete_cascade(detail_ids=detail_ids)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось удалить детали: {e}")
+                return
+            self.request_refresh("refresh_materials", "refresh_order_details", "refresh_reservations",
+                                 "refresh_writeoffs", "refresh_balance")
+            messagebox.showinfo("Успех", self._cascade_summary("Удалено деталей", "OrderDetails", deleted))
 
     def edit_order_detail(self):
         """Редактирование детали заказа с учетом этапов производства"""
@@ -3836,13 +4497,14 @@ class ProductionApp:
                                                "Проверьте правильность данных.\n\nПродолжить?"):
                         return
 
-                # Обновляем данные
+                # Обновляем данные; "Порезано"/"Погнуто" — событием журнала деталей
                 df.loc[df["ID"] == detail_id, "Название детали"] = new_name
                 df.loc[df["ID"] == detail_id, "Количество"] = new_qty
-                df.loc[df["ID"] == detail_id, "Порезано"] = new_cut
-                df.loc[df["ID"] == detail_id, "Погнуто"] = new_bent
 
-                save_data("OrderDetails", df)
+                with engine.undo_group(f"Изменение детали #{detail_id}"):
+                    save_data("OrderDetails", df)
+                    engine.set_detail_progress(detail_id, cut=new_cut, bent=new_bent,
+                                               comment="Редактирование детали")
                 self.refresh_order_details()
                 edit_window.destroy()
 
@@ -3924,11 +4586,83 @@ class ProductionApp:
 
         tk.Button(buttons_frame, text="✖ Сбросить фильтры", bg='#e67e22', fg='white',
                   command=self.clear_reservations_filters, **btn_style).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons_frame, text="🗂 Планировщик", bg='#27ae60', fg='white',
+                  command=self.plan_reservations, **btn_style).pack(side=tk.LEFT, padx=5)
 
         self.reservations_tree.bind('<Button-3>', self.on_reservations_right_click)
 
         self.refresh_reservations()
 
+    def plan_reservations(self):
+        """Автоматический план резервов для всех деталей заказов 'В работе' без резерва"""
+        try:
+            result = engine.plan_reservations()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось построить план:\n{e}")
+            return
+
+        plan, unplanned = result["plan"], result["unplanned"]
+        if not plan and not unplanned:
+            messagebox.showinfo("Планировщик резервов", "✅ У всех деталей заказов 'В работе' уже есть резерв")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Планировщик резервов")
+        dialog.geometry("1100x650")
+        dialog.configure(bg='#ecf0f1')
+        dialog.grab_set()
+
+        details_count = len({p["ID детали"] for p in plan})
+        tk.Label(dialog, text=f"📋 План: деталей {details_count}, резервов {len(plan)}, "
+                              f"листов {sum(p['Количество'] for p in plan)}",
+                 font=("Arial", 12, "bold"), bg='#ecf0f1', fg='#2c3e50').pack(pady=(10, 5))
+
+        def make_tree(parent, columns, rows, height):
+            frame = tk.Frame(parent, bg='#ecf0f1')
+            frame.pack(fill=tk.BOTH, expand=True, padx=15, pady=5)
+            tree = ttk.Treeview(frame, columns=columns, show='headings', height=height)
+            for col in columns:
+                tree.heading(col, text=col)
+                tree.column(col, width=90, anchor=tk.CENTER)
+            scroll_y = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+            tree.configure(yscrollcommand=scroll_y.set)
+            scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+            tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+            for row in rows:
+                tree.insert("", "end", values=[row.get(col, "") for col in columns])
+            return tree
+
+        make_tree(dialog, engine.RESERVATION_PLAN_COLUMNS, plan, 14)
+
+        if unplanned:
+            tk.Label(dialog, text=f"⚠️ Без плана: {len(unplanned)} деталей", font=("Arial", 10, "bold"),
+                     bg='#ecf0f1', fg='#e74c3c').pack(anchor='w', padx=15)
+            tree = make_tree(dialog, ["ID заказа", "Название заказа", "ID детали", "Название детали", "Причина"],
+                             unplanned, 6)
+            tree.column("Причина", width=380, anchor=tk.W)
+
+        def commit():
+            if not messagebox.askyesno("Подтверждение", f"Создать {len(plan)} резервов по плану?", parent=dialog):
+                return
+            try:
+                created = engine.commit_reservation_plan(plan)
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e), parent=dialog)
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось создать резервы:\n{e}", parent=dialog)
+                return
+            dialog.destroy()
+            messagebox.showinfo("Успех", f"✅ Создано резервов: {len(created)}")
+
+        btn_frame = tk.Frame(dialog, bg='#ecf0f1')
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="✅ Зарезервировать всё", bg='#27ae60', fg='white',
+                  font=("Arial", 11, "bold"), width=20, command=commit,
+                  state=tk.NORMAL if plan else tk.DISABLED).pack(side=tk.LEFT, padx=8)
+        tk.Button(btn_frame, text="Закрыть", bg='#3498db', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=dialog.destroy).pack(side=tk.LEFT, padx=8)
+
     def clear_reservations_filters(self):
         """Сбросить все фильтры резервирования"""
         if hasattr(self, 'reservations_excel_filter'):
@@ -4001,6 +4735,10 @@ class ProductionApp:
             label="➕  Зарезервировать материал",
             command=self.add_reservation,
         )
+        context_menu.add_command(
+            label="🗂  Планировщик резервов",
+            command=self.plan_reservations,
+        )
 
         context_menu.add_separator()
 
@@ -4047,16 +4785,9 @@ class ProductionApp:
         if hasattr(self, 'reservations_excel_filter') and self.reservations_excel_filter.active_filters:
             active_filters_backup = self.reservations_excel_filter.active_filters.copy()
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.reservations_tree.get_children():
-            self.reservations_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'reservations_excel_filter'):
-            self.reservations_excel_filter._all_item_cache = set()
-
         reservations_df = load_data("Reservations")
         orders_df = load_data("Orders")
+        rows = []
 
         if not reservations_df.empty:
             show_fully_written_off = True
@@ -4098,16 +4829,14 @@ class ProductionApp:
                     row["Дата резерва"]
                 ]
 
-                item_id = self.reservations_tree.insert("", "end", values=values)
+                rows.append((row["ID резерва"], values, ()))
 
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'reservations_excel_filter'):
-                    if not hasattr(self.reservations_excel_filter, '_all_item_cache'):
-                        self.reservations_excel_filter._all_item_cache = set()
-                    self.reservations_excel_filter._all_item_cache.add(item_id)
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ
+        self.sync_tree_rows(self.reservations_tree, rows, getattr(self, 'reservations_excel_filter', None))
 
         # ✅ АВТОПОДБОР ШИРИНЫ КОЛОНОК (ДОЛЖЕН БЫТЬ ЗДЕСЬ!)
-        self.auto_resize_columns(self.reservations_tree, min_width=80, max_width=400)
+        self.auto_resize_columns(self.reservations_tree, min_width=80, max_width=400,
+                                 rows=[values for _, values, _ in rows])
 
         # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ ПОСЛЕ ЗАГРУЗКИ ДАННЫХ
         if active_filters_backup and hasattr(self, 'reservations_excel_filter'):
@@ -4361,44 +5090,17 @@ class ProductionApp:
                     material_id = -1
                 else:
                     material_id = int(material_value.split(" - ")[0])
-                    material_row = materials_df[materials_df["ID"] == material_id].iloc[0]
-                    marka = material_row["Марка"]
-                    thickness = material_row["Толщина"]
-                    length = material_row["Длина"]
-                    width = material_row["Ширина"]
-
-                reservations_df = load_data("Reservations")
-                new_id = 1 if reservations_df.empty else int(reservations_df["ID резерва"].max()) + 1
-
-                new_row = pd.DataFrame([{
-                    "ID резерва": new_id,
-                    "ID заказа": order_id,
-                    "ID детали": detail_id,
-                    "Название детали": detail_name,
-                    "ID материала": material_id,
-                    "Марка": marka,
-                    "Толщина": thickness,
-                    "Длина": length,
-                    "Ширина": width,
-                    "Зарезервировано штук": quantity,
-                    "Списано": 0,
-                    "Остаток к списанию": quantity,
-                    "Дата резерва": datetime.now().strftime("%Y-%m-%d")
-                }])
+                    marka = thickness = length = width = None
 
-                reservations_df = pd.concat([reservations_df, new_row], ignore_index=True)
-                save_data("Reservations", reservations_df)
+                new_id = engine.create_reservation(
+                    order_id, quantity, material_id=material_id, detail_id=detail_id, detail_name=detail_name,
+                    marka=marka, thickness=thickness, length=length, width=width
+                )
 
                 if material_id != -1:
-                    materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = int(
-                        material_row["Зарезервировано"]) + quantity
-                    materials_df.loc[materials_df["ID"] == material_id, "Доступно"] = int(
-                        material_row["Доступно"]) - quantity
-                    save_data("Materials", materials_df)
                     self.refresh_materials()
 
-                self.refresh_reservations()
-                self.refresh_balance()
+                self.request_refresh("refresh_reservations", "refresh_balance")
                 add_window.destroy()
 
                 detail_info = f"\nДеталь: {detail_name}" if detail_name != "Не указана" else ""
@@ -4419,28 +5121,19 @@ class ProductionApp:
             return
         count = len(selected)
         if messagebox.askyesno("Подтверждение",
-                               f"Удалить выбранные резервы ({count} шт)?\n\nМатериалы вернутся на склад!"):
-            reservations_df = load_data("Reservations")
-            materials_df = load_data("Materials")
-            for item in selected:
-                reserve_id = self.reservations_tree.item(item)["values"][0]
-                reserve_row = reservations_df[reservations_df["ID резерва"] == reserve_id].iloc[0]
-                material_id = reserve_row["ID материала"]
-                if material_id != -1:
-                    quantity_to_return = int(reserve_row["Остаток к списанию"])
-                    if not materials_df[materials_df["ID"] == material_id].empty:
-                        mat_row = materials_df[materials_df["ID"] == material_id].iloc[0]
-                        materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = int(
-                            mat_row["Зарезервировано"]) - quantity_to_return
-                        materials_df.loc[materials_df["ID"] == material_id, "Доступно"] = int(
-                            mat_row["Доступно"]) + quantity_to_return
-                reservations_df = reservations_df[reservations_df["ID резерва"] != reserve_id]
-            save_data("Reservations", reservations_df)
-            save_data("Materials", materials_df)
-            self.refresh_materials()
-            self.refresh_reservations()
-            self.refresh_balance()
-            messagebox.showinfo("Успех", f"Удалено резервов: {count}")
+                               f"Удалить выбранные резервы ({count} шт)?\n\n"
+                               f"Списания с этих резервов тоже удалятся.\n"
+                               f"Несписанный остаток вернётся на склад!"):
+            reserve_ids = [self.reservations_tree.item(item)["values"][0] for item in selected]
+            try:
+                with engine.undo_group(f"Удаление резервов ({count} шт)"):
+                    deleted = engine.delete_cascade(reserve_ids=reserve_ids)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось удалить резервы: {e}")
+                return
+            self.request_refresh("refresh_materials", "refresh_reservations", "refresh_writeoffs",
+                                 "refresh_balance")
+            messagebox.showinfo("Успех", self._cascade_summary("Удалено резервов", "Reservations", deleted))
 
     def edit_reservation(self):
         """Редактирование резервирования с возможностью изменения заказа и детали"""
@@ -4707,35 +5400,13 @@ class ProductionApp:
                 if not messagebox.askyesno("Подтверждение изменений", changes_msg):
                     return
 
-                # Обновляем резерв
-                new_remainder = new_qty - written_off
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "ID заказа"] = new_order_id
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "ID детали"] = new_detail_id
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Название детали"] = new_detail_name
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Зарезервировано штук"] = new_qty
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-                save_data("Reservations", reservations_df)
-
-                # Обновляем материал на складе (если количество изменилось и не вручную добавленный)
+                # Обновляем резерв и материал на складе
+                result = engine.update_reservation(reserve_id, new_order_id, new_detail_id, new_detail_name, new_qty)
+                new_remainder = result["new_remainder"]
                 if qty_changed:
-                    material_id = int(reserve_row["ID материала"])
-                    if material_id != -1:
-                        materials_df = load_data("Materials")
-                        if not materials_df[materials_df["ID"] == material_id].empty:
-                            mat_row = materials_df[materials_df["ID"] == material_id].iloc[0]
-                            current_reserved = int(mat_row["Зарезервировано"])
-                            current_available = int(mat_row["Доступно"])
-
-                            new_reserved = current_reserved + qty_difference
-                            new_available = current_available - qty_difference
-
-                            materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-                            materials_df.loc[materials_df["ID"] == material_id, "Доступно"] = new_available
-                            save_data("Materials", materials_df)
-                            self.refresh_materials()
-
-                self.refresh_reservations()
-                self.refresh_balance()
+                    self.refresh_materials()
+
+                self.request_refresh("refresh_reservations", "refresh_balance")
                 edit_window.destroy()
 
                 result_msg = f"✅ Резерв #{reserve_id} обновлен!\n\n"
@@ -5005,7 +5676,7 @@ class ProductionApp:
         scroll_y = tk.Scrollbar(tree_frame, orient=tk.VERTICAL)
         scroll_x = tk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
 
-        self.writeoffs_tree = ttk.Treeview(tree_frame,
+        self.writeoffs_tree = VirtualTreeview(tree_frame,
                                            columns=("ID", "ID резерва", "Заказ", "Деталь", "Материал", "Марка",
                                                     "Толщина", "Размер", "Количество", "Дата", "Комментарий"),
                                            show="headings", yscrollcommand=scroll_y.set, xscrollcommand=scroll_x.set)
@@ -5065,17 +5736,10 @@ class ProductionApp:
         if hasattr(self, 'writeoffs_excel_filter') and self.writeoffs_excel_filter.active_filters:
             active_filters_backup = self.writeoffs_excel_filter.active_filters.copy()
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.writeoffs_tree.get_children():
-            self.writeoffs_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'writeoffs_excel_filter'):
-            self.writeoffs_excel_filter._all_item_cache = set()
-
         writeoffs_df = load_data("WriteOffs")
         orders_df = load_data("Orders")
         reservations_df = load_data("Reservations")
+        rows = []
 
         if not writeoffs_df.empty:
             for index, row in writeoffs_df.iterrows():
@@ -5120,14 +5784,12 @@ class ProductionApp:
                     row["Комментарий"]
                 ]
 
-                item_id = self.writeoffs_tree.insert("", "end", values=values)
+                rows.append((row["ID списания"], values, ()))
 
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'writeoffs_excel_filter'):
-                    if not hasattr(self.writeoffs_excel_filter, '_all_item_cache'):
-                        self.writeoffs_excel_filter._all_item_cache = set()
-                    self.writeoffs_excel_filter._all_item_cache.add(item_id)
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ
+        self.sync_tree_rows(self.writeoffs_tree, rows, getattr(self, 'writeoffs_excel_filter', None))
 
+        if not writeoffs_df.empty:
             # АВТОПОДБОР ШИРИНЫ КОЛОНОК (как в других вкладках)
             self.auto_resize_columns(self.writeoffs_tree, min_width=80, max_width=300)
 
@@ -5357,66 +6019,13 @@ class ProductionApp:
                     messagebox.showerror("Ошибка", f"Нельзя списать больше чем осталось!\nОсталось: {remainder} шт")
                     return
 
-                # Добавляем списание
-                writeoffs_df = load_data("WriteOffs")
-                new_id = 1 if writeoffs_df.empty else int(writeoffs_df["ID списания"].max()) + 1
-
-                new_row = pd.DataFrame([{
-                    "ID списания": new_id,
-                    "ID резерва": reserve_id,
-                    "ID заказа": reservation["ID заказа"],
-                    "ID материала": reservation["ID материала"],
-                    "Марка": reservation["Марка"],
-                    "Толщина": reservation["Толщина"],
-                    "Длина": reservation["Длина"],
-                    "Ширина": reservation["Ширина"],
-                    "Количество": quantity,
-                    "Дата списания": datetime.now().strftime("%Y-%m-%d"),
-                    "Комментарий": comment
-                }])
-
-                writeoffs_df = pd.concat([writeoffs_df, new_row], ignore_index=True)
-                save_data("WriteOffs", writeoffs_df)
-
-                # Обновляем резервирование
-                reservations_df = load_data("Reservations")
-                reservation = reservations_df[reservations_df["ID резерва"] == reserve_id].iloc[0]
-
-                new_written_off = int(reservation["Списано"]) + quantity
-                new_remainder = int(reservation["Зарезервировано штук"]) - new_written_off
-
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Списано"] = new_written_off
-                reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-                save_data("Reservations", reservations_df)
-
-                # Обновляем материал (ИСПРАВЛЕНО: уменьшаем И наличие И резерв)
-                material_id = int(reservation["ID материала"])
-                if material_id != -1:
-                    materials_df = load_data("Materials")
-                    material = materials_df[materials_df["ID"] == material_id].iloc[0]
-
-                    # Уменьшаем количество в наличии
-                    new_qty = int(material["Количество штук"]) - quantity
-
-                    # Уменьшаем зарезервировано
-                    new_reserved = int(material["Зарезервировано"]) - quantity
-
-                    # Доступно НЕ меняется (т.к. было уже зарезервировано)
-
-                    materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_qty
-                    materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-
-                    # Пересчитываем площадь
-                    area_per_piece = float(material["Длина"]) * float(material["Ширина"]) / 1_000_000
-                    new_area = new_qty * area_per_piece
-                    materials_df.loc[materials_df["ID"] == material_id, "Общая площадь"] = round(new_area, 2)
-
-                    save_data("Materials", materials_df)
+                # Списание, обновление резерва и материала на складе
+                with engine.undo_group(f"Списание с резерва #{reserve_id}"):
+                    new_id = engine.create_writeoff(reserve_id, quantity, comment)
+                if int(reservation["ID материала"]) != -1:
                     self.refresh_materials()
 
-                self.refresh_reservations()
-                self.refresh_writeoffs()
-                self.refresh_balance()
+                self.request_refresh("refresh_reservations", "refresh_writeoffs", "refresh_balance")
                 add_window.destroy()
                 messagebox.showinfo("Успех", f"✅ Списание #{new_id} успешно создано!\nСписано: {quantity} шт")
 
@@ -5442,7 +6051,6 @@ class ProductionApp:
             values = self.writeoffs_tree.item(selected[0])['values']
             writeoff_id = int(values[0])
             reserve_id = int(values[1])
-            comment = values[9] if len(values) > 9 else ""
 
             info_msg = (
                 f"Отменить списание?\n\n"
@@ -5457,249 +6065,38 @@ class ProductionApp:
             if not messagebox.askyesno("Подтверждение", info_msg):
                 return
 
-            writeoffs_df = load_data("WriteOffs")
-            reservations_df = load_data("Reservations")
-            materials_df = load_data("Materials")
-            order_details_df = load_data("OrderDetails")
-
-            writeoff_row = writeoffs_df[writeoffs_df["ID списания"] == writeoff_id]
-
-            if writeoff_row.empty:
-                messagebox.showerror("Ошибка", f"Списание ID={writeoff_id} не найдено!")
-                return
-
-            writeoff_row = writeoff_row.iloc[0]
-
-            reserve_id = int(writeoff_row["ID резерва"])
-            quantity = int(writeoff_row["Количество"])
-            material_id = int(writeoff_row["ID материала"])
-            writeoff_date = str(writeoff_row["Дата списания"])
-            writeoff_comment = str(writeoff_row["Комментарий"])
-
-            # ОБНОВЛЕНИЕ РЕЗЕРВА
-            reserve_row = reservations_df[reservations_df["ID резерва"] == reserve_id]
-
-            if reserve_row.empty:
-                messagebox.showerror("Ошибка", f"Резерв ID={reserve_id} не найден!")
+            try:
+                with engine.undo_group(f"Удаление списания #{writeoff_id}",
+                                       laser_rows=getattr(self, 'laser_table_data', None)):
+                    result = engine.reverse_writeoff(writeoff_id, getattr(self, 'laser_table_data', None))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
                 return
 
-            reserve_row = reserve_row.iloc[0]
-            old_written_off = int(reserve_row["Списано"])
-            old_remainder = int(reserve_row["Остаток к списанию"])
-
-            new_written_off = old_written_off - quantity
-            new_remainder = old_remainder + quantity
-
-            reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Списано"] = new_written_off
-            reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-
-            # ОБНОВЛЕНИЕ МАТЕРИАЛА
-            if material_id != -1:
-                material = materials_df[materials_df["ID"] == material_id]
-
-                if not material.empty:
-                    material = material.iloc[0]
-
-                    old_qty = int(material["Количество штук"])
-                    old_reserved = int(material["Зарезервировано"])
-
-                    new_qty = old_qty + quantity
-                    new_reserved = old_reserved + quantity
-
-                    materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_qty
-                    materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-
-                    area_per_piece = float(material["Длина"]) * float(material["Ширина"]) / 1_000_000
-                    new_area = new_qty * area_per_piece
-                    materials_df.loc[materials_df["ID"] == material_id, "Общая площадь"] = round(new_area, 2)
-
-            # ОБНОВЛЕНИЕ ТАБЛИЦЫ ИМПОРТА
-            is_laser_import = "Лазер:" in writeoff_comment or "лазерщик" in writeoff_comment.lower()
-
-            if is_laser_import and hasattr(self, 'laser_table_data') and self.laser_table_data:
-                import re
-
-                part_name = None
-                parts_qty = None
-
-                part_match = re.search(r'Деталь:\s*([^|]+)', writeoff_comment)
-                if part_match:
-                    part_name = part_match.group(1).strip()
-
-                date_match = re.search(r'Дата импорта:\s*(.+)', writeoff_comment)
-                import_date_str = date_match.group(1).strip() if date_match else None
-
-                for idx, row_data in enumerate(self.laser_table_data):
-                    row_part = str(row_data.get("part", ""))
-
-                    if part_name and (part_name.lower() in row_part.lower() or row_part.lower() in part_name.lower()):
-                        row_date = str(row_data.get("Дата (МСК)", ""))
-                        row_time = str(row_data.get("Время (МСК)", ""))
-                        row_datetime = f"{row_date} {row_time}"
-
-                        date_match_found = False
-                        if import_date_str and len(row_datetime) >= 16 and len(import_date_str) >= 16:
-                            if row_datetime[:16] == import_date_str[:16]:
-                                date_match_found = True
-                        elif not import_date_str:
-                            row_writeoff_date = row_data.get("Дата списания", "")
-
-                            # Безопасное преобразование
-                            if pd.isna(row_writeoff_date) or row_writeoff_date is None:
-                                row_writeoff_date = ""
-                            else:
-                                row_writeoff_date = str(row_writeoff_date)
-
-                            if len(row_writeoff_date) >= 16 and len(writeoff_date) >= 16:
-                                if row_writeoff_date[:16] == writeoff_date[:16]:
-                                    date_match_found = True
-
-                        if date_match_found:
-                            try:
-                                parts_qty = int(row_data.get("part_quantity", 0))
-                                self.laser_table_data[idx]["Списано"] = ""
-                                self.laser_table_data[idx]["Дата списания"] = ""
-                            except:
-                                pass
-                            break
-
-                if hasattr(self, 'laser_import_tree'):
-                    self.refresh_laser_import_table()
-                    try:
-                        self.save_laser_import_cache()
-                    except:
-                        pass
-
-            # ОТКАТ ДЕТАЛЕЙ
-            if is_laser_import and "Деталь:" in writeoff_comment and parts_qty:
+            if result["laser_row_unmarked"] and hasattr(self, 'laser_import_tree'):
+                self.refresh_laser_import_table()
                 try:
-                    import re
-                    part_match = re.search(r'Деталь:\s*([^|]+)', writeoff_comment)
-
-                    if part_match and parts_qty > 0:
-                        part_name = part_match.group(1).strip()
-                        order_id = int(writeoff_row["ID заказа"])
-
-                        detail_match = order_details_df[
-                            (order_details_df["ID заказа"] == order_id) &
-                            (order_details_df["Название детали"].str.contains(part_name, case=False, na=False))
-                            ]
-
-                        if not detail_match.empty:
-                            detail_id = int(detail_match.iloc[0]["ID"])
-                            old_cut = int(detail_match.iloc[0].get("Порезано", 0))
-                            new_cut = max(0, old_cut - parts_qty)
-                            order_details_df.loc[order_details_df["ID"] == detail_id, "Порезано"] = new_cut
-                            save_data("OrderDetails", order_details_df)
+                    self.save_laser_import_cache()
                 except:
                     pass
 
-            # УДАЛЕНИЕ СПИСАНИЯ
-            writeoffs_df = writeoffs_df[writeoffs_df["ID списания"] != writeoff_id]
-
-            # СОХРАНЕНИЕ
-            save_data("WriteOffs", writeoffs_df)
-            save_data("Reservations", reservations_df)
-            save_data("Materials", materials_df)
-
             # ОБНОВЛЕНИЕ ИНТЕРФЕЙСА
-            self.refresh_writeoffs()
-            self.refresh_reservations()
-            self.refresh_materials()
-            self.refresh_balance()
+            self.request_refresh("refresh_writeoffs", "refresh_reservations", "refresh_materials",
+                                 "refresh_balance")
 
-            if hasattr(self, 'refresh_orders'):
-                self.refresh_orders()
-            if hasattr(self, 'refresh_order_details'):
-                self.refresh_order_details()
+            self.request_refresh("refresh_orders", "refresh_order_details")
 
             messagebox.showinfo("Успех",
                                 f"✅ Списание отменено!\n\n"
-                                f"Возвращено в резерв: {quantity} шт\n"
-                                f"Резерв ID: {reserve_id}\n"
-                                f"Остаток к списанию: {new_remainder} шт")
+                                f"Возвращено в резерв: {result['quantity']} шт\n"
+                                f"Резерв ID: {result['reserve_id']}\n"
+                                f"Остаток к списанию: {result['new_remainder']} шт")
 
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось отменить списание:\n{e}")
             import traceback
             traceback.print_exc()
 
-    def find_laser_import_row_by_writeoff(self, writeoff_data):
-        """
-        Поиск строки в таблице импорта по данным списания
-
-        Args:
-            writeoff_data: dict с ключами 'Дата списания', 'Комментарий', 'Количество'
-
-        Returns:
-            list: индексы найденных строк в laser_table_data
-        """
-        if not hasattr(self, 'laser_table_data') or not self.laser_table_data:
-            return []
-
-        writeoff_date = writeoff_data.get('Дата списания', '')
-        writeoff_comment = writeoff_data.get('Комментарий', '')
-        writeoff_qty = writeoff_data.get('Количество', 0)
-
-        # Извлекаем информацию из комментария
-        # Формат: "Лазер: @username | Деталь: название_детали"
-        import re
-        username_match = re.search(r'Лазер:\s*(@?\w+)', writeoff_comment)
-        part_match = re.search(r'Деталь:\s*(.+?)(?:\||$)', writeoff_comment)
-
-        username = username_match.group(1) if username_match else None
-        part_name = part_match.group(1).strip() if part_match else None
-
-        print(f"   🔍 Критерии поиска:")
-        print(f"      Дата: {writeoff_date}")
-        print(f"      Пользователь: {username}")
-        print(f"      Деталь: {part_name}")
-        print(f"      Количество: {writeoff_qty}")
-
-        matching_indices = []
-
-        for idx, row_data in enumerate(self.laser_table_data):
-            # Проверяем только списанные строки
-            if row_data.get("Списано") not in ["✓", "Да", "Yes"]:
-                continue
-
-            match_score = 0
-
-            # Сопоставление по дате списания (приоритет 3)
-            row_writeoff_date = row_data.get("Дата списания", "")
-            if row_writeoff_date and writeoff_date:
-                # Сравниваем первые 16 символов (дата + время без секунд)
-                if row_writeoff_date[:16] == writeoff_date[:16]:
-                    match_score += 3
-
-            # Сопоставление по пользователю (приоритет 2)
-            if username:
-                row_username = row_data.get("username", "")
-                if username.lower() in row_username.lower() or row_username.lower() in username.lower():
-                    match_score += 2
-
-            # Сопоставление по детали (приоритет 2)
-            if part_name:
-                row_part = row_data.get("part", "")
-                if part_name.lower() in row_part.lower() or row_part.lower() in part_name.lower():
-                    match_score += 2
-
-            # Сопоставление по количеству (приоритет 1)
-            try:
-                row_qty = int(row_data.get("metal_quantity", 0))
-                if row_qty == writeoff_qty:
-                    match_score += 1
-            except:
-                pass
-
-            # Если набрали достаточно совпадений (минимум 3 балла)
-            if match_score >= 3:
-                matching_indices.append((idx, match_score))
-                print(f"      ✓ Строка #{idx + 1}: score={match_score}")
-
-        # Сортируем по убыванию score и возвращаем индексы
-        matching_indices.sort(key=lambda x: x[1], reverse=True)
-        return [idx for idx, score in matching_indices]
     def edit_writeoff(self):
         """Редактирование списания"""
         selected = self.writeoffs_tree.selection()
@@ -5849,54 +6246,10 @@ class ProductionApp:
                 if not messagebox.askyesno("Подтверждение", msg):
                     return
 
-                # Обновляем списание
-                writeoffs_df.loc[writeoffs_df["ID списания"] == writeoff_id, "Количество"] = new_qty
-                writeoffs_df.loc[writeoffs_df["ID списания"] == writeoff_id, "Комментарий"] = new_comment
-                save_data("WriteOffs", writeoffs_df)
+                # Обновляем списание, резерв и материал (разница проводится через журнал склада)
+                engine.update_writeoff(writeoff_id, new_qty, new_comment)
 
-                # Если количество изменилось - обновляем резерв и материал
-                if difference != 0:
-                    # Обновляем резерв
-                    if not reservations_df.empty and not reserve_row.empty:
-                        reserve_data = reserve_row.iloc[0]
-                        current_written = int(reserve_data["Списано"])
-                        current_remainder = int(reserve_data["Остаток к списанию"])
-
-                        new_written = current_written + difference
-                        new_remainder = current_remainder - difference
-
-                        reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Списано"] = new_written
-                        reservations_df.loc[
-                            reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-                        save_data("Reservations", reservations_df)
-
-                    # Обновляем материал (если не вручную добавленный)
-                    material_id = int(writeoff_row["ID материала"])
-                    if material_id != -1:
-                        materials_df = load_data("Materials")
-                        if not materials_df[materials_df["ID"] == material_id].empty:
-                            mat_row = materials_df[materials_df["ID"] == material_id].iloc[0]
-                            current_qty = int(mat_row["Количество штук"])
-                            current_reserved = int(mat_row["Зарезервировано"])
-
-                            # Разница списания влияет на количество и резерв
-                            new_mat_qty = current_qty - difference
-                            new_reserved = current_reserved - difference
-
-                            materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_mat_qty
-                            materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-
-                            # Пересчитываем площадь
-                            area_per_piece = float(mat_row["Длина"]) * float(mat_row["Ширина"]) / 1_000_000
-                            new_area = new_mat_qty * area_per_piece
-                            materials_df.loc[materials_df["ID"] == material_id, "Общая площадь"] = round(new_area, 2)
-
-                            save_data("Materials", materials_df)
-                            self.refresh_materials()
-
-                self.refresh_reservations()
-                self.refresh_writeoffs()
-                self.refresh_balance()
+                self.request_refresh("refresh_reservations", "refresh_writeoffs", "refresh_balance")
                 edit_window.destroy()
                 messagebox.showinfo("Успех", f"Списание #{writeoff_id} обновлено!")
 
@@ -5950,6 +6303,9 @@ class ProductionApp:
         tk.Button(buttons_frame, text="📁 Импорт файла", bg='#3498db', fg='white',
                   command=self.import_laser_table, **btn_style).pack(side=tk.LEFT, padx=5)
 
+        tk.Button(buttons_frame, text="✅ Списать все", bg='#27ae60', fg='white',
+                  command=self.writeoff_all_laser_rows, **btn_style).pack(side=tk.LEFT, padx=5)
+
         tk.Button(buttons_frame, text="✖ Сбросить фильтры", bg='#e67e22', fg='white',
                   command=self.clear_laser_import_filters, **btn_style).pack(side=tk.LEFT, padx=5)
 
@@ -5968,7 +6324,7 @@ class ProductionApp:
         scroll_x = tk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
 
         # 🆕 СОЗДАНИЕ TREEVIEW С ЯВНЫМИ ПАРАМЕТРАМИ
-        self.laser_import_tree = ttk.Treeview(
+        self.laser_import_tree = VirtualTreeview(
             tree_frame,
             columns=("Дата", "Время", "Пользователь", "Заказ", "Металл", "Кол-во", "Деталь", "Кол-во деталей",
                      "Списано", "Дата списания"),
@@ -6209,19 +6565,15 @@ class ProductionApp:
         if hasattr(self, 'details_excel_filter') and self.details_excel_filter.active_filters:
             active_filters_backup = self.details_excel_filter.active_filters.copy()
 
-        # Очищаем таблицу
-        for item in self.details_tree.get_children():
-            self.details_tree.delete(item)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'details_excel_filter'):
-            self.details_excel_filter._all_item_cache = set()
+        details_filter = getattr(self, 'details_excel_filter', None)
+        rows = []
 
         # Загружаем данные
         orders_df = load_data("Orders")
         order_details_df = load_data("OrderDetails")
 
         if orders_df.empty or order_details_df.empty:
+            self.sync_tree_rows(self.details_tree, rows, details_filter)
             if hasattr(self, 'details_status_label'):
                 self.details_status_label.config(
                     text="⚠️ Нет данных о деталях",
@@ -6247,6 +6599,7 @@ class ProductionApp:
         active_orders = orders_df[orders_df["Статус"] == "В работе"]
 
         if active_orders.empty:
+            self.sync_tree_rows(self.details_tree, rows, details_filter)
             if hasattr(self, 'details_status_label'):
                 self.details_status_label.config(
                     text="ℹ️ Нет заказов в работе",
@@ -6320,17 +6673,15 @@ class ProductionApp:
                 else:
                     tag = status
 
-                item_id = self.details_tree.insert("", "end", values=values, tags=(tag,))
+                rows.append((detail_id, values, (tag,)))
                 shown_count += 1
 
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'details_excel_filter'):
-                    if not hasattr(self.details_excel_filter, '_all_item_cache'):
-                        self.details_excel_filter._all_item_cache = set()
-                    self.details_excel_filter._all_item_cache.add(item_id)
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ
+        self.sync_tree_rows(self.details_tree, rows, details_filter)
 
         # АВТОПОДБОР ШИРИНЫ КОЛОНОК
-        self.auto_resize_columns(self.details_tree, min_width=80, max_width=300)
+        self.auto_resize_columns(self.details_tree, min_width=80, max_width=300,
+                                 rows=[values for _, values, _ in rows])
 
         # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ
         if active_filters_backup and hasattr(self, 'details_excel_filter'):
@@ -6352,210 +6703,25 @@ class ProductionApp:
                 fg='#155724'
             )
 
-        def safe_int(value, default=0):
-            if value == "" or pd.isna(value) or value is None:
-                return default
-            try:
-                return int(value)
-            except (ValueError, TypeError):
-                return default
+    def edit_detail_inline(self, event):
+        """Редактирование Порезано/Погнуто прямо в таблице учёта деталей"""
+        try:
+            # Определяем колонку и строку
+            region = self.details_tree.identify("region", event.x, event.y)
+            if region != "cell":
+                return
 
-        for item in self.details_tree.get_children():
-            self.details_tree.delete(item)
+            column = self.details_tree.identify_column(event.x)
+            if not column:
+                return
 
-        order_details_df = load_data("OrderDetails")
-        orders_df = load_data("Orders")
+            # Преобразуем #5, #6 в индексы
+            column_index = int(column.replace('#', '')) - 1
 
-        if order_details_df.empty:
-            return
-
-        # 🆕 ОЧИСТКА ПУСТЫХ ЗНАЧЕНИЙ
-        order_details_df["Количество"] = order_details_df["Количество"].replace("", 0)
-        order_details_df["Порезано"] = order_details_df["Порезано"].replace("", 0)
-        order_details_df["Погнуто"] = order_details_df["Погнуто"].replace("", 0)
-
-        # Сохраняем очищенные данные
-        save_data("OrderDetails", order_details_df)
-
-        """Обновление таблицы учёта деталей"""
-
-        # Очищаем таблицу
-        for item in self.details_tree.get_children():
-            self.details_tree.delete(item)
-
-        # Загружаем данные
-        orders_df = load_data("Orders")
-        order_details_df = load_data("OrderDetails")
-
-        if orders_df.empty or order_details_df.empty:
-            if hasattr(self, 'details_status_label'):
-                self.details_status_label.config(
-                    text="⚠️ Нет данных о деталях",
-                    bg='#fff3cd',
-                    fg='#856404'
-                )
-            return
-
-        # Читаем переключатели
-        show_completed = self.details_toggles['show_completed'].get()
-        show_in_progress = self.details_toggles['show_in_progress'].get()
-        show_not_started = self.details_toggles['show_not_started'].get()
-
-        # Фильтруем заказы со статусом "В работе"
-        active_orders = orders_df[orders_df["Статус"] == "В работе"]
-
-        if active_orders.empty:
-            if hasattr(self, 'details_status_label'):
-                self.details_status_label.config(
-                    text="ℹ️ Нет заказов в работе",
-                    bg='#d1ecf1',
-                    fg='#0c5460'
-                )
-            return
-
-        # Счётчики
-        total_count = 0
-        shown_count = 0
-        completed_count = 0
-        in_progress_count = 0
-        not_started_count = 0
-
-        # Получаем активные фильтры
-        active_filters = {}
-        if hasattr(self, 'details_filters') and self.details_filters:
-            for col_name, filter_var in self.details_filters.items():
-                filter_text = filter_var.get().strip().lower()
-                if filter_text:
-                    active_filters[col_name] = filter_text
-
-        # Проходим по всем деталям активных заказов
-        for _, order_row in active_orders.iterrows():
-            order_id = int(order_row["ID заказа"])
-            order_name = order_row["Название заказа"]
-            customer_name = order_row["Заказчик"]
-
-            # Получаем детали этого заказа
-            order_details = order_details_df[order_details_df["ID заказа"] == order_id]
-
-            for _, detail_row in order_details.iterrows():
-                detail_id = int(detail_row["ID"])
-                detail_name = detail_row["Название детали"]
-                quantity = int(detail_row["Количество"])
-                cut = int(detail_row.get("Порезано", 0))
-                bent = int(detail_row.get("Погнуто", 0))
-
-                # Рассчитываем остаток и прогресс
-                remaining = quantity - cut
-                progress_pct = round((cut / quantity * 100), 1) if quantity > 0 else 0
-
-                total_count += 1
-
-                # Определяем статус
-                if cut >= quantity:
-                    status = 'completed'
-                    completed_count += 1
-                    if not show_completed:
-                        continue
-                elif cut > 0:
-                    status = 'in_progress'
-                    in_progress_count += 1
-                    if not show_in_progress:
-                        continue
-                else:
-                    status = 'not_started'
-                    not_started_count += 1
-                    if not show_not_started:
-                        continue
-
-                # Формируем значения
-                values = (
-                    detail_id,
-                    customer_name,
-                    detail_name,
-                    order_name,
-                    quantity,
-                    cut,
-                    bent,
-                    remaining,
-                    f"{progress_pct}%"
-                )
-
-                # Применяем фильтры
-                if active_filters:
-                    skip_row = False
-
-                    if "Заказчик" in active_filters:
-                        if active_filters["Заказчик"] not in customer_name.lower():
-                            skip_row = True
-
-                    if "Название детали" in active_filters:
-                        if active_filters["Название детали"] not in detail_name.lower():
-                            skip_row = True
-
-                    if "Заказ" in active_filters:
-                        if active_filters["Заказ"] not in order_name.lower():
-                            skip_row = True
-
-                    if skip_row:
-                        continue
-
-                # Цветовая индикация с учётом перепорезки
-                if cut > quantity:
-                    tag = 'over_cut'  # Порезано больше чем нужно
-                else:
-                    tag = status
-
-                item_id = self.details_tree.insert("", "end", values=values, tags=(tag,))
-                shown_count += 1
-
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'details_excel_filter'):
-                    if not hasattr(self.details_excel_filter, '_all_item_cache'):
-                        self.details_excel_filter._all_item_cache = set()
-                    self.details_excel_filter._all_item_cache.add(item_id)
-
-        # АВТОПОДБОР ШИРИНЫ КОЛОНОК
-        self.auto_resize_columns(self.details_tree, min_width=80, max_width=300)
-
-        # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ
-        if active_filters_backup and hasattr(self, 'details_excel_filter'):
-            self.details_excel_filter.active_filters = active_filters_backup
-            self.details_excel_filter.reapply_all_filters()
-
-        # Обновляем статусную строку
-        if hasattr(self, 'details_status_label'):
-            status_text = (
-                f"📊 Отображено: {shown_count} из {total_count} | "
-                f"🟢 Завершено: {completed_count} | "
-                f"🟡 В процессе: {in_progress_count} | "
-                f"⚪ Не начато: {not_started_count}"
-            )
-
-            self.details_status_label.config(
-                text=status_text,
-                bg='#d4edda',
-                fg='#155724'
-            )
-
-    def edit_detail_inline(self, event):
-        """Редактирование Порезано/Погнуто прямо в таблице учёта деталей"""
-        try:
-            # Определяем колонку и строку
-            region = self.details_tree.identify("region", event.x, event.y)
-            if region != "cell":
-                return
-
-            column = self.details_tree.identify_column(event.x)
-            if not column:
-                return
-
-            # Преобразуем #5, #6 в индексы
-            column_index = int(column.replace('#', '')) - 1
-
-            # Проверяем что это колонки "Порезано" (индекс 5) или "Погнуто" (индекс 6)
-            columns = self.details_tree['columns']
-            if column_index < 0 or column_index >= len(columns):
-                return
+            # Проверяем что это колонки "Порезано" (индекс 5) или "Погнуто" (индекс 6)
+            columns = self.details_tree['columns']
+            if column_index < 0 or column_index >= len(columns):
+                return
 
             column_name = columns[column_index]
 
@@ -6656,9 +6822,6 @@ class ProductionApp:
                                 edit_entry.destroy()
                                 return
 
-                        # Сохраняем
-                        order_details_df.loc[order_details_df["ID"] == detail_id, "Порезано"] = new_cut
-
                     elif column_name == "Погнуто":
                         new_cut = actual_cut
                         new_bent = new_value
@@ -6672,11 +6835,9 @@ class ProductionApp:
                                 edit_entry.destroy()
                                 return
 
-                        # Сохраняем
-                        order_details_df.loc[order_details_df["ID"] == detail_id, "Погнуто"] = new_bent
-
-                    # Сохраняем изменения
-                    save_data("OrderDetails", order_details_df)
+                    # Сохраняем событием журнала деталей
+                    engine.set_detail_progress(detail_id, cut=new_cut, bent=new_bent,
+                                               comment=f"Правка в таблице: {column_name}")
 
                     # Обновляем таблицу
                     self.refresh_details()
@@ -6784,16 +6945,11 @@ class ProductionApp:
                                                    f"Продолжить?"):
                             return
 
-                    # Загружаем и обновляем
-                    order_details_df = load_data("OrderDetails")
-                    order_details_df.loc[order_details_df["ID"] == detail_id, "Порезано"] = new_cut
-                    order_details_df.loc[order_details_df["ID"] == detail_id, "Погнуто"] = new_bent
-                    save_data("OrderDetails", order_details_df)
+                    engine.set_detail_progress(detail_id, cut=new_cut, bent=new_bent,
+                                               comment="Редактирование в учёте деталей")
 
                     # Обновляем таблицу
-                    self.refresh_details()
-                    if hasattr(self, 'refresh_order_details'):
-                        self.refresh_order_details()
+                    self.request_refresh("refresh_details", "refresh_order_details")
 
                     edit_window.destroy()
                     messagebox.showinfo("Успех", "Деталь обновлена!")
@@ -6809,6 +6965,117 @@ class ProductionApp:
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось открыть окно редактирования: {e}")
 
+    # ==================== ПАКЕТНАЯ ПРАВКА ПОРЕЗАНО/ПОГНУТО ====================
+
+    def _selected_details_rows(self):
+        """Выбранные строки учёта деталей в порядке таблицы: (item, ID, количество, порезано, погнуто)"""
+        selected = set(self.details_tree.selection())
+        rows = []
+        for item in self.details_tree.get_children():
+            if item not in selected:
+                continue
+            values = self.details_tree.item(item, 'values')
+            rows.append((item, int(values[0]), int(values[4]), int(values[5]), int(values[6])))
+        return rows
+
+    def _apply_details_bulk_edit(self, new_values, comment):
+        """
+        Записать новые Порезано/Погнуто выбранных деталей одним сохранением.
+        Таблицу обновит refresh_details по событию сохранения — меняются только изменённые строки.
+
+        Args:
+            new_values: {item: (ID детали, порезано, погнуто)}
+        """
+        updates = {detail_id: {engine.DETAIL_CUT: cut, engine.DETAIL_BEND: bent}
+                   for detail_id, cut, bent in new_values.values()}
+        try:
+            engine.set_details_progress(updates, comment=comment)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось обновить детали:\n{e}")
+            return
+
+        self.show_status_tooltip(f"✅ Обновлено деталей: {len(new_values)}")
+
+    def bulk_set_cut_to_quantity(self):
+        """Порезано = Количество для всех выбранных деталей"""
+        rows = self._selected_details_rows()
+        if not rows:
+            messagebox.showwarning("Предупреждение", "Выберите детали!")
+            return
+        new_values = {item: (detail_id, quantity, bent)
+                      for item, detail_id, quantity, cut, bent in rows if cut != quantity}
+        if not new_values:
+            messagebox.showinfo("Информация", "У выбранных деталей порезано уже равно количеству")
+            return
+        if not messagebox.askyesno("Подтверждение",
+                                   f"Отметить полностью порезанными {len(new_values)} дет.?"):
+            return
+        self._apply_details_bulk_edit(new_values, "Пакетная правка: порезано = количество")
+
+    def bulk_add_bent(self):
+        """Прибавить N к Погнуто у всех выбранных деталей"""
+        rows = self._selected_details_rows()
+        if not rows:
+            messagebox.showwarning("Предупреждение", "Выберите детали!")
+            return
+        amount = simpledialog.askinteger("Добавить к погнутому",
+                                         f"Сколько добавить к «Погнуто» ({len(rows)} дет.)?\n"
+                                         f"Отрицательное число — уменьшить.",
+                                         parent=self.root)
+        if not amount:
+            return
+        over = [detail_id for _, detail_id, _, cut, bent in rows if bent + amount > cut]
+        if any(bent + amount < 0 for *_, bent in rows):
+            messagebox.showerror("Ошибка", "Погнуто не может стать отрицательным!")
+            return
+        if over and not messagebox.askyesno("Предупреждение",
+                                            f"У {len(over)} дет. погнуто станет больше порезанного.\n\n"
+                                            f"Продолжить?"):
+            return
+        new_values = {item: (detail_id, cut, bent + amount) for item, detail_id, _, cut, bent in rows}
+        self._apply_details_bulk_edit(new_values, f"Пакетная правка: погнуто {amount:+d}")
+
+    def bulk_paste_details_column(self, column_name):
+        """
+        Вставить колонку значений из буфера обмена (например, из Excel) в "Порезано" или "Погнуто"
+        выбранных деталей по порядку строк; одно значение вставляется во все выбранные строки.
+        """
+        rows = self._selected_details_rows()
+        if not rows:
+            messagebox.showwarning("Предупреждение", "Выберите детали!")
+            return
+        try:
+            text = self.root.clipboard_get()
+        except tk.TclError:
+            messagebox.showwarning("Предупреждение", "Буфер обмена пуст")
+            return
+
+        lines = [line.split("\t")[0].strip() for line in text.strip().splitlines()]
+        try:
+            pasted = [int(float(line.replace(",", "."))) if line else 0 for line in lines]
+        except ValueError:
+            messagebox.showerror("Ошибка", "В буфере обмена должны быть только числа (по одному в строке)")
+            return
+        if len(pasted) == 1:
+            pasted = pasted * len(rows)
+        if len(pasted) != len(rows):
+            messagebox.showerror("Ошибка",
+                                 f"В буфере {len(pasted)} значений, выбрано строк: {len(rows)}.\n"
+                                 f"Количество должно совпадать.")
+            return
+        if any(value < 0 for value in pasted):
+            messagebox.showerror("Ошибка", "Значения не могут быть отрицательными!")
+            return
+
+        if column_name == "Порезано":
+            new_values = {item: (detail_id, value, bent) for (item, detail_id, _, _, bent), value in zip(rows, pasted)}
+        else:
+            new_values = {item: (detail_id, cut, value) for (item, detail_id, _, cut, _), value in zip(rows, pasted)}
+        if not messagebox.askyesno("Подтверждение",
+                                   f"Вставить {len(pasted)} значений в «{column_name}»?"):
+            return
+        self._apply_details_bulk_edit(new_values, f"Вставка из буфера: {column_name}")
+
     def on_details_right_click(self, event):
         """Обработчик правого клика на таблице учёта де��алей"""
         # Определяем регион клика
@@ -6858,6 +7125,24 @@ class ProductionApp:
 
                 context_menu.add_separator()
 
+            context_menu.add_command(
+                label="✂️  Порезано = Количество",
+                command=self.bulk_set_cut_to_quantity
+            )
+            context_menu.add_command(
+                label="🔧  Добавить к Погнуто...",
+                command=self.bulk_add_bent
+            )
+            context_menu.add_command(
+                label="📋  Вставить из буфера в Порезано",
+                command=lambda: self.bulk_paste_details_column("Порезано")
+            )
+            context_menu.add_command(
+                label="📋  Вставить из буфера в Погнуто",
+                command=lambda: self.bulk_paste_details_column("Погнуто")
+            )
+            context_menu.add_separator()
+
         # ========== ЭКСПОРТ (ВСЕГДА ДОСТУПЕН) ==========
         context_menu.add_command(
             label="📊  Экспорт в Excel",
@@ -7050,39 +7335,6 @@ class ProductionApp:
                   bg='#3498db', fg='white', font=("Arial", 12, "bold"),
                   width=20, height=2).pack(pady=10)
 
-    def import_laser_writeoff_table(self):
-        """Импорт таблицы от лазерщиков"""
-        file_path = filedialog.askopenfilename(
-            title="Выберите таблицу от лазерщиков",
-            filetypes=[("Excel files", "*.xlsx *.xls"), ("All files", "*.*")]
-        )
-
-        if not file_path:
-            return
-
-        try:
-            import_df = pd.read_excel(file_path, engine='openpyxl')
-
-            # Проверка колонок
-            required_cols = ["Дата (МСК)", "Время (МСК)", "username", "order", "metal",
-                             "metal_quantity", "part", "part_quantity"]
-            missing = [col for col in required_cols if col not in import_df.columns]
-
-            if missing:
-                messagebox.showerror("Ошибка", f"Отсутствуют колонки:\n{', '.join(missing)}")
-                return
-
-            # Сохраняем данные
-            self.laser_import_data = import_df.to_dict('records')
-
-            # Отображаем
-            self.refresh_laser_import_table()
-
-            messagebox.showinfo("Успех", f"Загружено {len(self.laser_import_data)} записей")
-
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось импортировать:\n{e}")
-
     def refresh_laser_import_table(self):
         """Обновление таблицы импорта от лазерщиков"""
 
@@ -7350,271 +7602,150 @@ class ProductionApp:
 
         print("🔄 Восстановление порядка сортировки...")
 
-        # Собираем все видимые элементы с их порядком сортировки
-        items_to_sort = []
+        # Порядок сортировки каждой строки таблицы по её item_id
+        sort_orders = {}
+        for row_data in self.laser_table_data:
+            sort_orders.setdefault(row_data.get('_item_id'), row_data.get('_sort_order', 999999))
 
-        for item_id in self.laser_import_tree.get_children(''):
-            # Ищем соответствующую запись в laser_table_data
-            for row_data in self.laser_table_data:
-                if row_data.get('_item_id') == item_id:
-                    sort_order = row_data.get('_sort_order', 999999)
-                    items_to_sort.append((sort_order, item_id))
-                    break
+        # Собираем все видимые элементы с их порядком сортировки
+        children = self.laser_import_tree.get_children('')
+        items_to_sort = [(sort_orders[item_id], item_id) for item_id in children if item_id in sort_orders]
+        unsorted = [item_id for item_id in children if item_id not in sort_orders]
 
         # Сортируем по _sort_order (который соответствует дате)
         items_to_sort.sort(key=lambda x: x[0])
 
-        # Переставляем элементы в правильном порядке
-        for new_index, (sort_order, item_id) in enumerate(items_to_sort):
-            try:
-                self.laser_import_tree.move(item_id, '', new_index)
-            except:
-                pass
+        # Переставляем элементы в правильном порядке одним set_children
+        self.laser_import_tree.set_children('', *[item_id for sort_order, item_id in items_to_sort], *unsorted)
 
         print(f"✅ Порядок восстановлен: {len(items_to_sort)} элементов")
 
-    def writeoff_selected_laser_row(self):
-        """Списание выбранной строки"""
-        selected = self.laser_import_tree.selection()
-        if not selected:
-            messagebox.showwarning("Предупреждение", "Выберите строку для списания")
-            return
-
-        item = selected[0]
-        row_index = self.laser_import_tree.index(item)
-
-        self.process_laser_writeoff(row_index)
-        self.refresh_laser_import_table()
-
     def writeoff_all_laser_rows(self):
-        """Массовое списание всех строк"""
-        if not hasattr(self, 'laser_import_data') or not self.laser_import_data:
-            messagebox.showwarning("Предупреждение", "Таблица пуста")
-            return
+        """Массовое списание всех ожидающих строк одним пакетом (после предпросмотра)"""
+        done_statuses = engine.LASER_DONE_STATUSES + [engine.LASER_MANUAL_STATUS]
+        pending = [r for r in self.laser_table_data if _safe_str(r.get("Списано", "")) not in done_statuses]
 
-        if not messagebox.askyesno("Подтверждение",
-                                   f"Списать все записи ({len(self.laser_import_data)} шт)?"):
+        if not pending:
+            messagebox.showwarning("Предупреждение", "Нет строк, ожидающих списания")
             return
 
-        success = 0
-        errors = 0
-
-        for idx in range(len(self.laser_import_data)):
-            if self.process_laser_writeoff(idx, silent=True):
-                success += 1
-            else:
-                errors += 1
-
-        self.refresh_laser_import_table()
-        self.refresh_writeoffs()
-        self.refresh_reservations()
-        self.refresh_materials()
-
-        messagebox.showinfo("Результат", f"✅ Списано: {success}\n❌ Ошибок: {errors}")
-
-    def process_laser_writeoff(self, row_index, silent=False):
-        """Обработка одной строки списания"""
-        if row_index >= len(self.laser_import_data):
-            return False
-
-        row_data = self.laser_import_data[row_index]
-
-        # Проверка: уже списано?
-        if row_data.get("_status") == "✅ Списано":
-            if not silent:
-                messagebox.showwarning("Внимание", "Уже списано!")
-            return False
+        self.show_laser_writeoff_preview(pending, "Списание всех строк лазерщиков")
 
+    def show_laser_writeoff_preview(self, rows, undo_label):
+        """
+        Предпросмотр пакетного списания: результат каждой строки считается в памяти
+        (writeoff_laser_rows с dry_run=True), списываются только отмеченные в таблице строки.
+        """
         try:
-            # Извлекаем данные
-            order_name = str(row_data.get("order", "")).strip()
-            metal_description = str(row_data.get("metal", "")).strip()
-
-            try:
-                metal_qty = int(float(row_data.get("metal_quantity", 0)))
-            except:
-                row_data["_status"] = "Ошибка: некорректное количество"
-                return False
-
-            part_name = str(row_data.get("part", "")).strip()
-            username = str(row_data.get("username", "")).strip()
-            date_str = str(row_data.get("Дата (МСК)", ""))
-            time_str = str(row_data.get("Время (МСК)", ""))
-
-            # Поиск заказа
-            orders_df = load_data("Orders")
-            import re
-            match = re.search(r'УП-(\d+)', order_name)
-            order_id = None
-
-            if match:
-                up_number = match.group(1)
-                order_match = orders_df[orders_df["Название заказа"].str.contains(
-                    f"УП-{up_number}", case=False, na=False, regex=False)]
-                if not order_match.empty:
-                    order_id = int(order_match.iloc[0]["ID заказа"])
-
-            if not order_id:
-                row_data["_status"] = f"Ошибка: заказ '{order_name}' не найден"
-                return False
-
-            # Парсинг размеров
-            import re
-            thickness = None
-            width = None
-            length = None
-
-            print(f"   🔍 Парсинг материала: '{metal_description}'")
-            print(f"   📏 Длина строки: {len(metal_description)} символов")
-            print(f"   🔤 Побайтово: {metal_description.encode('utf-8')}")
-
-            # Пробуем разные паттерны
-            patterns = [
-                (r'(\d+(?:\.\d+)?)\s*мм\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)', "Формат: 4.0мм 1500x3000"),
-                (r'(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)', "Формат: 4x1500x3000"),
-                (r'(\d+(?:\.\d+)?)\s*мм?\s*(\d+(?:\.\d+)?)\s*[xXхХ×]?\s*(\d+(?:\.\d+)?)', "Формат гибкий"),
-            ]
-
-            for idx, (pattern, description) in enumerate(patterns, 1):
-                print(f"   🧪 Тест паттерна {idx}: {description}")
-                match = re.search(pattern, metal_description, re.IGNORECASE)
-
-                if match:
-                    thickness = float(match.group(1))
-                    width = float(match.group(2))
-                    length = float(match.group(3))
-                    print(f"   ✅ УСПЕХ! Найдено: {thickness} × {width} × {length}")
-                    break
-                else:
-                    print(f"   ❌ Не подошёл")
-
-            if not thickness:
-                # Попробуем найти хоть какие-то числа
-                all_numbers = re.findall(r'\d+(?:\.\d+)?', metal_description)
-                print(f"   🔢 Все числа в строке: {all_numbers}")
-
-                # Если нашли минимум 3 числа - попробуем взять последние 3
-                if len(all_numbers) >= 3:
-                    try:
-                        # Ищем первое число как толщину (обычно 3-10)
-                        for i, num in enumerate(all_numbers):
-                            val = float(num)
-                            if 0.5 <= val <= 50:  # Толщина обычно от 0.5 до 50 мм
-                                thickness = val
-                                # Берём следующие 2 числа как размеры
-                                if i + 2 < len(all_numbers):
-                                    width = float(all_numbers[i + 1])
-                                    length = float(all_numbers[i + 2])
-                                    print(f"   ⚠️ Использована эвристика: {thickness} × {width} × {length}")
-                                    break
-                    except:
-                        pass
-
-            if not thickness:
-                print(f"   ❌ НЕ РАСПОЗНАНО: '{metal_description}'")
-                row_data["_status"] = f"Ошибка парсинга материала"
-                return False
-
-            print(f"   ✅ ИТОГО: толщина={thickness}, ширина={width}, длина={length}")
-
-            # Поиск резерва
-            reservations_df = load_data("Reservations")
-            order_reserves = reservations_df[reservations_df["ID заказа"] == order_id]
-
-            if order_reserves.empty:
-                row_data["_status"] = f"Ошибка: нет резервов"
-                return False
-
-            suitable_reserve = None
-            tolerance = 0.01
-
-            for _, reserve in order_reserves.iterrows():
-                thickness_match = abs(float(reserve["Толщина"]) - thickness) < tolerance
+            preview = engine.writeoff_laser_rows(rows, dry_run=True)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось рассчитать списание:\n{e}")
+            return
 
-                if width and length:
-                    width_match = abs(float(reserve["Ширина"]) - width) < tolerance
-                    length_match = abs(float(reserve["Длина"]) - length) < tolerance
+        outcomes = preview["results"]
+        ok_count = sum(1 for res in outcomes if res["status"] == "success")
 
-                    if thickness_match and width_match and length_match and int(reserve["Остаток к списанию"]) > 0:
-                        suitable_reserve = reserve
-                        break
-                else:
-                    if thickness_match and int(reserve["Остаток к списанию"]) > 0:
-                        suitable_reserve = reserve
-                        break
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Предпросмотр списания")
+        dialog.geometry("1250x600")
+        dialog.configure(bg='#ecf0f1')
+        dialog.grab_set()
 
-            if suitable_reserve is None:
-                row_data["_status"] = f"Ошибка: резерв не найден"
-                return False
-
-            reserve_id = int(suitable_reserve["ID резерва"])
-            remainder = int(suitable_reserve["Остаток к списанию"])
-
-            if metal_qty > remainder:
-                row_data["_status"] = f"Ошибка: недостаточно ({remainder} шт)"
-                return False
-
-            # СПИСАНИЕ
-            writeoffs_df = load_data("WriteOffs")
-            new_writeoff_id = 1 if writeoffs_df.empty else int(writeoffs_df["ID списания"].max()) + 1
-
-            comment = f"Оператор: {username} | Деталь: {part_name}"
-            writeoff_datetime = f"{date_str} {time_str}"
-
-            new_writeoff = pd.DataFrame([{
-                "ID списания": new_writeoff_id,
-                "ID резерва": reserve_id,
-                "ID заказа": order_id,
-                "ID материала": int(suitable_reserve["ID материала"]),
-                "Марка": suitable_reserve["Марка"],
-                "Толщина": thickness,
-                "Длина": length,
-                "Ширина": width,
-                "Количество": metal_qty,
-                "Дата списания": writeoff_datetime,
-                "Комментарий": comment
-            }])
-
-            writeoffs_df = pd.concat([writeoffs_df, new_writeoff], ignore_index=True)
-            save_data("WriteOffs", writeoffs_df)
-
-            # Обновляем резерв
-            new_written_off = int(suitable_reserve["Списано"]) + metal_qty
-            new_remainder = remainder - metal_qty
-
-            reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Списано"] = new_written_off
-            reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-            save_data("Reservations", reservations_df)
-
-            # Обновляем склад
-            material_id = int(suitable_reserve["ID материала"])
-            if material_id != -1:
-                materials_df = load_data("Materials")
-                if not materials_df[materials_df["ID"] == material_id].empty:
-                    mat_row = materials_df[materials_df["ID"] == material_id].iloc[0]
-                    old_qty = int(mat_row["Количество штук"])
-                    new_qty = old_qty - metal_qty
+        tk.Label(dialog, text=f"📋 Строк: {len(rows)} | ✅ Спишется: {ok_count} | ❌ С ошибкой: {len(rows) - ok_count}",
+                 font=("Arial", 12, "bold"), bg='#ecf0f1', fg='#2c3e50').pack(pady=(10, 2))
+        tk.Label(dialog, text="Выделены строки, которые будут списаны. Ctrl/Shift + клик — изменить выбор, "
+                              "клик по заголовку — сортировка.",
+                 font=("Arial", 9), bg='#ecf0f1', fg='#7f8c8d').pack(pady=(0, 5))
+
+        columns = ("Дата", "Время", "Заказ", "Металл", "Листов", "Деталь", "Результат", "Резерв",
+                   "Остаток резерва", "Остаток на складе", "Сообщение")
+        frame = tk.Frame(dialog, bg='#ecf0f1')
+        frame.pack(fill=tk.BOTH, expand=True, padx=15, pady=5)
+        tree = ttk.Treeview(frame, columns=columns, show='headings', selectmode='extended')
+        for col in columns:
+            tree.column(col, width=90, anchor=tk.CENTER)
+        for col in ("Заказ", "Металл", "Деталь"):
+            tree.column(col, width=140, anchor=tk.W)
+        tree.column("Сообщение", width=280, anchor=tk.W)
+        scroll_y = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scroll_y.set)
+        scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
-                    materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_qty
+        tree.tag_configure('ok', background='#d4edda')
+        tree.tag_configure('warning', background='#fff3cd')
+        tree.tag_configure('error', background='#f8d7da')
 
-                    reserved = int(mat_row["Зарезервировано"])
-                    new_reserved = max(0, reserved - metal_qty)
-                    materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-                    materials_df.loc[materials_df["ID"] == material_id, "Доступно"] = new_qty - new_reserved
+        row_by_item = {}
+        for row, res in zip(rows, outcomes):
+            if res["status"] == "success":
+                tag, outcome = ('warning', "⚠️ Частично") if res["message"] else ('ok', "✅ Спишется")
+            else:
+                tag, outcome = 'error', "❌ Ошибка"
+            item = tree.insert("", "end", tags=(tag,), values=(
+                row.get("Дата (МСК)", ""), row.get("Время (МСК)", ""), row.get("order", ""), row.get("metal", ""),
+                res["quantity"] or row.get("metal_quantity", ""), row.get("part", ""), outcome,
+                f"#{res['reserve_id']}" if res["reserve_id"] else "",
+                "" if res["reserve_left"] is None else res["reserve_left"],
+                "" if res["stock_left"] is None else res["stock_left"],
+                " ".join(res["message"].split())
+            ))
+            row_by_item[item] = row
+        tree.selection_set([item for item, res in zip(row_by_item, outcomes) if res["status"] == "success"])
+
+        def sort_by(col, reverse=False):
+            def sort_key(item):
+                value = tree.set(item, col)
+                try:
+                    return 0, float(str(value).lstrip("#"))
+                except ValueError:
+                    return 1, str(value).lower()
+            for index, item in enumerate(sorted(tree.get_children(), key=sort_key, reverse=reverse)):
+                tree.move(item, "", index)
+            tree.heading(col, command=lambda: sort_by(col, not reverse))
+
+        for col in columns:
+            tree.heading(col, text=col, command=lambda c=col: sort_by(c))
+
+        def commit():
+            selected_rows = [row_by_item[item] for item in tree.selection()]
+            if not selected_rows:
+                messagebox.showwarning("Предупреждение", "Не выбрано ни одной строки", parent=dialog)
+                return
+            try:
+                with engine.undo_group(undo_label, laser_rows=self.laser_table_data):
+                    result = engine.writeoff_laser_rows(selected_rows)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось выполнить списание:\n{e}", parent=dialog)
+                return
+            dialog.destroy()
 
-                    save_data("Materials", materials_df)
+            self.refresh_laser_import_table()
+            self.save_laser_import_cache()
 
-            row_data["_status"] = "✅ Списано"
-            return True
+            failed = [(row, res) for row, res in zip(selected_rows, result["results"]) if res["status"] == "error"]
+            result_msg = f"✅ Списано: {result['success']}\n❌ Не списано: {len(failed)}"
+            if failed:
+                lines = [
+                    f"{row.get('Дата (МСК)', '')} {row.get('Время (МСК)', '')} | {row.get('order', '')}: "
+                    f"{res['message'].splitlines()[0]}"
+                    for row, res in failed[:10]
+                ]
+                result_msg += "\n\n" + "\n".join(lines)
+                if len(failed) > 10:
+                    result_msg += f"\n... и еще {len(failed) - 10}"
+            messagebox.showinfo("Результат списания", result_msg)
 
-        except Exception as e:
-            row_data["_status"] = f"Ошибка: {str(e)}"
-            return False
+        btn_frame = tk.Frame(dialog, bg='#ecf0f1')
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="✅ Списать выбранные", bg='#27ae60', fg='white',
+                  font=("Arial", 11, "bold"), width=20, command=commit).pack(side=tk.LEFT, padx=8)
+        tk.Button(btn_frame, text="Отмена", bg='#3498db', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=dialog.destroy).pack(side=tk.LEFT, padx=8)
 
     def clear_laser_table(self):
         """Очистка таблицы импорта"""
-        if hasattr(self, 'laser_import_data'):
-            self.laser_import_data = []
+        self.laser_table_data = []
 
         for i in self.laser_import_tree.get_children():
             self.laser_import_tree.delete(i)
@@ -7634,122 +7765,15 @@ class ProductionApp:
             return
 
         try:
-            # Загрузка файла
-            if file_path.endswith('.csv'):
-                try:
-                    laser_df = pd.read_csv(file_path, sep=';', encoding='utf-8')
-                except:
-                    laser_df = pd.read_csv(file_path, sep=';', encoding='cp1251')
-            else:
-                laser_df = pd.read_excel(file_path, engine='openpyxl')
-
-            # Проверка обязательных колонок
-            required = ["Дата (МСК)", "Время (МСК)", "username", "order", "metal", "metal_quantity", "part",
-                        "part_quantity"]
-            missing = [col for col in required if col not in laser_df.columns]
-
-            if missing:
-                messagebox.showerror("Ошибка", f"Отсутствуют колонки:\n{', '.join(missing)}")
-                return
-
-            # Добавляем колонки статуса если их нет
-            if "Списано" not in laser_df.columns:
-                laser_df["Списано"] = ""
-            if "Дата списания" not in laser_df.columns:
-                laser_df["Дата списания"] = ""
-
-            # Создаём уникальный ключ для каждой строки
-            def create_row_key(row):
-                """Создание уникального ключа для строки"""
-                return (
-                    str(row.get("Дата (МСК)", "")),
-                    str(row.get("Время (МСК)", "")),
-                    str(row.get("username", "")),
-                    str(row.get("order", "")),
-                    str(row.get("metal", "")),
-                    str(row.get("metal_quantity", "")),
-                    str(row.get("part", "")),
-                    str(row.get("part_quantity", ""))
-                )
-
-            # Создаём словарь существующих строк с их статусами
-            existing_rows = {}
-            if hasattr(self, 'laser_table_data') and self.laser_table_data:
-                for row_data in self.laser_table_data:
-                    key = create_row_key(row_data)
-                    existing_rows[key] = {
-                        "Списано": row_data.get("Списано", ""),
-                        "Дата списания": row_data.get("Дата списания", "")
-                    }
-
-            # Обрабатываем новый файл
-            new_rows = []
-            updated_rows = 0
-
-            for _, row in laser_df.iterrows():
-                row_dict = row.to_dict()
-                key = create_row_key(row_dict)
-
-                # Проверяем, существует ли уже эта строка
-                if key in existing_rows:
-                    # Строка уже есть - сохраняем её статус
-                    row_dict["Списано"] = existing_rows[key]["Списано"]
-                    row_dict["Дата списания"] = existing_rows[key]["Дата списания"]
-                    updated_rows += 1
-                else:
-                    # Новая строка - оставляем пустой статус
-                    if not row_dict.get("Списано"):
-                        row_dict["Списано"] = ""
-                    if not row_dict.get("Дата списания"):
-                        row_dict["Дата списания"] = ""
-
-                new_rows.append(row_dict)
-
-            # Объединяем данные
-            merged_data = []
-            new_count = 0
-
-            # Создаём множество ключей из нового файла
-            new_keys = set()
-            for row_dict in new_rows:
-                new_keys.add(create_row_key(row_dict))
-
-            # Добавляем старые строки, если они есть в новом файле
-            if hasattr(self, 'laser_table_data') and self.laser_table_data:
-                for old_row in self.laser_table_data:
-                    old_key = create_row_key(old_row)
-                    if old_key in new_keys:
-                        # Строка есть в новом файле - берём из старой таблицы
-                        merged_data.append(old_row)
-
-            # Добавляем только НОВЫЕ строки из импортированного файла
-            for new_row in new_rows:
-                new_key = create_row_key(new_row)
-                is_new = new_key not in existing_rows
-
-                if is_new:
-                    merged_data.append(new_row)
-                    new_count += 1
-
-            # Сохраняем объединённые данные
-            self.laser_table_data = merged_data
-
-            # 🆕 СОРТИРОВКА: НОВЫЕ ЗАПИСИ ВВЕРХУ
             try:
-                print("🔄 Сортировка импортированных данных...")
-                df_merged = pd.DataFrame(self.laser_table_data)
-
-                df_merged['_datetime_sort'] = pd.to_datetime(
-                    df_merged['Дата (МСК)'].astype(str) + ' ' + df_merged['Время (МСК)'].astype(str),
-                    errors='coerce'
-                )
-                df_merged = df_merged.sort_values('_datetime_sort', ascending=False, na_position='last')
-                df_merged = df_merged.drop('_datetime_sort', axis=1)
+                result = engine.import_laser_file(file_path, getattr(self, 'laser_table_data', None))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
+                return
 
-                self.laser_table_data = df_merged.to_dict('records')
-                print(f"✅ Данные отсортированы: {len(self.laser_table_data)} записей")
-            except Exception as e:
-                print(f"⚠️ Ошибка сортировки после импорта: {e}")
+            self.laser_table_data = result["rows"]
+            new_count = result["new"]
+            updated_rows = result["updated"]
 
             # Обновляем таблицу
             self.refresh_laser_import_table()
@@ -7781,9 +7805,7 @@ class ProductionApp:
 
             # Считаем статистику по статусам
             if self.laser_table_data:
-                auto_count = sum(1 for r in self.laser_table_data if r.get("Списано") in ["✓", "Да", "Yes"])
-                manual_count = sum(1 for r in self.laser_table_data if r.get("Списано") == "Вручную")
-                pending_count = sum(1 for r in self.laser_table_data if not r.get("Списано"))
+                auto_count, manual_count, pending_count = engine.laser_status_counts(self.laser_table_data)
 
                 result_msg += (
                     f"📈 Статистика:\n"
@@ -7792,6 +7814,9 @@ class ProductionApp:
                     f"  • 🟡 Ожидает списания: {pending_count}\n"
                 )
 
+            if not result["report"].empty:
+                result_msg += f"\n⚠️ Ошибок в строках файла: {len(result['report'])} (проверьте перед списанием)\n"
+
             # Сохраняем в кэш
             try:
                 self.save_laser_import_cache()
@@ -7799,6 +7824,7 @@ class ProductionApp:
                 print(f"⚠️ Не удалось сохранить кэш: {cache_err}")
 
             messagebox.showinfo("Успех", result_msg)
+            self.offer_import_error_report(result["report"])
 
         except Exception as e:
             messagebox.showerror("Ошибка импорта", f"Не удалось импортировать файл:\n\n{str(e)}")
@@ -7992,7 +8018,7 @@ class ProductionApp:
             if values[8] in ["Да", "✓", "Yes"]:  # Колонка "Списано"
                 already_written_off.append(values[3])  # order
             else:
-                rows_to_writeoff.append((item, values))
+                rows_to_writeoff.append(self.laser_table_data[self.laser_import_tree.index(item)])
 
         if already_written_off:
             messagebox.showinfo("Информация",
@@ -8002,380 +8028,7 @@ class ProductionApp:
             messagebox.showwarning("Предупреждение", "Нет строк для списания!")
             return
 
-        # Подтверждение
-        if not messagebox.askyesno("Подтверждение",
-                                   f"Списать выбранные строки ({len(rows_to_writeoff)} шт)?"):
-            return
-
-        try:
-            # Загружаем данные
-            orders_df = load_data("Orders")
-            reservations_df = load_data("Reservations")
-            materials_df = load_data("Materials")
-            writeoffs_df = load_data("WriteOffs")
-            order_details_df = load_data("OrderDetails")
-
-            success_count = 0
-            errors = []
-
-            print(f"\n{'=' * 80}")
-            print(f"🔵 НАЧАЛО СПИСАНИЯ: {len(rows_to_writeoff)} строк(и)")
-            print(f"{'=' * 80}")
-
-            for item, values in rows_to_writeoff:
-                try:
-                    date_val, time_val, username, order_name, metal_desc, metal_qty_str, part_name, part_qty = values[
-                        :8]
-
-                    print(f"\n📋 Обработка строки:")
-                    print(f"   Заказ: {order_name}")
-                    print(f"   Металл: {metal_desc}")
-                    print(f"   Количество металла: {metal_qty_str}")
-                    print(f"   Деталь: {part_name}")
-
-                    # ========== ШАГ 1: ПОИСК ЗАКАЗА ==========
-                    # Ищем по точному совпадению или по номеру УП-XXX
-                    order_match = None
-
-                    # Пробуем найти номер УП-XXX
-                    import re
-                    up_match = re.search(r'УП-(\d+)', order_name)
-                    if up_match:
-                        up_number = up_match.group(1)
-                        order_match = orders_df[
-                            orders_df["Название заказа"].str.contains(f"УП-{up_number}", case=False, na=False)]
-                        print(f"   🔍 Поиск по УП-{up_number}")
-
-                    # Если не нашли, ищем по частичному совпадению названия
-                    if order_match is None or order_match.empty:
-                        order_match = orders_df[
-                            orders_df["Название заказа"].str.contains(order_name, case=False, na=False)]
-                        print(f"   🔍 Поиск по названию: {order_name}")
-
-                    if order_match.empty:
-                        errors.append(f"❌ Заказ '{order_name}' не найден в базе")
-                        print(f"   ❌ Заказ не найден")
-                        continue
-
-                    order_id = int(order_match.iloc[0]["ID заказа"])
-                    print(f"   ✅ Заказ найден: ID={order_id}")
-
-                    # ========== ШАГ 2: ПАРСИНГ МАТЕРИАЛА ==========
-                    # Примеры:
-                    # "ГК Ст.3 4.0мм 1500x3000" → марка="ГК Ст.3", толщина=4.0, ширина=1500, длина=3000
-                    # "ГК Ст.3 6х1500х3000" → марка="ГК Ст.3", толщина=6, ширина=1500, длина=3000
-
-                    thickness = None
-                    width = None
-                    length = None
-                    marka = None
-
-                    print(f"   🔍 Парсинг материала: '{metal_desc}'")
-
-                    # 🆕 ПАТТЕРН 1: Формат с "мм" (4.0мм 1500x3000)
-                    pattern1 = r'(\d+(?:\.\d+)?)\s*мм\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)'
-                    match1 = re.search(pattern1, metal_desc, re.IGNORECASE)
-
-                    if match1:
-                        thickness = float(match1.group(1))
-                        width = float(match1.group(2))
-                        length = float(match1.group(3))
-                        # Марка - всё до размеров
-                        marka = metal_desc.split(match1.group(0))[0].strip()
-                        print(f"   ✅ Паттерн 1 (с мм): {thickness}мм {width}x{length}, марка='{marka}'")
-
-                    # ПАТТЕРН 2: Классический формат (6х1500х3000)
-                    if not thickness:
-                        pattern2 = r'(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)'
-                        match2 = re.search(pattern2, metal_desc)
-
-                        if match2:
-                            thickness = float(match2.group(1))
-                            width = float(match2.group(2))
-                            length = float(match2.group(3))
-                            # Марка - всё до размеров
-                            marka = metal_desc.split(match2.group(0))[0].strip()
-                            print(f"   ✅ Паттерн 2 (без мм): {thickness}х{width}х{length}, марка='{marka}'")
-
-                    if not thickness or not marka:
-                        errors.append(f"❌ Не удалось распарсить материал: {metal_desc}")
-                        print(f"   ❌ Ошибка парсинга материала: '{metal_desc}'")
-                        continue
-
-                    print(f"   📦 Распарсенный материал:")
-                    print(f"      Марка: {marka}")
-                    print(f"      Толщина: {thickness} мм")
-                    print(f"      Размер: {width}x{length}")
-
-                    # ========== ШАГ 3: ПОИСК ДЕТАЛИ В ЗАКАЗЕ ==========
-                    detail_id = None
-                    detail_match = order_details_df[
-                        (order_details_df["ID заказа"] == order_id) &
-                        (order_details_df["Название детали"].str.contains(part_name, case=False, na=False))
-                        ]
-
-                    if not detail_match.empty:
-                        detail_id = int(detail_match.iloc[0]["ID"])
-                        print(f"   🔧 Деталь найдена: ID={detail_id}, Название='{part_name}'")
-                    else:
-                        print(f"   ⚠️ Деталь '{part_name}' не найдена в заказе (списание без привязки)")
-
-                    # ========== ШАГ 4: ПОИСК РЕЗЕРВА С УЧЕТОМ МАТЕРИАЛА И ДЕТАЛИ ==========
-                    # Ищем резервы этого заказа
-                    order_reserves = reservations_df[
-                        (reservations_df["ID заказа"] == order_id) &
-                        (reservations_df["Остаток к списанию"] > 0)
-                        ]
-
-                    if order_reserves.empty:
-                        errors.append(f"❌ Нет доступных резервов для заказа '{order_name}'")
-                        print(f"   ❌ Резервы не найдены")
-                        continue
-
-                    print(f"   🔍 Найдено резервов для заказа: {len(order_reserves)}")
-
-                    # Фильтруем резервы по материалу
-                    suitable_reserves = order_reserves[
-                        (order_reserves["Марка"].str.contains(marka, case=False, na=False)) &
-                        (order_reserves["Толщина"] == thickness)
-                        ]
-
-                    # Если указаны размеры, фильтруем и по ним
-                    if width and length:
-                        suitable_reserves = suitable_reserves[
-                            (suitable_reserves["Ширина"] == width) &
-                            (suitable_reserves["Длина"] == length)
-                            ]
-
-                    print(f"   🔍 Подходящих по материалу: {len(suitable_reserves)}")
-
-                    # Если найдена деталь, фильтруем по детали
-                    if detail_id:
-                        detail_reserves = suitable_reserves[suitable_reserves["ID детали"] == detail_id]
-                        if not detail_reserves.empty:
-                            suitable_reserves = detail_reserves
-                            print(f"   ✅ Резервы с привязкой к детали ID={detail_id}: {len(suitable_reserves)}")
-
-                    if suitable_reserves.empty:
-                        errors.append(
-                            f"❌ Не найден резерв для:\n"
-                            f"   Заказ: {order_name}\n"
-                            f"   Материал: {marka} {thickness}мм {width}x{length}\n"
-                            f"   Деталь: {part_name}"
-                        )
-                        print(f"   ❌ Подходящий резерв не найден")
-                        continue
-
-                    # Берём первый подходящий резерв
-                    reserve_row = suitable_reserves.iloc[0]
-                    reserve_id = int(reserve_row["ID резерва"])
-                    remainder = int(reserve_row["Остаток к списанию"])
-
-                    print(f"   ✅ Выбран резерв ID={reserve_id}, остаток={remainder} шт")
-
-                    # ========== ШАГ 5: КОЛИЧЕСТВО ДЛЯ СПИСАНИЯ ==========
-                    try:
-                        qty_to_writeoff = int(metal_qty_str)
-                    except:
-                        qty_to_writeoff = 1
-
-                    if qty_to_writeoff > remainder:
-                        errors.append(
-                            f"⚠️ Недостаточно материала в резерве #{reserve_id}:\n"
-                            f"   Запрошено: {qty_to_writeoff}, Доступно: {remainder}"
-                        )
-                        print(f"   ⚠️ Недостаточно материала: нужно {qty_to_writeoff}, есть {remainder}")
-                        # Списываем сколько есть
-                        qty_to_writeoff = remainder
-
-                    print(f"   📝 Будет списано: {qty_to_writeoff} шт")
-
-                    # ========== ШАГ 6: СОЗДАНИЕ СПИСАНИЯ ==========
-                    new_writeoff_id = 1 if writeoffs_df.empty else int(writeoffs_df["ID списания"].max()) + 1
-
-                    # 🆕 УЛУЧШЕННЫЙ КОММЕНТАРИЙ для связи с таблицей импорта
-                    comment_text = (
-                        f"Лазер: {username} | "
-                        f"Деталь: {part_name} | "
-                        f"Дата импорта: {date_val} {time_val}"
-                    )
-
-                    new_writeoff = pd.DataFrame([{
-                        "ID списания": new_writeoff_id,
-                        "ID резерва": reserve_id,
-                        "ID заказа": reserve_row["ID заказа"],
-                        "ID материала": reserve_row["ID материала"],
-                        "Марка": reserve_row["Марка"],
-                        "Толщина": reserve_row["Толщина"],
-                        "Длина": reserve_row["Длина"],
-                        "Ширина": reserve_row["Ширина"],
-                        "Количество": qty_to_writeoff,
-                        "Дата списания": f"{date_val} {time_val}",  # 🆕 СОХРАНЯЕМ ИСХОДНУЮ ДАТУ
-                        "Комментарий": comment_text  # 🆕 РАСШИРЕННЫЙ КОММЕНТАРИЙ
-                    }])
-
-                    writeoffs_df = pd.concat([writeoffs_df, new_writeoff], ignore_index=True)
-
-                    # ========== ШАГ 7: ОБНОВЛЕНИЕ РЕЗЕРВА ==========
-                    new_written_off = int(reserve_row["Списано"]) + qty_to_writeoff
-                    new_remainder = int(reserve_row["Зарезервировано штук"]) - new_written_off
-
-                    reservations_df.loc[reservations_df["ID резерва"] == reserve_id, "Списано"] = new_written_off
-                    reservations_df.loc[
-                        reservations_df["ID резерва"] == reserve_id, "Остаток к списанию"] = new_remainder
-
-                    print(f"   ✅ Резерв обновлен: Списано={new_written_off}, Остаток={new_remainder}")
-
-                    # ========== ШАГ 8: ОБНОВЛЕНИЕ МАТЕРИАЛА НА СКЛАДЕ ==========
-                    material_id = int(reserve_row["ID материала"])
-                    if material_id != -1:
-                        material = materials_df[materials_df["ID"] == material_id]
-                        if not material.empty:
-                            material = material.iloc[0]
-
-                            new_qty = int(material["Количество штук"]) - qty_to_writeoff
-                            new_reserved = int(material["Зарезервировано"]) - qty_to_writeoff
-
-                            materials_df.loc[materials_df["ID"] == material_id, "Количество штук"] = new_qty
-                            materials_df.loc[materials_df["ID"] == material_id, "Зарезервировано"] = new_reserved
-
-                            # Пересчитываем площадь
-                            area_per_piece = float(material["Длина"]) * float(material["Ширина"]) / 1_000_000
-                            new_area = new_qty * area_per_piece
-                            materials_df.loc[materials_df["ID"] == material_id, "Общая площадь"] = round(new_area, 2)
-
-                            print(f"   ✅ Склад обновлен: Всего={new_qty}, Зарезервировано={new_reserved}")
-
-                    # ========== ШАГ 9: ОБНОВЛЕНИЕ ДЕТАЛИ В ЗАКАЗЕ (ПОРЕЗАНО) ==========
-                    if detail_id:
-                        try:
-                            # Загружаем детали заказа (если ещё не загружены)
-                            if 'order_details_df' not in locals():
-                                order_details_df = load_data("OrderDetails")
-
-                            detail_row = order_details_df[order_details_df["ID"] == detail_id]
-
-                            if not detail_row.empty:
-                                detail_row = detail_row.iloc[0]
-                                detail_name_full = detail_row["Название детали"]
-
-                                old_cut = int(detail_row.get("Порезано", 0))
-
-                                # Количество деталей из импорта
-                                try:
-                                    parts_qty = int(part_qty)
-                                except:
-                                    parts_qty = 0
-
-                                new_cut = old_cut + parts_qty
-
-                                # Обновляем количество порезанных деталей
-                                order_details_df.loc[order_details_df["ID"] == detail_id, "Порезано"] = new_cut
-
-                                # Проверяем общее количество
-                                total_qty = int(detail_row.get("Количество", 0))
-
-                                print(f"   📐 Деталь '{detail_name_full}' обновлена:")
-                                print(f"      ID детали: {detail_id}")
-                                print(f"      Всего требуется: {total_qty}")
-                                print(f"      Было порезано: {old_cut}")
-                                print(f"      Добавлено: +{parts_qty}")
-                                print(f"      Стало порезано: {new_cut}")
-
-                                # Сохраняем изменения
-                                save_data("OrderDetails", order_details_df)
-
-                                print(f"      💾 OrderDetails сохранён")
-
-                                # Если порезано больше или равно требуемому - показываем уведомление
-                                if new_cut >= total_qty:
-                                    print(f"      ✅ Деталь полностью порезана! ({new_cut}/{total_qty})")
-                                else:
-                                    remaining = total_qty - new_cut
-                                    print(f"      ⏳ Осталось порезать: {remaining} шт")
-                            else:
-                                print(f"   ⚠️ Деталь ID={detail_id} не найдена в OrderDetails")
-
-                        except Exception as e:
-                            print(f"   ⚠️ Ошибка обновления детали: {e}")
-                            import traceback
-                            traceback.print_exc()
-                    else:
-                        print(f"   ℹ️ Деталь не найдена в базе, пропускаем обновление 'Порезано'")
-
-                    # ========== ШАГ 10: ОБНОВЛЕНИЕ СТАТУСА В ТАБЛИЦЕ ИМПОРТА ==========
-                    item_index = self.laser_import_tree.index(item)
-                    self.laser_table_data[item_index]["Списано"] = "✓"
-                    self.laser_table_data[item_index]["Дата списания"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-
-                    # ========== ШАГ 9: ОБНОВЛЕНИЕ СТАТУСА В ТАБЛИЦЕ ИМПОРТА ==========
-                    item_index = self.laser_import_tree.index(item)
-                    self.laser_table_data[item_index]["Списано"] = "✓"
-                    self.laser_table_data[item_index]["Дата списания"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-
-                    success_count += 1
-                    print(f"   ✅ СПИСАНИЕ ВЫПОЛНЕНО УСПЕШНО")
-
-                except Exception as e:
-                    error_msg = f"❌ Ошибка обработки строки '{order_name}': {str(e)}"
-                    errors.append(error_msg)
-                    print(f"   {error_msg}")
-                    import traceback
-                    traceback.print_exc()
-
-            # ========== СОХРАНЕНИЕ ИЗМЕНЕНИЙ ==========
-            print(f"\n{'=' * 80}")
-            print(f"💾 СОХРАНЕНИЕ ИЗМЕНЕНИЙ В БАЗУ ДАННЫХ")
-            print(f"{'=' * 80}")
-
-            save_data("WriteOffs", writeoffs_df)
-            save_data("Reservations", reservations_df)
-            save_data("Materials", materials_df)
-
-            print(f"✅ Данные сохранены")
-
-            # ОБНОВЛЕНИЕ ИНТЕРФЕЙСА
-            self.refresh_laser_import_table()
-            self.refresh_materials()
-            self.refresh_reservations()
-            self.refresh_writeoffs()
-            self.refresh_balance()
-
-            if hasattr(self, 'refresh_orders'):
-                self.refresh_orders()
-            if hasattr(self, 'refresh_order_details'):
-                self.refresh_order_details()
-
-            # 🆕 ОБНОВЛЯЕМ ВКЛАДКУ УЧЁТА ДЕТАЛЕЙ
-            if hasattr(self, 'refresh_details'):
-                self.refresh_details()
-
-
-            print(f"✅ Интерфейс обновлен")
-
-            # ========== РЕЗУЛЬТАТ ==========
-            print(f"\n{'=' * 80}")
-            print(f"✅ СПИСАНИЕ ЗАВЕРШЕНО")
-            print(f"   Успешно: {success_count}")
-            print(f"   Ошибок: {len(errors)}")
-            print(f"{'=' * 80}\n")
-
-            result_msg = f"✅ Успешно списано: {success_count} записей"
-            if errors:
-                result_msg += f"\n\n⚠ Ошибки ({len(errors)}):\n" + "\n".join(errors[:10])
-                if len(errors) > 10:
-                    result_msg += f"\n... и еще {len(errors) - 10}"
-
-            messagebox.showinfo("Результат списания", result_msg)
-
-            # 🆕 АВТОСОХРАНЕНИЕ ПОСЛЕ СПИСАНИЯ
-            self.save_laser_import_cache()
-
-        except Exception as e:
-            print(f"\n💥 КРИТИЧЕСКАЯ ОШИБКА: {e}")
-            import traceback
-            traceback.print_exc()
-            messagebox.showerror("Ошибка", f"Не удалось выполнить списание:\n{e}")
+        self.show_laser_writeoff_preview(rows_to_writeoff, "Списание строк лазерщиков")
 
     def mark_manual_writeoff(self):
         """Пометка строк как 'списано вручную' без фактического списания"""
@@ -8592,41 +8245,7 @@ class ProductionApp:
             return
 
         try:
-            df = pd.DataFrame(self.laser_table_data)
-
-            if file_path.endswith('.csv'):
-                df.to_csv(file_path, index=False, sep=';', encoding='utf-8')
-            else:
-                df.to_excel(file_path, index=False, engine='openpyxl')
-
-            messagebox.showinfo("Успех", f"Таблица сохранена:\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{e}")
-
-    def export_laser_table(self):
-        """Экспорт таблицы обратно в Excel"""
-        if not self.laser_table_data:
-            messagebox.showwarning("Предупреждение", "Нет данных для экспорта!")
-            return
-
-        file_path = filedialog.asksaveasfilename(
-            title="Сохранить таблицу",
-            defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("All files", "*.*")],
-            initialfile=f"laser_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        )
-
-        if not file_path:
-            return
-
-        try:
-            df = pd.DataFrame(self.laser_table_data)
-
-            if file_path.endswith('.csv'):
-                df.to_csv(file_path, index=False, sep=';', encoding='utf-8')
-            else:
-                df.to_excel(file_path, index=False, engine='openpyxl')
-
+            engine.export_rows(self.laser_table_data, file_path)
             messagebox.showinfo("Успех", f"Таблица сохранена:\n{file_path}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{e}")
@@ -8638,14 +8257,12 @@ class ProductionApp:
             return
 
         try:
-            cache_file = os.path.join(get_database_path(), "laser_import_cache.xlsx")
-
-            print(f"💾 Сохранение {len(self.laser_table_data)} записей в кэш...")
-
-            df = pd.DataFrame(self.laser_table_data)
-            df.to_excel(cache_file, index=False, engine='openpyxl')
-
-            print(f"✅ Кэш импорта сохранён: {len(self.laser_table_data)} записей")
+            with engine.data_lock:
+                # Отметки, поставленные другим процессом после нашего чтения, не затираются
+                if self._merge_foreign_cache(vitaka_watch.LASER):
+                    self.refresh_laser_import_table()
+                engine.save_import_cache(self.laser_table_data, get_laser_cache_path())
+                self.import_cache_stamps[get_laser_cache_path()] = engine.import_cache_stamp(get_laser_cache_path())
         except Exception as e:
             print(f"⚠️ Ошибка сохранения кэша: {e}")
 
@@ -8653,73 +8270,32 @@ class ProductionApp:
     def load_laser_import_cache(self):
         """Автоматическая загрузка таблицы импорта из кэш-файла"""
         try:
-            cache_file = os.path.join(get_database_path(), "laser_import_cache.xlsx")
-
-            if not os.path.exists(cache_file):
-                print(f"ℹ️ Кэш импорта не найден: {cache_file}")
-                return
-
-            df = pd.read_excel(cache_file, engine='openpyxl')
-
-            if df.empty:
-                print("ℹ️ Кэш импорта пуст")
+            with engine.data_lock:
+                rows = engine.load_laser_cache()
+                self.import_cache_stamps[get_laser_cache_path()] = engine.import_cache_stamp(get_laser_cache_path())
+            if rows is None:
                 return
 
-            required = ["Дата (МСК)", "Время (МСК)", "username", "order", "metal", "metal_quantity", "part",
-                        "part_quantity"]
-
-            if all(col in df.columns for col in required):
-                df = df.fillna("")
-
-                # Преобразуем в список словарей
-                self.laser_table_data = df.to_dict('records')
+            self.laser_table_data = rows
 
-                # Очистка значений
-                for row in self.laser_table_data:
-                    if "Списано" in row:
-                        if pd.isna(row["Списано"]) or row["Списано"] is None:
-                            row["Списано"] = ""
-                        else:
-                            row["Списано"] = str(row["Списано"]).strip()
-
-                    if "Дата списания" in row:
-                        if pd.isna(row["Дата списания"]) or row["Дата списания"] is None:
-                            row["Дата списания"] = ""
-                        else:
-                            row["Дата списания"] = str(row["Дата списания"]).strip()
-
-                print(f"✅ Загружен кэш импорта: {len(self.laser_table_data)} записей из {cache_file}")
+            if hasattr(self, 'laser_import_tree'):
+                self.refresh_laser_import_table()
 
-                if self.laser_table_data:
-                    print("\n🔍 Проверка загруженных данных:")
-                    for i, row in enumerate(self.laser_table_data[:3]):
-                        status = row.get("Списано", "")
-                        print(f"   Строка {i + 1}: Списано = '{status}' (тип: {type(status).__name__})")
+                if hasattr(self, 'laser_status_label'):
+                    items_count = len(self.laser_table_data)
+                    auto_count, manual_count, pending_count = engine.laser_status_counts(self.laser_table_data)
 
-                if hasattr(self, 'laser_import_tree'):
-                    self.refresh_laser_import_table()
-
-                    if hasattr(self, 'laser_status_label'):
-                        items_count = len(self.laser_import_tree.get_children())
-                        auto_count = sum(
-                            1 for r in self.laser_table_data if r.get("Списано", "").strip() in ["✓", "Да", "Yes"])
-                        manual_count = sum(
-                            1 for r in self.laser_table_data if r.get("Списано", "").strip() == "Вручную")
-                        pending_count = sum(1 for r in self.laser_table_data if not r.get("Списано", "").strip())
-
-                        status_text = (
-                            f"📂 Загружено из кэша: {items_count} | "
-                            f"✅ Списано: {auto_count} | "
-                            f"🔵 Вручную: {manual_count} | "
-                            f"🟡 Ожидает: {pending_count}"
-                        )
-                        self.laser_status_label.config(
-                            text=status_text,
-                            bg='#d1ecf1',
-                            fg='#0c5460'
-                        )
-            else:
-                print("⚠️ Кэш импорта имеет неправильную структуру")
+                    status_text = (
+                        f"📂 Загружено из кэша: {items_count} | "
+                        f"✅ Списано: {auto_count} | "
+                        f"🔵 Вручную: {manual_count} | "
+                        f"🟡 Ожидает: {pending_count}"
+                    )
+                    self.laser_status_label.config(
+                        text=status_text,
+                        bg='#d1ecf1',
+                        fg='#0c5460'
+                    )
 
         except Exception as e:
             print(f"⚠️ Ошибка загрузки кэша: {e}")
@@ -8838,15 +8414,8 @@ class ProductionApp:
             active_filters_backup = self.balance_excel_filter.active_filters.copy()
             print(f"🔍 Сохранены фильтры: {list(active_filters_backup.keys())}")
 
-        # ПОЛНОСТЬЮ ОЧИЩАЕМ ДЕРЕВО
-        for i in self.balance_tree.get_children():
-            self.balance_tree.delete(i)
-
-        # ОЧИЩАЕМ КЭШ ЭЛЕМЕНТОВ
-        if hasattr(self, 'balance_excel_filter'):
-            self.balance_excel_filter._all_item_cache = set()
-
         df = load_data("Materials")
+        rows = []
 
         if not df.empty:
             # Группируем по марке, толщине и размеру
@@ -8891,16 +8460,15 @@ class ProductionApp:
                 else:
                     tag = 'empty'
 
-                item_id = self.balance_tree.insert("", "end", values=values, tags=(tag,))
+                # Ключ строки — марка, толщина и размер
+                rows.append((f"{marka}|{thickness}|{size}", values, (tag,)))
 
-                # СОХРАНЯЕМ item_id В КЭШ
-                if hasattr(self, 'balance_excel_filter'):
-                    if not hasattr(self.balance_excel_filter, '_all_item_cache'):
-                        self.balance_excel_filter._all_item_cache = set()
-                    self.balance_excel_filter._all_item_cache.add(item_id)
+        # ОБНОВЛЯЕМ ТОЛЬКО ИЗМЕНИВШИЕСЯ СТРОКИ
+        self.sync_tree_rows(self.balance_tree, rows, getattr(self, 'balance_excel_filter', None))
 
         # АВТОПОДБОР ШИРИНЫ КОЛОНОК С ОГРАНИЧЕНИЯМИ
-        self.auto_resize_columns(self.balance_tree, min_width=100, max_width=300)
+        self.auto_resize_columns(self.balance_tree, min_width=100, max_width=300,
+                                 rows=[values for _, values, _ in rows])
 
         # ПЕРЕПРИМЕНЯЕМ ФИЛЬТРЫ ПОСЛЕ ЗАГРУЗКИ ДАННЫХ
         if active_filters_backup and hasattr(self, 'balance_excel_filter'):
@@ -8973,6 +8541,8 @@ class ProductionApp:
                   command=self.bending_export_table, **btn_style).pack(side=tk.LEFT, padx=5)
         tk.Button(buttons_frame, text="🔄 Обновить", bg='#3498db', fg='white',
                   command=self.refresh_bending_import_table, **btn_style).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons_frame, text="🤖 Автосписание", bg='#16a085', fg='white',
+                  command=self.bending_auto_writeoff, **btn_style).pack(side=tk.LEFT, padx=5)
 
         table_label = tk.Label(self.bending_import_frame,
                                text="📊 Импортированные данные (ПКМ для операций)",
@@ -9091,6 +8661,7 @@ class ProductionApp:
                 sorted_data = self.bending_table_data
 
         written_off_count = cancelled_count = scrap_count = normal_count = 0
+        rendered_values = []
 
         for idx, row_data in enumerate(sorted_data):
             date_val = str(row_data.get("Дата (МСК)", ""))
@@ -9136,6 +8707,7 @@ class ProductionApp:
                     normal_count += 1
 
             item_id = self.bending_import_tree.insert("", idx, values=values, tags=(tag,))
+            rendered_values.append(values)
             row_data['_sort_order'] = idx
             row_data['_item_id'] = item_id
 
@@ -9144,7 +8716,7 @@ class ProductionApp:
                     self.bending_import_excel_filter._all_item_cache = set()
                 self.bending_import_excel_filter._all_item_cache.add(item_id)
 
-        self.auto_resize_columns(self.bending_import_tree, min_width=50, max_width=400)
+        self.auto_resize_columns(self.bending_import_tree, min_width=50, max_width=400, rows=rendered_values)
 
         if active_filters_backup and hasattr(self, 'bending_import_excel_filter'):
             self.bending_import_excel_filter.active_filters = active_filters_backup
@@ -9164,100 +8736,19 @@ class ProductionApp:
             return
 
         try:
-            if file_path.lower().endswith('.csv'):
-                try:
-                    df = pd.read_csv(file_path, sep='\t', encoding='utf-8')
-                except Exception:
-                    try:
-                        df = pd.read_csv(file_path, sep=';', encoding='utf-8')
-                    except Exception:
-                        df = pd.read_csv(file_path, sep=';', encoding='cp1251')
-            else:
-                df = pd.read_excel(file_path, engine='openpyxl')
-
-            required = ["Дата (МСК)", "Время (МСК)", "Оператор", "Заказчик", "Название детали", "Количество"]
-            missing = [col for col in required if col not in df.columns]
-            if missing:
-                messagebox.showerror("Ошибка", f"Отсутствуют обязательные колонки:\n{', '.join(missing)}")
+            try:
+                result = engine.import_bending_file(file_path, getattr(self, 'bending_table_data', None))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
                 return
 
-            # Добавляем необязательные колонки, если их нет
-            for col in ["Материал", "Толщина", "Количество брака", "Тип действия", "Статус", "GroupMessageID"]:
-                if col not in df.columns:
-                    df[col] = ""
-            for col in ["Списано", "Дата списания", "Связанный заказ"]:
-                if col not in df.columns:
-                    df[col] = ""
-
-            def create_bending_row_key(row):
-                return (
-                    str(row.get("Дата (МСК)", "")),
-                    str(row.get("Время (МСК)", "")),
-                    str(row.get("Оператор", "")),
-                    str(row.get("Заказчик", "")),
-                    str(row.get("Название детали", "")),
-                    str(row.get("Количество", ""))
-                )
-
-            existing_rows = {}
-            if hasattr(self, 'bending_table_data') and self.bending_table_data:
-                for row_data in self.bending_table_data:
-                    key = create_bending_row_key(row_data)
-                    existing_rows[key] = {
-                        "Списано": row_data.get("Списано", ""),
-                        "Дата списания": row_data.get("Дата списания", ""),
-                        "Связанный заказ": row_data.get("Связанный заказ", "")
-                    }
-
-            new_rows = []
-            updated_rows = 0
-            for _, row in df.iterrows():
-                row_dict = row.to_dict()
-                key = create_bending_row_key(row_dict)
-                if key in existing_rows:
-                    row_dict["Списано"] = existing_rows[key]["Списано"]
-                    row_dict["Дата списания"] = existing_rows[key]["Дата списания"]
-                    row_dict["Связанный заказ"] = existing_rows[key]["Связанный заказ"]
-                    updated_rows += 1
-                else:
-                    row_dict.setdefault("Списано", "")
-                    row_dict.setdefault("Дата списания", "")
-                    row_dict.setdefault("Связанный заказ", "")
-                new_rows.append(row_dict)
-
-            new_keys = {create_bending_row_key(r) for r in new_rows}
-            merged_data = []
-            new_count = 0
-
-            if hasattr(self, 'bending_table_data') and self.bending_table_data:
-                for old_row in self.bending_table_data:
-                    if create_bending_row_key(old_row) in new_keys:
-                        merged_data.append(old_row)
-
-            for new_row in new_rows:
-                if create_bending_row_key(new_row) not in existing_rows:
-                    merged_data.append(new_row)
-                    new_count += 1
-
-            self.bending_table_data = merged_data
-
-            # Сортировка: новые сверху
-            try:
-                df_merged = pd.DataFrame(self.bending_table_data)
-                df_merged['_datetime_sort'] = pd.to_datetime(
-                    df_merged['Дата (МСК)'].astype(str) + ' ' + df_merged['Время (МСК)'].astype(str),
-                    errors='coerce'
-                )
-                df_merged = df_merged.sort_values('_datetime_sort', ascending=False, na_position='last')
-                df_merged = df_merged.drop('_datetime_sort', axis=1)
-                self.bending_table_data = df_merged.to_dict('records')
-            except Exception as e:
-                print(f"⚠️ Ошибка сортировки после импорта гибщиков: {e}")
+            self.bending_table_data = result["rows"]
+            new_count = result["new"]
+            updated_rows = result["updated"]
 
             self.refresh_bending_import_table()
             self.bending_import_tree.update_idletasks()
             self.bending_import_frame.update()
-            self.auto_resize_columns(self.bending_import_tree)
 
             items_count = len(self.bending_import_tree.get_children())
 
@@ -9272,12 +8763,16 @@ class ProductionApp:
             except Exception as cache_err:
                 print(f"⚠️ Не удалось сохранить кэш гибщиков: {cache_err}")
 
-            messagebox.showinfo("Успех",
+            result_msg = (
                 f"✅ Импорт завершён!\n\n"
                 f"📊 Всего записей: {items_count}\n"
                 f"🆕 Новых: {new_count}\n"
                 f"🔄 Сохранено статусов: {updated_rows}"
             )
+            if not result["report"].empty:
+                result_msg += f"\n⚠️ Ошибок в строках файла: {len(result['report'])}"
+            messagebox.showinfo("Успех", result_msg)
+            self.offer_import_error_report(result["report"])
 
         except Exception as e:
             messagebox.showerror("Ошибка импорта", f"Не удалось импортировать файл:\n\n{str(e)}")
@@ -9368,7 +8863,7 @@ class ProductionApp:
     @staticmethod
     def bending_similarity(a, b):
         """Процент схожести двух строк (0-100) по алгоритму SequenceMatcher"""
-        return int(SequenceMatcher(None, str(a).lower(), str(b).lower()).ratio() * 100)
+        return engine.bending_similarity(a, b)
 
     def bending_writeoff_selected(self):
         """Умное сопоставление и списание деталей от гибщиков"""
@@ -9400,6 +8895,131 @@ class ProductionApp:
         row_data = self.bending_table_data[item_index]
         self._open_bending_writeoff_dialog(item, item_index, row_data)
 
+    def bending_auto_writeoff(self):
+        """Пакетное автосписание всех ожидающих строк гибщиков"""
+        pending_count = sum(1 for r in self.bending_table_data
+                            if not str(r.get("Списано", "")).strip().startswith("✓"))
+        if not pending_count:
+            messagebox.showinfo("Информация", "Нет строк, ожидающих списания")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Автосписание гибки")
+        dialog.geometry("460x230")
+        dialog.configure(bg='#ecf0f1')
+        dialog.grab_set()
+
+        tk.Label(dialog, text="🤖 Автосписание деталей от гибщиков",
+                 font=("Arial", 13, "bold"), bg='#ecf0f1', fg='#16a085').pack(pady=10)
+        tk.Label(dialog,
+                 text=f"Ожидают списания: {pending_count} строк.\n"
+                      f"Строки с уверенным совпадением будут списаны,\n"
+                      f"остальные попадут в список для ручной проверки.",
+                 bg='#ecf0f1', font=("Arial", 10), justify=tk.LEFT).pack(padx=15)
+
+        threshold_frame = tk.Frame(dialog, bg='#ecf0f1')
+        threshold_frame.pack(pady=10)
+        tk.Label(threshold_frame, text="Минимальная схожесть, %:", bg='#ecf0f1',
+                 font=("Arial", 10)).pack(side=tk.LEFT)
+        threshold_var = tk.IntVar(value=getattr(self, 'bending_auto_threshold', engine.BENDING_AUTO_MATCH_THRESHOLD))
+        tk.Spinbox(threshold_frame, from_=50, to=100, textvariable=threshold_var, width=5,
+                   font=("Arial", 10)).pack(side=tk.LEFT, padx=5)
+
+        def run():
+            try:
+                threshold = int(threshold_var.get())
+            except (tk.TclError, ValueError):
+                messagebox.showwarning("Предупреждение", "Введите число от 50 до 100", parent=dialog)
+                return
+            self.bending_auto_threshold = threshold
+            dialog.destroy()
+
+            try:
+                with engine.undo_group("Автосписание гибки", bending_rows=self.bending_table_data):
+                    result = engine.auto_writeoff_bending_rows(self.bending_table_data, threshold=threshold)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Ошибка автосписания:\n{e}")
+                import traceback
+                traceback.print_exc()
+                return
+
+            if result["applied"]:
+                self.refresh_bending_import_table()
+                self.save_bending_import_cache()
+            self._show_bending_review_dialog(result)
+
+        btn_frame = tk.Frame(dialog, bg='#ecf0f1')
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="▶ Запустить", bg='#27ae60', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=run).pack(side=tk.LEFT, padx=8)
+        tk.Button(btn_frame, text="❌ Отмена", bg='#e74c3c', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=dialog.destroy).pack(side=tk.LEFT, padx=8)
+
+    def _show_bending_review_dialog(self, result):
+        """Итог автосписания и очередь строк для ручной проверки"""
+        review = result["review"]
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Результат автосписания")
+        dialog.geometry("1000x520")
+        dialog.configure(bg='#ecf0f1')
+
+        tk.Label(dialog,
+                 text=f"✅ Списано автоматически: {len(result['applied'])}   |   "
+                      f"🔍 Требуют проверки: {len(review)}",
+                 font=("Arial", 12, "bold"), bg='#ecf0f1', fg='#2c3e50').pack(pady=10)
+
+        if not review:
+            tk.Button(dialog, text="Закрыть", bg='#3498db', fg='white', font=("Arial", 11, "bold"),
+                      width=14, command=dialog.destroy).pack(pady=10)
+            return
+
+        tree_frame = tk.Frame(dialog, bg='#ecf0f1')
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=15, pady=5)
+        columns = ("Дата", "Время", "Заказчик", "Деталь", "Кол-во", "Лучшее совпадение", "Причина")
+        review_tree = ttk.Treeview(tree_frame, columns=columns, show='headings', height=15)
+        widths = (80, 60, 130, 180, 60, 250, 220)
+        for col, width in zip(columns, widths):
+            review_tree.heading(col, text=col)
+            review_tree.column(col, width=width, anchor=tk.W)
+        scroll_y = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=review_tree.yview)
+        review_tree.configure(yscrollcommand=scroll_y.set)
+        scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+        review_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        for i, match in enumerate(review):
+            row = match["row"]
+            best = match["candidates"][0] if match["candidates"] else None
+            best_text = f"[{best['combined']}%] {best['detail_name']} ({best['order_name']})" if best else "—"
+            review_tree.insert("", "end", iid=str(i), values=(
+                row.get("Дата (МСК)", ""), row.get("Время (МСК)", ""), row.get("Заказчик", ""),
+                row.get("Название детали", ""), row.get("Количество", ""), best_text, match["reason"]
+            ))
+
+        def open_selected(event=None):
+            selected = review_tree.selection()
+            if not selected:
+                return
+            row_data = review[int(selected[0])]["row"]
+            if str(row_data.get("Списано", "")).strip().startswith("✓"):
+                review_tree.delete(selected[0])
+                return
+            item_index = next((i for i, r in enumerate(self.bending_table_data) if r is row_data), None)
+            if item_index is None:
+                messagebox.showerror("Ошибка", "Строка больше не найдена в таблице!", parent=dialog)
+                return
+            review_tree.delete(selected[0])
+            self._open_bending_writeoff_dialog(None, item_index, row_data)
+
+        review_tree.bind("<Double-1>", open_selected)
+
+        btn_frame = tk.Frame(dialog, bg='#ecf0f1')
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="🔧 Списать выбранную", bg='#27ae60', fg='white',
+                  font=("Arial", 11, "bold"), width=20, command=open_selected).pack(side=tk.LEFT, padx=8)
+        tk.Button(btn_frame, text="Закрыть", bg='#3498db', fg='white',
+                  font=("Arial", 11, "bold"), width=14, command=dialog.destroy).pack(side=tk.LEFT, padx=8)
+
     def _open_bending_writeoff_dialog(self, tree_item, item_index, row_data):
         """Открыть диалог умного списания гибки"""
         part_name = str(row_data.get("Название детали", ""))
@@ -9419,38 +9039,10 @@ class ProductionApp:
             return
 
         # Фильтруем только заказы со статусом "В работе"
-        if not orders_df.empty and "Статус" in orders_df.columns:
-            orders_df = orders_df[orders_df["Статус"] == "В работе"].reset_index(drop=True)
+        orders_df = engine.active_orders(orders_df)
 
         # Поиск кандидатов с нечётким сравнением
-        candidates = []
-        if not order_details_df.empty and not orders_df.empty:
-            for _, order_row in orders_df.iterrows():
-                order_id = order_row.get("ID заказа")
-                order_name = str(order_row.get("Название заказа", ""))
-                order_customer = str(order_row.get("Заказчик", ""))
-                details = order_details_df[order_details_df["ID заказа"] == order_id]
-                customer_sim = self.bending_similarity(customer, order_customer)
-                for _, detail_row in details.iterrows():
-                    detail_name = str(detail_row.get("Название детали", ""))
-                    part_sim = self.bending_similarity(part_name, detail_name)
-                    combined = int(customer_sim * BENDING_CUSTOMER_SIM_WEIGHT + part_sim * BENDING_PART_SIM_WEIGHT)
-                    bent_raw = detail_row.get("Погнуто", 0)
-                    bent_qty = int(bent_raw) if pd.notna(bent_raw) else 0
-                    candidates.append({
-                        "combined": combined,
-                        "part_sim": part_sim,
-                        "customer_sim": customer_sim,
-                        "order_id": order_id,
-                        "order_name": order_name,
-                        "order_customer": order_customer,
-                        "detail_id": detail_row.get("ID"),
-                        "detail_name": detail_name,
-                        "required_qty": int(detail_row.get("Количество", 0)),
-                        "bent_qty": bent_qty,
-                    })
-
-        candidates.sort(key=lambda x: x["combined"], reverse=True)
+        candidates = engine.find_bending_candidates(row_data, orders_df, order_details_df)
         top5 = candidates[:5]
 
         # Диалог
@@ -9732,71 +9324,28 @@ class ProductionApp:
                                    mark_done=True):
         """Выполнить списание гибки: записать в BendingWriteOffs и обновить Погнуто.
         mark_done=False используется при частичном списании (остаток будет распределён позже)."""
-        try:
-            bwo_df = load_data("BendingWriteOffs")
-        except Exception:
-            bwo_df = pd.DataFrame()
-
-        _bwo_cols = ["ID списания", "ID импорта гибки", "ID заказа", "ID детали",
-                     "Название детали", "Количество", "Дата списания", "Оператор", "Комментарий", "Тип"]
-        if bwo_df.empty or not all(c in bwo_df.columns for c in _bwo_cols):
-            bwo_df = pd.DataFrame(columns=_bwo_cols)
-
-        import_key = "|".join([
-            str(row_data.get("Дата (МСК)", "")),
-            str(row_data.get("Время (МСК)", "")),
-            str(row_data.get("Оператор", "")),
-            str(row_data.get("Название детали", "")),
-            str(row_data.get("Количество", ""))
-        ])
-
-        new_id = 1 if bwo_df.empty else int(bwo_df["ID списания"].max()) + 1
-        new_entry = pd.DataFrame([{
-            "ID списания": new_id,
-            "ID импорта гибки": import_key,
-            "ID заказа": order_id,
-            "ID детали": detail_id if detail_id is not None else "",
-            "Название детали": detail_name,
-            "Количество": quantity,
-            "Дата списания": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "Оператор": str(row_data.get("Оператор", "")),
-            "Комментарий": comment,
-            "Тип": writeoff_type
-        }])
-
-        bwo_df = pd.concat([bwo_df, new_entry], ignore_index=True)
-        save_data("BendingWriteOffs", bwo_df)
-
-        # Обновляем "Погнуто" в OrderDetails
-        if detail_id is not None:
-            try:
-                od_df = load_data("OrderDetails")
-                if not od_df.empty:
-                    if "Погнуто" not in od_df.columns:
-                        od_df["Погнуто"] = 0
-                    mask = od_df["ID"] == detail_id
-                    if mask.any():
-                        old_val = od_df.loc[mask, "Погнуто"].iloc[0]
-                        old_val = int(old_val) if pd.notna(old_val) else 0
-                        od_df.loc[mask, "Погнуто"] = old_val + quantity
-                        save_data("OrderDetails", od_df)
-                        print(f"✅ Погнуто обновлено: {old_val} → {old_val + quantity} (деталь ID={detail_id})")
-            except Exception as e:
-                print(f"⚠️ Ошибка обновления Погнуто: {e}")
+        # Пока был открыт диалог, строку могли списать через vitaka_api
+        with engine.data_lock:
+            if self._merge_foreign_cache(vitaka_watch.BENDING):
+                self.refresh_bending_import_table()
+        if str(row_data.get("Списано", "")).startswith("✓"):
+            raise ValueError("Строка уже списана другой программой (HTTP-сервис)")
 
-        if mark_done:
-            # Помечаем строку как списанную
-            self.bending_table_data[item_index]["Списано"] = "✓"
-            self.bending_table_data[item_index]["Дата списания"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-            self.bending_table_data[item_index]["Связанный заказ"] = order_name
+        with engine.undo_group(f"Списание гибки: {detail_name}", bending_rows=self.bending_table_data):
+            engine.perform_bending_writeoff(row_data, order_id, detail_id, detail_name, quantity,
+                                            writeoff_type, comment)
+
+            if mark_done:
+                # Помечаем строку как списанную
+                self.bending_table_data[item_index]["Списано"] = "✓"
+                self.bending_table_data[item_index]["Дата списания"] = datetime.now().strftime("%Y-%m-%d %H:%M")
+                self.bending_table_data[item_index]["Связанный заказ"] = order_name
 
+        if mark_done:
             self.refresh_bending_import_table()
             self.save_bending_import_cache()
 
-            if hasattr(self, 'refresh_details'):
-                self.refresh_details()
-            if hasattr(self, 'refresh_orders'):
-                self.refresh_orders()
+            self.request_refresh("refresh_details", "refresh_orders")
 
             messagebox.showinfo("Успех",
                 f"✅ Деталь '{detail_name}' списана!\n"
@@ -9816,8 +9365,7 @@ class ProductionApp:
             return
 
         # Фильтруем только заказы со статусом "В работе"
-        if not orders_df.empty and "Статус" in orders_df.columns:
-            orders_df = orders_df[orders_df["Статус"] == "В работе"].reset_index(drop=True)
+        orders_df = engine.active_orders(orders_df)
 
         if orders_df.empty:
             messagebox.showwarning("Предупреждение",
@@ -10091,10 +9639,7 @@ class ProductionApp:
             self.bending_table_data[item_index]["Связанный заказ"] = first_order_name
             self.refresh_bending_import_table()
             self.save_bending_import_cache()
-            if hasattr(self, 'refresh_details'):
-                self.refresh_details()
-            if hasattr(self, 'refresh_orders'):
-                self.refresh_orders()
+            self.request_refresh("refresh_details", "refresh_orders")
 
             dialog.destroy()
             messagebox.showinfo(
@@ -10213,39 +9758,7 @@ class ProductionApp:
 
     def _log_bending_manual_writeoff(self, row_data, comment):
         """Записать ручное списание в BendingWriteOffs"""
-        try:
-            bwo_df = load_data("BendingWriteOffs")
-        except Exception:
-            bwo_df = pd.DataFrame()
-
-        _bwo_cols = ["ID списания", "ID импорта гибки", "ID заказа", "ID детали",
-                     "Название детали", "Количество", "Дата списания", "Оператор", "Комментарий", "Тип"]
-        if bwo_df.empty or not all(c in bwo_df.columns for c in _bwo_cols):
-            bwo_df = pd.DataFrame(columns=_bwo_cols)
-
-        import_key = "|".join([
-            str(row_data.get("Дата (МСК)", "")),
-            str(row_data.get("Время (МСК)", "")),
-            str(row_data.get("Оператор", "")),
-            str(row_data.get("Название детали", "")),
-            str(row_data.get("Количество", ""))
-        ])
-
-        new_id = 1 if bwo_df.empty else int(bwo_df["ID списания"].max()) + 1
-        new_entry = pd.DataFrame([{
-            "ID списания": new_id,
-            "ID импорта гибки": import_key,
-            "ID заказа": "",
-            "ID детали": "",
-            "Название детали": str(row_data.get("Название детали", "")),
-            "Количество": str(row_data.get("Количество", "")),
-            "Дата списания": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "Оператор": str(row_data.get("Оператор", "")),
-            "Комментарий": comment,
-            "Тип": "ручной"
-        }])
-        bwo_df = pd.concat([bwo_df, new_entry], ignore_index=True)
-        save_data("BendingWriteOffs", bwo_df)
+        engine.log_bending_manual_writeoff(row_data, comment)
 
     def bending_unmark_writeoff(self):
         """Отменить списание гибки: восстановить Погнуто и удалить запись"""
@@ -10259,7 +9772,9 @@ class ProductionApp:
             values = self.bending_import_tree.item(item)['values']
             status = str(values[11]).strip() if len(values) > 11 else ""
             if status.startswith("✓"):
-                rows_to_unmark.append(item)
+                item_index = self.bending_import_tree.index(item)
+                if item_index < len(self.bending_table_data):
+                    rows_to_unmark.append(self.bending_table_data[item_index])
 
         if not rows_to_unmark:
             messagebox.showwarning("Предупреждение", "Нет списанных строк для отмены!")
@@ -10271,60 +9786,15 @@ class ProductionApp:
             return
 
         try:
-            bwo_df = load_data("BendingWriteOffs")
-        except Exception:
-            bwo_df = pd.DataFrame()
-
-        for item in rows_to_unmark:
-            item_index = self.bending_import_tree.index(item)
-            if item_index >= len(self.bending_table_data):
-                continue
-            row_data = self.bending_table_data[item_index]
-            import_key = "|".join([
-                str(row_data.get("Дата (МСК)", "")),
-                str(row_data.get("Время (МСК)", "")),
-                str(row_data.get("Оператор", "")),
-                str(row_data.get("Название детали", "")),
-                str(row_data.get("Количество", ""))
-            ])
-
-            if not bwo_df.empty and "ID импорта гибки" in bwo_df.columns:
-                matching = bwo_df[bwo_df["ID импорта гибки"] == import_key]
-                for _, wo_row in matching.iterrows():
-                    detail_id_raw = wo_row.get("ID детали", "")
-                    wo_qty = wo_row.get("Количество", 0)
-                    if str(detail_id_raw).strip() not in ("", "nan", "None"):
-                        try:
-                            od_df = load_data("OrderDetails")
-                            did = int(float(detail_id_raw))
-                            if "Погнуто" in od_df.columns:
-                                mask = od_df["ID"] == did
-                                if mask.any():
-                                    old_val = od_df.loc[mask, "Погнуто"].iloc[0]
-                                    old_val = int(old_val) if pd.notna(old_val) else 0
-                                    new_val = max(0, old_val - int(float(wo_qty)))
-                                    od_df.loc[mask, "Погнуто"] = new_val
-                                    save_data("OrderDetails", od_df)
-                                    print(f"✅ Погнуто восстановлено: {old_val} → {new_val}")
-                        except Exception as e:
-                            print(f"⚠️ Ошибка восстановления Погнуто: {e}")
-
-                bwo_df = bwo_df[bwo_df["ID импорта гибки"] != import_key]
-
-            self.bending_table_data[item_index]["Списано"] = ""
-            self.bending_table_data[item_index]["Дата списания"] = ""
-            self.bending_table_data[item_index]["Связанный заказ"] = ""
-
-        if not bwo_df.empty:
-            save_data("BendingWriteOffs", bwo_df)
+            engine.reverse_bending_writeoffs(rows_to_unmark)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось отменить списание:\n{e}")
+            return
 
         self.refresh_bending_import_table()
         self.save_bending_import_cache()
 
-        if hasattr(self, 'refresh_details'):
-            self.refresh_details()
-        if hasattr(self, 'refresh_orders'):
-            self.refresh_orders()
+        self.request_refresh("refresh_details", "refresh_orders")
 
         messagebox.showinfo("Успех", f"✅ Отменено списаний: {len(rows_to_unmark)}")
 
@@ -10358,14 +9828,7 @@ class ProductionApp:
         if not file_path:
             return
         try:
-            df = pd.DataFrame(self.bending_table_data)
-            for col in ['_sort_order', '_item_id', '_datetime_sort']:
-                if col in df.columns:
-                    df = df.drop(col, axis=1)
-            if file_path.lower().endswith('.csv'):
-                df.to_csv(file_path, index=False, sep=';', encoding='utf-8')
-            else:
-                df.to_excel(file_path, index=False, engine='openpyxl')
+            engine.export_rows(self.bending_table_data, file_path)
             messagebox.showinfo("Успех", f"Таблица сохранена:\n{file_path}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{e}")
@@ -10375,61 +9838,33 @@ class ProductionApp:
         if not hasattr(self, 'bending_table_data') or not self.bending_table_data:
             return
         try:
-            cache_file = os.path.join(get_database_path(), "bending_import_cache.xlsx")
-            df = pd.DataFrame(self.bending_table_data)
-            for col in ['_sort_order', '_item_id', '_datetime_sort']:
-                if col in df.columns:
-                    df = df.drop(col, axis=1)
-            df.to_excel(cache_file, index=False, engine='openpyxl')
-            print(f"✅ Кэш гибщиков сохранён: {len(self.bending_table_data)} записей → {cache_file}")
+            with engine.data_lock:
+                # Отметки, поставленные другим процессом после нашего чтения, не затираются
+                if self._merge_foreign_cache(vitaka_watch.BENDING):
+                    self.refresh_bending_import_table()
+                engine.save_import_cache(self.bending_table_data, get_bending_cache_path())
+                self.import_cache_stamps[get_bending_cache_path()] = \
+                    engine.import_cache_stamp(get_bending_cache_path())
         except Exception as e:
             print(f"⚠️ Ошибка сохранения кэша гибщиков: {e}")
 
     def load_bending_import_cache(self):
         """Автоматическая загрузка таблицы гибщиков из кэш-файла"""
         try:
-            cache_file = os.path.join(get_database_path(), "bending_import_cache.xlsx")
-
-            if not os.path.exists(cache_file):
-                print(f"ℹ️ Кэш гибщиков не найден: {cache_file}")
-                return
-
-            df = pd.read_excel(cache_file, engine='openpyxl')
-
-            if df.empty:
-                print("ℹ️ Кэш гибщиков пуст")
-                return
-
-            required = ["Дата (МСК)", "Время (МСК)", "Оператор", "Заказчик", "Название детали", "Количество"]
-            if not all(col in df.columns for col in required):
-                print("⚠️ Кэш гибщиков имеет неправильную структуру")
+            with engine.data_lock:
+                rows = engine.load_bending_cache()
+                self.import_cache_stamps[get_bending_cache_path()] = \
+                    engine.import_cache_stamp(get_bending_cache_path())
+            if rows is None:
                 return
 
-            df = df.fillna("")
-
-            try:
-                df['_datetime_sort'] = pd.to_datetime(
-                    df['Дата (МСК)'].astype(str) + ' ' + df['Время (МСК)'].astype(str),
-                    errors='coerce'
-                )
-                df = df.sort_values('_datetime_sort', ascending=False, na_position='last')
-                df = df.drop('_datetime_sort', axis=1)
-            except Exception as e:
-                print(f"⚠️ Ошибка сортировки кэша гибщиков: {e}")
-
-            self.bending_table_data = df.to_dict('records')
-
-            for row in self.bending_table_data:
-                for col in ["Списано", "Дата списания", "Связанный заказ"]:
-                    row[col] = _safe_str(row.get(col, ""))
-
-            print(f"✅ Кэш гибщиков загружен: {len(self.bending_table_data)} записей")
+            self.bending_table_data = rows
 
             if hasattr(self, 'bending_import_tree'):
                 self.refresh_bending_import_table()
 
                 if hasattr(self, 'bending_status_label'):
-                    items_count = len(self.bending_import_tree.get_children())
+                    items_count = len(self.bending_table_data)
                     written = sum(1 for r in self.bending_table_data
                                   if str(r.get("Списано", "")).startswith("✓"))
                     pending = len(self.bending_table_data) - written
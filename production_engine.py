@@ -0,0 +1,3363 @@
+# -*- coding: utf-8 -*-
+"""
+Ядро учёта производства без графического интерфейса.
+
+Здесь собрана вся работа с данными: чтение и запись базы, резервирование,
+списание материалов (вручную, от лазерщиков и гибщиков), отмена списаний,
+импорт файлов и журнал изменений материалов. Функции не используют tkinter,
+поэтому их можно вызывать из скриптов, планировщика и тестов.
+
+Ошибки проверки входных данных сообщаются через ValueError с текстом для
+пользователя; показывать их (messagebox, консоль) — задача вызывающего кода.
+"""
+import os
+import re
+import json
+import threading
+import functools
+import contextlib
+from datetime import datetime
+from difflib import SequenceMatcher
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+DATABASE_FILE = "production_database.xlsx"
+LASER_CACHE_FILE = "laser_import_cache.xlsx"
+BENDING_CACHE_FILE = "bending_import_cache.xlsx"
+SETTINGS_FILE = "app_settings.json"
+
+# Веса для расчёта схожести при поиске деталей гибщиков
+BENDING_CUSTOMER_SIM_WEIGHT = 0.3
+BENDING_PART_SIM_WEIGHT = 0.7
+
+# Пакетное автосписание гибки: минимальная схожесть (%) и отрыв лучшего кандидата от следующего
+BENDING_AUTO_MATCH_THRESHOLD = 85
+BENDING_AUTO_MATCH_MARGIN = 5
+
+# Структура листов базы данных
+SHEET_COLUMNS = {
+    "Materials": [
+        "ID", "Марка", "Толщина", "Длина", "Ширина",
+        "Количество штук", "Общая площадь", "Зарезервировано", "Доступно", "Дата добавления"
+    ],
+    "Orders": ["ID заказа", "Название заказа", "Заказчик", "Дата создания", "Статус", "Примечания"],
+    "OrderDetails": ["ID", "ID заказа", "Название детали", "Количество", "Порезано", "Погнуто", "Материал", "Листов"],
+    "Reservations": [
+        "ID резерва", "ID заказа", "ID детали", "Название детали", "ID материала", "Марка", "Толщина", "Длина",
+        "Ширина", "Зарезервировано штук", "Списано", "Остаток к списанию", "Дата резерва"
+    ],
+    "WriteOffs": [
+        "ID списания", "ID резерва", "ID заказа", "ID материала", "Марка", "Толщина", "Длина", "Ширина",
+        "Количество", "Дата списания", "Комментарий", "ID импорта лазера"
+    ],
+    "MaterialChangeLogs": [
+        "ID лога", "Дата и время", "ID материала", "Марка", "Толщина",
+        "Длина", "Ширина", "Старое кол-во", "Новое кол-во", "Изменение", "Комментарий"
+    ],
+    "BendingWriteOffs": [
+        "ID списания", "ID импорта гибки", "ID заказа", "ID детали",
+        "Название детали", "Количество", "Дата списания", "Оператор", "Комментарий", "Тип"
+    ],
+    "StockMovements": [
+        "ID движения", "Дата и время", "ID материала", "Тип", "Количество", "Резерв",
+        "ID резерва", "ID списания", "Комментарий"
+    ],
+    "StockCheckpoints": ["ID движения", "Дата и время", "ID материала", "Количество штук", "Зарезервировано"],
+    "DetailMovements": [
+        "ID события", "Дата и время", "ID детали", "Операция", "Количество", "Источник", "ID списания", "Комментарий"
+    ],
+}
+
+# Ключ строки листа для поиска изменённых строк при сохранении (по умолчанию — первая колонка)
+SHEET_KEYS = {
+    "StockCheckpoints": ["ID движения", "ID материала"],
+}
+
+# Журналы: строки только дописываются и удаляются, но не меняются — при сохранении сравниваются одни ключи
+APPEND_ONLY_SHEETS = {"StockMovements", "StockCheckpoints", "DetailMovements", "MaterialChangeLogs"}
+
+TEXT_COLUMNS = ["Примечания", "Комментарий", "Описание", "Заметки"]
+
+ORDER_STATUSES = ["Новый", "В работе", "Завершен", "Отменен"]
+
+LASER_REQUIRED_COLUMNS = ["Дата (МСК)", "Время (МСК)", "username", "order", "metal", "metal_quantity", "part",
+                          "part_quantity"]
+BENDING_REQUIRED_COLUMNS = ["Дата (МСК)", "Время (МСК)", "Оператор", "Заказчик", "Название детали", "Количество"]
+
+# Описание металла от лазерщиков: "4.0мм 1500x3000" или "6х1500х3000" (толщина, ширина, длина)
+METAL_DESCRIPTION_PATTERNS = [
+    r'(\d+(?:\.\d+)?)\s*мм\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)',
+    r'(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)\s*[xXхХ×]\s*(\d+(?:\.\d+)?)',
+]
+
+# Статусы колонки "Списано" в таблице лазерщиков
+LASER_DONE_STATUSES = ["✓", "Да", "Yes"]
+LASER_MANUAL_STATUS = "Вручную"
+
+# Служебные поля строк импорта, которые не сохраняются в файлы
+SERVICE_COLUMNS = ['_sort_order', '_item_id', '_datetime_sort']
+
+# Явно заданная папка базы данных (например, из командной строки)
+_database_path_override = None
+
+
+
+def _lock_file(path, blocking=True):
+    """
+    Открыть файл блокировки и взять исключительную блокировку (None — файл недоступен).
+    Без ожидания (blocking=False) занятая блокировка даёт BlockingIOError.
+    """
+    try:
+        lock_file = open(path, "a+b")
+    except OSError:
+        # Папка базы ещё не создана или недоступна на запись — остаётся блокировка потоков
+        return None
+    try:
+        if os.name == "nt":
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if not blocking:
+                        raise BlockingIOError(f"Файл {path} заблокирован")
+                    # LK_LOCK сдаётся примерно через 10 секунд — ждём дальше
+                    continue
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def _unlock_file(lock_file):
+    if lock_file is None:
+        return
+    try:
+        if os.name == "nt":
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+
+class _DataLock:
+    """
+    Блокировка базы для потоков этого процесса и для других процессов: программа, vitaka_api,
+    vitaka_watch и vitaka работают с одними файлами. Внешний вход берёт блокировку файла
+    production_database.xlsx.lock рядом с базой, повторный вход в том же потоке не ждёт.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """Взять блокировку; blocking=False — не ждать, если база занята (тогда False)"""
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                self._file = _lock_file(get_database_file() + ".lock", blocking)
+            except BlockingIOError:
+                self._lock.release()
+                return False
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                file, self._file = self._file, None
+                _unlock_file(file)
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Блокировка для чтения-изменения-записи базы и кэшей импорта из нескольких потоков и процессов.
+# Операции, которые загружают листы, меняют их и сохраняют, выполняются под ней целиком (@_locked).
+data_lock = _DataLock()
+
+
+def _locked(func):
+    """Выполнить операцию чтение-изменение-запись целиком под data_lock"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with data_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+# Кэш разобранной книги: путь, отметка версии файла, {лист: DataFrame}
+_workbook_cache = {"path": None, "stamp": None, "sheets": {}}
+
+
+# ==================== ХРАНИЛИЩЕ ====================
+
+def set_database_path(path):
+    """Задать папку с базой данных вместо настройки из app_settings.json (None — вернуть настройку)"""
+    global _database_path_override
+    _database_path_override = os.path.abspath(path) if path else None
+
+
+def get_database_path():
+    """Получить путь к папке с базой данных из настроек"""
+    if _database_path_override:
+        return _database_path_override
+    try:
+        if os.path.exists(SETTINGS_FILE):
+            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+                return settings.get("database_path", os.path.dirname(os.path.abspath(__file__)))
+    except:
+        pass
+    # По умолчанию - папка программы
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def get_database_file():
+    """Полный путь к файлу базы данных"""
+    return os.path.join(get_database_path(), DATABASE_FILE)
+
+
+def get_laser_cache_path():
+    """Получить путь к файлу кэша лазерщиков из настроек"""
+    return os.path.join(get_database_path(), LASER_CACHE_FILE)
+
+
+def get_bending_cache_path():
+    """Получить путь к файлу кэша гибщиков из настроек"""
+    return os.path.join(get_database_path(), BENDING_CACHE_FILE)
+
+
+def initialize_database():
+    """Создать пустую базу данных со всеми листами, если файла ещё нет"""
+    file_path = get_database_file()
+    if os.path.exists(file_path):
+        return False
+
+    wb = Workbook()
+    wb.remove(wb.active)
+    for sheet_name, columns in SHEET_COLUMNS.items():
+        sheet = wb.create_sheet(sheet_name)
+        sheet.append(columns)
+    wb.save(file_path)
+    print(f"База данных '{file_path}' создана!")
+    return True
+
+
+def _file_stamp(file_path):
+    """Отметка версии файла: время изменения и размер"""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_workbook(file_path):
+    """
+    Все листы базы в виде DataFrame. Файл разбирается заново только если он
+    изменился с прошлого чтения (другое время изменения или размер).
+    Возвращаемые DataFrame — общий кэш, их нельзя изменять.
+    """
+    with data_lock:
+        stamp = _file_stamp(file_path)
+        if _workbook_cache["path"] != file_path or _workbook_cache["stamp"] != stamp:
+            _workbook_cache["sheets"] = pd.read_excel(file_path, sheet_name=None, engine='openpyxl')
+            _workbook_cache["path"] = file_path
+            _workbook_cache["stamp"] = stamp
+        return _workbook_cache["sheets"]
+
+
+# Записи базы этим процессом: (файл, отметка после записи) → отметка до записи (database_changed_since)
+_own_saves = {}
+OWN_SAVES_LIMIT = 100
+
+
+def database_changed_since(stamp):
+    """
+    Перезаписан ли файл базы другим процессом (vitaka_api, vitaka, vitaka_watch) после отметки
+    stamp (_file_stamp). Цепочка записей этого процесса через save_sheets изменением не считается.
+
+    Returns:
+        tuple: (изменён ли другим процессом, текущая отметка файла или None — файла нет)
+    """
+    file_path = get_database_file()
+    with data_lock:
+        try:
+            current = _file_stamp(file_path)
+        except OSError:
+            return False, None
+        seen = current
+        for _ in range(len(_own_saves)):
+            if seen == stamp or (file_path, seen) not in _own_saves:
+                break
+            seen = _own_saves[(file_path, seen)]
+        return seen != stamp, current
+
+
+def _invalidate_workbook_cache():
+    with data_lock:
+        _workbook_cache["path"] = None
+        _workbook_cache["stamp"] = None
+        _workbook_cache["sheets"] = {}
+
+
+def load_data(sheet_name):
+    """Загрузка данных из Excel с учётом пути из настроек"""
+    file_path = get_database_file()
+
+    try:
+        if os.path.exists(file_path):
+            sheets = _read_workbook(file_path)
+            if sheet_name not in sheets:
+                raise ValueError(f"Worksheet named '{sheet_name}' not found")
+            df = sheets[sheet_name].copy()
+
+            # КОНВЕРТИРУЕМ ТЕКСТОВЫЕ КОЛОНКИ (NaN → пустая строка)
+            for col in TEXT_COLUMNS:
+                if col in df.columns:
+                    df[col] = df[col].fillna('').astype(str)
+
+            return df
+        else:
+            print(f"⚠️ Файл базы данных не найден: {file_path}")
+            return pd.DataFrame()
+    except Exception as e:
+        print(f"❌ Ошибка загрузки данных из {sheet_name}: {e}")
+        return pd.DataFrame()
+
+
+def save_sheets(changed_sheets, touched=None):
+    """
+    Сохранение нескольких листов за одну перезапись файла.
+    После записи подписчики subscribe_changes() получают ID изменённых строк.
+
+    Args:
+        changed_sheets: dict {имя листа: DataFrame}
+        touched: dict {имя листа: ключи строк (как в changed_row_ids), которые вызывающий код мог изменить} —
+                 остальные строки этих листов не сравниваются, проверяются только добавленные и удалённые
+
+    Raises:
+        Exception: если файл не удалось записать (ошибка уже выведена в консоль)
+    """
+    file_path = get_database_file()
+    names = ", ".join(changed_sheets)
+
+    with data_lock:
+        try:
+            if os.path.exists(file_path):
+                old_sheets = _read_workbook(file_path)
+                stamp_before = _file_stamp(file_path)
+            else:
+                old_sheets = {}
+                stamp_before = None
+            sheets = {s: df for s, df in old_sheets.items() if s not in changed_sheets}
+            sheets.update(changed_sheets)
+
+            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
+                for s, data in sheets.items():
+                    data.to_excel(writer, sheet_name=s, index=False)
+            _own_saves[(file_path, _file_stamp(file_path))] = stamp_before
+            if len(_own_saves) > OWN_SAVES_LIMIT:
+                del _own_saves[next(iter(_own_saves))]
+
+            print(f"✅ Данные сохранены в {names}")
+        except Exception as e:
+            print(f"❌ Ошибка сохранения данных в {names}: {e}")
+            raise
+        finally:
+            # Типы колонок после записи могут отличаться от переданных — перечитаем при следующей загрузке
+            _invalidate_workbook_cache()
+
+        touched = touched or {}
+        diffs = {s: _sheet_diff(s, old_sheets.get(s), df, touched.get(s)) for s, df in changed_sheets.items()}
+        diffs = {s: diff for s, diff in diffs.items() if diff["ids"]}
+        _record_undo(old_sheets, changed_sheets, diffs)
+        changes = {s: diff["ids"] for s, diff in diffs.items()}
+
+    _publish_changes(changes)
+
+
+# ==================== СОБЫТИЯ ИЗМЕНЕНИЯ ДАННЫХ ====================
+
+_change_listeners = []
+
+
+def subscribe_changes(callback):
+    """
+    Подписка на изменения базы: callback(changes) вызывается после каждого сохранения,
+    changes — {имя листа: множество ID (строкой) изменённых, добавленных и удалённых строк}.
+    """
+    if callback not in _change_listeners:
+        _change_listeners.append(callback)
+
+
+def unsubscribe_changes(callback):
+    if callback in _change_listeners:
+        _change_listeners.remove(callback)
+
+
+def _publish_changes(changes):
+    if not changes:
+        return
+    for callback in list(_change_listeners):
+        try:
+            callback(changes)
+        except Exception as e:
+            print(f"⚠️ Ошибка обработчика изменений: {e}")
+
+
+def _cell_key(value):
+    """Значение ячейки для сравнения: 5 и 5.0, NaN и "" считаются одинаковыми"""
+    if isinstance(value, float) and not pd.isna(value) and value.is_integer():
+        return str(int(value))
+    return _safe_str(value)
+
+
+def _cell_keys(values):
+    """_cell_key для целой колонки (список строк)"""
+    if pd.api.types.is_integer_dtype(values):
+        return [str(v) for v in values.tolist()]
+    return [_cell_key(v) for v in values.tolist()]
+
+
+def _row_keys(df, sheet):
+    """
+    Ключи строк листа (SHEET_KEYS, по умолчанию первая колонка) — pd.Index в порядке строк df;
+    None — ключевых колонок нет. Целочисленный ключ из одной колонки остаётся числами
+    (так быстрее сравниваются большие журналы), остальные — строки _cell_key, составной — через "|".
+    """
+    if df is None or len(df.columns) == 0:
+        return None
+    columns = SHEET_KEYS.get(sheet, [df.columns[0]])
+    if any(col not in df.columns for col in columns):
+        return None
+    if len(columns) == 1 and pd.api.types.is_integer_dtype(df[columns[0]]):
+        return pd.Index(df[columns[0]].to_numpy())
+    parts = [_cell_keys(df[col]) for col in columns]
+    keys = parts[0] if len(parts) == 1 else ["|".join(key) for key in zip(*parts)]
+    return pd.Index(keys, dtype=object)
+
+
+def _text_keys(keys):
+    """Ключи _row_keys строками (как в событиях изменения и в отмене)"""
+    if pd.api.types.is_integer_dtype(keys):
+        return pd.Index([str(key) for key in keys.tolist()], dtype=object)
+    return keys
+
+
+def _keys_isin(keys, ids):
+    """Маска ключей _row_keys, входящих в множество ключей-строк ids"""
+    if pd.api.types.is_integer_dtype(keys):
+        return keys.isin([int(key) for key in ids if key.lstrip("-").isdigit()])
+    return keys.isin(list(ids))
+
+
+def _empty_cells(values):
+    """Маска пустых ячеек массива: NaN/None и "" """
+    empty = pd.isna(values)
+    if values.dtype == object:
+        empty |= values == ""
+    return empty
+
+
+def _rows_differ(old_df, new_df, old_positions, new_positions):
+    """
+    Маска пар строк (old_positions[i], new_positions[i]), которые различаются хотя бы в одной колонке.
+    Колонки сравниваются целиком; по _cell_key перепроверяются только неравные пары (5 и "5", " a" и "a").
+    """
+    differs = np.zeros(len(new_positions), dtype=bool)
+    if not len(new_positions):
+        return differs
+    for column in new_df.columns:
+        new_values = new_df[column].to_numpy()[new_positions]
+        if column not in old_df.columns:
+            differs |= ~_empty_cells(new_values)
+            continue
+        old_values = old_df[column].to_numpy()[old_positions]
+        try:
+            equal = np.asarray(old_values == new_values, dtype=bool)
+            if equal.shape != differs.shape:
+                raise TypeError
+        except (TypeError, ValueError):
+            equal = np.zeros(len(new_positions), dtype=bool)
+        unequal = ~(equal | (_empty_cells(old_values) & _empty_cells(new_values))) & ~differs
+        for i in np.flatnonzero(unequal):
+            if _cell_key(old_values[i]) != _cell_key(new_values[i]):
+                differs[i] = True
+    return differs
+
+
+def _sheet_diff(sheet, old_df, new_df, touched=None):
+    """
+    Разница двух версий листа по ключу строки (SHEET_KEYS).
+
+    Добавленные и удалённые строки находятся по множествам ключей; строки с одинаковым ключом
+    сравниваются по колонкам (_rows_differ) — только если лист не журнал (APPEND_ONLY_SHEETS)
+    и, когда передан touched, только строки с ключами из touched. Строки с повторяющимся
+    ключом считаются изменёнными.
+
+    Returns:
+        dict: ids — множество ключей изменённых, добавленных и удалённых строк;
+              old_keys / new_keys — ключи строк (pd.Index по порядку строк, None — ключа нет)
+    """
+    new_keys = _row_keys(new_df, sheet)
+    old_keys = _row_keys(old_df, sheet) if new_keys is not None else None
+    if old_keys is not None and old_keys.dtype != new_keys.dtype:
+        # Тип ключевой колонки изменился (например, появились пустые ID) — сравниваем строками
+        old_keys, new_keys = _text_keys(old_keys), _text_keys(new_keys)
+    diff = {"ids": set(), "old_keys": old_keys, "new_keys": new_keys}
+    if new_keys is None:
+        return diff
+    if old_keys is None:
+        diff["ids"] = set(_text_keys(new_keys))
+        return diff
+
+    old_unique = ~old_keys.duplicated(keep=False)
+    new_unique = ~new_keys.duplicated(keep=False)
+    changed = [old_keys[~old_unique], new_keys[~new_unique],
+               new_keys[~new_keys.isin(old_keys)], old_keys[~old_keys.isin(new_keys)]]
+
+    if sheet not in APPEND_ONLY_SHEETS:
+        old_positions = np.flatnonzero(old_unique)
+        new_positions = np.flatnonzero(new_unique)
+        matched = old_keys[old_positions].get_indexer(new_keys[new_positions])
+        common = matched >= 0
+        if touched is not None:
+            common &= _keys_isin(new_keys[new_positions], touched)
+        new_positions = new_positions[common]
+        old_positions = old_positions[matched[common]]
+        differs = _rows_differ(old_df, new_df, old_positions, new_positions)
+        changed.append(new_keys[new_positions[differs]])
+
+    diff["ids"] = set().union(*(_text_keys(keys) for keys in changed))
+    return diff
+
+
+def changed_row_ids(old_df, new_df, sheet=None, touched=None):
+    """
+    Ключи строк (SHEET_KEYS листа sheet, по умолчанию первая колонка), которые отличаются
+    между двумя версиями листа. Если старой версии нет — все ключи новой.
+    """
+    return _sheet_diff(sheet, old_df, new_df, touched)["ids"]
+
+
+# ==================== ОТМЕНА И ПОВТОР ОПЕРАЦИЙ ====================
+# Каждое сохранение запоминается как построчная разница листов: строки до и после
+# (по ключу строки, SHEET_KEYS) только для изменённых ключей. Отмена подставляет строки "до"
+# и сохраняет все затронутые листы одной записью; повтор — строки "после".
+# Стек живёт в памяти процесса и сбрасывается при перезапуске программы.
+
+UNDO_LIMIT = 50
+
+# Колонки статуса строк импорта лазерщиков/гибщиков, которые откатываются вместе с операцией
+IMPORT_STATUS_COLUMNS = ["Списано", "Дата списания", "Связанный заказ"]
+
+_undo_stack = []
+_redo_stack = []
+_undo_state = threading.local()
+
+
+def _rows_with_keys(df, ids, sheet):
+    """Строки листа, чей ключ (_row_keys) входит в ids"""
+    keys = _row_keys(df, sheet)
+    if keys is None:
+        return pd.DataFrame()
+    return df[_keys_isin(keys, ids)]
+
+
+def _import_statuses(rows, key_func):
+    """{ключ строки импорта: {колонка статуса: значение}}"""
+    return {key_func(row): {c: row[c] for c in IMPORT_STATUS_COLUMNS if c in row} for row in rows}
+
+
+def _import_sources():
+    """Кэши импорта, статусы которых могут участвовать в отмене: имя → (ключ строки, загрузка, путь)"""
+    return {
+        "laser": (laser_row_key, load_laser_cache, get_laser_cache_path),
+        "bending": (bending_row_key, load_bending_cache, get_bending_cache_path),
+    }
+
+
+@contextlib.contextmanager
+def undo_group(label, laser_rows=None, bending_rows=None):
+    """
+    Все сохранения внутри блока отменяются и повторяются как одна операция label.
+
+    laser_rows / bending_rows — строки таблиц импорта, которые операция помечает
+    ("Списано", "Дата списания", "Связанный заказ"): при отмене статусы откатываются
+    и в кэш-файле импорта. Вложенный блок входит во внешний.
+    """
+    if getattr(_undo_state, "group", None) is not None:
+        yield _undo_state.group
+        return
+
+    sources = _import_sources()
+    watched = {name: (rows, _import_statuses(rows, sources[name][0]))
+               for name, rows in (("laser", laser_rows), ("bending", bending_rows)) if rows is not None}
+    entry = {"label": label, "sheets": {}, "imports": {}}
+    _undo_state.group = entry
+    try:
+        yield entry
+    finally:
+        _undo_state.group = None
+        for name, (rows, before) in watched.items():
+            after = _import_statuses(rows, sources[name][0])
+            diff = {key: (before.get(key, {}), status) for key, status in after.items() if before.get(key) != status}
+            if diff:
+                entry["imports"][name] = diff
+        if entry["sheets"] or entry["imports"]:
+            _push_undo(entry)
+
+
+def _push_undo(entry):
+    with data_lock:
+        _undo_stack.append(entry)
+        del _undo_stack[:-UNDO_LIMIT]
+        _redo_stack.clear()
+
+
+def _record_undo(old_sheets, changed_sheets, diffs):
+    """
+    Запомнить разницу сохранения (вызывается из save_sheets). Строки "до" и "после" выбираются
+    по ключам, уже посчитанным в _sheet_diff, без повторного разбора листов.
+    """
+    if getattr(_undo_state, "replaying", False):
+        return
+    group = getattr(_undo_state, "group", None)
+    entry = group if group is not None else {"label": f"Изменение: {', '.join(diffs)}", "sheets": {}, "imports": {}}
+
+    for sheet, sheet_diff in diffs.items():
+        new_df = changed_sheets[sheet]
+        diff = entry["sheets"].get(sheet)
+        if diff is None:
+            diff = entry["sheets"][sheet] = {"ids": set(), "before": pd.DataFrame()}
+        new_ids = sheet_diff["ids"] - diff["ids"]
+        if new_ids:
+            # "до" — состояние строки перед первым изменением внутри операции
+            old_keys = sheet_diff["old_keys"]
+            old_rows = (old_sheets[sheet][_keys_isin(old_keys, new_ids)] if old_keys is not None
+                        else pd.DataFrame())
+            diff["before"] = old_rows.copy() if diff["before"].empty else pd.concat([diff["before"], old_rows])
+            diff["ids"] |= new_ids
+        diff["after"] = new_df[_keys_isin(sheet_diff["new_keys"], diff["ids"])].copy()
+        try:
+            diff["sorted"] = len(new_df.columns) > 0 and new_df[new_df.columns[0]].is_monotonic_increasing
+        except TypeError:
+            diff["sorted"] = False
+
+    if group is None and entry["sheets"]:
+        _push_undo(entry)
+
+
+def _row_signatures(df):
+    """Мультимножество строк для сравнения (5 и 5.0, NaN и "" одинаковы)"""
+    if df is None or df.empty:
+        return []
+    return sorted(tuple(_cell_key(v) for v in row) for row in df[sorted(df.columns)].itertuples(index=False, name=None))
+
+
+def _apply_undo_entry(entry, current_side, target_side):
+    """Заменить строки current_side на target_side во всех листах операции и сохранить одной записью"""
+    changed = {}
+    for sheet, diff in entry["sheets"].items():
+        df = load_data(sheet)
+        current = _rows_with_keys(df, diff["ids"], sheet)
+        expected = diff[current_side]
+        columns = [c for c in expected.columns if c in current.columns] if not expected.empty else list(current.columns)
+        if _row_signatures(current[columns] if columns else current) != _row_signatures(expected[columns] if columns else expected):
+            raise ValueError(f"Лист {sheet} изменён после операции «{entry['label']}».\n"
+                             f"Отмена невозможна — измените данные вручную.")
+        rest = df[~df.index.isin(current.index)] if len(df.columns) else df
+        target = diff[target_side]
+        parts = [part for part in (rest, target) if not part.empty]
+        restored = pd.concat(parts, ignore_index=True) if parts else rest.iloc[0:0]
+        # Порядок восстанавливается, только если вернулись строки (удаление порядок не нарушает)
+        if diff.get("sorted") and not target.empty and len(restored.columns) and not restored.empty:
+            try:
+                restored = restored.sort_values(restored.columns[0], kind="stable", ignore_index=True)
+            except TypeError:
+                pass
+        changed[sheet] = restored
+
+    _undo_state.replaying = True
+    try:
+        if changed:
+            # Сравнивать при сохранении нужно только строки операции
+            save_sheets(changed, touched={sheet: entry["sheets"][sheet]["ids"] for sheet in changed})
+    finally:
+        _undo_state.replaying = False
+
+    sources = _import_sources()
+    side = 0 if target_side == "before" else 1
+    for name, diff in entry["imports"].items():
+        key_func, load_cache, cache_path = sources[name]
+        rows = load_cache()
+        if not rows:
+            continue
+        for row in rows:
+            statuses = diff.get(key_func(row))
+            if statuses is not None:
+                for column in IMPORT_STATUS_COLUMNS:
+                    if column in statuses[0] or column in statuses[1]:
+                        row[column] = statuses[side].get(column, "")
+        save_import_cache(rows, cache_path())
+
+
+def _undo_result(entry):
+    return {"label": entry["label"], "sheets": sorted(entry["sheets"]), "imports": sorted(entry["imports"])}
+
+
+def can_undo():
+    return bool(_undo_stack)
+
+
+def can_redo():
+    return bool(_redo_stack)
+
+
+def undo():
+    """
+    Отменить последнюю операцию.
+
+    Returns:
+        dict: label, sheets, imports (затронутые кэши импорта: "laser"/"bending") или None — отменять нечего
+
+    Raises:
+        ValueError: строки операции с тех пор изменены другой операцией
+    """
+    with data_lock:
+        if not _undo_stack:
+            return None
+        entry = _undo_stack[-1]
+        _apply_undo_entry(entry, "after", "before")
+        _redo_stack.append(_undo_stack.pop())
+    print(f"↩️ Отменено: {entry['label']}")
+    return _undo_result(entry)
+
+
+def redo():
+    """Повторить последнюю отменённую операцию (как undo(): dict или None)"""
+    with data_lock:
+        if not _redo_stack:
+            return None
+        entry = _redo_stack[-1]
+        _apply_undo_entry(entry, "before", "after")
+        _undo_stack.append(_redo_stack.pop())
+    print(f"↪️ Повторено: {entry['label']}")
+    return _undo_result(entry)
+
+
+def save_data(sheet_name, df):
+    """Сохранение одного листа в Excel с учётом пути из настроек"""
+    save_sheets({sheet_name: df})
+
+
+def _safe_str(value):
+    """Преобразует значение в строку, заменяя пустые/null значения на пустую строку"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and pd.isna(value):
+        return ""
+    s = str(value).strip()
+    return "" if s in ('nan', 'None', 'NaN') else s
+
+
+def _safe_int(value, default=0):
+    """Целое из ячейки Excel: пустые и нечисловые значения превращаются в default"""
+    try:
+        if value is None or value == "" or pd.isna(value):
+            return default
+        return int(float(value))
+    except (ValueError, TypeError):
+        return default
+
+
+def _next_id(df, column, empty_value=1):
+    """Следующий свободный ID в колонке (empty_value — для пустого листа)"""
+    if df.empty or column not in df.columns or df[column].dropna().empty:
+        return empty_value
+    return int(df[column].max()) + 1
+
+
+def _sheet_or_empty(sheet_name):
+    """Загрузить лист; если его нет — пустой DataFrame с нужными колонками, недостающие колонки добавляются"""
+    df = load_data(sheet_name)
+    columns = SHEET_COLUMNS[sheet_name]
+    if df.empty and len(df.columns) == 0:
+        return pd.DataFrame(columns=columns)
+    for col in columns:
+        if col not in df.columns:
+            df[col] = ""
+    return df
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M")
+
+
+# ==================== ЖУРНАЛ ДВИЖЕНИЙ СКЛАДА ====================
+# Источник истины по наличию и резерву — лист StockMovements: каждое изменение склада
+# (поступление, резерв, снятие резерва, списание, отмена списания, корректировка) дописывается
+# в журнал. "Количество штук", "Зарезервировано", "Доступно" и "Общая площадь" в Materials —
+# проекция журнала, которая обновляется по каждому движению. StockCheckpoints хранит снимки
+# проекции, чтобы пересчёт по журналу начинался с последнего снимка, а не с первого движения.
+
+MOVEMENT_RECEIPT = "Поступление"
+MOVEMENT_RESERVE = "Резерв"
+MOVEMENT_UNRESERVE = "Снятие резерва"
+MOVEMENT_WRITEOFF = "Списание"
+MOVEMENT_REVERSAL = "Отмена списания"
+MOVEMENT_CORRECTION = "Корректировка"
+
+# Снимок проекции пишется перед первым движением каждого дня (хранятся все) и каждые
+# STOCK_CHECKPOINT_INTERVAL движений (хранятся последние STOCK_CHECKPOINTS_KEEP)
+STOCK_CHECKPOINT_INTERVAL = 500
+STOCK_CHECKPOINTS_KEEP = 5
+
+STOCK_ON_DATE_COLUMNS = ["ID", "Марка", "Толщина", "Длина", "Ширина", "Количество штук", "Общая площадь",
+                         "Зарезервировано", "Доступно"]
+
+STOCK_VERIFY_COLUMNS = ["ID", "Марка", "Толщина", "Длина", "Ширина", "Количество штук", "Количество (журнал)",
+                        "Зарезервировано", "Зарезервировано (журнал)"]
+
+
+def stock_movement(material_id, movement_type, quantity=0, reserved=0, reserve_id="", writeoff_id="", comment=""):
+    """
+    Движение склада для commit_stock_movements.
+
+    Args:
+        quantity: изменение "Количество штук" (со знаком)
+        reserved: изменение "Зарезервировано" (со знаком)
+    """
+    return {"ID материала": _safe_int(material_id, default=-1), "Тип": movement_type,
+            "Количество": int(quantity), "Резерв": int(reserved),
+            "ID резерва": reserve_id, "ID списания": writeoff_id, "Комментарий": comment}
+
+
+def _material_positions(materials_df):
+    """Словарь ID материала → метка строки в Materials (поиск строки за O(1))"""
+    return {_safe_int(mid, default=-1): label for label, mid in zip(materials_df.index, materials_df["ID"])}
+
+
+def _apply_stock_movement(materials_df, positions, movement):
+    """Применить одно движение к проекции: меняется одна строка, Доступно и площадь пересчитываются"""
+    label = positions.get(movement["ID материала"])
+    if label is None:
+        return
+    quantity = _safe_int(materials_df.at[label, "Количество штук"]) + movement["Количество"]
+    reserved = _safe_int(materials_df.at[label, "Зарезервировано"]) + movement["Резерв"]
+    materials_df.at[label, "Количество штук"] = quantity
+    materials_df.at[label, "Зарезервировано"] = reserved
+    materials_df.at[label, "Доступно"] = quantity - reserved
+    materials_df.at[label, "Общая площадь"] = material_area(materials_df.at[label, "Длина"],
+                                                            materials_df.at[label, "Ширина"], quantity)
+
+
+def _stock_snapshot(materials_df, movement_id):
+    """
+    Снимок проекции после движения movement_id. Материалы без наличия и резерва
+    не записываются — при пересчёте отсутствующий материал считается нулевым.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    snapshot = pd.DataFrame({
+        "ID движения": movement_id,
+        "Дата и время": timestamp,
+        "ID материала": materials_df["ID"].values,
+        "Количество штук": pd.to_numeric(materials_df["Количество штук"], errors="coerce").fillna(0).astype("int64").values,
+        "Зарезервировано": pd.to_numeric(materials_df["Зарезервировано"], errors="coerce").fillna(0).astype("int64").values,
+    }, columns=SHEET_COLUMNS["StockCheckpoints"])
+    return snapshot[(snapshot["Количество штук"] != 0) | (snapshot["Зарезервировано"] != 0)]
+
+
+def commit_stock_movements(changed_sheets, materials_df, movements):
+    """
+    Записать движения в журнал и применить их к проекции Materials.
+
+    Вызывающий код сохраняет changed_sheets одной записью вместе со своими листами:
+    сюда добавляются Materials, StockMovements и, когда нужен снимок, StockCheckpoints.
+    Движения по материалам, добавленным вручную (ID=-1), и нулевые движения не пишутся.
+
+    Returns:
+        int: ID последнего записанного движения (0 — движений не было)
+    """
+    changed_sheets["Materials"] = materials_df
+    movements = [m for m in movements if m["ID материала"] != -1 and (m["Количество"] or m["Резерв"])]
+    if not movements:
+        return 0
+
+    journal_df = _sheet_or_empty("StockMovements")
+    checkpoints_df = _sheet_or_empty("StockCheckpoints")
+    last_id = _next_id(journal_df, "ID движения") - 1
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    has_snapshot = not checkpoints_df.empty and (checkpoints_df["ID движения"] == last_id).any()
+    if not has_snapshot and (checkpoints_df.empty or str(checkpoints_df["Дата и время"].iloc[-1])[:10] != today):
+        # Первое движение дня (или журнала): остатки на начало дня становятся снимком.
+        # Если последним снимком вчера был интервальный на last_id, он и есть остатки на начало дня
+        checkpoints_df = pd.concat([checkpoints_df, _stock_snapshot(materials_df, last_id)], ignore_index=True)
+        changed_sheets["StockCheckpoints"] = checkpoints_df
+
+    materials_df["Общая площадь"] = materials_df["Общая площадь"].astype(float)
+    positions = _material_positions(materials_df)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for movement in movements:
+        last_id += 1
+        movement["ID движения"] = last_id
+        movement["Дата и время"] = timestamp
+        _apply_stock_movement(materials_df, positions, movement)
+
+    new_rows = pd.DataFrame(movements, columns=SHEET_COLUMNS["StockMovements"])
+    journal_df = new_rows if journal_df.empty else pd.concat([journal_df, new_rows], ignore_index=True)
+    changed_sheets["StockMovements"] = journal_df
+
+    last_checkpoint = _safe_int(checkpoints_df["ID движения"].max()) if not checkpoints_df.empty else 0
+    if last_id - last_checkpoint >= STOCK_CHECKPOINT_INTERVAL:
+        checkpoints_df = pd.concat([checkpoints_df, _stock_snapshot(materials_df, last_id)], ignore_index=True)
+        # Дневные снимки (первый за каждый день) хранятся всегда — по ним считаются остатки на дату
+        days = checkpoints_df["Дата и время"].astype(str).str[:10]
+        daily_ids = set(checkpoints_df["ID движения"].groupby(days).min())
+        other_ids = sorted(set(checkpoints_df["ID движения"]) - daily_ids)
+        keep = daily_ids.union(other_ids[-STOCK_CHECKPOINTS_KEEP:])
+        changed_sheets["StockCheckpoints"] = checkpoints_df[checkpoints_df["ID движения"].isin(keep)]
+
+    return last_id
+
+
+def replay_stock(until_movement_id=None):
+    """
+    Остатки по журналу движений: последний снимок не позже until_movement_id плюс сумма
+    движений после него (один groupby, без прохода по всему журналу).
+
+    Returns:
+        DataFrame: ID материала, Количество штук, Зарезервировано, Доступно
+    """
+    journal_df = _sheet_or_empty("StockMovements")
+    checkpoints_df = _sheet_or_empty("StockCheckpoints")
+    if until_movement_id is None:
+        until_movement_id = _next_id(journal_df, "ID движения") - 1
+
+    base = pd.DataFrame(columns=["Количество штук", "Зарезервировано"], dtype="int64")
+    base_id = 0
+    if not checkpoints_df.empty:
+        earlier = checkpoints_df[checkpoints_df["ID движения"] <= until_movement_id]
+        if not earlier.empty:
+            base_id = int(earlier["ID движения"].max())
+            # Один снимок на ID движения (в старых базах дневной снимок мог повторять интервальный)
+            snapshot = earlier[earlier["ID движения"] == base_id].drop_duplicates("ID материала")
+            base = snapshot.set_index("ID материала")[["Количество штук", "Зарезервировано"]].astype("int64")
+
+    if not journal_df.empty:
+        ids = journal_df["ID движения"]
+        tail = journal_df[(ids > base_id) & (ids <= until_movement_id)]
+        deltas = tail.groupby("ID материала")[["Количество", "Резерв"]].sum().astype("int64")
+        deltas.columns = ["Количество штук", "Зарезервировано"]
+        base = base.add(deltas, fill_value=0).astype("int64")
+
+    result = base.rename_axis("ID материала").reset_index()
+    result["Доступно"] = result["Количество штук"] - result["Зарезервировано"]
+    return result
+
+
+def stock_start_date():
+    """Дата начала журнала движений ("YYYY-MM-DD") или None, если журнал ещё не ведётся"""
+    checkpoints_df = _sheet_or_empty("StockCheckpoints")
+    journal_df = _sheet_or_empty("StockMovements")
+    stamps = [str(df["Дата и время"].iloc[0])[:10] for df in (checkpoints_df, journal_df) if not df.empty]
+    return min(stamps) if stamps else None
+
+
+def stock_on_date(date):
+    """
+    Остатки склада на конец дня date (date/datetime или строка "YYYY-MM-DD").
+
+    Берётся ближайший снимок StockCheckpoints не позже последнего движения этого дня
+    и к нему прибавляются только последующие движения того же дня (см. replay_stock).
+
+    Returns:
+        DataFrame (колонки STOCK_ON_DATE_COLUMNS) с материалами, у которых было наличие или резерв;
+        удалённые с тех пор материалы помечаются в колонке "Марка"
+
+    Raises:
+        ValueError: дата раньше начала журнала движений
+    """
+    day = pd.Timestamp(date).normalize()
+    start = stock_start_date()
+    if start is None:
+        raise ValueError("Журнал движений склада ещё пуст — остатки на дату появятся после первой операции")
+    if day < pd.Timestamp(start):
+        raise ValueError(f"Журнал движений склада ведётся с {start}, остатки на более раннюю дату недоступны")
+
+    journal_df = _sheet_or_empty("StockMovements")
+    until_movement_id = 0
+    if not journal_df.empty:
+        times = pd.to_datetime(journal_df["Дата и время"], errors="coerce")
+        earlier = journal_df.loc[times < day + pd.Timedelta(days=1), "ID движения"]
+        if not earlier.empty:
+            until_movement_id = int(earlier.max())
+
+    stock = replay_stock(until_movement_id)
+    stock = stock[(stock["Количество штук"] != 0) | (stock["Зарезервировано"] != 0)]
+
+    materials_df = load_data("Materials")
+    info = (materials_df.set_index("ID")[["Марка", "Толщина", "Длина", "Ширина"]] if not materials_df.empty
+            else pd.DataFrame(columns=["Марка", "Толщина", "Длина", "Ширина"]))
+    result = stock.rename(columns={"ID материала": "ID"}).join(info, on="ID")
+    result["Марка"] = result["Марка"].fillna("(материал удалён)")
+    result["Общая площадь"] = [
+        material_area(length, width, qty) if pd.notna(length) and pd.notna(width) else 0.0
+        for length, width, qty in zip(result["Длина"], result["Ширина"], result["Количество штук"])
+    ]
+    return result[STOCK_ON_DATE_COLUMNS].sort_values("ID").reset_index(drop=True)
+
+
+def verify_stock_projection():
+    """
+    Сравнить Materials с пересчётом по журналу движений.
+
+    Returns:
+        DataFrame (колонки STOCK_VERIFY_COLUMNS) с материалами, где проекция расходится с журналом;
+        пустой, если журнал ещё не ведётся
+    """
+    materials_df = load_data("Materials")
+    if materials_df.empty or _sheet_or_empty("StockCheckpoints").empty:
+        return pd.DataFrame(columns=STOCK_VERIFY_COLUMNS)
+
+    replayed = replay_stock().set_index("ID материала")
+    quantity = pd.to_numeric(materials_df["Количество штук"], errors="coerce").fillna(0).astype("int64")
+    reserved = pd.to_numeric(materials_df["Зарезервировано"], errors="coerce").fillna(0).astype("int64")
+    journal_quantity = materials_df["ID"].map(replayed["Количество штук"]).fillna(0).astype("int64")
+    journal_reserved = materials_df["ID"].map(replayed["Зарезервировано"]).fillna(0).astype("int64")
+
+    mismatch = (quantity != journal_quantity) | (reserved != journal_reserved)
+    report = materials_df.loc[mismatch, ["ID", "Марка", "Толщина", "Длина", "Ширина"]].copy()
+    report["Количество штук"] = quantity[mismatch]
+    report["Количество (журнал)"] = journal_quantity[mismatch]
+    report["Зарезервировано"] = reserved[mismatch]
+    report["Зарезервировано (журнал)"] = journal_reserved[mismatch]
+    return report[STOCK_VERIFY_COLUMNS].reset_index(drop=True)
+
+
+# ==================== ПРОВЕРКА ФАЙЛОВ ИМПОРТА ====================
+
+IMPORT_ERROR_COLUMNS = ["Лист", "Строка", "Колонка", "Значение", "Ошибка"]
+
+IMPORT_ERROR_MESSAGES = {
+    "required": "Не заполнено",
+    "numeric": "Не число: '{value}'",
+    "positive": "Должно быть больше нуля: {value}",
+    "choices": "Недопустимое значение '{value}'",
+    "pattern": "Неверный формат '{value}'",
+}
+
+# Правила колонок для validate_import (описание ключей — там же)
+IMPORT_RULES = {
+    "Материалы": [
+        {"column": "Толщина", "required": True, "numeric": True, "positive": True},
+        {"column": "Длина", "required": True, "numeric": True, "positive": True},
+        {"column": "Ширина", "required": True, "numeric": True, "positive": True},
+        {"column": "Количество штук", "required": True, "numeric": True},
+    ],
+    "Заказы": [
+        {"column": "Заказчик", "required": True, "messages": {"required": "Отсутствует заказчик"}},
+        {"column": "Статус", "choices": ORDER_STATUSES, "warning": True,
+         "messages": {"choices": "Неверный статус '{value}', установлен 'Новый'"}},
+    ],
+    "Детали": [
+        {"column": "Название детали", "required": True, "messages": {"required": "Отсутствует название детали"}},
+        {"column": "Количество", "required": True, "numeric": True, "integer": True, "positive": True,
+         "label": "Название детали",
+         "messages": {"required": "Отсутствует количество для детали '{label}'",
+                      "numeric": "Неверное количество '{value}' для детали '{label}'",
+                      "positive": "Количество должно быть больше нуля для детали '{label}'"}},
+    ],
+    # Строки лазерщиков и гибщиков импортируются все, ошибки — предупреждения перед списанием
+    "Лазер": [
+        {"column": "Дата (МСК)", "required": True, "warning": True},
+        {"column": "order", "required": True, "warning": True},
+        {"column": "metal", "required": True, "pattern": "|".join(METAL_DESCRIPTION_PATTERNS), "warning": True,
+         "messages": {"pattern": "Не распознан металл '{value}'"}},
+        {"column": "metal_quantity", "required": True, "numeric": True, "positive": True, "warning": True},
+        {"column": "part", "required": True, "warning": True},
+    ],
+    "Гибка": [
+        {"column": "Дата (МСК)", "required": True, "warning": True},
+        {"column": "Название детали", "required": True, "warning": True},
+        {"column": "Количество", "required": True, "numeric": True, "integer": True, "positive": True,
+         "warning": True},
+    ],
+}
+
+
+def _text_column(df, column):
+    """Колонка как строки без пробелов по краям; пустые ячейки и отсутствующая колонка — "" """
+    if column not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    values = df[column]
+    return values.astype(str).str.strip().where(values.notna(), "")
+
+
+def validate_import(df, rules, sheet, key_column=None, first_error_only=False):
+    """
+    Проверка таблицы импорта сразу по целым колонкам (без цикла по строкам).
+
+    Правило — словарь: column — колонка; required — обязательна; numeric — число
+    (integer — проверяется целая часть); positive — больше нуля; choices — список допустимых
+    значений; pattern — регулярное выражение (ищется в любом месте значения); warning — ошибка
+    попадает в отчёт, но строка импортируется; label — колонка, значение которой подставляется
+    в {label} текста ошибки; messages — свои тексты по видам проверок ({value} — значение ячейки).
+    Проверки одного правила идут по порядку, в отчёт попадает первая неудачная.
+
+    Args:
+        key_column: строки с пустым значением этой колонки пропускаются без ошибки
+        first_error_only: строка, не прошедшая правило, дальше не проверяется — в отчёте
+                          одна ошибка на строку (первая по порядку правил)
+
+    Returns:
+        tuple: (отчёт — DataFrame IMPORT_ERROR_COLUMNS, строки файла по порядку;
+                маска строк, которые можно импортировать)
+    """
+    texts = {}
+
+    def text(column):
+        if column not in texts:
+            texts[column] = _text_column(df, column)
+        return texts[column]
+
+    considered = text(key_column) != "" if key_column else pd.Series(True, index=df.index)
+    valid = considered.copy()
+    reported = pd.Series(False, index=df.index)
+    parts = []
+    for rule_index, rule in enumerate(rules):
+        column = rule["column"]
+        values = text(column)
+        filled = considered & (values != "")
+        checks = []
+        if rule.get("required"):
+            checks.append(("required", considered & ~filled))
+        if rule.get("numeric") or rule.get("positive"):
+            raw = df[column] if column in df.columns else values
+            numbers = pd.to_numeric(raw, errors="coerce").replace([np.inf, -np.inf], np.nan)
+            checks.append(("numeric", filled & numbers.isna()))
+            if rule.get("positive"):
+                compared = np.trunc(numbers) if rule.get("integer") else numbers
+                checks.append(("positive", filled & (compared <= 0)))
+        if rule.get("choices") is not None:
+            checks.append(("choices", filled & ~values.isin(list(rule["choices"]))))
+        if rule.get("pattern"):
+            # match вместо contains: в шаблоне могут быть группы, contains на них предупреждает
+            found = values.str.match(f".*?(?:{rule['pattern']})", case=False)
+            checks.append(("pattern", filled & ~found))
+
+        if first_error_only:
+            checks = [(check, mask & ~reported) for check, mask in checks]
+        failed = pd.Series(False, index=df.index)
+        for check, mask in checks:
+            mask = mask & ~failed
+            failed |= mask
+            if not mask.any():
+                continue
+            template = rule.get("messages", {}).get(check, IMPORT_ERROR_MESSAGES[check])
+            bad_values = values[mask]
+            labels = text(rule["label"])[mask] if rule.get("label") else bad_values
+            parts.append(pd.DataFrame({
+                "Лист": sheet,
+                "Строка": bad_values.index + 2,
+                "Колонка": column,
+                "Значение": bad_values.values,
+                "Ошибка": [template.format(value=v, label=l) for v, l in zip(bad_values, labels)],
+                "_rule": rule_index,
+            }))
+        if not rule.get("warning"):
+            valid &= ~failed
+        reported |= failed
+
+    if not parts:
+        return pd.DataFrame(columns=IMPORT_ERROR_COLUMNS), valid
+    report = pd.concat(parts, ignore_index=True).sort_values(["Строка", "_rule"], kind="stable")
+    return report[IMPORT_ERROR_COLUMNS].reset_index(drop=True), valid
+
+
+def import_error_messages(report):
+    """Строки отчёта validate_import в виде текстов "Лист, строка N: ошибка" """
+    return [f"{sheet}, строка {row}: {error}"
+            for sheet, row, error in zip(report["Лист"], report["Строка"], report["Ошибка"])]
+
+
+def export_import_errors(report, file_path):
+    """Сохранить отчёт об ошибках импорта в CSV (';') или Excel"""
+    if file_path.lower().endswith('.csv'):
+        report.to_csv(file_path, index=False, sep=';', encoding='utf-8')
+    else:
+        report.to_excel(file_path, index=False, engine='openpyxl')
+
+
+# ==================== МАТЕРИАЛЫ ====================
+
+def material_area(length, width, quantity):
+    """Общая площадь листов в м²"""
+    return round(float(length) * float(width) * quantity / 1_000_000, 2)
+
+
+def _material_change_log_rows(logs_df, entries):
+    """
+    Строки MaterialChangeLogs для списка изменений (ID лога — подряд после последнего).
+
+    Args:
+        entries: словари с ключами ID материала, Марка, Толщина, Длина, Ширина,
+                 Старое кол-во, Новое кол-во, Комментарий
+    """
+    log_id = _next_id(logs_df, "ID лога")
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for offset, entry in enumerate(entries):
+        change = entry["Новое кол-во"] - entry["Старое кол-во"]
+        rows.append({**entry, "ID лога": log_id + offset, "Дата и время": timestamp,
+                     "Изменение": f"+{change}" if change > 0 else str(change)})  # СТРОКА СО ЗНАКОМ: "+5" или "-3"
+    return pd.DataFrame(rows, columns=SHEET_COLUMNS["MaterialChangeLogs"])
+
+
+@_locked
+def log_material_change(material_id, marka, thickness, length, width, old_qty, new_qty, comment):
+    """Записать изменение количества материала в MaterialChangeLogs. Возвращает ID лога."""
+    logs_df = _sheet_or_empty("MaterialChangeLogs")
+    new_log = _material_change_log_rows(logs_df, [{
+        "ID материала": material_id,
+        "Марка": marka,
+        "Толщина": thickness,
+        "Длина": length,
+        "Ширина": width,
+        "Старое кол-во": old_qty,
+        "Новое кол-во": new_qty,
+        "Комментарий": comment
+    }])
+
+    logs_df = new_log if logs_df.empty else pd.concat([logs_df, new_log], ignore_index=True)
+    save_data("MaterialChangeLogs", logs_df)
+
+    log_id, change_str = int(new_log.at[0, "ID лога"]), new_log.at[0, "Изменение"]
+    print(f"✅ Лог изменения записан: ID материала={material_id}, изменение={change_str}, комментарий='{comment}'")
+    return log_id
+
+
+@_locked
+def add_material(marka, thickness, length, width, quantity):
+    """
+    Добавить материал на склад: строка с нулевым остатком и движение "Поступление".
+
+    Returns:
+        int: ID нового материала
+    """
+    if not marka:
+        raise ValueError("Заполните марку стали!")
+    materials_df = load_data("Materials")
+    new_id = _next_id(materials_df, "ID")
+    new_row = pd.DataFrame([{"ID": new_id, "Марка": marka, "Толщина": thickness, "Длина": length, "Ширина": width,
+                             "Количество штук": 0, "Общая площадь": 0.0, "Зарезервировано": 0, "Доступно": 0,
+                             "Дата добавления": datetime.now().strftime("%Y-%m-%d")}])
+    materials_df = new_row if materials_df.empty else pd.concat([materials_df, new_row], ignore_index=True)
+    changed = {}
+    commit_stock_movements(changed, materials_df, [
+        stock_movement(new_id, MOVEMENT_RECEIPT, quantity=quantity, comment="Добавлен вручную")])
+    save_sheets(changed)
+    return new_id
+
+
+@_locked
+def update_material(material_id, marka, thickness, length, width, quantity, comment=""):
+    """
+    Изменить материал; изменение количества записывается движением "Корректировка".
+
+    Returns:
+        int: старое количество штук
+    """
+    materials_df = load_data("Materials")
+    mask = materials_df["ID"] == material_id
+    if not mask.any():
+        raise ValueError(f"Материал ID={material_id} не найден!")
+    old_qty = _safe_int(materials_df.loc[mask, "Количество штук"].iloc[0])
+
+    materials_df.loc[mask, "Марка"] = marka
+    materials_df.loc[mask, "Толщина"] = thickness
+    materials_df.loc[mask, "Длина"] = length
+    materials_df.loc[mask, "Ширина"] = width
+    changed = {}
+    commit_stock_movements(changed, materials_df, [
+        stock_movement(material_id, MOVEMENT_CORRECTION, quantity=quantity - old_qty, comment=comment)])
+    # Размеры могли измениться без движения — площадь пересчитываем в любом случае
+    materials_df["Общая площадь"] = materials_df["Общая площадь"].astype(float)
+    materials_df.loc[mask, "Общая площадь"] = material_area(length, width, quantity)
+    save_sheets(changed)
+    return old_qty
+
+
+@_locked
+def delete_materials(material_ids):
+    """
+    Удалить материалы со склада. Остаток и резерв обнуляются движением "Корректировка",
+    чтобы журнал сходился с проекцией. Возвращает число удалённых.
+    """
+    materials_df = load_data("Materials")
+    removed = materials_df[materials_df["ID"].isin(material_ids)]
+    movements = [
+        stock_movement(row["ID"], MOVEMENT_CORRECTION, quantity=-_safe_int(row["Количество штук"]),
+                       reserved=-_safe_int(row["Зарезервировано"]), comment="Материал удалён")
+        for _, row in removed.iterrows()
+    ]
+    changed = {}
+    commit_stock_movements(changed, materials_df, movements)
+    changed["Materials"] = materials_df[~materials_df["ID"].isin(material_ids)]
+    save_sheets(changed)
+    return len(removed)
+
+
+def read_materials_file(file_path):
+    """Прочитать файл поставки материалов и проверить обязательные колонки"""
+    import_df = pd.read_excel(file_path, engine='openpyxl')
+    required_columns = ["Марка", "Толщина", "Длина", "Ширина", "Количество штук"]
+    missing_columns = [col for col in required_columns if col not in import_df.columns]
+    if missing_columns:
+        raise ValueError(f"В файле отсутствуют колонки:\n{', '.join(missing_columns)}")
+    return import_df
+
+
+MATERIAL_KEY_COLUMNS = ["Марка", "Толщина", "Длина", "Ширина"]
+
+
+@_locked
+def import_materials(file_path):
+    """
+    Импорт материалов из Excel с объединением дубликатов по (Марка, Толщина, Длина, Ширина).
+
+    Файл проверяется validate_import по целым колонкам, повторы внутри файла суммируются
+    одним groupby, существующие материалы находятся по словарю ключ → ID. Новые материалы
+    добавляются одним concat, на каждый материал пишется одно движение "Поступление"
+    и одна запись MaterialChangeLogs; база сохраняется одной перезаписью файла.
+
+    Returns:
+        dict: imported — число обработанных строк, new / updated — число новых и пополненных
+              материалов, errors — список текстов ошибок, report — отчёт об ошибках по строкам
+    """
+    import_df = read_materials_file(file_path)
+    materials_df = load_data("Materials")
+    comment = f"Импорт из файла {os.path.basename(file_path)}"
+    report, valid = validate_import(import_df, IMPORT_RULES["Материалы"], "Материалы", key_column="Марка")
+    errors = import_error_messages(report)
+
+    parsed = pd.DataFrame({"Марка": _text_column(import_df, "Марка")[valid]})
+    for column in ["Толщина", "Длина", "Ширина", "Количество штук"]:
+        parsed[column] = pd.to_numeric(import_df.loc[valid, column], errors="coerce")
+    imported_count = len(parsed)
+    if parsed.empty:
+        return {"imported": 0, "new": 0, "updated": 0, "errors": errors, "report": report}
+    parsed["Количество штук"] = parsed["Количество штук"].astype("int64")
+    incoming = parsed.groupby(MATERIAL_KEY_COLUMNS, sort=False)["Количество штук"].sum()
+
+    known = {}
+    if not materials_df.empty:
+        for mid, key in zip(materials_df["ID"], zip(*(materials_df[c] for c in MATERIAL_KEY_COLUMNS))):
+            known.setdefault(key, int(mid))
+
+    # Новые материалы появляются с нулевым остатком, количество приходит движением "Поступление"
+    new_keys = [key for key in incoming.index if key not in known]
+    next_id = _next_id(materials_df, "ID")
+    if new_keys:
+        new_ids = list(range(next_id, next_id + len(new_keys)))
+        new_df = pd.DataFrame(new_keys, columns=MATERIAL_KEY_COLUMNS)
+        new_df.insert(0, "ID", new_ids)
+        new_df["Количество штук"] = 0
+        new_df["Общая площадь"] = 0.0
+        new_df["Зарезервировано"] = 0
+        new_df["Доступно"] = 0
+        new_df["Дата добавления"] = datetime.now().strftime("%Y-%m-%d")
+        known.update(zip(new_keys, new_ids))
+        materials_df = new_df if materials_df.empty else pd.concat([materials_df, new_df], ignore_index=True)
+
+    positions = _material_positions(materials_df)
+    old_quantities = {mid: _safe_int(materials_df.at[positions[mid], "Количество штук"])
+                      for mid in (known[key] for key in incoming.index)}
+    movements = [stock_movement(known[key], MOVEMENT_RECEIPT, quantity=quantity, comment=comment)
+                 for key, quantity in incoming.items()]
+
+    changed = {}
+    commit_stock_movements(changed, materials_df, movements)
+
+    log_entries = []
+    for mid, old_qty in old_quantities.items():
+        row = materials_df.loc[positions[mid]]
+        new_qty = _safe_int(row["Количество штук"])
+        if new_qty != old_qty:
+            log_entries.append({"ID материала": mid, "Марка": row["Марка"], "Толщина": row["Толщина"],
+                                "Длина": row["Длина"], "Ширина": row["Ширина"],
+                                "Старое кол-во": old_qty, "Новое кол-во": new_qty, "Комментарий": comment})
+    if log_entries:
+        logs_df = _sheet_or_empty("MaterialChangeLogs")
+        new_logs = _material_change_log_rows(logs_df, log_entries)
+        changed["MaterialChangeLogs"] = new_logs if logs_df.empty else pd.concat([logs_df, new_logs],
+                                                                                 ignore_index=True)
+    save_sheets(changed)
+    return {"imported": imported_count, "new": len(new_keys), "updated": len(incoming) - len(new_keys),
+            "errors": errors, "report": report}
+
+
+# ==================== ЗАКАЗЫ ====================
+
+def read_orders_file(file_path):
+    """
+    Прочитать файл импорта заказов (листы "Заказы" и "Детали").
+
+    Returns:
+        tuple: (orders_import_df, details_import_df или None, список предупреждений)
+    """
+    try:
+        orders_import_df = pd.read_excel(file_path, sheet_name="Заказы", engine='openpyxl')
+    except:
+        raise ValueError("В файле отсутствует лист 'Заказы'!\n\nИспользуйте шаблон.")
+
+    try:
+        details_import_df = pd.read_excel(file_path, sheet_name="Детали", engine='openpyxl')
+    except:
+        details_import_df = None
+
+    missing_columns = [col for col in ["Название заказа", "Заказчик"] if col not in orders_import_df.columns]
+    if missing_columns:
+        raise ValueError(f"В листе 'Заказы' отсутствуют колонки:\n{', '.join(missing_columns)}\n\n"
+                         f"Используйте кнопку 'Скачать шаблон'.")
+
+    warnings = []
+    if details_import_df is not None and not details_import_df.empty:
+        required_columns_details = ["Название заказа", "Название детали", "Количество"]
+        missing_details = [col for col in required_columns_details if col not in details_import_df.columns]
+        if missing_details:
+            warnings.append(f"В листе 'Детали' отсутствуют колонки:\n{', '.join(missing_details)}\n\n"
+                            f"Детали не будут импортированы.")
+            details_import_df = None
+
+    if details_import_df is not None and details_import_df.empty:
+        details_import_df = None
+
+    return orders_import_df, details_import_df, warnings
+
+
+@_locked
+def import_orders(file_path):
+    """
+    Импорт заказов и их деталей из Excel.
+
+    Строки проверяются validate_import по целым колонкам, заказам и деталям выделяются блоки ID подряд,
+    детали связываются с заказами по названию одним map, оба листа дополняются одним concat
+    и сохраняются одной записью.
+
+    Returns:
+        dict: orders, details — число импортированных записей,
+              errors — список ошибок по строкам, report — те же ошибки таблицей (для выгрузки),
+              warnings — предупреждения о структуре файла
+    """
+    orders_import_df, details_import_df, warnings = read_orders_file(file_path)
+
+    orders_df = load_data("Orders")
+    order_details_df = load_data("OrderDetails")
+
+    # ---- Заказы ----
+    orders_report, valid = validate_import(orders_import_df, IMPORT_RULES["Заказы"], "Заказы",
+                                           key_column="Название заказа", first_error_only=True)
+    names = _text_column(orders_import_df, "Название заказа")
+    statuses = _text_column(orders_import_df, "Статус")
+
+    first_order_id = 1001 if orders_df.empty else int(orders_df["ID заказа"].max()) + 1
+    new_orders = pd.DataFrame({
+        "ID заказа": range(first_order_id, first_order_id + int(valid.sum())),
+        "Название заказа": names[valid].values,
+        "Заказчик": _text_column(orders_import_df, "Заказчик")[valid].values,
+        "Дата создания": datetime.now().strftime("%Y-%m-%d"),
+        "Статус": statuses[valid].where(statuses[valid].isin(ORDER_STATUSES), "Новый").values,
+        "Примечания": _text_column(orders_import_df, "Примечания")[valid].values,
+    })
+    # Повтор названия в файле — детали привязываются к последнему заказу, как при построчном импорте
+    order_name_to_id = new_orders.drop_duplicates("Название заказа", keep="last").set_index("Название заказа")["ID заказа"]
+
+    # ---- Детали ----
+    reports = [orders_report]
+    new_details = pd.DataFrame(columns=SHEET_COLUMNS["OrderDetails"])
+    if details_import_df is not None:
+        order_rule = {"column": "Название заказа", "choices": order_name_to_id.index,
+                      "messages": {"choices": "Заказ '{value}' не найден в листе 'Заказы'"}}
+        # Как при построчном импорте: одна ошибка на строку — заказ, затем название, затем количество
+        details_report, valid_details = validate_import(details_import_df, [order_rule] + IMPORT_RULES["Детали"],
+                                                        "Детали", key_column="Название заказа",
+                                                        first_error_only=True)
+        reports.append(details_report)
+        order_ids = _text_column(details_import_df, "Название заказа").map(order_name_to_id)
+        quantity = pd.to_numeric(details_import_df["Количество"], errors="coerce")
+
+        first_detail_id = _next_id(order_details_df, "ID")
+        sheets = details_import_df["Листов"] if "Листов" in details_import_df.columns else pd.Series(
+            np.nan, index=details_import_df.index)
+        new_details = pd.DataFrame({
+            "ID": range(first_detail_id, first_detail_id + int(valid_details.sum())),
+            "ID заказа": order_ids[valid_details].astype("int64").values,
+            "Название детали": _text_column(details_import_df, "Название детали")[valid_details].values,
+            "Количество": quantity[valid_details].astype("int64").values,
+            "Порезано": 0,
+            "Погнуто": 0,
+            "Материал": _text_column(details_import_df, "Материал")[valid_details].values,
+            "Листов": pd.to_numeric(sheets[valid_details], errors="coerce").replace([np.inf, -np.inf], np.nan)
+                        .fillna(1).astype("int64").values,
+        })
+
+    if not new_orders.empty:
+        orders_df = new_orders if orders_df.empty else pd.concat([orders_df, new_orders], ignore_index=True)
+    changed = {"Orders": orders_df}
+    if not new_details.empty:
+        changed["OrderDetails"] = (new_details if order_details_df.empty
+                                   else pd.concat([order_details_df, new_details], ignore_index=True))
+    save_sheets(changed)
+
+    report = pd.concat(reports, ignore_index=True) if len(reports) > 1 else orders_report
+    return {"orders": len(new_orders), "details": len(new_details), "errors": import_error_messages(report),
+            "report": report, "warnings": warnings}
+
+
+def find_order_id(orders_df, order_name, allow_partial=True):
+    """
+    Поиск заказа по названию из таблицы импорта.
+
+    Сначала ищется номер "УП-XXX", затем (если allow_partial) частичное совпадение названия.
+    Возвращает ID заказа или None.
+    """
+    if orders_df.empty:
+        return None
+
+    names = orders_df["Название заказа"].astype(str)
+    order_match = None
+
+    up_match = re.search(r'УП-(\d+)', order_name)
+    if up_match:
+        order_match = orders_df[names.str.contains(f"УП-{up_match.group(1)}", case=False, na=False, regex=False)]
+
+    if allow_partial and (order_match is None or order_match.empty):
+        order_match = orders_df[names.str.contains(order_name, case=False, na=False, regex=False)]
+
+    if order_match is None or order_match.empty:
+        return None
+    return int(order_match.iloc[0]["ID заказа"])
+
+
+# ==================== ЖУРНАЛ ПРОИЗВОДСТВА ДЕТАЛЕЙ ====================
+# Источник истины по "Порезано" и "Погнуто" — лист DetailMovements: каждая резка от лазерщиков,
+# гибка, отмена и ручная правка дописывается событием с изменением счётчика. Колонки в OrderDetails —
+# проекция журнала, которая обновляется по каждому событию, поэтому таблицы деталей и статистика
+# читают готовые суммы, а не пересчитывают журналы.
+
+DETAIL_CUT = "Резка"
+DETAIL_BEND = "Гибка"
+DETAIL_COUNTERS = {DETAIL_CUT: "Порезано", DETAIL_BEND: "Погнуто"}
+
+DETAIL_SOURCE_LASER = "Лазер"
+DETAIL_SOURCE_BENDING = "Гибщики"
+DETAIL_SOURCE_MANUAL = "Вручную"
+DETAIL_SOURCE_OPENING = "Начальное значение"
+
+DETAIL_VERIFY_COLUMNS = ["ID", "ID заказа", "Название детали", "Порезано", "Порезано (журнал)",
+                         "Погнуто", "Погнуто (журнал)"]
+
+
+def detail_movement(detail_id, operation, quantity, source, writeoff_id="", comment=""):
+    """
+    Событие журнала деталей для commit_detail_movements.
+
+    Args:
+        operation: DETAIL_CUT или DETAIL_BEND
+        quantity: изменение счётчика (со знаком)
+    """
+    return {"ID детали": _safe_int(detail_id, default=-1), "Операция": operation, "Количество": int(quantity),
+            "Источник": source, "ID списания": writeoff_id, "Комментарий": comment}
+
+
+def _opening_detail_movements(details_df):
+    """События "Начальное значение" для счётчиков, заполненных до появления журнала"""
+    movements = []
+    for operation, column in DETAIL_COUNTERS.items():
+        if column not in details_df.columns:
+            continue
+        values = pd.to_numeric(details_df[column], errors="coerce").fillna(0).astype("int64")
+        for detail_id, value in zip(details_df.loc[values != 0, "ID"], values[values != 0]):
+            movements.append(detail_movement(detail_id, operation, value, DETAIL_SOURCE_OPENING))
+    return movements
+
+
+def commit_detail_movements(changed_sheets, details_df, movements):
+    """
+    Записать события в журнал и применить их к проекции "Порезано"/"Погнуто" в OrderDetails.
+
+    Вызывающий код сохраняет changed_sheets одной записью вместе со своими листами:
+    сюда добавляются OrderDetails и DetailMovements. При первой записи журнала текущие
+    значения счётчиков переносятся в него событиями "Начальное значение".
+
+    Returns:
+        int: ID последнего записанного события (0 — событий не было)
+    """
+    movements = [m for m in movements if m["ID детали"] != -1 and m["Количество"]]
+    if not movements:
+        return 0
+    changed_sheets["OrderDetails"] = details_df
+
+    journal_df = _sheet_or_empty("DetailMovements")
+    if journal_df.empty:
+        movements = _opening_detail_movements(details_df) + movements
+
+    for column in DETAIL_COUNTERS.values():
+        if column not in details_df.columns:
+            details_df[column] = 0
+    positions = {_safe_int(did, default=-1): label for label, did in zip(details_df.index, details_df["ID"])}
+
+    last_id = _next_id(journal_df, "ID события") - 1
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for movement in movements:
+        last_id += 1
+        movement["ID события"] = last_id
+        movement["Дата и время"] = timestamp
+        label = positions.get(movement["ID детали"])
+        if label is not None and movement["Источник"] != DETAIL_SOURCE_OPENING:
+            column = DETAIL_COUNTERS[movement["Операция"]]
+            details_df.at[label, column] = _safe_int(details_df.at[label, column]) + movement["Количество"]
+
+    new_rows = pd.DataFrame(movements, columns=SHEET_COLUMNS["DetailMovements"])
+    journal_df = new_rows if journal_df.empty else pd.concat([journal_df, new_rows], ignore_index=True)
+    changed_sheets["DetailMovements"] = journal_df
+    return last_id
+
+
+@_locked
+def set_detail_progress(detail_id, cut=None, bent=None, comment=""):
+    """
+    Ручная правка "Порезано"/"Погнуто": разница с текущим значением записывается
+    в журнал событием "Вручную". None — счётчик не меняется.
+
+    Returns:
+        dict: {"Порезано": ..., "Погнуто": ...} после правки
+    """
+    return set_details_progress({detail_id: {DETAIL_CUT: cut, DETAIL_BEND: bent}}, comment=comment)[detail_id]
+
+
+@_locked
+def set_details_progress(updates, comment=""):
+    """
+    Пакетная ручная правка счётчиков нескольких деталей: OrderDetails загружается
+    и сохраняется один раз, разница по каждой детали пишется событием "Вручную".
+
+    Args:
+        updates: {ID детали: {DETAIL_CUT: значение, DETAIL_BEND: значение}};
+                 None или отсутствующая операция — счётчик не меняется
+
+    Returns:
+        dict: {ID детали: {"Порезано": ..., "Погнуто": ...}} после правки
+    """
+    details_df = load_data("OrderDetails")
+    labels = {}
+    if not details_df.empty:
+        labels = {_safe_int(detail_id): label for label, detail_id in details_df["ID"].items()}
+
+    movements = []
+    for detail_id, values in updates.items():
+        if detail_id not in labels:
+            raise ValueError(f"Деталь ID={detail_id} не найдена!")
+        row = details_df.loc[labels[detail_id]]
+        for operation, value in values.items():
+            if value is None:
+                continue
+            if value < 0:
+                raise ValueError(f"{DETAIL_COUNTERS[operation]} не может быть отрицательным!")
+            difference = int(value) - _safe_int(row.get(DETAIL_COUNTERS[operation], 0))
+            movements.append(detail_movement(detail_id, operation, difference, DETAIL_SOURCE_MANUAL, comment=comment))
+
+    changed = {}
+    commit_detail_movements(changed, details_df, movements)
+    if changed:
+        save_sheets(changed)
+
+    return {
+        detail_id: {column: _safe_int(details_df.loc[labels[detail_id]].get(column, 0))
+                    for column in DETAIL_COUNTERS.values()}
+        for detail_id in updates
+    }
+
+
+def replay_detail_progress():
+    """
+    Счётчики деталей по журналу событий (один groupby по всему журналу).
+
+    Returns:
+        DataFrame: ID детали, Порезано, Погнуто
+    """
+    journal_df = _sheet_or_empty("DetailMovements")
+    columns = list(DETAIL_COUNTERS.values())
+    if journal_df.empty:
+        return pd.DataFrame(columns=["ID детали"] + columns)
+    quantities = pd.to_numeric(journal_df["Количество"], errors="coerce").fillna(0).astype("int64")
+    totals = quantities.groupby([journal_df["ID детали"], journal_df["Операция"]]).sum().unstack(fill_value=0)
+    totals = totals.rename(columns=DETAIL_COUNTERS).reindex(columns=columns, fill_value=0)
+    return totals.rename_axis("ID детали").reset_index().rename_axis(None, axis=1)
+
+
+def verify_detail_progress():
+    """
+    Сравнить "Порезано"/"Погнуто" в OrderDetails с пересчётом по журналу событий.
+
+    Returns:
+        DataFrame (колонки DETAIL_VERIFY_COLUMNS) с деталями, где проекция расходится с журналом;
+        пустой, если журнал ещё не ведётся
+    """
+    details_df = load_data("OrderDetails")
+    if details_df.empty or _sheet_or_empty("DetailMovements").empty:
+        return pd.DataFrame(columns=DETAIL_VERIFY_COLUMNS)
+
+    replayed = replay_detail_progress().set_index("ID детали")
+    report = details_df[["ID", "ID заказа", "Название детали"]].copy()
+    mismatch = pd.Series(False, index=details_df.index)
+    for column in DETAIL_COUNTERS.values():
+        current = pd.to_numeric(details_df[column], errors="coerce").fillna(0).astype("int64")
+        journal = details_df["ID"].map(replayed[column]).fillna(0).astype("int64")
+        report[column] = current
+        report[f"{column} (журнал)"] = journal
+        mismatch |= current != journal
+    return report.loc[mismatch, DETAIL_VERIFY_COLUMNS].reset_index(drop=True)
+
+
+# ==================== РЕЗЕРВИРОВАНИЕ ====================
+
+def _reservation_entry(reserve_id, order_id, detail_id, detail_name, material_id, marka, thickness, length, width,
+                       quantity):
+    """Строка листа Reservations для нового резерва"""
+    return {
+        "ID резерва": reserve_id,
+        "ID заказа": order_id,
+        "ID детали": detail_id,
+        "Название детали": detail_name,
+        "ID материала": material_id,
+        "Марка": marka,
+        "Толщина": thickness,
+        "Длина": length,
+        "Ширина": width,
+        "Зарезервировано штук": quantity,
+        "Списано": 0,
+        "Остаток к списанию": quantity,
+        "Дата резерва": datetime.now().strftime("%Y-%m-%d")
+    }
+
+
+@_locked
+def create_reservation(order_id, quantity, material_id=-1, detail_id=-1, detail_name="Не указана",
+                       marka=None, thickness=None, length=None, width=None):
+    """
+    Резервирование материала под заказ (material_id=-1 — материал добавлен вручную).
+
+    Returns:
+        int: ID нового резерва
+    """
+    if quantity <= 0:
+        raise ValueError("Количество должно быть больше нуля!")
+
+    materials_df = load_data("Materials")
+    if material_id != -1:
+        material = materials_df[materials_df["ID"] == material_id]
+        if material.empty:
+            raise ValueError(f"Материал ID={material_id} не найден!")
+        material_row = material.iloc[0]
+        marka = material_row["Марка"]
+        thickness = material_row["Толщина"]
+        length = material_row["Длина"]
+        width = material_row["Ширина"]
+    elif not marka:
+        raise ValueError("Заполните марку стали!")
+
+    reservations_df = load_data("Reservations")
+    new_id = _next_id(reservations_df, "ID резерва")
+
+    new_row = pd.DataFrame([_reservation_entry(new_id, order_id, detail_id, detail_name, material_id,
+                                               marka, thickness, length, width, quantity)])
+
+    reservations_df = pd.concat([reservations_df, new_row], ignore_index=True)
+    changed = {"Reservations": reservations_df}
+
+    if material_id != -1:
+        commit_stock_movements(changed, materials_df, [
+            stock_movement(material_id, MOVEMENT_RESERVE, reserved=quantity, reserve_id=new_id)])
+
+    save_sheets(changed)
+    return new_id
+
+
+@_locked
+def update_reservation(reserve_id, order_id, detail_id, detail_name, quantity):
+    """
+    Изменение заказа, детали и количества резерва с пересчётом резерва на складе.
+
+    Returns:
+        dict: old_qty, new_qty, written_off, new_remainder
+    """
+    reservations_df = load_data("Reservations")
+    reserve = reservations_df[reservations_df["ID резерва"] == reserve_id]
+    if reserve.empty:
+        raise ValueError(f"Резерв ID={reserve_id} не найден!")
+    reserve_row = reserve.iloc[0]
+
+    written_off = int(reserve_row["Списано"])
+    if quantity < written_off:
+        raise ValueError(f"Нельзя установить количество ({quantity}) меньше уже списанного ({written_off})!")
+    if quantity <= 0:
+        raise ValueError("Количество должно быть больше нуля!")
+
+    old_qty = int(reserve_row["Зарезервировано штук"])
+    qty_difference = quantity - old_qty
+    new_remainder = quantity - written_off
+
+    mask = reservations_df["ID резерва"] == reserve_id
+    reservations_df.loc[mask, "ID заказа"] = order_id
+    reservations_df.loc[mask, "ID детали"] = detail_id
+    reservations_df.loc[mask, "Название детали"] = detail_name
+    reservations_df.loc[mask, "Зарезервировано штук"] = quantity
+    reservations_df.loc[mask, "Остаток к списанию"] = new_remainder
+    changed = {"Reservations": reservations_df}
+
+    # Обновляем материал на складе (если количество изменилось и не вручную добавленный)
+    material_id = int(reserve_row["ID материала"])
+    if qty_difference != 0 and material_id != -1:
+        movement_type = MOVEMENT_RESERVE if qty_difference > 0 else MOVEMENT_UNRESERVE
+        commit_stock_movements(changed, load_data("Materials"), [
+            stock_movement(material_id, movement_type, reserved=qty_difference, reserve_id=reserve_id,
+                           comment="Изменение резерва")])
+
+    save_sheets(changed)
+    return {"old_qty": old_qty, "new_qty": quantity, "written_off": written_off, "new_remainder": new_remainder}
+
+
+def delete_reservations(reserve_ids):
+    """
+    Удаление резервов с возвратом несписанного остатка на склад (вместе с их списаниями,
+    см. delete_cascade). Возвращает число удалённых резервов.
+    """
+    return delete_cascade(reserve_ids=reserve_ids)["Reservations"]
+
+
+# ==================== КАСКАДНОЕ УДАЛЕНИЕ ====================
+
+def _isin_mask(df, column, ids):
+    """Маска строк листа, у которых column входит в ids (для пустого листа — пустая маска)"""
+    if df.empty or column not in df.columns:
+        return pd.Series(False, index=df.index)
+    return df[column].isin(ids)
+
+
+@_locked
+def delete_cascade(order_ids=(), detail_ids=(), reserve_ids=()):
+    """
+    Удаление заказов, деталей и резервов со всеми зависимыми строками за одну запись базы.
+
+    Зависимости находятся через isin по колонкам-ссылкам, без цикла по удаляемым ID:
+        заказ  → его детали, резервы, списания материалов и списания гибки;
+        деталь → её резервы и списания гибки;
+        резерв → его списания материалов.
+    Несписанный остаток удаляемых резервов возвращается на склад движением "Снятие резерва",
+    "Порезано"/"Погнуто" удаляемых деталей обнуляются в журнале деталей.
+    Уже списанный материал на склад не возвращается: лист израсходован, удаляется только запись.
+
+    Returns:
+        dict: {лист: число удалённых строк} для Orders, OrderDetails, Reservations, WriteOffs, BendingWriteOffs
+    """
+    order_ids = {int(i) for i in order_ids}
+    sheets = {name: load_data(name) for name in
+              ("Orders", "OrderDetails", "Reservations", "WriteOffs", "BendingWriteOffs")}
+    orders_df, details_df, reservations_df, writeoffs_df, bending_df = sheets.values()
+
+    detail_mask = _isin_mask(details_df, "ID заказа", order_ids) | _isin_mask(details_df, "ID", set(detail_ids))
+    all_detail_ids = set(details_df.loc[detail_mask, "ID"]) | set(detail_ids)
+
+    reserve_mask = (_isin_mask(reservations_df, "ID заказа", order_ids) |
+                    _isin_mask(reservations_df, "ID детали", all_detail_ids) |
+                    _isin_mask(reservations_df, "ID резерва", set(reserve_ids)))
+    removed_reserves = reservations_df[reserve_mask]
+    all_reserve_ids = set(removed_reserves["ID резерва"]) if not removed_reserves.empty else set()
+
+    masks = {
+        "Orders": _isin_mask(orders_df, "ID заказа", order_ids),
+        "OrderDetails": detail_mask,
+        "Reservations": reserve_mask,
+        "WriteOffs": (_isin_mask(writeoffs_df, "ID резерва", all_reserve_ids) |
+                      _isin_mask(writeoffs_df, "ID заказа", order_ids)),
+        "BendingWriteOffs": (_isin_mask(bending_df, "ID заказа", order_ids) |
+                             _isin_mask(bending_df, "ID детали", all_detail_ids)),
+    }
+
+    # Счётчики удаляемых деталей обнуляются в журнале деталей, чтобы ID, выданный новой детали, начинал с нуля
+    detail_journal = {}
+    if detail_mask.any():
+        removed_details = details_df[detail_mask]
+        commit_detail_movements(detail_journal, details_df, [
+            detail_movement(detail_id, operation, -_safe_int(value), DETAIL_SOURCE_MANUAL, comment="Удаление детали")
+            for operation, column in DETAIL_COUNTERS.items()
+            for detail_id, value in zip(removed_details["ID"], removed_details[column])
+        ])
+
+    changed = {name: sheets[name][~mask] for name, mask in masks.items() if mask.any()}
+    if "DetailMovements" in detail_journal:
+        changed["DetailMovements"] = detail_journal["DetailMovements"]
+    deleted = {name: int(mask.sum()) for name, mask in masks.items()}
+
+    if not removed_reserves.empty:
+        movements = [
+            stock_movement(material_id, MOVEMENT_UNRESERVE, reserved=-_safe_int(remainder), reserve_id=reserve_id,
+                           comment="Удаление резерва")
+            for reserve_id, material_id, remainder in zip(removed_reserves["ID резерва"],
+                                                          removed_reserves["ID материала"],
+                                                          removed_reserves["Остаток к списанию"])
+        ]
+        commit_stock_movements(changed, load_data("Materials"), movements)
+
+    if changed:
+        save_sheets(changed)
+        print("✅ Каскадное удаление: " + ", ".join(f"{name} {count}" for name, count in deleted.items() if count))
+    return deleted
+
+
+# ==================== ПЛАНИРОВАНИЕ РЕЗЕРВОВ ====================
+
+RESERVATION_PLAN_COLUMNS = ["ID заказа", "Название заказа", "ID детали", "Название детали", "ID материала",
+                            "Марка", "Толщина", "Длина", "Ширина", "Количество"]
+
+
+def _grade_key(marka):
+    """Марка для сравнения: без пробелов и регистра ("Ст 3" == "ст3")"""
+    return re.sub(r"\s+", "", _safe_str(marka)).lower()
+
+
+def _parse_material_requirement(text):
+    """
+    Материал детали: "Ст3 2мм 1250x2500" (как у лазерщиков) или "Ст3 2мм" без размера листа.
+
+    Returns:
+        tuple (марка, толщина, ширина, длина) — ширина/длина None, если размер не указан; или None
+    """
+    parsed = parse_metal_description(text)
+    if parsed and parsed[0]:
+        return parsed
+    match = re.search(r'(\d+(?:\.\d+)?)\s*мм', text, re.IGNORECASE)
+    if match:
+        marka = text.split(match.group(0))[0].strip()
+        if marka:
+            return marka, float(match.group(1)), None, None
+    return None
+
+
+def plan_reservations(orders_df=None, order_details_df=None, reservations_df=None, materials_df=None):
+    """
+    План резервирования для всех деталей заказов "В работе", у которых ещё нет резерва.
+
+    Материал детали берётся из колонки "Материал" (количество листов — "Листов", по умолчанию 1),
+    а если она пуста — из резервов того же заказа, когда все они на один материал.
+    Детали обрабатываются от старых заказов к новым; для каждой подбираются материалы той же
+    марки и толщины (и размера, если он указан) по индексу, листы берутся жадно с учётом
+    "Доступно", уменьшенного предыдущими деталями плана. Деталь, которой не хватает листов,
+    в план не попадает.
+
+    Returns:
+        dict: plan — строки резервов (колонки RESERVATION_PLAN_COLUMNS),
+              unplanned — детали без плана: ID заказа, Название заказа, ID детали, Название детали, Причина
+    """
+    orders_df = load_data("Orders") if orders_df is None else orders_df
+    order_details_df = load_data("OrderDetails") if order_details_df is None else order_details_df
+    reservations_df = load_data("Reservations") if reservations_df is None else reservations_df
+    materials_df = load_data("Materials") if materials_df is None else materials_df
+
+    plan = []
+    unplanned = []
+    work_orders = active_orders(orders_df)
+    if work_orders.empty or order_details_df.empty:
+        return {"plan": plan, "unplanned": unplanned}
+
+    # Индекс склада: (марка, толщина) → материалы в порядке поступления
+    stock_index = {}
+    available = {}
+    if not materials_df.empty:
+        for mid, marka, thickness, length, width, free in zip(
+                materials_df["ID"], materials_df["Марка"], materials_df["Толщина"], materials_df["Длина"],
+                materials_df["Ширина"], materials_df["Доступно"]):
+            mid = int(mid)
+            available[mid] = _safe_int(free)
+            stock_index.setdefault((_grade_key(marka), float(thickness)), []).append(
+                (mid, marka, thickness, float(length), float(width)))
+        for candidates in stock_index.values():
+            candidates.sort(key=lambda c: c[0])
+
+    reserved_details = set()
+    order_specs = {}
+    if not reservations_df.empty:
+        reserved_details = set(reservations_df["ID детали"].dropna().astype(int))
+        stock_reserves = reservations_df[reservations_df["ID материала"] != -1]
+        for order_id, marka, thickness, width, length in zip(
+                stock_reserves["ID заказа"], stock_reserves["Марка"], stock_reserves["Толщина"],
+                stock_reserves["Ширина"], stock_reserves["Длина"]):
+            order_specs.setdefault(int(order_id), set()).add(
+                (_safe_str(marka), float(thickness), float(width), float(length)))
+
+    work_orders = work_orders.sort_values(["Дата создания", "ID заказа"])
+    order_names = dict(zip(work_orders["ID заказа"].astype(int), work_orders["Название заказа"]))
+    order_rank = {order_id: rank for rank, order_id in enumerate(order_names)}
+    details = order_details_df[order_details_df["ID заказа"].isin(order_rank) &
+                               ~order_details_df["ID"].isin(reserved_details)].copy()
+    details["_rank"] = details["ID заказа"].map(order_rank)
+    details = details.sort_values(["_rank", "ID"])
+
+    materials_text = details["Материал"] if "Материал" in details.columns else pd.Series("", index=details.index)
+    sheets_needed = details["Листов"] if "Листов" in details.columns else pd.Series(1, index=details.index)
+
+    for order_id, detail_id, detail_name, material_text, sheets in zip(
+            details["ID заказа"], details["ID"], details["Название детали"],
+            materials_text, sheets_needed):
+        order_id = int(order_id)
+        entry = {"ID заказа": order_id, "Название заказа": order_names[order_id],
+                 "ID детали": int(detail_id), "Название детали": detail_name}
+
+        material_text = _safe_str(material_text)
+        if material_text:
+            requirement = _parse_material_requirement(material_text)
+            if requirement is None:
+                unplanned.append({**entry, "Причина": f"Не удалось разобрать материал: {material_text}"})
+                continue
+        elif len(order_specs.get(order_id, ())) == 1:
+            requirement = next(iter(order_specs[order_id]))
+        else:
+            unplanned.append({**entry, "Причина": "Не указан материал детали"})
+            continue
+        marka, thickness, width, length = requirement
+        need = max(_safe_int(sheets, default=1), 1)
+
+        candidates = stock_index.get((_grade_key(marka), float(thickness)), [])
+        if width and length:
+            candidates = [c for c in candidates if (c[3], c[4]) in ((length, width), (width, length))]
+        total = sum(available[c[0]] for c in candidates if available[c[0]] > 0)
+        if total < need:
+            size = f" {width:g}x{length:g}" if width and length else ""
+            unplanned.append({**entry, "Причина": f"Недостаточно {marka} {thickness:g}мм{size}: "
+                                                  f"нужно {need}, доступно {total}"})
+            continue
+
+        for mid, stock_marka, stock_thickness, stock_length, stock_width in candidates:
+            if need == 0:
+                break
+            take = min(available[mid], need)
+            if take <= 0:
+                continue
+            available[mid] -= take
+            need -= take
+            plan.append({**entry, "ID материала": mid, "Марка": stock_marka, "Толщина": stock_thickness,
+                         "Длина": stock_length, "Ширина": stock_width, "Количество": take})
+
+    return {"plan": plan, "unplanned": unplanned}
+
+
+@_locked
+def commit_reservation_plan(plan):
+    """
+    Создать все резервы плана одной записью базы. Перед записью проверяется, что детали
+    всё ещё без резерва и листов хватает (план мог устареть); иначе ничего не сохраняется.
+
+    Returns:
+        list: ID созданных резервов
+    """
+    if not plan:
+        return []
+    reservations_df = load_data("Reservations")
+    materials_df = load_data("Materials")
+
+    reserved_details = set() if reservations_df.empty else set(reservations_df["ID детали"].dropna().astype(int))
+    stale = sorted({p["Название детали"] for p in plan if p["ID детали"] in reserved_details})
+    if stale:
+        more = f" и ещё {len(stale) - 10}" if len(stale) > 10 else ""
+        raise ValueError(f"Детали уже зарезервированы: {', '.join(map(str, stale[:10]))}{more}\n"
+                         f"Постройте план заново.")
+
+    available = dict(zip(materials_df["ID"].astype(int), materials_df["Доступно"].map(_safe_int)))
+    requested = {}
+    for p in plan:
+        requested[p["ID материала"]] = requested.get(p["ID материала"], 0) + p["Количество"]
+    short = [mid for mid, qty in requested.items() if qty > available.get(mid, 0)]
+    if short:
+        raise ValueError(f"Недостаточно доступных листов у материалов ID: {', '.join(map(str, short))}\n"
+                         f"Постройте план заново.")
+
+    new_id = _next_id(reservations_df, "ID резерва")
+    new_rows = []
+    movements = []
+    for p in plan:
+        new_rows.append(_reservation_entry(new_id, p["ID заказа"], p["ID детали"], p["Название детали"],
+                                           p["ID материала"], p["Марка"], p["Толщина"], p["Длина"], p["Ширина"],
+                                           p["Количество"]))
+        movements.append(stock_movement(p["ID материала"], MOVEMENT_RESERVE, reserved=p["Количество"],
+                                        reserve_id=new_id, comment="Планировщик резервов"))
+        new_id += 1
+
+    new_df = pd.DataFrame(new_rows)
+    reservations_df = new_df if reservations_df.empty else pd.concat([reservations_df, new_df], ignore_index=True)
+    changed = {"Reservations": reservations_df}
+    commit_stock_movements(changed, materials_df, movements)
+    save_sheets(changed)
+    print(f"✅ Планировщик: создано резервов {len(new_rows)}")
+    return [row["ID резерва"] for row in new_rows]
+
+
+# ==================== СПИСАНИЕ МАТЕРИАЛОВ ====================
+
+def _writeoff_movement(material_id, quantity, reserve_id, writeoff_id):
+    """
+    Движение склада для списания с резерва: наличие и резерв уменьшаются на quantity
+    (Доступно не меняется). Отрицательное quantity — отмена списания.
+    """
+    movement_type = MOVEMENT_WRITEOFF if quantity > 0 else MOVEMENT_REVERSAL
+    return stock_movement(material_id, movement_type, quantity=-quantity, reserved=-quantity,
+                          reserve_id=reserve_id, writeoff_id=writeoff_id)
+
+
+@_locked
+def create_writeoff(reserve_id, quantity, comment=""):
+    """
+    Ручное списание материала с резерва.
+
+    Returns:
+        int: ID нового списания
+    """
+    reservations_df = load_data("Reservations")
+    reserve = reservations_df[reservations_df["ID резерва"] == reserve_id]
+    if reserve.empty:
+        raise ValueError(f"Резерв ID={reserve_id} не найден!")
+    reservation = reserve.iloc[0]
+    remainder = int(reservation["Остаток к списанию"])
+
+    if quantity > remainder:
+        raise ValueError(f"Нельзя списать больше чем осталось!\nОсталось: {remainder} шт")
+
+    writeoffs_df = load_data("WriteOffs")
+    new_id = _next_id(writeoffs_df, "ID списания")
+
+    new_row = pd.DataFrame([{
+        "ID списания": new_id,
+        "ID резерва": reserve_id,
+        "ID заказа": reservation["ID заказа"],
+        "ID материала": reservation["ID материала"],
+        "Марка": reservation["Марка"],
+        "Толщина": reservation["Толщина"],
+        "Длина": reservation["Длина"],
+        "Ширина": reservation["Ширина"],
+        "Количество": quantity,
+        "Дата списания": datetime.now().strftime("%Y-%m-%d"),
+        "Комментарий": comment
+    }])
+    writeoffs_df = pd.concat([writeoffs_df, new_row], ignore_index=True)
+
+    new_written_off = int(reservation["Списано"]) + quantity
+    mask = reservations_df["ID резерва"] == reserve_id
+    reservations_df.loc[mask, "Списано"] = new_written_off
+    reservations_df.loc[mask, "Остаток к списанию"] = int(reservation["Зарезервировано штук"]) - new_written_off
+    changed = {"WriteOffs": writeoffs_df, "Reservations": reservations_df}
+
+    material_id = int(reservation["ID материала"])
+    if material_id != -1:
+        commit_stock_movements(changed, load_data("Materials"), [
+            _writeoff_movement(material_id, quantity, reserve_id, new_id)])
+
+    save_sheets(changed)
+    return new_id
+
+
+@_locked
+def update_writeoff(writeoff_id, quantity, comment):
+    """
+    Изменить количество и комментарий списания. Разница проводится через резерв
+    и склад как дополнительное списание или частичная отмена.
+
+    Returns:
+        int: разница количества (новое − старое)
+    """
+    if quantity <= 0:
+        raise ValueError("Количество должно быть больше нуля!")
+    writeoffs_df = load_data("WriteOffs")
+    writeoff = writeoffs_df[writeoffs_df["ID списания"] == writeoff_id]
+    if writeoff.empty:
+        raise ValueError(f"Списание ID={writeoff_id} не найдено!")
+    writeoff_row = writeoff.iloc[0]
+    reserve_id = int(writeoff_row["ID резерва"])
+    difference = quantity - int(writeoff_row["Количество"])
+
+    reservations_df = load_data("Reservations")
+    reserve = reservations_df[reservations_df["ID резерва"] == reserve_id]
+    if not reserve.empty and difference > int(reserve.iloc[0]["Остаток к списанию"]):
+        raise ValueError(f"Нельзя списать {quantity} шт!\n"
+                         f"Максимально доступно: {int(reserve.iloc[0]['Остаток к списанию']) + quantity - difference} шт")
+
+    mask = writeoffs_df["ID списания"] == writeoff_id
+    writeoffs_df.loc[mask, "Количество"] = quantity
+    writeoffs_df.loc[mask, "Комментарий"] = comment
+    changed = {"WriteOffs": writeoffs_df}
+
+    if difference != 0:
+        if not reserve.empty:
+            reserve_mask = reservations_df["ID резерва"] == reserve_id
+            reservations_df.loc[reserve_mask, "Списано"] = int(reserve.iloc[0]["Списано"]) + difference
+            reservations_df.loc[reserve_mask, "Остаток к списанию"] = int(reserve.iloc[0]["Остаток к списанию"]) - difference
+            changed["Reservations"] = reservations_df
+        material_id = int(writeoff_row["ID материала"])
+        if material_id != -1:
+            commit_stock_movements(changed, load_data("Materials"), [
+                _writeoff_movement(material_id, difference, reserve_id, writeoff_id)])
+
+    save_sheets(changed)
+    return difference
+
+
+def _unmark_laser_row_by_comment(laser_rows, writeoff_comment, writeoff_date):
+    """
+    Снять отметку "Списано" со строки импорта лазерщиков для списаний, сделанных до появления
+    колонки "ID импорта лазера": строка ищется по детали и дате импорта из комментария.
+    Возвращает part_quantity строки или None.
+    """
+    part_match = re.search(r'Деталь:\s*([^|]+)', writeoff_comment)
+    part_name = part_match.group(1).strip() if part_match else None
+
+    date_match = re.search(r'Дата импорта:\s*(.+)', writeoff_comment)
+    import_date_str = date_match.group(1).strip() if date_match else None
+
+    for row_data in laser_rows:
+        row_part = str(row_data.get("part", ""))
+        if not (part_name and (part_name.lower() in row_part.lower() or row_part.lower() in part_name.lower())):
+            continue
+
+        row_datetime = f"{row_data.get('Дата (МСК)', '')} {row_data.get('Время (МСК)', '')}"
+        date_match_found = False
+        if import_date_str and len(row_datetime) >= 16 and len(import_date_str) >= 16:
+            date_match_found = row_datetime[:16] == import_date_str[:16]
+        elif not import_date_str:
+            row_writeoff_date = _safe_str(row_data.get("Дата списания", ""))
+            if len(row_writeoff_date) >= 16 and len(writeoff_date) >= 16:
+                date_match_found = row_writeoff_date[:16] == writeoff_date[:16]
+
+        if date_match_found:
+            row_data["Списано"] = ""
+            row_data["Дата списания"] = ""
+            return _safe_int(row_data.get("part_quantity", 0))
+
+    return None
+
+
+@_locked
+def reverse_writeoff(writeoff_id, laser_rows=None):
+    """
+    Отмена списания: материал возвращается в резерв и на склад, запись удаляется.
+
+    Если списание сделано из импорта лазерщиков, в laser_rows (список строк таблицы
+    импорта) снимается отметка "Списано", а у детали уменьшается "Порезано". Строка
+    находится по "ID импорта лазера" списания (find_laser_row), у старых записей — по комментарию.
+
+    Returns:
+        dict: quantity, reserve_id, new_remainder, laser_row_unmarked
+    """
+    writeoffs_df = load_data("WriteOffs")
+    reservations_df = load_data("Reservations")
+
+    writeoff = writeoffs_df[writeoffs_df["ID списания"] == writeoff_id]
+    if writeoff.empty:
+        raise ValueError(f"Списание ID={writeoff_id} не найдено!")
+    writeoff_row = writeoff.iloc[0]
+
+    reserve_id = int(writeoff_row["ID резерва"])
+    quantity = int(writeoff_row["Количество"])
+    material_id = int(writeoff_row["ID материала"])
+    writeoff_date = str(writeoff_row["Дата списания"])
+    writeoff_comment = str(writeoff_row["Комментарий"])
+
+    reserve = reservations_df[reservations_df["ID резерва"] == reserve_id]
+    if reserve.empty:
+        raise ValueError(f"Резерв ID={reserve_id} не найден!")
+    reserve_row = reserve.iloc[0]
+
+    new_remainder = int(reserve_row["Остаток к списанию"]) + quantity
+    mask = reservations_df["ID резерва"] == reserve_id
+    reservations_df.loc[mask, "Списано"] = int(reserve_row["Списано"]) - quantity
+    reservations_df.loc[mask, "Остаток к списанию"] = new_remainder
+
+    writeoffs_df = writeoffs_df[writeoffs_df["ID списания"] != writeoff_id]
+    changed = {"WriteOffs": writeoffs_df, "Reservations": reservations_df}
+
+    # Возврат на склад — обратное движение к списанию
+    if material_id != -1:
+        commit_stock_movements(changed, load_data("Materials"), [
+            _writeoff_movement(material_id, -quantity, reserve_id, writeoff_id)])
+
+    # Строка импорта лазерщиков и "Порезано" у детали
+    import_key = writeoff_row.get("ID импорта лазера", "")
+    import_key = import_key if isinstance(import_key, str) else ""
+    is_laser_import = "Лазер:" in writeoff_comment or "лазерщик" in writeoff_comment.lower()
+    parts_qty = None
+    part_name = None
+    if import_key and laser_rows:
+        laser_row = find_laser_row(laser_rows, import_key)
+        if laser_row is not None:
+            laser_row["Списано"] = ""
+            laser_row["Дата списания"] = ""
+            parts_qty = _safe_int(laser_row.get("part_quantity", 0))
+            part_name = str(laser_row.get("part", "")).strip()
+    elif is_laser_import and laser_rows:
+        parts_qty = _unmark_laser_row_by_comment(laser_rows, writeoff_comment, writeoff_date)
+        part_match = re.search(r'Деталь:\s*([^|]+)', writeoff_comment)
+        part_name = part_match.group(1).strip() if part_match else None
+
+    # Резка этого списания снимается по его событиям в журнале деталей, у старых записей — по названию детали
+    order_details_df = load_data("OrderDetails")
+    detail_movements = []
+    journal_df = _sheet_or_empty("DetailMovements")
+    cut_events = journal_df[(journal_df["Источник"] == DETAIL_SOURCE_LASER) &
+                            (journal_df["ID списания"] == writeoff_id)]
+    if not cut_events.empty:
+        cut_by_detail = pd.to_numeric(cut_events["Количество"], errors="coerce").fillna(0).groupby(
+            cut_events["ID детали"]).sum()
+        detail_movements = [detail_movement(detail_id, DETAIL_CUT, -int(cut), DETAIL_SOURCE_LASER, writeoff_id,
+                                            "Отмена списания") for detail_id, cut in cut_by_detail.items() if cut > 0]
+    elif parts_qty and part_name:
+        detail_match = order_details_df[
+            (order_details_df["ID заказа"] == int(writeoff_row["ID заказа"])) &
+            (order_details_df["Название детали"].str.contains(part_name, case=False, na=False, regex=False))
+        ]
+        if not detail_match.empty:
+            old_cut = _safe_int(detail_match.iloc[0].get("Порезано", 0))
+            detail_movements = [detail_movement(detail_match.iloc[0]["ID"], DETAIL_CUT, -min(old_cut, parts_qty),
+                                                DETAIL_SOURCE_LASER, writeoff_id, "Отмена списания")]
+    commit_detail_movements(changed, order_details_df, detail_movements)
+
+    save_sheets(changed)
+    return {"quantity": quantity, "reserve_id": reserve_id, "new_remainder": new_remainder,
+            "laser_row_unmarked": parts_qty is not None}
+
+
+# ==================== СВЕРКА ОСТАТКОВ ====================
+
+STOCK_CHECK_COLUMNS = ["ID", "Марка", "Толщина", "Длина", "Ширина", "Количество штук",
+                       "Зарезервировано", "Зарезервировано (расчёт)", "Доступно", "Доступно (расчёт)"]
+
+
+def compute_stock_discrepancies(materials_df, reservations_df):
+    """
+    Пересчёт резерва и остатка материалов по листу Reservations.
+
+    Зарезервировано = сумма "Остаток к списанию" резервов материала,
+    Доступно = Количество штук − Зарезервировано. Считается одним groupby для всех материалов.
+
+    Returns:
+        DataFrame (колонки STOCK_CHECK_COLUMNS) только с материалами, где значения в базе
+        расходятся с расчётом
+    """
+    if materials_df.empty:
+        return pd.DataFrame(columns=STOCK_CHECK_COLUMNS)
+
+    if reservations_df.empty:
+        reserved_by_material = pd.Series(dtype="int64")
+    else:
+        remainders = pd.to_numeric(reservations_df["Остаток к списанию"], errors="coerce").fillna(0)
+        reserved_by_material = remainders.groupby(reservations_df["ID материала"]).sum()
+
+    quantity = pd.to_numeric(materials_df["Количество штук"], errors="coerce").fillna(0).astype("int64")
+    reserved = pd.to_numeric(materials_df["Зарезервировано"], errors="coerce").fillna(0).astype("int64")
+    available = pd.to_numeric(materials_df["Доступно"], errors="coerce").fillna(0).astype("int64")
+    expected_reserved = materials_df["ID"].map(reserved_by_material).fillna(0).astype("int64")
+    expected_available = quantity - expected_reserved
+
+    mismatch = (reserved != expected_reserved) | (available != expected_available)
+    report = materials_df.loc[mismatch, ["ID", "Марка", "Толщина", "Длина", "Ширина"]].copy()
+    report["Количество штук"] = quantity[mismatch]
+    report["Зарезервировано"] = reserved[mismatch]
+    report["Зарезервировано (расчёт)"] = expected_reserved[mismatch]
+    report["Доступно"] = available[mismatch]
+    report["Доступно (расчёт)"] = expected_available[mismatch]
+    return report[STOCK_CHECK_COLUMNS].reset_index(drop=True)
+
+
+@_locked
+def reconcile_stock(fix=False):
+    """
+    Сверка "Зарезервировано"/"Доступно" в Materials с резервами.
+
+    Args:
+        fix: записать расчётные значения для всех расхождений
+
+    Returns:
+        dict: discrepancies — DataFrame расхождений (до исправления),
+              orphan_reservations — ID резервов на отсутствующие материалы,
+              fixed — число исправленных материалов
+    """
+    materials_df = load_data("Materials")
+    reservations_df = load_data("Reservations")
+    discrepancies = compute_stock_discrepancies(materials_df, reservations_df)
+
+    orphans = []
+    if not reservations_df.empty and not materials_df.empty:
+        stock_reserves = reservations_df[reservations_df["ID материала"] != -1]
+        orphans = stock_reserves.loc[~stock_reserves["ID материала"].isin(materials_df["ID"]), "ID резерва"].tolist()
+
+    fixed = 0
+    if fix and not discrepancies.empty:
+        # Резерв исправляется движением "Корректировка" относительно значения по журналу
+        # (в Materials оно могло быть изменено мимо журнала), затем проекции задаются расчётные значения
+        expected = discrepancies.set_index("ID")
+        journal_reserved = expected["Зарезервировано"]
+        if not _sheet_or_empty("StockCheckpoints").empty:
+            replayed = replay_stock().set_index("ID материала")["Зарезервировано"]
+            journal_reserved = expected.index.to_series().map(replayed).fillna(0).astype("int64")
+        movements = [
+            stock_movement(material_id, MOVEMENT_CORRECTION,
+                           reserved=int(expected.at[material_id, "Зарезервировано (расчёт)"]) -
+                           int(journal_reserved[material_id]),
+                           comment="Сверка резервов")
+            for material_id in expected.index
+        ]
+        changed = {}
+        commit_stock_movements(changed, materials_df, movements)
+        mask = materials_df["ID"].isin(expected.index)
+        materials_df.loc[mask, "Зарезервировано"] = materials_df.loc[mask, "ID"].map(expected["Зарезервировано (расчёт)"])
+        materials_df.loc[mask, "Доступно"] = materials_df.loc[mask, "ID"].map(expected["Доступно (расчёт)"])
+        save_sheets(changed)
+        fixed = int(mask.sum())
+        print(f"✅ Исправлены остатки материалов: {fixed}")
+
+    return {"discrepancies": discrepancies, "orphan_reservations": orphans, "fixed": fixed}
+
+
+# ==================== ИМПОРТ ОТ ЛАЗЕРЩИКОВ ====================
+
+def parse_metal_description(metal_desc):
+    """
+    Разбор описания металла из таблицы лазерщиков.
+
+    Примеры:
+        "ГК Ст.3 4.0мм 1500x3000" → ("ГК Ст.3", 4.0, 1500.0, 3000.0)
+        "ГК Ст.3 6х1500х3000"     → ("ГК Ст.3", 6.0, 1500.0, 3000.0)
+
+    Returns:
+        tuple (марка, толщина, ширина, длина) или None, если формат не распознан
+    """
+    for pattern in METAL_DESCRIPTION_PATTERNS:
+        match = re.search(pattern, metal_desc, re.IGNORECASE)
+        if match:
+            marka = metal_desc.split(match.group(0))[0].strip()
+            return marka, float(match.group(1)), float(match.group(2)), float(match.group(3))
+    return None
+
+
+def laser_row_key(row):
+    """Уникальный ключ строки таблицы лазерщиков"""
+    return tuple(str(row.get(col, "")) for col in LASER_REQUIRED_COLUMNS)
+
+
+def laser_import_key(row_data):
+    """Ключ строки лазерщиков для колонки "ID импорта лазера" журнала WriteOffs"""
+    return "|".join(laser_row_key(row_data))
+
+
+# Обратный индекс "ID импорта лазера" → строка таблицы импорта (перестраивается, если таблица сменилась)
+_laser_row_index = {"rows": None, "index": {}}
+
+
+def find_laser_row(laser_rows, import_key):
+    """
+    Строка таблицы лазерщиков по "ID импорта лазера" списания (None — строки нет).
+    Индекс строится один раз на список строк; если найденная строка не совпадает
+    с ключом (таблицу перезагрузили или изменили), индекс перестраивается.
+    """
+    with data_lock:
+        if _laser_row_index["rows"] is laser_rows:
+            row = _laser_row_index["index"].get(import_key)
+            if row is not None and laser_import_key(row) == import_key:
+                return row
+        _laser_row_index["rows"] = laser_rows
+        _laser_row_index["index"] = {laser_import_key(r): r for r in laser_rows}
+        return _laser_row_index["index"].get(import_key)
+
+
+def laser_writeoff_comment(row_data):
+    """Комментарий списания, по которому запись связывается со строкой импорта"""
+    return (
+        f"Лазер: {row_data.get('username', '')} | "
+        f"Деталь: {row_data.get('part', '')} | "
+        f"Дата импорта: {row_data.get('Дата (МСК)', '')} {row_data.get('Время (МСК)', '')}"
+    )
+
+
+def _laser_row_result(status, message="", writeoff_id=None, reserve_id=None, quantity=0,
+                      material_id=None, reserve_left=None, stock_left=None):
+    return {"status": status, "message": message, "writeoff_id": writeoff_id,
+            "reserve_id": reserve_id, "quantity": quantity, "material_id": material_id,
+            "reserve_left": reserve_left, "stock_left": stock_left}
+
+
+@_locked
+def writeoff_laser_rows(rows, dry_run=False):
+    """
+    Пакетное списание строк от лазерщиков с точным сопоставлением заказа, материала и детали.
+
+    Листы загружаются один раз, все строки сопоставляются и списываются в памяти
+    (следующая строка видит уже уменьшенный остаток резерва), затем база сохраняется
+    одной перезаписью файла. Заказы и материалы разбираются один раз на уникальное
+    значение, детали и резервы ищутся по индексу заказа.
+
+    Для каждой строки: поиск заказа (УП-XXX или название) → разбор материала →
+    поиск детали → выбор резерва → списание, обновление резерва, склада и "Порезано".
+    Успешные строки помечаются "✓" прямо в переданных словарях; уже списанные
+    и помеченные "Вручную" строки пропускаются. Строка, для которой в WriteOffs уже есть
+    списание с её "ID импорта лазера" (например, через vitaka_api, пока таблица в окне
+    не перечитана), не списывается повторно, а только помечается "✓".
+
+    Args:
+        dry_run: только рассчитать результат каждой строки — база не сохраняется,
+                 строки не помечаются (предпросмотр перед списанием)
+
+    Returns:
+        dict: success — число списанных строк, errors — список текстов ошибок,
+              results — отчёт по каждой строке (в порядке rows): status
+              ("success" / "error" / "skipped"), message, writeoff_id, reserve_id, quantity,
+              material_id, reserve_left и stock_left — остаток резерва и листов на складе после строки
+    """
+    orders_df = load_data("Orders")
+    reservations_df = load_data("Reservations")
+    materials_df = load_data("Materials")
+    writeoffs_df = load_data("WriteOffs")
+    order_details_df = load_data("OrderDetails")
+
+    next_writeoff_id = _next_id(writeoffs_df, "ID списания")
+    new_writeoffs = []
+    movements = []
+    detail_movements = []
+
+    # Разбор заказов и материалов — по одному разу на уникальное значение
+    order_ids = {name: find_order_id(orders_df, name) for name in {str(r.get("order", "")) for r in rows}}
+    parsed_metals = {desc: parse_metal_description(desc) for desc in {str(r.get("metal", "")) for r in rows}}
+    # Индексы по заказу: метки строк деталей и резервов
+    details_by_order = order_details_df.groupby("ID заказа").groups if not order_details_df.empty else {}
+    reserves_by_order = reservations_df.groupby("ID заказа").groups if not reservations_df.empty else {}
+    stock_left = dict(zip(materials_df["ID"].map(_safe_int), materials_df["Количество штук"].map(_safe_int))) \
+        if not materials_df.empty else {}
+    written_keys = set(writeoffs_df["ID импорта лазера"].map(_safe_str)) - {""} \
+        if "ID импорта лазера" in writeoffs_df.columns else set()
+
+    success_count = 0
+    errors = []
+    results = []
+
+    for row_data in rows:
+        order_name = str(row_data.get("order", ""))
+        status = _safe_str(row_data.get("Списано", ""))
+        if status in LASER_DONE_STATUSES or status == LASER_MANUAL_STATUS:
+            results.append(_laser_row_result("skipped", f"Уже отмечено: {status}"))
+            continue
+        import_key = laser_import_key(row_data)
+        if import_key in written_keys:
+            if not dry_run:
+                row_data["Списано"] = "✓"
+            results.append(_laser_row_result("skipped", "Уже списано: запись есть в журнале списаний"))
+            continue
+
+        def fail(message):
+            errors.append(message)
+            results.append(_laser_row_result("error", message))
+
+        try:
+            metal_desc = str(row_data.get("metal", ""))
+            part_name = str(row_data.get("part", ""))
+
+            # ШАГ 1: ПОИСК ЗАКАЗА
+            order_id = order_ids[order_name]
+            if order_id is None:
+                fail(f"❌ Заказ '{order_name}' не найден в базе")
+                continue
+
+            # ШАГ 2: ПАРСИНГ МАТЕРИАЛА
+            parsed = parsed_metals[metal_desc]
+            if not parsed or not parsed[0]:
+                fail(f"❌ Не удалось распарсить материал: {metal_desc}")
+                continue
+            marka, thickness, width, length = parsed
+
+            # ШАГ 3: ПОИСК ДЕТАЛИ В ЗАКАЗЕ
+            detail_id = None
+            if order_id in details_by_order:
+                order_details = order_details_df.loc[details_by_order[order_id]]
+                detail_match = order_details[
+                    order_details["Название детали"].str.contains(part_name, case=False, na=False, regex=False)]
+                if not detail_match.empty:
+                    detail_id = int(detail_match.iloc[0]["ID"])
+
+            # ШАГ 4: ПОИСК РЕЗЕРВА С УЧЕТОМ МАТЕРИАЛА И ДЕТАЛИ
+            order_reserves = reservations_df.loc[reserves_by_order[order_id]] \
+                if order_id in reserves_by_order else reservations_df.iloc[0:0]
+            order_reserves = order_reserves[order_reserves["Остаток к списанию"] > 0]
+            if order_reserves.empty:
+                fail(f"❌ Нет доступных резервов для заказа '{order_name}'")
+                continue
+
+            suitable_reserves = order_reserves[
+                (order_reserves["Марка"].str.contains(marka, case=False, na=False, regex=False)) &
+                (order_reserves["Толщина"] == thickness)
+            ]
+            if width and length:
+                suitable_reserves = suitable_reserves[
+                    (suitable_reserves["Ширина"] == width) &
+                    (suitable_reserves["Длина"] == length)
+                ]
+            if detail_id:
+                detail_reserves = suitable_reserves[suitable_reserves["ID детали"] == detail_id]
+                if not detail_reserves.empty:
+                    suitable_reserves = detail_reserves
+
+            if suitable_reserves.empty:
+                fail(
+                    f"❌ Не найден резерв для:\n"
+                    f"   Заказ: {order_name}\n"
+                    f"   Материал: {marka} {thickness}мм {width}x{length}\n"
+                    f"   Деталь: {part_name}"
+                )
+                continue
+
+            reserve_label = suitable_reserves.index[0]
+            reserve_row = suitable_reserves.iloc[0]
+            reserve_id = int(reserve_row["ID резерва"])
+            remainder = int(reserve_row["Остаток к списанию"])
+
+            # ШАГ 5: КОЛИЧЕСТВО ДЛЯ СПИСАНИЯ
+            message = ""
+            qty_to_writeoff = _safe_int(row_data.get("metal_quantity"), default=1)
+            if qty_to_writeoff > remainder:
+                message = (
+                    f"⚠️ Недостаточно материала в резерве #{reserve_id}:\n"
+                    f"   Запрошено: {qty_to_writeoff}, Доступно: {remainder}"
+                )
+                errors.append(message)
+                # Списываем сколько есть
+                qty_to_writeoff = remainder
+
+            # ШАГ 6: СОЗДАНИЕ СПИСАНИЯ
+            writeoff_id = next_writeoff_id
+            next_writeoff_id += 1
+            new_writeoffs.append({
+                "ID списания": writeoff_id,
+                "ID резерва": reserve_id,
+                "ID заказа": reserve_row["ID заказа"],
+                "ID материала": reserve_row["ID материала"],
+                "Марка": reserve_row["Марка"],
+                "Толщина": reserve_row["Толщина"],
+                "Длина": reserve_row["Длина"],
+                "Ширина": reserve_row["Ширина"],
+                "Количество": qty_to_writeoff,
+                "Дата списания": f"{row_data.get('Дата (МСК)', '')} {row_data.get('Время (МСК)', '')}",
+                "Комментарий": laser_writeoff_comment(row_data),
+                "ID импорта лазера": import_key
+            })
+            written_keys.add(import_key)
+
+            # ШАГ 7: ОБНОВЛЕНИЕ РЕЗЕРВА
+            new_written_off = int(reserve_row["Списано"]) + qty_to_writeoff
+            reservations_df.at[reserve_label, "Списано"] = new_written_off
+            reservations_df.at[reserve_label, "Остаток к списанию"] = \
+                int(reserve_row["Зарезервировано штук"]) - new_written_off
+
+            # ШАГ 8: ОБНОВЛЕНИЕ МАТЕРИАЛА НА СКЛАДЕ
+            material_id = _safe_int(reserve_row["ID материала"], default=-1)
+            movements.append(_writeoff_movement(material_id, qty_to_writeoff, reserve_id, writeoff_id))
+            if material_id in stock_left:
+                stock_left[material_id] -= qty_to_writeoff
+
+            # ШАГ 9: ОБНОВЛЕНИЕ ДЕТАЛИ В ЗАКАЗЕ (ПОРЕЗАНО)
+            if detail_id:
+                detail_movements.append(detail_movement(detail_id, DETAIL_CUT, _safe_int(row_data.get("part_quantity")),
+                                                        DETAIL_SOURCE_LASER, writeoff_id))
+
+            # ШАГ 10: ОБНОВЛЕНИЕ СТАТУСА В ТАБЛИЦЕ ИМПОРТА
+            if not dry_run:
+                row_data["Списано"] = "✓"
+                row_data["Дата списания"] = _now()
+            success_count += 1
+            results.append(_laser_row_result(
+                "success", message, writeoff_id, reserve_id, qty_to_writeoff, material_id,
+                int(reservations_df.at[reserve_label, "Остаток к списанию"]), stock_left.get(material_id)))
+
+        except Exception as e:
+            fail(f"❌ Ошибка обработки строки '{order_name}': {str(e)}")
+
+    if new_writeoffs and not dry_run:
+        writeoffs_df = pd.concat([writeoffs_df, pd.DataFrame(new_writeoffs)], ignore_index=True)
+        changed = {"WriteOffs": writeoffs_df, "Reservations": reservations_df}
+        commit_stock_movements(changed, materials_df, movements)
+        commit_detail_movements(changed, order_details_df, detail_movements)
+        save_sheets(changed)
+
+    mode = "Предпросмотр списания" if dry_run else "Списание"
+    print(f"✅ {mode} от лазерщиков: успешно {success_count}, ошибок {len(errors)}")
+    return {"success": success_count, "errors": errors, "results": results}
+
+
+# ==================== ФАЙЛЫ ИМПОРТА И КЭШ ====================
+
+def read_laser_file(file_path):
+    """Прочитать таблицу от лазерщиков (CSV через ';' или Excel) и проверить колонки"""
+    if file_path.lower().endswith('.csv'):
+        try:
+            laser_df = pd.read_csv(file_path, sep=';', encoding='utf-8')
+        except:
+            laser_df = pd.read_csv(file_path, sep=';', encoding='cp1251')
+    else:
+        laser_df = pd.read_excel(file_path, engine='openpyxl')
+    return prepare_laser_frame(laser_df)
+
+
+def prepare_laser_frame(laser_df):
+    """Проверить колонки таблицы лазерщиков и добавить колонки статуса"""
+    missing = [col for col in LASER_REQUIRED_COLUMNS if col not in laser_df.columns]
+    if missing:
+        raise ValueError(f"Отсутствуют колонки:\n{', '.join(missing)}")
+
+    for col in ["Списано", "Дата списания"]:
+        if col not in laser_df.columns:
+            laser_df[col] = ""
+    return laser_df
+
+
+def read_bending_file(file_path):
+    """Прочитать таблицу от гибщиков (CSV через TAB/';' или Excel) и проверить колонки"""
+    if file_path.lower().endswith('.csv'):
+        try:
+            df = pd.read_csv(file_path, sep='\t', encoding='utf-8')
+        except Exception:
+            try:
+                df = pd.read_csv(file_path, sep=';', encoding='utf-8')
+            except Exception:
+                df = pd.read_csv(file_path, sep=';', encoding='cp1251')
+    else:
+        df = pd.read_excel(file_path, engine='openpyxl')
+    return prepare_bending_frame(df)
+
+
+def prepare_bending_frame(df):
+    """Проверить колонки таблицы гибщиков и добавить необязательные колонки"""
+    missing = [col for col in BENDING_REQUIRED_COLUMNS if col not in df.columns]
+    if missing:
+        raise ValueError(f"Отсутствуют обязательные колонки:\n{', '.join(missing)}")
+
+    # Добавляем необязательные колонки, если их нет
+    for col in ["Материал", "Толщина", "Количество брака", "Тип действия", "Статус", "GroupMessageID",
+                "Списано", "Дата списания", "Связанный заказ"]:
+        if col not in df.columns:
+            df[col] = ""
+    return df
+
+
+def merge_import_rows(existing_rows, incoming_df, key_func, status_columns):
+    """
+    Объединение новой выгрузки с уже загруженной таблицей импорта.
+
+    Строки, которые уже были в таблице, остаются со своими статусами (status_columns);
+    строки, которых нет в новой выгрузке, удаляются; новые строки добавляются.
+
+    Returns:
+        tuple: (объединённый список строк, число новых, число сохранённых статусов)
+    """
+    existing_rows = existing_rows or []
+    existing = {key_func(r): r for r in existing_rows}
+
+    new_rows = []
+    updated_rows = 0
+    for row_dict in incoming_df.to_dict('records'):
+        key = key_func(row_dict)
+        if key in existing:
+            for col in status_columns:
+                row_dict[col] = existing[key].get(col, "")
+            updated_rows += 1
+        else:
+            for col in status_columns:
+                if not row_dict.get(col) or pd.isna(row_dict.get(col)):
+                    row_dict[col] = ""
+        new_rows.append(row_dict)
+
+    new_keys = {key_func(r) for r in new_rows}
+    merged = [r for r in existing_rows if key_func(r) in new_keys]
+
+    new_count = 0
+    for row_dict in new_rows:
+        if key_func(row_dict) not in existing:
+            merged.append(row_dict)
+            new_count += 1
+
+    return merged, new_count, updated_rows
+
+
+def append_import_rows(existing_rows, incoming_df, key_func, status_columns):
+    """
+    Дописать в таблицу импорта только строки, которых в ней ещё нет (по key_func).
+    В отличие от merge_import_rows, строки, отсутствующие во входных данных, не удаляются —
+    так дописываются новые строки, дочитанные из хвоста выгрузки.
+
+    Returns:
+        list: добавленные строки (existing_rows дополняется на месте)
+    """
+    known = {key_func(r) for r in existing_rows}
+    added = []
+    for row_dict in incoming_df.to_dict('records'):
+        key = key_func(row_dict)
+        if key in known:
+            continue
+        for col in status_columns:
+            if not row_dict.get(col) or pd.isna(row_dict.get(col)):
+                row_dict[col] = ""
+        known.add(key)
+        existing_rows.append(row_dict)
+        added.append(row_dict)
+    return added
+
+
+def sort_rows_newest_first(rows, date_format=None):
+    """Сортировка строк импорта по "Дата (МСК)" + "Время (МСК)": новые сверху"""
+    if not rows:
+        return rows
+    df = pd.DataFrame(rows)
+    df['_datetime_sort'] = pd.to_datetime(
+        df['Дата (МСК)'].astype(str) + ' ' + df['Время (МСК)'].astype(str),
+        format=date_format, errors='coerce'
+    )
+    df = df.sort_values('_datetime_sort', ascending=False, na_position='last')
+    df = df.drop('_datetime_sort', axis=1)
+    return df.to_dict('records')
+
+
+def import_laser_file(file_path, existing_rows=None):
+    """
+    Импорт таблицы от лазерщиков с сохранением статусов существующих записей.
+
+    Returns:
+        dict: rows — новая таблица (новые сверху), new — число новых строк, updated — сохранённых статусов,
+              report — строки с ошибками (validate_import; строки всё равно импортируются)
+    """
+    laser_df = read_laser_file(file_path)
+    report, _ = validate_import(laser_df, IMPORT_RULES["Лазер"], "Лазер")
+    merged, new_count, updated_rows = merge_import_rows(
+        existing_rows, laser_df, laser_row_key, ["Списано", "Дата списания"])
+    try:
+        merged = sort_rows_newest_first(merged)
+    except Exception as e:
+        print(f"⚠️ Ошибка сортировки после импорта: {e}")
+    return {"rows": merged, "new": new_count, "updated": updated_rows, "report": report}
+
+
+def import_bending_file(file_path, existing_rows=None):
+    """Импорт таблицы от гибщиков с сохранением статусов (аналогично import_laser_file)"""
+    df = read_bending_file(file_path)
+    report, _ = validate_import(df, IMPORT_RULES["Гибка"], "Гибка")
+    merged, new_count, updated_rows = merge_import_rows(
+        existing_rows, df, bending_row_key, ["Списано", "Дата списания", "Связанный заказ"])
+    try:
+        merged = sort_rows_newest_first(merged)
+    except Exception as e:
+        print(f"⚠️ Ошибка сортировки после импорта гибщиков: {e}")
+    return {"rows": merged, "new": new_count, "updated": updated_rows, "report": report}
+
+
+def laser_status_counts(rows):
+    """Счётчики строк лазерщиков: (списано автоматически, помечено вручную, ожидает)"""
+    auto_count = manual_count = pending_count = 0
+    for r in rows:
+        status = _safe_str(r.get("Списано", ""))
+        if status in LASER_DONE_STATUSES:
+            auto_count += 1
+        elif status == LASER_MANUAL_STATUS:
+            manual_count += 1
+        elif not status:
+            pending_count += 1
+    return auto_count, manual_count, pending_count
+
+
+def export_rows(rows, file_path):
+    """Экспорт строк таблицы импорта в CSV (';') или Excel без служебных полей"""
+    df = pd.DataFrame(rows)
+    df = df.drop(columns=[c for c in SERVICE_COLUMNS if c in df.columns])
+    if file_path.lower().endswith('.csv'):
+        df.to_csv(file_path, index=False, sep=';', encoding='utf-8')
+    else:
+        df.to_excel(file_path, index=False, engine='openpyxl')
+
+
+@_locked
+def save_import_cache(rows, cache_file):
+    """Сохранение таблицы импорта в кэш-файл"""
+    if not rows:
+        return
+    export_rows(rows, cache_file)
+    print(f"✅ Кэш импорта сохранён: {len(rows)} записей → {cache_file}")
+
+
+@_locked
+def _load_import_cache(cache_file, required_columns, status_columns):
+    """Общая загрузка кэша импорта; возвращает список строк или None"""
+    if not os.path.exists(cache_file):
+        print(f"ℹ️ Кэш импорта не найден: {cache_file}")
+        return None
+
+    df = pd.read_excel(cache_file, engine='openpyxl')
+    if df.empty:
+        print("ℹ️ Кэш импорта пуст")
+        return None
+    if not all(col in df.columns for col in required_columns):
+        print("⚠️ Кэш импорта имеет неправильную структуру")
+        return None
+
+    df = df.fillna("")
+    rows = df.to_dict('records')
+    for row in rows:
+        for col in status_columns:
+            if col in row:
+                row[col] = _safe_str(row[col])
+    return rows
+
+
+def load_laser_cache(cache_file=None):
+    """Загрузка таблицы лазерщиков из кэш-файла (None — кэша нет)"""
+    rows = _load_import_cache(cache_file or get_laser_cache_path(), LASER_REQUIRED_COLUMNS,
+                              ["Списано", "Дата списания"])
+    if rows is not None:
+        print(f"✅ Загружен кэш импорта: {len(rows)} записей")
+    return rows
+
+
+def load_bending_cache(cache_file=None):
+    """Загрузка таблицы гибщиков из кэш-файла (новые сверху; None — кэша нет)"""
+    rows = _load_import_cache(cache_file or get_bending_cache_path(), BENDING_REQUIRED_COLUMNS,
+                              ["Списано", "Дата списания", "Связанный заказ"])
+    if rows is None:
+        return None
+    try:
+        rows = sort_rows_newest_first(rows)
+    except Exception as e:
+        print(f"⚠️ Ошибка сортировки кэша гибщиков: {e}")
+    for row in rows:
+        for col in ["Списано", "Дата списания", "Связанный заказ"]:
+            row[col] = _safe_str(row.get(col, ""))
+    print(f"✅ Кэш гибщиков загружен: {len(rows)} записей")
+    return rows
+
+
+def import_cache_stamp(cache_file):
+    """Отметка версии кэш-файла импорта (None — файла нет): по ней видно, что его перезаписал другой процесс"""
+    try:
+        return _file_stamp(cache_file)
+    except OSError:
+        return None
+
+
+def merge_import_cache(rows, cache_rows, key_func):
+    """
+    Перенести в rows изменения кэш-файла, который записал другой процесс (vitaka_api, vitaka_watch):
+    строки, которых нет в rows, дописываются; строке, списанной там и не отмеченной в rows,
+    копируются колонки статуса ("Списано", "Дата списания", "Связанный заказ").
+
+    Returns:
+        int: число добавленных и обновлённых строк
+    """
+    by_key = {key_func(row): row for row in rows}
+    merged = 0
+    for cached in cache_rows:
+        key = key_func(cached)
+        row = by_key.get(key)
+        if row is None:
+            rows.append(cached)
+            by_key[key] = cached
+            merged += 1
+        elif _safe_str(cached.get("Списано")) and not _safe_str(row.get("Списано")):
+            for column in IMPORT_STATUS_COLUMNS:
+                if column in cached:
+                    row[column] = cached[column]
+            merged += 1
+    return merged
+
+
+# ==================== ИМПОРТ ОТ ГИБЩИКОВ ====================
+
+def bending_row_key(row):
+    """Уникальный ключ строки таблицы гибщиков"""
+    return tuple(str(row.get(col, "")) for col in BENDING_REQUIRED_COLUMNS)
+
+
+def bending_import_key(row_data):
+    """Ключ строки гибщиков для колонки "ID импорта гибки" журнала BendingWriteOffs"""
+    return "|".join([
+        str(row_data.get("Дата (МСК)", "")),
+        str(row_data.get("Время (МСК)", "")),
+        str(row_data.get("Оператор", "")),
+        str(row_data.get("Название детали", "")),
+        str(row_data.get("Количество", ""))
+    ])
+
+
+def bending_similarity(a, b):
+    """Процент схожести двух строк (0-100) по алгоритму SequenceMatcher"""
+    return int(SequenceMatcher(None, str(a).lower(), str(b).lower()).ratio() * 100)
+
+
+def active_orders(orders_df):
+    """Только заказы со статусом "В работе" """
+    if not orders_df.empty and "Статус" in orders_df.columns:
+        return orders_df[orders_df["Статус"] == "В работе"].reset_index(drop=True)
+    return orders_df
+
+
+def find_bending_candidates(row_data, orders_df, order_details_df):
+    """
+    Кандидаты (деталь заказа "В работе") для строки гибщиков, по убыванию схожести.
+
+    Схожесть = схожесть заказчика × BENDING_CUSTOMER_SIM_WEIGHT + схожесть детали × BENDING_PART_SIM_WEIGHT.
+    orders_df должен быть уже отфильтрован через active_orders().
+    """
+    part_name = str(row_data.get("Название детали", ""))
+    customer = str(row_data.get("Заказчик", ""))
+
+    candidates = []
+    if order_details_df.empty or orders_df.empty:
+        return candidates
+
+    for _, order_row in orders_df.iterrows():
+        order_id = order_row.get("ID заказа")
+        order_name = str(order_row.get("Название заказа", ""))
+        order_customer = str(order_row.get("Заказчик", ""))
+        details = order_details_df[order_details_df["ID заказа"] == order_id]
+        customer_sim = bending_similarity(customer, order_customer)
+        for _, detail_row in details.iterrows():
+            detail_name = str(detail_row.get("Название детали", ""))
+            part_sim = bending_similarity(part_name, detail_name)
+            combined = int(customer_sim * BENDING_CUSTOMER_SIM_WEIGHT + part_sim * BENDING_PART_SIM_WEIGHT)
+            candidates.append({
+                "combined": combined,
+                "part_sim": part_sim,
+                "customer_sim": customer_sim,
+                "order_id": order_id,
+                "order_name": order_name,
+                "order_customer": order_customer,
+                "detail_id": detail_row.get("ID"),
+                "detail_name": detail_name,
+                "required_qty": _safe_int(detail_row.get("Количество", 0)),
+                "bent_qty": _safe_int(detail_row.get("Погнуто", 0)),
+            })
+
+    candidates.sort(key=lambda x: x["combined"], reverse=True)
+    return candidates
+
+
+def _bending_writeoff_entry(writeoff_id, row_data, order_id, detail_id, detail_name, quantity,
+                            writeoff_type, comment=""):
+    """Строка журнала BendingWriteOffs"""
+    return {
+        "ID списания": writeoff_id,
+        "ID импорта гибки": bending_import_key(row_data),
+        "ID заказа": order_id,
+        "ID детали": detail_id if detail_id is not None else "",
+        "Название детали": detail_name,
+        "Количество": quantity,
+        "Дата списания": _now(),
+        "Оператор": str(row_data.get("Оператор", "")),
+        "Комментарий": comment,
+        "Тип": writeoff_type
+    }
+
+
+@_locked
+def perform_bending_writeoff(row_data, order_id, detail_id, detail_name, quantity, writeoff_type, comment=""):
+    """
+    Списание гибки: запись в BendingWriteOffs и увеличение "Погнуто" у детали.
+
+    Returns:
+        int: ID записи журнала
+    """
+    bwo_df = _sheet_or_empty("BendingWriteOffs")
+    new_id = _next_id(bwo_df, "ID списания")
+    new_entry = pd.DataFrame([_bending_writeoff_entry(new_id, row_data, order_id, detail_id, detail_name,
+                                                      quantity, writeoff_type, comment)])
+    changed = {"BendingWriteOffs": pd.concat([bwo_df, new_entry], ignore_index=True)}
+
+    # "Погнуто" в OrderDetails — событием журнала деталей
+    if detail_id is not None:
+        commit_detail_movements(changed, load_data("OrderDetails"), [
+            detail_movement(detail_id, DETAIL_BEND, quantity, DETAIL_SOURCE_BENDING, new_id)])
+
+    save_sheets(changed)
+    return new_id
+
+
+def _similarity_table(values_a, values_b):
+    """Схожесть (0-100) для всех пар уникальных строк: {(a, b): процент}"""
+    table = {}
+    matcher = SequenceMatcher(None)
+    lowered_a = {a: str(a).lower() for a in set(values_a)}
+    for b in set(values_b):
+        # set_seq2 кэширует разбор строки b для всех сравнений с ней
+        matcher.set_seq2(str(b).lower())
+        for a, a_low in lowered_a.items():
+            matcher.set_seq1(a_low)
+            table[(a, b)] = int(matcher.ratio() * 100)
+    return table
+
+
+def _char_counts(strings, alphabet):
+    """Матрица количества символов (строка × символ алфавита)"""
+    counts = np.zeros((len(strings), len(alphabet)), dtype=np.int32)
+    for i, text in enumerate(strings):
+        for ch in text:
+            counts[i, alphabet[ch]] += 1
+    return counts
+
+
+def match_bending_rows(rows, orders_df, order_details_df,
+                       threshold=BENDING_AUTO_MATCH_THRESHOLD, margin=BENDING_AUTO_MATCH_MARGIN):
+    """
+    Сопоставление всех строк гибщиков со всеми деталями активных заказов за один проход.
+
+    Строка подходит для автосписания, если схожесть лучшего кандидата не ниже threshold,
+    он опережает следующую деталь хотя бы на margin и количество не превышает остатка
+    "нужно − погнуто" (с учётом строк, уже сопоставленных в этом пакете).
+    orders_df должен быть уже отфильтрован через active_orders().
+
+    Returns:
+        list: по строке на каждую row (в том же порядке): row, status ("auto" / "review"),
+              reason, quantity, candidates (топ-5 в формате find_bending_candidates)
+    """
+    details = []
+    if not orders_df.empty and not order_details_df.empty:
+        orders = {row["ID заказа"]: row for row in orders_df.to_dict('records')}
+        for detail_row in order_details_df.to_dict('records'):
+            order_row = orders.get(detail_row.get("ID заказа"))
+            if order_row is not None:
+                details.append((order_row, detail_row))
+
+    customer_sims = _similarity_table([str(r.get("Заказчик", "")) for r in rows],
+                                      [str(o.get("Заказчик", "")) for o, _ in details])
+
+    # Верхняя граница схожести названий для всех пар сразу (аналог SequenceMatcher.quick_ratio):
+    # точный ratio считается только для деталей, которые ещё могут попасть в топ-5
+    detail_names = [str(d.get("Название детали", "")).lower() for _, d in details]
+    part_names = sorted({str(r.get("Название детали", "")).lower() for r in rows})
+    alphabet = {ch: i for i, ch in enumerate(sorted(set("".join(detail_names + part_names))))}
+    detail_counts = _char_counts(detail_names, alphabet)
+    detail_lengths = np.array([len(n) for n in detail_names], dtype=np.int32)
+    part_counts = dict(zip(part_names, _char_counts(part_names, alphabet)))
+    part_sims = {}
+
+    def part_similarity(part_low, detail_index):
+        key = (part_low, detail_index)
+        if key not in part_sims:
+            part_sims[key] = int(SequenceMatcher(None, part_low, detail_names[detail_index]).ratio() * 100)
+        return part_sims[key]
+
+    remaining = {}
+    for order_row, detail_row in details:
+        remaining[detail_row.get("ID")] = (_safe_int(detail_row.get("Количество", 0)) -
+                                           _safe_int(detail_row.get("Погнуто", 0)))
+
+    results = []
+    for row_data in rows:
+        customer = str(row_data.get("Заказчик", ""))
+        part_name = str(row_data.get("Название детали", ""))
+        part_low = part_name.lower()
+        quantity = _safe_int(row_data.get("Количество", 0))
+
+        top5 = []
+        if details:
+            total_lengths = detail_lengths + len(part_low)
+            common = np.minimum(detail_counts, part_counts[part_low]).sum(axis=1)
+            part_bounds = np.where(total_lengths > 0, 200 * common // np.maximum(total_lengths, 1), 100)
+            customer_row = np.array([customer_sims[(customer, str(o.get("Заказчик", "")))] for o, _ in details])
+            bounds = (customer_row * BENDING_CUSTOMER_SIM_WEIGHT + part_bounds * BENDING_PART_SIM_WEIGHT).astype(int)
+
+            scored = []
+            for idx in np.argsort(-bounds, kind="stable"):
+                if len(scored) >= 5 and bounds[idx] < scored[4][0]:
+                    break
+                part_sim = part_similarity(part_low, idx)
+                combined = int(customer_row[idx] * BENDING_CUSTOMER_SIM_WEIGHT + part_sim * BENDING_PART_SIM_WEIGHT)
+                scored.append((combined, part_sim, int(idx)))
+                scored.sort(key=lambda x: x[0], reverse=True)
+
+            for combined, part_sim, idx in scored[:5]:
+                order_row, detail_row = details[idx]
+                top5.append({
+                    "combined": combined,
+                    "part_sim": part_sim,
+                    "customer_sim": int(customer_row[idx]),
+                    "order_id": order_row.get("ID заказа"),
+                    "order_name": str(order_row.get("Название заказа", "")),
+                    "order_customer": str(order_row.get("Заказчик", "")),
+                    "detail_id": detail_row.get("ID"),
+                    "detail_name": str(detail_row.get("Название детали", "")),
+                    "required_qty": _safe_int(detail_row.get("Количество", 0)),
+                    "bent_qty": _safe_int(detail_row.get("Погнуто", 0)),
+                })
+
+        result = {"row": row_data, "status": "review", "reason": "", "quantity": quantity, "candidates": top5}
+        results.append(result)
+
+        if quantity <= 0:
+            result["reason"] = "Некорректное количество"
+            continue
+        if not top5:
+            result["reason"] = "Совпадения не найдены"
+            continue
+        best = top5[0]
+        if best["combined"] < threshold:
+            result["reason"] = f"Низкая схожесть ({best['combined']}%)"
+            continue
+        if len(top5) > 1 and best["combined"] - top5[1]["combined"] < margin:
+            result["reason"] = f"Неоднозначно: {top5[1]['detail_name']} ({top5[1]['combined']}%)"
+            continue
+        if quantity > remaining[best["detail_id"]]:
+            result["reason"] = f"Превышает потребность (осталось {max(0, remaining[best['detail_id']])} шт)"
+            continue
+
+        remaining[best["detail_id"]] -= quantity
+        result["status"] = "auto"
+
+    return results
+
+
+@_locked
+def auto_writeoff_bending_rows(rows, threshold=BENDING_AUTO_MATCH_THRESHOLD, margin=BENDING_AUTO_MATCH_MARGIN):
+    """
+    Пакетное автосписание ожидающих строк гибщиков.
+
+    Уверенные совпадения (см. match_bending_rows) списываются: записи BendingWriteOffs и
+    "Погнуто" всех деталей сохраняются одной записью файла, строки помечаются "✓".
+    Уже списанные строки пропускаются.
+
+    Returns:
+        dict: applied — результаты списанных строк, review — строки для ручной проверки
+    """
+    pending = [r for r in rows if not _safe_str(r.get("Списано", "")).startswith("✓")]
+    orders_df = active_orders(load_data("Orders"))
+    od_df = load_data("OrderDetails")
+    matches = match_bending_rows(pending, orders_df, od_df, threshold, margin)
+
+    applied = [m for m in matches if m["status"] == "auto"]
+    review = [m for m in matches if m["status"] != "auto"]
+    if not applied:
+        return {"applied": applied, "review": review}
+
+    bwo_df = _sheet_or_empty("BendingWriteOffs")
+    next_id = _next_id(bwo_df, "ID списания")
+
+    entries = []
+    detail_movements = []
+    for match in applied:
+        best = match["candidates"][0]
+        entries.append(_bending_writeoff_entry(next_id, match["row"], best["order_id"], best["detail_id"],
+                                               best["detail_name"], match["quantity"], "авто",
+                                               f"Автосопоставление {best['combined']}%"))
+        detail_movements.append(detail_movement(best["detail_id"], DETAIL_BEND, match["quantity"],
+                                                DETAIL_SOURCE_BENDING, next_id))
+        match["writeoff_id"] = next_id
+        next_id += 1
+
+    changed = {"BendingWriteOffs": pd.concat([bwo_df, pd.DataFrame(entries)], ignore_index=True)}
+    commit_detail_movements(changed, od_df, detail_movements)
+    save_sheets(changed)
+
+    now = _now()
+    for match in applied:
+        match["row"]["Списано"] = "✓"
+        match["row"]["Дата списания"] = now
+        match["row"]["Связанный заказ"] = match["candidates"][0]["order_name"]
+
+    print(f"✅ Автосписание гибки: списано {len(applied)}, на проверку {len(review)}")
+    return {"applied": applied, "review": review}
+
+
+@_locked
+def log_bending_manual_writeoff(row_data, comment):
+    """Записать ручное списание гибки (без привязки к заказу) в BendingWriteOffs"""
+    bwo_df = _sheet_or_empty("BendingWriteOffs")
+    new_entry = pd.DataFrame([{
+        "ID списания": _next_id(bwo_df, "ID списания"),
+        "ID импорта гибки": bending_import_key(row_data),
+        "ID заказа": "",
+        "ID детали": "",
+        "Название детали": str(row_data.get("Название детали", "")),
+        "Количество": str(row_data.get("Количество", "")),
+        "Дата списания": _now(),
+        "Оператор": str(row_data.get("Оператор", "")),
+        "Комментарий": comment,
+        "Тип": "ручной"
+    }])
+    save_data("BendingWriteOffs", pd.concat([bwo_df, new_entry], ignore_index=True))
+
+
+@_locked
+def reverse_bending_writeoffs(rows):
+    """
+    Отмена списаний гибки для строк импорта: "Погнуто" уменьшается, записи журнала удаляются,
+    статусы строк очищаются. Возвращает число обработанных строк.
+    """
+    bwo_df = load_data("BendingWriteOffs")
+    od_df = load_data("OrderDetails")
+    bent = dict(zip(od_df["ID"], od_df["Погнуто"].map(_safe_int))) if not od_df.empty else {}
+    detail_movements = []
+    journal_changed = False
+
+    for row_data in rows:
+        import_key = bending_import_key(row_data)
+
+        if not bwo_df.empty and "ID импорта гибки" in bwo_df.columns:
+            matching = bwo_df[bwo_df["ID импорта гибки"] == import_key]
+            for writeoff_id, detail_id_raw, quantity in zip(matching["ID списания"], matching["ID детали"],
+                                                            matching["Количество"]):
+                detail_id = _safe_int(detail_id_raw, default=-1)
+                if detail_id not in bent:
+                    continue
+                # "Погнуто" не уходит ниже нуля, даже если его правили вручную после списания
+                returned = min(bent[detail_id], _safe_int(quantity))
+                bent[detail_id] -= returned
+                detail_movements.append(detail_movement(detail_id, DETAIL_BEND, -returned, DETAIL_SOURCE_BENDING,
+                                                        writeoff_id, "Отмена списания"))
+                print(f"✅ Погнуто восстановлено: {bent[detail_id] + returned} → {bent[detail_id]}")
+
+            if not matching.empty:
+                bwo_df = bwo_df[bwo_df["ID импорта гибки"] != import_key]
+                journal_changed = True
+
+        row_data["Списано"] = ""
+        row_data["Дата списания"] = ""
+        row_data["Связанный заказ"] = ""
+
+    changed = {}
+    if journal_changed:
+        changed["BendingWriteOffs"] = bwo_df
+    commit_detail_movements(changed, od_df, detail_movements)
+    if changed:
+        save_sheets(changed)
+    return len(rows)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Списание через vitaka_api, запущенный отдельным процессом: результат, остаток и смена файла базы"""
+import http.client
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import production_engine as engine  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    engine.set_database_path(str(tmp_path))
+    engine.initialize_database()
+    yield tmp_path
+    engine._invalidate_workbook_cache()
+    engine.set_database_path(None)
+
+
+@pytest.fixture
+def api_port(database):
+    """vitaka_api на свободном порту localhost с той же базой"""
+    process = subprocess.Popen([sys.executable, "-u", str(ROOT / "vitaka_api.py"), "--db", str(database),
+                                "--host", "127.0.0.1", "--port", "0"],
+                               cwd=str(database), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               text=True, encoding="utf-8", env={**os.environ, "PYTHONIOENCODING": "utf-8"})
+    try:
+        line = process.stdout.readline()
+        assert "http://127.0.0.1:" in line, line
+        yield int(line.split("http://127.0.0.1:")[1].split("/")[0])
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def _post(port, path, body):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("POST", path, body=json.dumps(body), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_laser_writeoff_from_another_process(database, api_port):
+    _, stamp = engine.database_changed_since(None)
+    material_id = engine.add_material("Ст3", 2, 2500, 1250, 10)
+    engine.save_data("Orders", pd.DataFrame([{"ID заказа": 1, "Название заказа": "УП-001 Кронштейны",
+                                              "Заказчик": "Ромашка", "Дата создания": "2025-01-05",
+                                              "Статус": "В работе", "Примечания": ""}]))
+    engine.create_reservation(1, 3, material_id=material_id)
+    changed, stamp = engine.database_changed_since(stamp)
+    assert not changed  # только записи этого процесса
+
+    row = {"Дата (МСК)": "05.01.2025", "Время (МСК)": "12:00", "username": "планшет", "order": "УП-001",
+           "metal": "Ст3 2.0мм 1250x2500", "metal_quantity": 1, "part": "Кронштейн", "part_quantity": 2}
+    status, result = _post(api_port, "/api/laser/writeoff", row)
+
+    assert status == 200
+    assert result == {"success": 1, "skipped": 0, "errors": []}
+    changed, _ = engine.database_changed_since(stamp)
+    assert changed  # запись сервиса видна программе
+
+    material = engine.load_data("Materials").set_index("ID").loc[material_id]
+    assert material["Количество штук"] == 9
+    assert material["Зарезервировано"] == 2
+    assert engine.load_data("WriteOffs")["Количество"].tolist() == [1]
+
+    status, result = _post(api_port, "/api/laser/writeoff", row)
+    assert status == 200
+    assert result == {"success": 0, "skipped": 1, "errors": []}
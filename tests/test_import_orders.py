@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Импорт заказов и деталей: одна ошибка на строку, как при построчной проверке"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import production_engine as engine  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    engine.set_database_path(str(tmp_path))
+    engine.initialize_database()
+    yield tmp_path
+    engine._invalidate_workbook_cache()
+    engine.set_database_path(None)
+
+
+def _write_import_file(path, orders, details):
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        pd.DataFrame(orders).to_excel(writer, sheet_name="Заказы", index=False)
+        pd.DataFrame(details).to_excel(writer, sheet_name="Детали", index=False)
+    return str(path)
+
+
+def test_first_failing_rule_per_detail_row(database):
+    file_path = _write_import_file(database / "import.xlsx", {
+        "Название заказа": ["УП-001", "УП-002"],
+        "Заказчик": ["Ромашка", None],
+        "Статус": ["Новый", "Непонятный"],
+    }, {
+        "Название заказа": ["УП-001", "УП-999", "УП-001", "УП-001"],
+        "Название детали": ["Кронштейн", None, None, "Уголок"],
+        "Количество": [4, "много", "много", 0],
+    })
+
+    result = engine.import_orders(file_path)
+
+    assert result["orders"] == 1
+    assert result["details"] == 1
+    assert result["errors"] == [
+        "Заказы, строка 3: Отсутствует заказчик",
+        "Детали, строка 3: Заказ 'УП-999' не найден в листе 'Заказы'",
+        "Детали, строка 4: Отсутствует название детали",
+        "Детали, строка 5: Количество должно быть больше нуля для детали 'Уголок'",
+    ]
+
+
+def test_validate_import_reports_every_rule_by_default():
+    df = pd.DataFrame({"Название детали": [None], "Количество": ["много"]})
+
+    report, valid = engine.validate_import(df, engine.IMPORT_RULES["Детали"], "Детали")
+    assert report["Колонка"].tolist() == ["Название детали", "Количество"]
+
+    report, _ = engine.validate_import(df, engine.IMPORT_RULES["Детали"], "Детали", first_error_only=True)
+    assert report["Колонка"].tolist() == ["Название детали"]
+    assert not valid.any()
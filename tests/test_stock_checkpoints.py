@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Снимки журнала движений склада на границе дней (StockCheckpoints)"""
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import production_engine as engine  # noqa: E402
+
+
+class _Clock(datetime):
+    """datetime.now() ядра, которое можно перевести на следующий день"""
+    current = datetime(2025, 3, 10, 17, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "datetime", _Clock)
+    monkeypatch.setattr(engine, "STOCK_CHECKPOINT_INTERVAL", 1)
+    monkeypatch.setattr(_Clock, "current", datetime(2025, 3, 10, 17, 0))
+    engine.set_database_path(str(tmp_path))
+    engine.initialize_database()
+    yield tmp_path
+    engine._invalidate_workbook_cache()
+    engine.set_database_path(None)
+
+
+def _set_quantity(material_id, quantity):
+    engine.update_material(material_id, "Ст3", 2, 2500, 1250, quantity)
+
+
+def test_day_boundary_after_interval_snapshot(database):
+    material_id = engine.add_material("Ст3", 2, 2500, 1250, 10)
+    _set_quantity(material_id, 12)  # интервальный снимок на последнем движении дня
+
+    checkpoints = engine.load_data("StockCheckpoints")
+    last_id = int(engine.load_data("StockMovements")["ID движения"].max())
+    assert int(checkpoints["ID движения"].max()) == last_id
+
+    _Clock.current = datetime(2025, 3, 11, 9, 0)
+    _set_quantity(material_id, 7)  # первое движение нового дня
+
+    checkpoints = engine.load_data("StockCheckpoints")
+    assert not checkpoints.duplicated(["ID движения", "ID материала"]).any()
+
+    replayed = engine.replay_stock()
+    assert replayed["ID материала"].is_unique
+    assert replayed.set_index("ID материала").at[material_id, "Количество штук"] == 7
+    assert engine.verify_stock_projection().empty
+
+    assert engine.stock_on_date("2025-03-10")["Количество штук"].tolist() == [12]
+    assert engine.stock_on_date("2025-03-11")["Количество штук"].tolist() == [7]
+
+
+def test_replay_ignores_duplicated_snapshot_rows(database):
+    material_id = engine.add_material("Ст3", 2, 2500, 1250, 10)
+    _set_quantity(material_id, 12)
+
+    # База, записанная до исправления: дневной снимок повторяет интервальный с тем же ID движения
+    checkpoints = engine.load_data("StockCheckpoints")
+    last = checkpoints[checkpoints["ID движения"] == checkpoints["ID движения"].max()]
+    engine.save_data("StockCheckpoints", pd.concat([checkpoints, last.assign(**{"Дата и время": "2025-03-11 09:00:00"})],
+                                                   ignore_index=True))
+
+    replayed = engine.replay_stock()
+    assert replayed["ID материала"].is_unique
+    assert engine.verify_stock_projection().empty
+    assert len(engine.stock_on_date("2025-03-11")) == 1
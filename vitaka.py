@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Консольный запуск операций учёта без графического интерфейса.
+
+Примеры:
+    python vitaka.py --db D:\\Учёт import-materials materials.xlsx
+    python vitaka.py --db D:\\Учёт import-laser export_20250101.csv --writeoff
+    python vitaka.py writeoff-laser --dry-run
+    python vitaka.py export-sheet WriteOffs writeoffs.xlsx
+
+Результат печатается в stdout одной строкой JSON, служебные сообщения ядра — в stderr.
+
+Коды возврата:
+    0 — операция выполнена без ошибок
+    1 — операция выполнена, но часть строк не обработана (см. "errors")
+    2 — операция не выполнена (нет файла, неверный формат, неверные аргументы)
+"""
+import sys
+import json
+import argparse
+import contextlib
+
+import production_engine as engine
+
+EXIT_OK = 0
+EXIT_ROW_ERRORS = 1
+EXIT_FAILED = 2
+
+
+def _json_default(value):
+    """Числа numpy (из DataFrame) → обычные числа, остальное → строка"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def _pending_laser_rows(rows):
+    """Строки лазерщиков, которые ещё не списаны и не помечены вручную"""
+    done = engine.LASER_DONE_STATUSES + [engine.LASER_MANUAL_STATUS]
+    return [r for r in rows if engine._safe_str(r.get("Списано", "")) not in done]
+
+
+def _writeoff_laser(rows, dry_run=False):
+    """Списать ожидающие строки и сохранить кэш; возвращает результат для вывода"""
+    pending = _pending_laser_rows(rows)
+    if not pending:
+        return {"processed": 0, "success": 0, "errors": []}
+    result = engine.writeoff_laser_rows(pending, dry_run=dry_run)
+    output = {"processed": len(pending), "success": result["success"], "errors": result["errors"]}
+    if dry_run:
+        output["dry_run"] = True
+        output["preview"] = [
+            {"date": row.get("Дата (МСК)", ""), "time": row.get("Время (МСК)", ""), "order": row.get("order", ""),
+             "part": row.get("part", ""), **res}
+            for row, res in zip(pending, result["results"])
+        ]
+    else:
+        engine.save_import_cache(rows, engine.get_laser_cache_path())
+    return output
+
+
+def _save_report(result, args):
+    """Убрать таблицу ошибок из результата (в JSON — только число строк) и сохранить её по --report"""
+    report = result.pop("report")
+    output = {"report_rows": len(report)}
+    if args.report and not report.empty:
+        engine.export_import_errors(report, args.report)
+        output["report"] = args.report
+    return output
+
+
+# ==================== КОМАНДЫ ====================
+
+def cmd_init(args):
+    created = engine.initialize_database()
+    return {"database": engine.get_database_file(), "created": created}
+
+
+def cmd_import_materials(args):
+    result = engine.import_materials(args.file)
+    result.update(_save_report(result, args))
+    return result
+
+
+def cmd_import_orders(args):
+    result = engine.import_orders(args.file)
+    result.update(_save_report(result, args))
+    return result
+
+
+def cmd_import_laser(args):
+    existing = engine.load_laser_cache() or []
+    result = engine.import_laser_file(args.file, existing)
+    rows = result["rows"]
+    output = {"rows": len(rows), "new": result["new"], "updated": result["updated"], **_save_report(result, args)}
+    if args.writeoff:
+        output["writeoff"] = _writeoff_laser(rows)
+        output["errors"] = output["writeoff"]["errors"]
+    else:
+        engine.save_import_cache(rows, engine.get_laser_cache_path())
+    auto_count, manual_count, pending_count = engine.laser_status_counts(rows)
+    output.update({"written_off": auto_count, "manual": manual_count, "pending": pending_count})
+    return output
+
+
+def cmd_writeoff_laser(args):
+    rows = engine.load_laser_cache()
+    if rows is None:
+        raise ValueError("Кэш импорта лазерщиков не найден, сначала выполните import-laser")
+    return _writeoff_laser(rows, dry_run=args.dry_run)
+
+
+def cmd_import_bending(args):
+    existing = engine.load_bending_cache() or []
+    result = engine.import_bending_file(args.file, existing)
+    engine.save_import_cache(result["rows"], engine.get_bending_cache_path())
+    return {"rows": len(result["rows"]), "new": result["new"], "updated": result["updated"],
+            **_save_report(result, args)}
+
+
+def cmd_writeoff_bending(args):
+    rows = engine.load_bending_cache()
+    if rows is None:
+        raise ValueError("Кэш импорта гибщиков не найден, сначала выполните import-bending")
+    result = engine.auto_writeoff_bending_rows(rows, threshold=args.threshold)
+    if result["applied"]:
+        engine.save_import_cache(rows, engine.get_bending_cache_path())
+    return {
+        "applied": len(result["applied"]),
+        "review": [
+            {"date": m["row"].get("Дата (МСК)", ""), "time": m["row"].get("Время (МСК)", ""),
+             "part": m["row"].get("Название детали", ""), "reason": m["reason"]}
+            for m in result["review"]
+        ],
+    }
+
+
+def cmd_reconcile(args):
+    result = engine.reconcile_stock(fix=args.fix)
+    discrepancies = result["discrepancies"]
+    return {
+        "discrepancies": discrepancies.to_dict("records"),
+        "orphan_reservations": result["orphan_reservations"],
+        "fixed": result["fixed"],
+        "errors": [] if args.fix or discrepancies.empty else [f"Расхождений: {len(discrepancies)}"],
+    }
+
+
+def cmd_export_laser(args):
+    rows = engine.load_laser_cache()
+    if not rows:
+        raise ValueError("Нет данных лазерщиков для экспорта")
+    engine.export_rows(rows, args.output)
+    return {"rows": len(rows), "output": args.output}
+
+
+def cmd_export_bending(args):
+    rows = engine.load_bending_cache()
+    if not rows:
+        raise ValueError("Нет данных гибщиков для экспорта")
+    engine.export_rows(rows, args.output)
+    return {"rows": len(rows), "output": args.output}
+
+
+def cmd_export_sheet(args):
+    df = engine.load_data(args.sheet)
+    if args.output.lower().endswith('.csv'):
+        df.to_csv(args.output, index=False, sep=';', encoding='utf-8')
+    else:
+        df.to_excel(args.output, index=False, engine='openpyxl')
+    return {"sheet": args.sheet, "rows": len(df), "output": args.output}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="vitaka", description="Пакетные операции учёта производства")
+    parser.add_argument("--db", help="Папка с production_database.xlsx (по умолчанию — из app_settings.json)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("init", help="Создать пустую базу данных")
+    p.set_defaults(func=cmd_init)
+
+    p = sub.add_parser("import-materials", help="Импорт материалов из Excel")
+    p.add_argument("file")
+    p.add_argument("--report", help="Сохранить ошибки по строкам в файл (.xlsx или .csv)")
+    p.set_defaults(func=cmd_import_materials)
+
+    p = sub.add_parser("import-orders", help="Импорт заказов и деталей из Excel")
+    p.add_argument("file")
+    p.add_argument("--report", help="Сохранить ошибки по строкам в файл (.xlsx или .csv)")
+    p.set_defaults(func=cmd_import_orders)
+
+    p = sub.add_parser("import-laser", help="Импорт таблицы от лазерщиков в кэш")
+    p.add_argument("file")
+    p.add_argument("--report", help="Сохранить ошибки по строкам в файл (.xlsx или .csv)")
+    p.add_argument("--writeoff", action="store_true", help="Сразу списать все ожидающие строки")
+    p.set_defaults(func=cmd_import_laser)
+
+    p = sub.add_parser("writeoff-laser", help="Списать все ожидающие строки из кэша лазерщиков")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Только показать результат каждой строки, ничего не списывая")
+    p.set_defaults(func=cmd_writeoff_laser)
+
+    p = sub.add_parser("import-bending", help="Импорт таблицы от гибщиков в кэш")
+    p.add_argument("file")
+    p.add_argument("--report", help="Сохранить ошибки по строкам в файл (.xlsx или .csv)")
+    p.set_defaults(func=cmd_import_bending)
+
+    p = sub.add_parser("writeoff-bending", help="Автосписание строк гибщиков с уверенным совпадением")
+    p.add_argument("--threshold", type=int, default=engine.BENDING_AUTO_MATCH_THRESHOLD,
+                   help="Минимальная схожесть, %% (по умолчанию %(default)s)")
+    p.set_defaults(func=cmd_writeoff_bending)
+
+    p = sub.add_parser("reconcile", help="Сверка резервов материалов с листом Reservations")
+    p.add_argument("--fix", action="store_true", help="Исправить найденные расхождения")
+    p.set_defaults(func=cmd_reconcile)
+
+    p = sub.add_parser("export-laser", help="Экспорт таблицы лазерщиков (.xlsx или .csv)")
+    p.add_argument("output")
+    p.set_defaults(func=cmd_export_laser)
+
+    p = sub.add_parser("export-bending", help="Экспорт таблицы гибщиков (.xlsx или .csv)")
+    p.add_argument("output")
+    p.set_defaults(func=cmd_export_bending)
+
+    p = sub.add_parser("export-sheet", help="Экспорт листа базы данных (.xlsx или .csv)")
+    p.add_argument("sheet", choices=list(engine.SHEET_COLUMNS))
+    p.add_argument("output")
+    p.set_defaults(func=cmd_export_sheet)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db:
+        engine.set_database_path(args.db)
+
+    output = {"command": args.command}
+    try:
+        # Сообщения ядра уходят в stderr, чтобы stdout содержал только JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.command != "init":
+                engine.initialize_database()
+            result = args.func(args)
+        output.update(result)
+        output["ok"] = True
+        exit_code = EXIT_ROW_ERRORS if result.get("errors") else EXIT_OK
+    except Exception as e:
+        output["ok"] = False
+        output["error"] = str(e)
+        exit_code = EXIT_FAILED
+
+    print(json.dumps(output, ensure_ascii=False, default=_json_default))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
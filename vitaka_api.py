@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный HTTP/JSON сервис для планшетов на участках лазера и гибки.
+
+Запуск:
+    python vitaka_api.py --db D:\\Учёт --host 0.0.0.0 --port 8765
+
+Чтение:
+    GET  /api/health
+    GET  /api/materials              все материалы склада
+    GET  /api/stock[?date=ГГГГ-ММ-ДД] материалы с доступным остатком; с date — остатки на конец дня
+    GET  /api/orders[?status=...]    заказы
+    GET  /api/orders/<id>            заказ с деталями и резервами
+    GET  /api/details[?order_id=..]  детали заказов
+    GET  /api/reservations[?order_id=..]
+
+Списание:
+    POST /api/laser/writeoff         строка (или {"rows": [...]}) в формате выгрузки лазерщиков
+    POST /api/bending/writeoff       строка гибщиков + order_id/detail_id; без них — список кандидатов
+
+Сервис работает с той же базой и кэшами импорта, что и программа: списанные через него
+строки попадают в таблицы лазерщиков/гибщиков со статусом "✓" и не будут списаны повторно
+при импорте выгрузки. Каждый запрос обрабатывается в своём потоке, соединения keep-alive.
+
+Сервис — отдельный процесс: загрузка, изменение и запись базы и кэшей выполняются под
+engine.data_lock, который блокирует и файл production_database.xlsx.lock рядом с базой,
+поэтому программа и сервис не перезаписывают изменения друг друга. Программа в течение
+нескольких секунд обновляет вкладки после записи сервиса в базу и подхватывает строки
+и отметки, записанные им в кэши.
+"""
+import sys
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+import production_engine as engine
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class ApiError(Exception):
+    """Ошибка запроса с HTTP-статусом и телом ответа"""
+
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": message, **extra}
+
+
+def _records(df):
+    """DataFrame → список словарей с обычными типами Python (NaN → null)"""
+    if df.empty:
+        return []
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+def _json_default(value):
+    """Числа numpy (из DataFrame) → обычные числа, остальное → строка"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def _int_param(query, name):
+    values = query.get(name)
+    if not values:
+        return None
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ApiError(400, f"Параметр '{name}' должен быть числом")
+
+
+def _require_columns(row, columns):
+    missing = [col for col in columns if col not in row]
+    if missing:
+        raise ApiError(400, f"Не хватает полей: {', '.join(missing)}")
+
+
+# ==================== ЧТЕНИЕ ====================
+
+def get_materials(query):
+    return _records(engine.load_data("Materials"))
+
+
+def get_stock(query):
+    date = query.get("date")
+    if date:
+        try:
+            return _records(engine.stock_on_date(date[0]))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+    df = engine.load_data("Materials")
+    if not df.empty:
+        df = df[pd.to_numeric(df["Доступно"], errors="coerce").fillna(0) > 0]
+        df = df[["ID", "Марка", "Толщина", "Длина", "Ширина", "Количество штук", "Зарезервировано", "Доступно"]]
+    return _records(df)
+
+
+def get_orders(query):
+    df = engine.load_data("Orders")
+    status = query.get("status")
+    if status and not df.empty:
+        df = df[df["Статус"] == status[0]]
+    return _records(df)
+
+
+def get_order(order_id):
+    orders_df = engine.load_data("Orders")
+    order = orders_df[orders_df["ID заказа"] == order_id] if not orders_df.empty else orders_df
+    if order.empty:
+        raise ApiError(404, f"Заказ {order_id} не найден")
+    result = _records(order)[0]
+    details_df = engine.load_data("OrderDetails")
+    reservations_df = engine.load_data("Reservations")
+    result["details"] = _records(details_df[details_df["ID заказа"] == order_id]) if not details_df.empty else []
+    result["reservations"] = (_records(reservations_df[reservations_df["ID заказа"] == order_id])
+                              if not reservations_df.empty else [])
+    return result
+
+
+def get_details(query):
+    df = engine.load_data("OrderDetails")
+    order_id = _int_param(query, "order_id")
+    if order_id is not None and not df.empty:
+        df = df[df["ID заказа"] == order_id]
+    return _records(df)
+
+
+def get_reservations(query):
+    df = engine.load_data("Reservations")
+    order_id = _int_param(query, "order_id")
+    if order_id is not None and not df.empty:
+        df = df[df["ID заказа"] == order_id]
+    return _records(df)
+
+
+# ==================== СПИСАНИЕ ====================
+
+def post_laser_writeoff(body):
+    """Списание строк лазерщиков и запись их в кэш таблицы лазерщиков"""
+    submitted = body.get("rows", [body]) if isinstance(body, dict) else body
+    if not isinstance(submitted, list) or not submitted:
+        raise ApiError(400, "Ожидается строка или {\"rows\": [...]}")
+    for row in submitted:
+        if not isinstance(row, dict):
+            raise ApiError(400, "Каждая строка должна быть объектом")
+        _require_columns(row, engine.LASER_REQUIRED_COLUMNS)
+
+    with engine.data_lock:
+        cache_rows = engine.load_laser_cache() or []
+        by_key = {engine.laser_row_key(r): r for r in cache_rows}
+        pending = []
+        skipped = 0
+        for row in submitted:
+            key = engine.laser_row_key(row)
+            cached = by_key.get(key)
+            if cached is None:
+                cached = dict(row)
+                cached.setdefault("Списано", "")
+                cached.setdefault("Дата списания", "")
+                cache_rows.append(cached)
+                by_key[key] = cached
+            if engine._safe_str(cached.get("Списано")) in engine.LASER_DONE_STATUSES + [engine.LASER_MANUAL_STATUS]:
+                skipped += 1
+                continue
+            pending.append(cached)
+
+        result = engine.writeoff_laser_rows(pending) if pending else {"success": 0, "errors": []}
+        engine.save_import_cache(engine.sort_rows_newest_first(cache_rows), engine.get_laser_cache_path())
+
+    response = {"success": result["success"], "skipped": skipped, "errors": result["errors"]}
+    if result["errors"] and not result["success"]:
+        raise ApiError(422, "Строки не списаны", **response)
+    return response
+
+
+def post_bending_writeoff(body):
+    """Списание строки гибщиков на деталь заказа и запись её в кэш таблицы гибщиков"""
+    if not isinstance(body, dict):
+        raise ApiError(400, "Ожидается объект со строкой гибщиков")
+    _require_columns(body, engine.BENDING_REQUIRED_COLUMNS)
+    row = {col: body[col] for col in engine.BENDING_REQUIRED_COLUMNS}
+
+    quantity = engine._safe_int(body.get("quantity", row["Количество"]))
+    if quantity <= 0:
+        raise ApiError(400, "Количество должно быть больше 0")
+
+    with engine.data_lock:
+        orders_df = engine.active_orders(engine.load_data("Orders"))
+        details_df = engine.load_data("OrderDetails")
+
+        if body.get("order_id") is None or body.get("detail_id") is None:
+            candidates = engine.find_bending_candidates(row, orders_df, details_df)[:5]
+            raise ApiError(409, "Укажите order_id и detail_id", candidates=candidates)
+
+        order_id = engine._safe_int(body["order_id"])
+        detail_id = engine._safe_int(body["detail_id"])
+        order = orders_df[orders_df["ID заказа"] == order_id] if not orders_df.empty else orders_df
+        if order.empty:
+            raise ApiError(404, f"Заказ {order_id} не найден среди заказов 'В работе'")
+        detail = details_df[(details_df["ID"] == detail_id) & (details_df["ID заказа"] == order_id)]
+        if detail.empty:
+            raise ApiError(404, f"Деталь {detail_id} не найдена в заказе {order_id}")
+
+        cache_rows = engine.load_bending_cache() or []
+        key = engine.bending_row_key(row)
+        cached = next((r for r in cache_rows if engine.bending_row_key(r) == key), None)
+        if cached is not None and engine._safe_str(cached.get("Списано")).startswith("✓"):
+            raise ApiError(409, "Строка уже списана")
+        if cached is None:
+            cached = dict(row)
+            cache_rows.append(cached)
+
+        order_name = str(order.iloc[0]["Название заказа"])
+        detail_name = str(detail.iloc[0]["Название детали"])
+        writeoff_id = engine.perform_bending_writeoff(row, order_id, detail_id, detail_name, quantity,
+                                                      "авто", body.get("comment", ""))
+        cached["Списано"] = "✓"
+        cached["Дата списания"] = engine._now()
+        cached["Связанный заказ"] = order_name
+        engine.save_import_cache(engine.sort_rows_newest_first(cache_rows), engine.get_bending_cache_path())
+
+    return {"writeoff_id": writeoff_id, "order_id": order_id, "order_name": order_name,
+            "detail_id": detail_id, "detail_name": detail_name, "quantity": quantity}
+
+
+GET_ROUTES = {
+    "/api/health": lambda query: {"status": "ok", "database": engine.get_database_file()},
+    "/api/materials": get_materials,
+    "/api/stock": get_stock,
+    "/api/orders": get_orders,
+    "/api/details": get_details,
+    "/api/reservations": get_reservations,
+}
+
+POST_ROUTES = {
+    "/api/laser/writeoff": post_laser_writeoff,
+    "/api/bending/writeoff": post_bending_writeoff,
+}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 — соединение остаётся открытым между запросами (keep-alive)
+    protocol_version = "HTTP/1.1"
+    server_version = "VitaKaAPI/1.0"
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, resolve):
+        try:
+            self._send_json(200, resolve())
+        except ApiError as e:
+            self._send_json(e.status, e.body)
+        except Exception as e:
+            print(f"❌ Ошибка обработки {self.command} {self.path}: {e}", file=sys.stderr)
+            self._send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/")
+
+        def resolve():
+            if path in GET_ROUTES:
+                return GET_ROUTES[path](query)
+            if path.startswith("/api/orders/"):
+                try:
+                    order_id = int(path.rsplit("/", 1)[1])
+                except ValueError:
+                    raise ApiError(400, "ID заказа должен быть числом")
+                return get_order(order_id)
+            raise ApiError(404, f"Неизвестный адрес: {url.path}")
+
+        self._handle(resolve)
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+
+        def resolve():
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_SIZE:
+                raise ApiError(413, "Слишком большой запрос")
+            raw = self.rfile.read(length) if length else b""
+            if path not in POST_ROUTES:
+                raise ApiError(404, f"Неизвестный адрес: {path}")
+            try:
+                body = json.loads(raw.decode("utf-8")) if raw else {}
+            except ValueError:
+                raise ApiError(400, "Тело запроса должно быть JSON")
+            try:
+                return POST_ROUTES[path](body)
+            except ValueError as e:
+                raise ApiError(400, str(e))
+
+        self._handle(resolve)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+
+def create_server(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Создать сервер (port=0 — свободный порт); запуск — server.serve_forever()"""
+    engine.initialize_database()
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vitaka-api", description="Локальный HTTP-сервис учёта производства")
+    parser.add_argument("--db", help="Папка с production_database.xlsx (по умолчанию — из app_settings.json)")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    if args.db:
+        engine.set_database_path(args.db)
+    server = create_server(args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"🌐 Сервис запущен: http://{host}:{port}/api/health (база: {engine.get_database_file()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
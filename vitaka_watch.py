@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Фоновый приём выгрузок лазерщиков и гибщиков из папок обмена.
+
+Запуск отдельно от программы:
+    python vitaka_watch.py --db D:\\Учёт --laser D:\\Обмен\\Лазер --bending D:\\Обмен\\Гибка --writeoff
+
+Сервис раз в несколько секунд проверяет папки на новые и изменённые файлы .csv/.xlsx.
+Из CSV дочитывается только хвост, дописанный с прошлой проверки (по смещению в байтах),
+Excel-файл перечитывается целиком, но в таблицу попадают только строки после уже прочитанных.
+Строки добавляются с той же проверкой повторов, что и при ручном импорте (laser_row_key /
+bending_row_key). С --writeoff новые строки сразу списываются.
+
+Программа (production_app_v0.1.py) запускает тот же сервис в фоновом потоке, если папки
+указаны в настройках; строки передаются в окно через очередь и не блокируют интерфейс.
+"""
+import io
+import os
+import sys
+import asyncio
+import argparse
+import threading
+
+import pandas as pd
+
+import production_engine as engine
+
+DEFAULT_INTERVAL = 2.0
+EXPORT_EXTENSIONS = (".csv", ".xlsx")
+
+LASER = "laser"
+BENDING = "bending"
+
+SOURCES = {
+    LASER: {"prepare": engine.prepare_laser_frame, "key": engine.laser_row_key,
+            "status_columns": ["Списано", "Дата списания"]},
+    BENDING: {"prepare": engine.prepare_bending_frame, "key": engine.bending_row_key,
+              "status_columns": ["Списано", "Дата списания", "Связанный заказ"]},
+}
+
+
+def _decode(data):
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251")
+
+
+class _FileTail:
+    """Состояние чтения одного файла выгрузки: что уже прочитано с прошлой проверки"""
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.offset = 0
+        self.header = None
+        self.rows_read = 0
+
+    def read_new(self):
+        """DataFrame строк, появившихся с прошлого чтения (None — файл не менялся)"""
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return None
+        if self.path.lower().endswith(".csv"):
+            df = self._read_csv_tail(stat.st_size)
+        else:
+            df = self._read_excel_tail()
+        self.stamp = stamp
+        return df
+
+    def _read_csv_tail(self, size):
+        if size < self.offset:
+            # Файл перезаписан короче прежнего — читаем заново, повторы отсеются по ключу строки
+            self.offset, self.header = 0, None
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Последняя строка может быть ещё недописана — берём только до последнего перевода строки
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        self.offset += end
+        text = _decode(data[:end])
+        if self.header is None:
+            self.header, _, text = text.partition("\n")
+            self.header = self.header.rstrip("\r")
+        if not text.strip():
+            return None
+        sep = "\t" if "\t" in self.header else ";"
+        return pd.read_csv(io.StringIO(self.header + "\n" + text), sep=sep)
+
+    def _read_excel_tail(self):
+        df = pd.read_excel(self.path, engine="openpyxl")
+        start = self.rows_read if len(df) >= self.rows_read else 0
+        self.rows_read = len(df)
+        return df.iloc[start:]
+
+
+class WatchService:
+    """
+    Проверка папок выгрузок на asyncio-цикле.
+
+    on_rows(kind, df, path) вызывается для каждой порции новых строк (kind — LASER или BENDING);
+    чтение файлов выполняется в пуле потоков, поэтому цикл не блокируется на больших Excel.
+    """
+
+    def __init__(self, folders, on_rows, interval=DEFAULT_INTERVAL):
+        self.folders = {kind: folder for kind, folder in folders.items() if folder}
+        self.on_rows = on_rows
+        self.interval = interval
+        self._tails = {}
+        self._loop = None
+        self._stop = None
+        self._thread = None
+
+    def _scan(self):
+        """Новые строки всех файлов папок: список (kind, DataFrame, путь)"""
+        batches = []
+        for kind, folder in self.folders.items():
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                name = entry.name.lower()
+                if not entry.is_file() or name.startswith("~$") or not name.endswith(EXPORT_EXTENSIONS):
+                    continue
+                tail = self._tails.setdefault(entry.path, _FileTail(entry.path))
+                try:
+                    df = tail.read_new()
+                    if df is None or df.empty:
+                        continue
+                    batches.append((kind, SOURCES[kind]["prepare"](df), entry.path))
+                except OSError as e:
+                    # Файл ещё пишется (занят другой программой) — попробуем на следующей проверке
+                    tail.stamp = None
+                    print(f"⚠️ Не удалось прочитать {entry.path}: {e}", file=sys.stderr)
+                except ValueError as e:
+                    # Не выгрузка или неверные колонки — файл пропускается до следующего изменения
+                    print(f"⚠️ Файл {entry.path} пропущен: {e}", file=sys.stderr)
+        return batches
+
+    async def run(self):
+        """Проверять папки каждые interval секунд до вызова stop()"""
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        while not self._stop.is_set():
+            for kind, df, path in await asyncio.to_thread(self._scan):
+                try:
+                    self.on_rows(kind, df, path)
+                except Exception as e:
+                    print(f"❌ Ошибка обработки {path}: {e}", file=sys.stderr)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_in_thread(self):
+        """Запустить цикл в фоновом потоке (для программы с окном)"""
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run(),), name="vitaka-watch", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+
+def append_rows(kind, rows, df):
+    """Дописать новые строки в таблицу импорта kind (повторы отсеиваются); возвращает добавленные"""
+    source = SOURCES[kind]
+    return engine.append_import_rows(rows, df, source["key"], source["status_columns"])
+
+
+def writeoff_rows(kind, rows):
+    """Списать новые строки: лазер — writeoff_laser_rows, гибка — автосписание уверенных совпадений"""
+    if kind == LASER:
+        result = engine.writeoff_laser_rows(rows)
+        return result["success"], len(result["errors"])
+    result = engine.auto_writeoff_bending_rows(rows)
+    return len(result["applied"]), len(result["review"])
+
+
+def ingest_to_cache(kind, df, path, writeoff=False):
+    """
+    Дописать новые строки выгрузки в кэш-файл импорта и, если writeoff, сразу списать их.
+    Используется консольным режимом и потоком слежения программы (списание — одна операция
+    для Ctrl+Z). Возвращает текст итога или None, если новых строк нет.
+    """
+    cache_path = engine.get_laser_cache_path() if kind == LASER else engine.get_bending_cache_path()
+    name = os.path.basename(path)
+    with engine.data_lock:
+        rows = (engine.load_laser_cache() if kind == LASER else engine.load_bending_cache()) or []
+        added = append_rows(kind, rows, df)
+        if not added:
+            return None
+        message = f"📥 {name}: новых строк {len(added)}"
+        if writeoff:
+            with engine.undo_group(f"Автосписание выгрузки {name}",
+                                   laser_rows=rows if kind == LASER else None,
+                                   bending_rows=None if kind == LASER else rows):
+                done, problems = writeoff_rows(kind, added)
+            message += f"\n✅ Списано: {done}" + (f" | ⚠️ Не списано: {problems}" if problems else "")
+        engine.save_import_cache(engine.sort_rows_newest_first(rows), cache_path)
+    print(message)
+    return message
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vitaka-watch", description="Приём выгрузок лазерщиков и гибщиков из папок")
+    parser.add_argument("--db", help="Папка с production_database.xlsx (по умолчанию — из app_settings.json)")
+    parser.add_argument("--laser", help="Папка выгрузок лазерщиков")
+    parser.add_argument("--bending", help="Папка выгрузок гибщиков")
+    parser.add_argument("--writeoff", action="store_true", help="Сразу списывать новые строки")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Период проверки, сек")
+    args = parser.parse_args(argv)
+
+    if not args.laser and not args.bending:
+        parser.error("укажите --laser и/или --bending")
+    if args.db:
+        engine.set_database_path(args.db)
+    engine.initialize_database()
+
+    service = WatchService({LASER: args.laser, BENDING: args.bending},
+                           lambda kind, df, path: ingest_to_cache(kind, df, path, args.writeoff),
+                           interval=args.interval)
+    print(f"👀 Слежение за папками: {', '.join(service.folders.values())} (каждые {args.interval:g} с)")
+    try:
+        asyncio.run(service.run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())